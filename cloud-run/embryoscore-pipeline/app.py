@@ -2,6 +2,7 @@
 EmbryoScore Pipeline v8 — Streaming Architecture
 
 POST /analyze          — Full pipeline: detect + kinetics + DINOv2 + Gemini + Storage
+POST /classify         — Deferred Gemini + KNN for jobs saved with pending classification
 POST /ocr              — OCR de relatórios de campo via Gemini 2.0 Flash Vision
 POST /detect-and-crop  — Retrocompat: OpenCV detect + crop (from frame-extractor)
 POST /analyze-activity — Retrocompat: Advanced kinetics (from frame-extractor)
@@ -11,32 +12,50 @@ Consolidates frame-extractor (kinetics, detection) + old pipeline (DINOv2, Gemin
 DINOv2 via ONNX Runtime (~15MB) instead of PyTorch (~800MB).
 """
 
+import asyncio
 import base64
 import collections
 import gc
-import io
+import hashlib
 import json
 import logging
+import math
 import os
+import queue
+import random
 import re
 import tempfile
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed, wait as futures_wait
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from typing import Any, Optional
 
 import cv2
+import httpx
 import numpy as np
 import requests as http_requests
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from PIL import Image
 
+from atlas_index import AtlasIndex, parse_timestamp, project_scope
+from embedding_projection import EmbeddingProjection
+from gemini_quota import (
+    GeminiDeadlineExceeded, GeminiRateLimiter, GeminiResultCache, is_rate_limit_error, retry_delay,
+)
+from gemini_client import (
+    GeminiClient, GeminiHTTPError, jpeg_part, response_text, text_part, total_tokens,
+)
+
 # Lazy imports for heavy libs
-genai = None
-_cached_gemini_key = None
+gemini_http = None
 ort_session = None
+ort_model_path = None
+_ort_signature = None
 supabase_client = None
 
 logging.basicConfig(level=logging.INFO)
@@ -65,42 +84,352 @@ OUTPUT_SIZE = 400
 MAX_FRAME_HEIGHT = 720          # Downscale to 720p max to save memory
 MAX_SAMPLED_FRAMES = 120        # Sampled frames (~15s at 8fps)
 MAX_WIDTH = 1920                # Max width to prevent OOM with 4K+ videos
-ONNX_MODEL_PATH = "dinov2_vits14.onnx"
+# DINOv2 variant built by convert_dino_to_onnx.py: fp32 | int8-dynamic | int8-static
+DINO_MODEL_VARIANT = os.environ.get("DINO_MODEL_VARIANT", "fp32")
+_DINO_STEM = "dinov2_vits14" if DINO_MODEL_VARIANT == "fp32" else f"dinov2_vits14.{DINO_MODEL_VARIANT}"
+ONNX_MODEL_PATH = f"{_DINO_STEM}.onnx"
+# Pre-optimized ORT-format artifact; preferred when present
+ONNX_ORT_MODEL_PATH = os.environ.get("ONNX_ORT_MODEL_PATH", f"{_DINO_STEM}.ort")
+# Fallback when the configured INT8 variant isn't shipped in the image
+ONNX_FP32_PATHS = ("dinov2_vits14.ort", "dinov2_vits14.onnx")
+ORT_INTRA_OP_THREADS = int(os.environ.get("ORT_INTRA_OP_THREADS", "0"))  # 0 = container CPU quota
+# Every DINO_MODEL_VARIANT is a ViT-S/14 export: one embedding model, 384-d
+EMBEDDING_MODEL = "dinov2_vits14"
+EMBEDDING_DIM = 384
+# "native": embedding_model + the model's own column at its dimension (halfvec where
+# pgvector has it; 20261016000700_native_embeddings.sql). "padded": legacy vector(768)
+# column, zero-padded, for databases without that migration.
+EMBEDDING_STORAGE = os.environ.get("EMBEDDING_STORAGE", "native")
+# Background noise floor: max background pixels sampled per frame (0 = every pixel,
+# the pre-sampling behaviour). The sparse grid keeps bg_std and the bg timeline
+# within 3% of the dense values (tests/test_streaming_accumulator.py).
+BG_SAMPLE_BUDGET = int(os.environ.get("BG_SAMPLE_BUDGET", "65536"))
+BG_PATCH_SIZE = 8
+# "sequential" = decode once with grab()/retrieve(); "seek" = legacy set(POS_FRAMES) per sample
+FRAME_SAMPLER_MODE = os.environ.get("FRAME_SAMPLER_MODE", "sequential")
+# Staged /analyze: decoded frames buffered ahead of the accumulator, and workers
+# for per-embryo JPEG encode
+PIPELINE_QUEUE_DEPTH = int(os.environ.get("PIPELINE_QUEUE_DEPTH", "8"))
+PIPELINE_UPLOAD_WORKERS = int(os.environ.get("PIPELINE_UPLOAD_WORKERS", "4"))
+# Storage uploads in flight per request (crops, motion maps, plate frame)
+STORAGE_UPLOAD_CONCURRENCY = int(os.environ.get("STORAGE_UPLOAD_CONCURRENCY", "8"))
+STORAGE_RETRY_BASE_SECONDS = 0.5  # Full-jitter backoff: sleep U(0, base * 2^attempt)
+# /analyze time budget: the Cloud Run request timeout (keep in sync with the
+# service's --timeout) minus a margin for the response and progress writes
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get("REQUEST_TIMEOUT_SECONDS", "300"))
+DEADLINE_SAFETY_SECONDS = float(os.environ.get("DEADLINE_SAFETY_SECONDS", "20"))
+MIN_DEGRADED_HEIGHT = 480       # Lowest working resolution when a long video must be shed
+MIN_KINETIC_SECONDS = 5         # Shortest analyzed span when a long video must be cut
+# progress_message writes per job are coalesced to at most one per interval
+PROGRESS_MIN_INTERVAL_MS = int(os.environ.get("PROGRESS_MIN_INTERVAL_MS", "1000"))
+# Gemini quota per API key (AI Studio project limits). The pool size follows from
+# RPM x typical call latency (Little's law), capped at GEMINI_MAX_CONCURRENCY.
+GEMINI_RPM = int(os.environ.get("GEMINI_RPM", "60"))
+GEMINI_TPM = int(os.environ.get("GEMINI_TPM", "1000000"))
+GEMINI_OCR_RPM = int(os.environ.get("GEMINI_OCR_RPM", str(GEMINI_RPM)))
+GEMINI_OCR_TPM = int(os.environ.get("GEMINI_OCR_TPM", str(GEMINI_TPM)))
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_CALL_SECONDS = float(os.environ.get("GEMINI_CALL_SECONDS", "6"))
+# Prompt + 2 images + JSON answer; reconciled with usage_metadata after each call
+GEMINI_EST_TOKENS = int(os.environ.get("GEMINI_EST_TOKENS", "2000"))
+# Embryos per Gemini request (1 = one call per embryo). K > 1 sends the prompt
+# once with K labeled image pairs and a per-embryo response_schema array.
+GEMINI_BATCH_SIZE = int(os.environ.get("GEMINI_BATCH_SIZE", "1"))
+# Gemini result cache: in-process LRU entries + optional Supabase table tier
+# ("" disables it; see supabase/migrations/20261016000100_gemini_result_cache.sql)
+GEMINI_CACHE_SIZE = int(os.environ.get("GEMINI_CACHE_SIZE", "1024"))
+GEMINI_CACHE_TABLE = os.environ.get("GEMINI_CACHE_TABLE", "gemini_result_cache")
+# Pooled HTTP/2 connections to the Gemini API, shared by /analyze and /ocr
+GEMINI_HTTP_MAX_CONNECTIONS = int(os.environ.get("GEMINI_HTTP_MAX_CONNECTIONS", "16"))
+# "inline": /analyze classifies with Gemini before returning. "deferred": /analyze
+# stops after kinetics + embeddings + uploads and saves the scores as pending
+# classification; POST /classify (any instance — it is I/O-bound) finishes them.
+CLASSIFY_MODE = os.environ.get("CLASSIFY_MODE", "inline")
+# Re-drive of pending classifications nobody finished (lost /classify call, Gemini
+# "Pending", deadline cut, callers that never chain /classify): after /analyze and
+# /classify, at most one sweep per CLASSIFY_REDRIVE_INTERVAL_SECONDS per instance
+# (0 = off) classifies up to CLASSIFY_REDRIVE_BATCH jobs completed more than
+# CLASSIFY_REDRIVE_AFTER_SECONDS and less than CLASSIFY_REDRIVE_MAX_AGE_HOURS ago.
+# POST /classify/redrive runs one sweep on demand (e.g. from Cloud Scheduler).
+CLASSIFY_REDRIVE_AFTER_SECONDS = float(os.environ.get("CLASSIFY_REDRIVE_AFTER_SECONDS", "600"))
+CLASSIFY_REDRIVE_INTERVAL_SECONDS = float(os.environ.get("CLASSIFY_REDRIVE_INTERVAL_SECONDS", "300"))
+CLASSIFY_REDRIVE_BATCH = int(os.environ.get("CLASSIFY_REDRIVE_BATCH", "5"))
+CLASSIFY_REDRIVE_MAX_AGE_HOURS = float(os.environ.get("CLASSIFY_REDRIVE_MAX_AGE_HOURS", "72"))
+# embryo_score_config / secrets / Supabase clients: fresh for the TTL, then served
+# stale while one background refresh runs (callers block only on a miss or past
+# CACHE_MAX_STALE_FACTOR x TTL). Prompt edits reach /classify within ~TTL.
+CONFIG_CACHE_TTL_SECONDS = float(os.environ.get("CONFIG_CACHE_TTL_SECONDS", "60"))
+SECRETS_CACHE_TTL_SECONDS = float(os.environ.get("SECRETS_CACHE_TTL_SECONDS", "300"))
+SUPABASE_CLIENT_TTL_SECONDS = float(os.environ.get("SUPABASE_CLIENT_TTL_SECONDS", "3600"))
+CACHE_MAX_STALE_FACTOR = 10
+# DINOv2: crops per ort_session.run() (the export has a dynamic batch axis)
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "8"))
+EMBED_INPUT_SIZE = 224
+# KNN against the embryo_references atlas. "local": in-memory mirror of the table
+# (atlas_index.py; one matmul per plate, RPC path until the first load finishes).
+# "rpc": one match_embryos_batch call per job (match_embryos_v3/v2 per embryo without it).
+KNN_BACKEND = os.environ.get("KNN_BACKEND", "local")
+ATLAS_INDEX_DTYPE = os.environ.get("ATLAS_INDEX_DTYPE", "float32")  # float16 halves the matrix
+ATLAS_SYNC_SECONDS = float(os.environ.get("ATLAS_SYNC_SECONDS", "30"))
+ATLAS_SYNC_OVERLAP_SECONDS = 120  # Re-read window for rows committed after a sync with older updated_at
+ATLAS_PAGE_SIZE = 1000            # PostgREST max-rows
+# .npz snapshot read at startup and rewritten after each sync ("" = start empty)
+ATLAS_SNAPSHOT_PATH = os.environ.get("ATLAS_SNAPSHOT_PATH", "")
+# fit_projection.py artifact ("" = full-dimension search only). With it, KNN
+# shortlists visual_top_n * factor candidates in the reduced space and re-ranks
+# them by full-dimension cosine (20261017000100_embedding_projection.sql for the RPC path).
+EMBEDDING_PROJECTION_PATH = os.environ.get("EMBEDDING_PROJECTION_PATH", "")
+PROJECTION_CANDIDATE_FACTOR = int(os.environ.get("PROJECTION_CANDIDATE_FACTOR", "4"))
+# In-process shortlist only from this many refs: below it the exact matmul is as fast
+# (benchmark.py projection: break-even near 5k refs, 1.4-2x faster from 10k)
+PROJECTION_MIN_REFS = int(os.environ.get("PROJECTION_MIN_REFS", "10000"))
+REDUCED_EMBEDDING_DIM = 128  # embedding_reduced column; other sizes are searched in-process only
 
 # ─── Lazy Loading ────────────────────────────────────────
 
+_onnx_lock = threading.Lock()
+_onnx_ready = threading.Event()  # Set once the startup load + warm-up has finished
+
+
+def _container_cpu_quota() -> int:
+    """CPUs this container may use: cgroup quota (v2, then v1), else CPU affinity."""
+    quota_files = (
+        ("/sys/fs/cgroup/cpu.max", None),
+        ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"),
+    )
+    for quota_path, period_path in quota_files:
+        try:
+            with open(quota_path) as f:
+                fields = f.read().split()
+            if period_path:
+                with open(period_path) as f:
+                    fields.append(f.read().strip())
+            quota, period = fields[0], fields[1]
+            if quota not in ("max", "-1"):
+                return max(1, -(-int(quota) // int(period)))  # ceil
+        except (OSError, ValueError, IndexError):
+            continue
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _onnx_session_options(ort):
+    """Intra-op threads = CPU quota (ORT defaults to host cores, which oversubscribes
+    a throttled Cloud Run container); one op at a time; arena + memory patterns on."""
+    threads = ORT_INTRA_OP_THREADS or _container_cpu_quota()
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = threads
+    so.inter_op_num_threads = 1
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    so.enable_cpu_mem_arena = True
+    so.enable_mem_pattern = True
+    return so, threads
+
+
+def _resolve_onnx_path() -> str | None:
+    """Configured variant (.ort, then .onnx); fp32 if that variant isn't in the image."""
+    for path in (ONNX_ORT_MODEL_PATH, ONNX_MODEL_PATH):
+        if os.path.exists(path):
+            return path
+    for path in ONNX_FP32_PATHS:
+        if os.path.exists(path):
+            logger.warning(f"DINOv2 variant '{DINO_MODEL_VARIANT}' not found "
+                           f"({ONNX_MODEL_PATH}); falling back to {path}")
+            return path
+    return None
+
+
 def _ensure_onnx():
-    global ort_session
+    global ort_session, ort_model_path, _ort_signature
     if ort_session is not None:
         return
-    if not os.path.exists(ONNX_MODEL_PATH):
-        logger.warning(f"ONNX model not found at {ONNX_MODEL_PATH}. Embeddings will be zeros.")
-        return
-    import onnxruntime as ort
-    logger.info(f"Loading DINOv2 ONNX model from {ONNX_MODEL_PATH}...")
-    ort_session = ort.InferenceSession(ONNX_MODEL_PATH, providers=["CPUExecutionProvider"])
-    logger.info("DINOv2 ONNX model loaded.")
+    with _onnx_lock:  # The startup warm-up thread may be loading right now
+        if ort_session is not None:
+            return
+        path = _resolve_onnx_path()
+        if path is None:
+            logger.warning(f"ONNX model not found at {ONNX_MODEL_PATH}. Embeddings will be zeros.")
+            return
+        import onnxruntime as ort
+        logger.info(f"Loading DINOv2 ONNX model from {path}...")
+        t0 = time.time()
+        so, threads = _onnx_session_options(ort)
+        session = ort.InferenceSession(path, sess_options=so, providers=["CPUExecutionProvider"])
+        _ort_signature = None  # Re-read input names/shapes for the new graph
+        ort_session = session
+        ort_model_path = path
+        logger.info(f"DINOv2 ONNX model loaded in {time.time() - t0:.2f}s (intra_op_threads={threads}).")
+
+
+def _warm_up_onnx():
+    """Load DINOv2 and run one inference (kernels, arena) so the first job pays neither."""
+    try:
+        _ensure_onnx()
+        if ort_session is not None:
+            t0 = time.time()
+            dummy = np.zeros((OUTPUT_SIZE, OUTPUT_SIZE, 3), dtype=np.uint8)
+            _get_embeddings_batch([dummy])
+            logger.info(f"DINOv2 warm-up inference took {time.time() - t0:.2f}s")
+    except Exception as e:
+        logger.error(f"DINOv2 warm-up failed (first job will load lazily): {e}")
+    finally:
+        _onnx_ready.set()
+
+
+@app.on_event("startup")
+def _start_onnx_warm_up():
+    # Background thread: /ocr and /extract-frame serve immediately; /health is 503 until done
+    threading.Thread(target=_warm_up_onnx, name="onnx-warm-up", daemon=True).start()
+
 
+_gemini_http_lock = threading.Lock()
 
-def _ensure_gemini(api_key: str):
-    global genai, _cached_gemini_key
-    if genai is not None and _cached_gemini_key == api_key:
-        return  # Same key, reuse
-    import google.generativeai as _genai
-    _genai.configure(api_key=api_key)
-    genai = _genai
-    _cached_gemini_key = api_key
-    logger.info("Gemini API configured.")
+def _get_gemini_http() -> GeminiClient:
+    """Process-wide Gemini client (the API key travels per request)."""
+    global gemini_http
+    with _gemini_http_lock:
+        if gemini_http is None:
+            gemini_http = GeminiClient(max_connections=GEMINI_HTTP_MAX_CONNECTIONS)
+            logger.info("Gemini HTTP client created.")
+        return gemini_http
 
 
-_sb_cache = {}
+class _TTLCache:
+    """In-process TTL cache with stale-while-revalidate and explicit invalidation.
+
+    get(key, loader) returns the cached value while it is younger than ttl.
+    Older (up to max_stale) it still returns at once and refreshes the entry on
+    a background thread, one refresh per key at a time; a failed refresh keeps
+    the stale value. Only a miss, an entry past max_stale or an invalidated one
+    makes the caller wait for loader(), whose exceptions propagate uncached.
+    """
+
+    def __init__(self, name: str, ttl: float, max_stale: float | None = None):
+        self.name = name
+        self.ttl = ttl
+        self.max_stale = ttl * CACHE_MAX_STALE_FACTOR if max_stale is None else max_stale
+        self._lock = threading.Lock()
+        self._entries: dict = {}  # key -> (value, loaded_at monotonic)
+        self._refreshing: set = set()
+        self.hits = self.stale_hits = self.misses = 0
+        self.refreshes = self.refresh_errors = 0
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, loaded_at = entry
+                age = now - loaded_at
+                if age < self.ttl:
+                    self.hits += 1
+                    return value
+                if age < self.max_stale:
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        threading.Thread(target=self._refresh, args=(key, loader),
+                                         name=f"cache-{self.name}", daemon=True).start()
+                    return value
+            self.misses += 1
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _refresh(self, key, loader):
+        try:
+            self.put(key, loader())
+            with self._lock:
+                self.refreshes += 1
+        except Exception as e:
+            with self._lock:
+                self.refresh_errors += 1
+            logger.warning(f"{self.name} cache refresh failed (serving stale): {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            ages = [now - loaded_at for _, loaded_at in self._entries.values()]
+            return {
+                "entries": len(ages),
+                "ttl_s": self.ttl,
+                "max_age_s": round(max(ages), 1) if ages else None,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors,
+            }
+
+
+_sb_clients = _TTLCache("supabase_client", SUPABASE_CLIENT_TTL_SECONDS)
+_config_cache = _TTLCache("score_config", CONFIG_CACHE_TTL_SECONDS)
+_secrets_cache = _TTLCache("score_secrets", SECRETS_CACHE_TTL_SECONDS)
+
 
 def _get_supabase(url: str, key: str):
-    cache_key = f"{url}:{key[:8]}"
-    if cache_key not in _sb_cache:
+    def _create():
         from supabase import create_client
-        _sb_cache[cache_key] = create_client(url, key)
-    return _sb_cache[cache_key]
+        return create_client(url, key)
+    # Full-key digest: two keys sharing a prefix must not share a client
+    return _sb_clients.get(f"{url}:{hashlib.sha256(key.encode()).hexdigest()[:16]}", _create)
+
+
+# Cache key for per-project values: one Supabase project per client URL
+_cache_scope = project_scope
+
+
+def _fetch_score_config(sb) -> dict:
+    config_rows = sb.table('embryo_score_config').select(
+        'calibration_prompt, model_name'
+    ).eq('active', True).order('created_at', desc=True).limit(1).execute()
+    if config_rows.data and len(config_rows.data) > 0:
+        return config_rows.data[0]
+    return {}
+
+
+def _fetch_gemini_key(sb) -> str | None:
+    secret_rows = sb.table('embryo_score_secrets').select(
+        'key_value'
+    ).eq('key_name', 'GEMINI_API_KEY').limit(1).execute()
+    if secret_rows.data and len(secret_rows.data) > 0:
+        return secret_rows.data[0].get('key_value') or None
+    return None
+
+
+def _load_score_config(sb) -> dict:
+    """Active embryo_score_config (prompt, model), TTL-cached — non-critical, {} on failure."""
+    try:
+        return _config_cache.get(_cache_scope(sb), lambda: _fetch_score_config(sb))
+    except Exception as cfg_err:
+        logger.warning(f"Could not load embryo_score_config (using defaults): {cfg_err}")
+    return {}
+
+
+def _load_gemini_key(sb, default: str) -> str:
+    """Gemini API key from embryo_score_secrets (TTL-cached), falling back to `default` (env var)."""
+    try:
+        return _secrets_cache.get(_cache_scope(sb), lambda: _fetch_gemini_key(sb)) or default
+    except Exception as sec_err:
+        logger.warning(f"Could not load embryo_score_secrets (using env var): {sec_err}")
+    return default
 
 
 # ─── API Key Auth ────────────────────────────────────────
@@ -137,29 +466,146 @@ class AnalyzeRequest(BaseModel):
     embryo_offset: int = 0
     # Biologist-provided bboxes (replaces OpenCV detection when present)
     bboxes: Optional[list[dict]] = None
+    # Stop before Gemini and leave classification to /classify (None = CLASSIFY_MODE)
+    defer_classification: Optional[bool] = None
 
 
 # ─── Progress Helper ─────────────────────────────────────
 
-def _update_progress(sb, job_id: str, message: str):
-    """Update progress_message in embryo_analysis_queue for real-time UI feedback."""
-    try:
-        sb.table('embryo_analysis_queue').update({
-            'progress_message': message,
-        }).eq('id', job_id).execute()
-    except Exception as e:
-        logger.warning(f"Progress update failed for {job_id}: {e}")
+_NO_MESSAGE = object()
+
+
+class _ProgressReporter:
+    """Coalescing, non-blocking progress_message writer for one job.
+
+    update() only records the message and wakes a background writer, so the
+    processing thread never waits on the database. The writer sends the latest
+    message at most once per min_interval — intermediate ones are dropped
+    (latest wins), which makes per-frame progress essentially free. close()
+    flushes a final state and stops the writer; cancel() stops it without
+    writing when the caller's own status update sets progress_message.
+    """
+
+    def __init__(self, sb, job_id: str, min_interval: float = PROGRESS_MIN_INTERVAL_MS / 1000):
+        self.sb = sb
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.updates = 0
+        self.writes = 0
+        self._cond = threading.Condition()
+        self._pending = _NO_MESSAGE
+        self._closed = False
+        self._thread: threading.Thread | None = None
+        self._last_write = 0.0
+        self._last_percent = None
+
+    def update(self, message: str | None):
+        with self._cond:
+            if self._closed:
+                return
+            self._pending = message
+            self.updates += 1
+            if self._thread is None:  # Lives only while there is something to write
+                self._thread = threading.Thread(
+                    target=self._run, name=f"progress-{self.job_id}", daemon=True)
+                self._thread.start()
+            # No notify: a running writer picks up the latest message when its interval ends
+
+    def update_fraction(self, label: str, done: int, total: int):
+        """'label NN%' — only whole-percent changes reach update()."""
+        percent = min(100, int(100 * done / total)) if total > 0 else 0
+        if percent != self._last_percent:
+            self._last_percent = percent
+            self.update(f"{label} {percent}%")
+
+    def close(self, final=_NO_MESSAGE, timeout: float = 5.0):
+        """Write `final` (None clears the message), or whatever is still pending, then stop."""
+        self._stop(final, flush=True, timeout=timeout)
+
+    def cancel(self, timeout: float = 5.0):
+        """Stop and drop anything pending; waits out a write already in flight."""
+        self._stop(_NO_MESSAGE, flush=False, timeout=timeout)
+
+    def _stop(self, final, flush: bool, timeout: float):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            if final is not _NO_MESSAGE:
+                self._pending = final
+            elif not flush:
+                self._pending = _NO_MESSAGE
+            thread = self._thread
+            self._cond.notify()
+        if thread is not None:
+            thread.join(timeout)
+        elif self._pending is not _NO_MESSAGE:
+            message, self._pending = self._pending, _NO_MESSAGE
+            self._write(message)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._pending is _NO_MESSAGE:
+                    self._thread = None  # Idle: the next update() starts a new writer
+                    return
+                delay = self._last_write + self.min_interval - time.monotonic()
+                if delay > 0 and not self._closed:
+                    self._cond.wait(delay)  # Newer messages replace this one meanwhile
+                    continue
+                message, self._pending = self._pending, _NO_MESSAGE
+            self._write(message)
+            self._last_write = time.monotonic()
+
+    def _write(self, message: str | None):
+        try:
+            self.sb.table('embryo_analysis_queue').update({
+                'progress_message': message,
+            }).eq('id', self.job_id).execute()
+            self.writes += 1
+        except Exception as e:
+            logger.warning(f"Progress update failed for {self.job_id}: {e}")
 
 
 # ─── Health ──────────────────────────────────────────────
 
 @app.get("/health")
 def health():
-    return {
-        "status": "ok",
+    body = {
+        "status": "ok" if _onnx_ready.is_set() else "warming",
         "service": "embryoscore-pipeline-v8",
-        "onnx_available": os.path.exists(ONNX_MODEL_PATH),
+        "onnx_available": os.path.exists(ONNX_MODEL_PATH) or os.path.exists(ONNX_ORT_MODEL_PATH),
+        "onnx_loaded": ort_session is not None,
+        "onnx_model": ort_model_path,
+        "gemini_cache": _gemini_cache.snapshot(),
+        "stage_costs": _stage_costs.snapshot(),
+        "config_caches": {c.name: c.snapshot() for c in (_config_cache, _secrets_cache, _sb_clients)},
+        "atlas_index": _atlas_index.snapshot(),
     }
+    if not _onnx_ready.is_set():
+        return JSONResponse(body, status_code=503)
+    return body
+
+
+class CacheInvalidateRequest(BaseModel):
+    cache: Optional[str] = None  # "config", "secrets" or "clients"; None = all
+
+
+@app.post("/cache/invalidate")
+def invalidate_caches(req: CacheInvalidateRequest, request: Request = None):
+    """Drop this instance's cached config / secrets / clients (after an admin edit).
+
+    Other instances pick the change up within their TTL.
+    """
+    if request is not None:
+        _check_api_key(request)
+    caches = {"config": _config_cache, "secrets": _secrets_cache, "clients": _sb_clients}
+    if req.cache is not None and req.cache not in caches:
+        raise HTTPException(400, f"Unknown cache: {req.cache}")
+    names = [req.cache] if req.cache else list(caches)
+    for name in names:
+        caches[name].invalidate()
+    return {"invalidated": names}
 
 
 # ─── Extract Frame (lightweight) ─────────────────────────
@@ -217,27 +663,502 @@ async def extract_frame(req: ExtractFrameRequest):
             os.remove(tmp_path)
 
 
+# ═══════════════════════════════════════════════════════════
+# FRAME SOURCE — decode-once sequential sampler
+# ═══════════════════════════════════════════════════════════
+
+
+def _sample_frame_indices(total_frames: int, video_fps: float,
+                          target_fps: float = KINETIC_FPS,
+                          max_frames: int = MAX_SAMPLED_FRAMES) -> list[int]:
+    """Uniformly sampled frame indices at ~target_fps, capped at max_frames."""
+    sample_interval = max(1, round(video_fps / target_fps))
+    sampled_indices = list(range(0, total_frames, sample_interval))
+    if len(sampled_indices) > max_frames:
+        step = len(sampled_indices) / max_frames
+        sampled_indices = [sampled_indices[int(i * step)] for i in range(max_frames)]
+    return sampled_indices
+
+
+class _FrameSampler:
+    """Serves sampled frames from an open cv2.VideoCapture.
+
+    Sequential mode walks the stream once: grab() on every frame (decode only)
+    and retrieve() only on sampled ones. On H.264/HEVC phone videos each
+    set(CAP_PROP_POS_FRAMES) re-decodes from the previous keyframe, so seeking
+    per sample costs up to GOP × samples decodes; walking costs total_frames.
+
+    The mid-video detection frame is captured during the same walk. When it is
+    needed before the walk (OpenCV detection), read_detection_frame() does one
+    seek, which is the only out-of-order decode of the job.
+    """
+
+    def __init__(self, cap, sampled_indices: list[int], det_index: int | None = None,
+                 out_size: tuple[int, int] | None = None, mode: str = FRAME_SAMPLER_MODE):
+        self.cap = cap
+        self.sampled_indices = sampled_indices
+        self._sampled_set = set(sampled_indices)
+        self.det_index = det_index
+        self.out_size = out_size  # (w, h) — downscale target, None = native
+        self.mode = mode
+        self.detection_frame = None
+        self.frames_decoded = 0
+        self.frames_retrieved = 0
+        self.decode_seconds = 0.0
+
+    def narrow(self, sampled_indices: list[int], out_size: tuple[int, int] | None):
+        """Replace the sample plan before the walk starts (deadline budget)."""
+        self.sampled_indices = sampled_indices
+        self._sampled_set = set(sampled_indices)
+        self.out_size = out_size
+        if self.detection_frame is None and sampled_indices and self.det_index is not None:
+            self.det_index = min(self.det_index, sampled_indices[len(sampled_indices) // 2])
+
+    def _resize(self, frame):
+        if self.out_size is not None and (frame.shape[1], frame.shape[0]) != self.out_size:
+            frame = cv2.resize(frame, self.out_size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    def read_detection_frame(self):
+        """Seek once to det_index (fallback: frame 0). Returns None if unreadable."""
+        if self.detection_frame is not None:
+            return self.detection_frame
+        t0 = time.time()
+        frame = None
+        for idx in (self.det_index or 0, 0):
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            ret, frame = self.cap.read()
+            if ret:
+                break
+            frame = None
+        # Rewind so the sequential walk starts at frame 0 (keyframe — cheap)
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.decode_seconds += time.time() - t0
+        if frame is not None:
+            self.detection_frame = self._resize(frame)
+        return self.detection_frame
+
+    def __iter__(self):
+        if self.mode == "seek":
+            yield from self._iter_seek()
+        else:
+            yield from self._iter_sequential()
+
+    def _iter_seek(self):
+        for idx in self.sampled_indices:
+            t0 = time.time()
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            ret, frame = self.cap.read()
+            self.decode_seconds += time.time() - t0
+            if not ret:
+                break
+            self.frames_decoded += 1
+            self.frames_retrieved += 1
+            yield idx, self._resize(frame)
+
+    def _iter_sequential(self):
+        wanted = set(self._sampled_set)
+        if self.det_index is not None and self.detection_frame is None:
+            wanted.add(self.det_index)
+        if not wanted:
+            return
+        last = max(wanted)
+        pos = 0
+        while pos <= last:
+            t0 = time.time()
+            if not self.cap.grab():
+                self.decode_seconds += time.time() - t0
+                break
+            self.frames_decoded += 1
+            frame = None
+            if pos in wanted:
+                ret, frame = self.cap.retrieve()
+                if not ret:
+                    frame = None
+            self.decode_seconds += time.time() - t0
+            if frame is not None:
+                frame = self._resize(frame)
+                self.frames_retrieved += 1
+                if pos == self.det_index and self.detection_frame is None:
+                    self.detection_frame = frame
+                if pos in self._sampled_set:
+                    yield pos, frame
+            pos += 1
+
+
+# ═══════════════════════════════════════════════════════════
+# STAGED EXECUTION — bounded hand-off between threads + stage timings
+# ═══════════════════════════════════════════════════════════
+
+_STAGE_DONE = object()
+
+
+def _iter_in_thread(iterable, depth: int = PIPELINE_QUEUE_DEPTH, name: str = "producer"):
+    """Iterate `iterable` on a producer thread, handing items over a bounded queue.
+
+    The producer blocks when `depth` items are waiting, so memory stays bounded
+    (depth decoded frames). cv2 decode and most numpy kernels release the GIL,
+    so decoding frame N+1 overlaps with accumulating frame N. Producer errors are
+    re-raised in the consumer; closing the consumer early stops the producer.
+    """
+    q = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run():
+        try:
+            for item in iterable:
+                if not _put(item):
+                    return
+            _put(_STAGE_DONE)
+        except BaseException as e:  # noqa: BLE001 — forwarded to the consumer
+            _put(e)
+
+    thread = threading.Thread(target=_run, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _STAGE_DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class _StageClock:
+    """Thread-safe wall-clock spans and busy time per pipeline stage.
+
+    Times are relative to job start. A stage's span is [first start, last end]
+    across all its calls (possibly on several threads); busy is the summed call
+    time. Spans of different stages overlapping is the point of the staging —
+    summary() reports sum(busy) / total as the effective parallelism.
+    """
+
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages: dict[str, dict] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def timed(self, name: str, fn):
+        """Wrap fn so every call (on any thread) is recorded under `name`."""
+        def _wrapped(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return _wrapped
+
+    def record(self, name: str, start: float, end: float, busy: float | None = None):
+        with self._lock:
+            st = self._stages.get(name)
+            if st is None:
+                st = self._stages[name] = {"start": start, "end": end, "busy": 0.0, "calls": 0}
+            st["start"] = min(st["start"], start)
+            st["end"] = max(st["end"], end)
+            st["busy"] += (end - start) if busy is None else busy
+            st["calls"] += 1
+
+    def summary(self) -> dict:
+        total = time.perf_counter() - self.t0
+        with self._lock:
+            stages = {
+                name: {
+                    "start_s": round(st["start"] - self.t0, 3),
+                    "end_s": round(st["end"] - self.t0, 3),
+                    "busy_s": round(st["busy"], 3),
+                    "calls": st["calls"],
+                }
+                for name, st in sorted(self._stages.items(), key=lambda kv: kv[1]["start"])
+            }
+        busy = sum(st["busy_s"] for st in stages.values())
+        return {
+            "total_s": round(total, 3),
+            "stage_busy_s": round(busy, 3),
+            "parallelism": round(busy / total, 2) if total > 0 else 0.0,
+            "stages": stages,
+        }
+
+    def log(self, job_id: str):
+        summary = self.summary()
+        spans = ", ".join(
+            f"{name}=[{st['start_s']:.1f}-{st['end_s']:.1f}s busy {st['busy_s']:.1f}s]"
+            for name, st in summary["stages"].items())
+        logger.info(
+            f"Job {job_id} timings: total={summary['total_s']:.1f}s "
+            f"parallelism={summary['parallelism']:.2f} | {spans}")
+        return summary
+
+
+# ─── Request deadline budget ─────────────────────────────
+
+class _StageCosts:
+    """Per-instance unit costs of the pipeline stages, learned from finished jobs (EWMA)."""
+
+    def __init__(self, defaults: dict[str, float], alpha: float = 0.3):
+        self.alpha = alpha
+        self._costs = dict(defaults)
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._costs[name]
+
+    def observe(self, name: str, value: float):
+        if value <= 0 or not math.isfinite(value):
+            return
+        with self._lock:
+            self._costs[name] += self.alpha * (value - self._costs[name])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {k: round(v, 5) for k, v in self._costs.items()}
+
+
+_stage_costs = _StageCosts({
+    "decode": 0.011,                # s per walked frame per native megapixel
+    "accumulate": 0.027,            # s per sampled frame per working megapixel per _embryo_load()
+    "embryo": 0.4,                  # s of finalize + encode/upload + embed per embryo
+    "gemini": GEMINI_CALL_SECONDS,  # s per Gemini request
+    "save": 0.25,                   # s per embryo (score row + KNN RPC)
+})
+
+
+def _embryo_load(n_embryos: int) -> float:
+    """Accumulator work per frame grows with the embryo ROIs on top of the full-frame passes."""
+    return 1.0 + n_embryos / 4
+
+
+class _DeadlineBudget:
+    """Time left for one /analyze request against the Cloud Run request timeout.
+
+    Starts when the request arrives, so claim, context resolution and download
+    all count. Estimates come from _stage_costs. The video stage is fitted
+    first (plan_video() lowers the working resolution, then shortens the
+    analyzed span); Gemini gets as many requests as fit before
+    gemini_deadline(), which always leaves the save stage its reserve.
+    Embryos that don't fit keep their kinetics, crops and embeddings and are
+    saved with a Pending classification.
+    """
+
+    def __init__(self, total: float | None = None, costs: _StageCosts = _stage_costs):
+        if total is None:
+            total = REQUEST_TIMEOUT_SECONDS - DEADLINE_SAFETY_SECONDS
+        self.start = time.time()
+        self.total = total
+        self.end = self.start + total
+        self.costs = costs
+        self.plan = {}
+        self._gemini_slots = None
+
+    def remaining(self) -> float:
+        return self.end - time.time()
+
+    def _after_video(self, n_embryos: int, gemini_workers: int) -> float:
+        groups = -(-n_embryos // max(1, GEMINI_BATCH_SIZE))
+        rounds = -(-groups // max(1, gemini_workers))
+        return (n_embryos * (self.costs.get("embryo") + self.costs.get("save"))
+                + rounds * self.costs.get("gemini"))
+
+    def plan_video(self, total_frames: int, fps: float, native_wh: tuple[int, int],
+                   work_wh: tuple[int, int], n_embryos: int, gemini_workers: int) -> dict:
+        """Span (frames from the start) and working size that fit the budget."""
+        native_mpx = native_wh[0] * native_wh[1] / 1e6
+        c_decode, c_accumulate = self.costs.get("decode"), self.costs.get("accumulate")
+
+        def estimate(span: int, wh: tuple[int, int]) -> float:
+            sampled = len(_sample_frame_indices(span, fps))
+            return (span * native_mpx * c_decode
+                    + sampled * wh[0] * wh[1] / 1e6 * _embryo_load(n_embryos) * c_accumulate)
+
+        video_budget = self.remaining() - self._after_video(n_embryos, gemini_workers)
+        span, wh = total_frames, work_wh
+        est = estimate(span, wh)
+        if est > video_budget and wh[1] > MIN_DEGRADED_HEIGHT:
+            # Kinetics cost scales with working pixels; decode cost doesn't
+            decode_s = span * native_mpx * c_decode
+            ratio = max(0.0, video_budget - decode_s) / max(est - decode_s, 1e-9)
+            scale = max(MIN_DEGRADED_HEIGHT / wh[1], min(1.0, math.sqrt(ratio)))
+            wh = (int(wh[0] * scale) // 2 * 2, int(wh[1] * scale) // 2 * 2)
+            est = estimate(span, wh)
+        min_span = min(total_frames, int(MIN_KINETIC_SECONDS * fps))
+        while est > video_budget and span > min_span:
+            span = max(min_span, int(span * max(0.5, video_budget / est)))
+            est = estimate(span, wh)
+
+        self.plan = {
+            "span_frames": span,
+            "total_frames": total_frames,
+            "work_size": list(wh),
+            "degraded": span < total_frames or wh != tuple(work_wh),
+            "est_video_s": round(est, 2),
+            "video_budget_s": round(video_budget, 2),
+        }
+        return self.plan
+
+    def gemini_deadline(self, n_embryos: int) -> float:
+        """Latest start for a Gemini request that still leaves save its reserve."""
+        return self.end - n_embryos * self.costs.get("save") - self.costs.get("gemini")
+
+    def take_gemini_slot(self, n_embryos: int, workers: int) -> bool:
+        """True while another request fits before gemini_deadline() (first call fixes the count)."""
+        if self._gemini_slots is None:
+            ahead = self.gemini_deadline(n_embryos) - time.time()
+            rounds = int(ahead // self.costs.get("gemini")) + 1 if ahead >= 0 else 0
+            self._gemini_slots = rounds * max(1, workers)
+        if self._gemini_slots <= 0:
+            return False
+        self._gemini_slots -= 1
+        return True
+
+    def learn(self, summary: dict, n_tracked: int, n_results: int, frames_walked: int,
+              native_mpx: float, frames_sampled: int, work_mpx: float):
+        """Fold this job's measured unit costs into _stage_costs.
+
+        n_tracked is the number of bboxes the accumulator ran on (its per-frame
+        load, as in plan_video); n_results the embryos that reached the
+        per-embryo stages and the save.
+        """
+        st = summary["stages"]
+        if "decode" in st and frames_walked:
+            self.costs.observe("decode", st["decode"]["busy_s"] / (frames_walked * native_mpx))
+        if "accumulate" in st and frames_sampled:
+            self.costs.observe("accumulate", st["accumulate"]["busy_s"]
+                               / (frames_sampled * work_mpx * _embryo_load(n_tracked)))
+        if "finalize" in st and n_results:
+            end = max(st[name]["end_s"] for name in ("finalize", "upload", "embed") if name in st)
+            self.costs.observe("embryo", (end - st["finalize"]["start_s"]) / n_results)
+        if "gemini" in st and st["gemini"]["calls"]:
+            self.costs.observe("gemini", st["gemini"]["busy_s"] / st["gemini"]["calls"])
+        if "save" in st and n_results:
+            self.costs.observe("save", st["save"]["busy_s"] / n_results)
+
+    def report(self, deferred: list[int]) -> dict:
+        return {
+            "limit_s": round(self.total, 1),
+            "remaining_s": round(self.remaining(), 1),
+            "plan": self.plan,
+            "deferred_classification": deferred,
+        }
+
+
 # ═══════════════════════════════════════════════════════════
 # STREAMING ACCUMULATOR — O(1) memory per frame
 # ═══════════════════════════════════════════════════════════
 
 
+def _background_sample_index(all_mask: np.ndarray, budget: int = BG_SAMPLE_BUDGET,
+                             patch: int = BG_PATCH_SIZE) -> np.ndarray:
+    """Flat indices of background pixels (all_mask == 0) used for the noise floor.
+
+    With budget <= 0, or when the background already fits the budget, every
+    background pixel is returned (exact, same order as boolean indexing).
+    Otherwise the frame is split into a stratified grid with one patch×patch
+    patch per cell, centred in the cell, keeping only the background pixels of
+    each patch. The result holds at most ~budget pixels spread evenly over the
+    plate, so vignetting and illumination gradients are still represented.
+    """
+    h, w = all_mask.shape[:2]
+    flat_mask = all_mask.reshape(-1)
+    bg_total = int(np.count_nonzero(flat_mask == 0))
+    if budget <= 0 or bg_total <= budget:
+        return np.flatnonzero(flat_mask == 0)
+
+    # Oversample cells by the background fraction so ~budget pixels survive
+    bg_fraction = bg_total / float(h * w)
+    n_patches = max(1, int(budget / (patch * patch * bg_fraction)))
+    grid_y = max(1, min(h // patch, round((n_patches * h / w) ** 0.5)))
+    grid_x = max(1, min(w // patch, -(-n_patches // grid_y)))
+
+    tops = ((np.arange(grid_y) + 0.5) * h / grid_y - patch / 2).astype(np.int64).clip(0, h - patch)
+    lefts = ((np.arange(grid_x) + 0.5) * w / grid_x - patch / 2).astype(np.int64).clip(0, w - patch)
+    offs = np.arange(patch)
+    rows = (tops[:, None] + offs[None, :]).reshape(-1)      # grid_y * patch
+    cols = (lefts[:, None] + offs[None, :]).reshape(-1)     # grid_x * patch
+    flat = (rows[:, None] * w + cols[None, :]).reshape(-1)  # row-major over the grid
+    flat = np.unique(flat)
+    flat = flat[flat_mask[flat] == 0]
+    if flat.size > budget:
+        # Keep stratification: drop evenly spaced samples, never whole regions
+        flat = flat[np.linspace(0, flat.size - 1, budget).astype(np.int64)]
+    return flat
+
+
+def _accumulator_dtypes(max_frames: int) -> tuple[type, type, type]:
+    """Smallest exact (sum, sum-of-squares, heat) dtypes for max_frames uint8 samples."""
+    max_sum = max_frames * 255
+    max_sumsq = max_frames * 255 * 255
+    sum_dtype = np.uint16 if max_sum <= np.iinfo(np.uint16).max else np.uint32
+    sumsq_dtype = np.uint32 if max_sumsq <= np.iinfo(np.uint32).max else np.uint64
+    # Heat accumulates at most max_frames - gap diffs of uint8
+    return sum_dtype, sumsq_dtype, sum_dtype
+
+
+def _variance_from_sums(n: int, sums: np.ndarray, sumsqs: np.ndarray, ddof: int = 0) -> np.ndarray:
+    """Exact per-pixel variance from integer sums: (n·Σx² − (Σx)²) / (n·(n − ddof))."""
+    s = sums.astype(np.int64)
+    numer = sumsqs.astype(np.int64) * n - s * s
+    return numer / float(n * (n - ddof))
+
+
 class _StreamingAccumulator:
-    """Processes video frames one at a time. Eliminates storing all frames in memory."""
+    """Processes video frames one at a time. Eliminates storing all frames in memory.
+
+    roi=True (default): each embryo keeps only its padded crop window, with its
+    masks cropped to that window, so per-frame work and memory scale with embryo
+    area instead of frame area. roi=False uses the full frame as the window
+    (legacy behaviour, kept for benchmarking). Pixel order inside the window
+    matches full-frame boolean indexing, so both modes give identical metrics.
+
+    Per-pixel stats are fused across embryos: one flat index of every embryo
+    pixel (with embryo label and core flag) is gathered with a single take()
+    per frame. Core and periphery are a partition of the full mask, so their
+    statistics come from segmented reductions (bincount) in finalize().
+
+    The background noise floor (bg_std, bg_timeline) is estimated on a sparse
+    stratified grid of at most bg_budget pixels (see _background_sample_index);
+    bg_budget=0 uses every background pixel.
+
+    Gray pixels are uint8 and at most max_frames are fed, so per-pixel stats are
+    exact integer sums and sums of squares (uint16/uint32 at 120 frames) and the
+    heatmap is an integer sum of diffs. The hot loop has no float conversion or
+    division; variance is derived once in finalize().
+    """
 
-    def __init__(self, bboxes, vid_w, vid_h, fps, gap):
+    def __init__(self, bboxes, vid_w, vid_h, fps, gap, roi: bool = True,
+                 bg_budget: int = BG_SAMPLE_BUDGET, max_frames: int = MAX_SAMPLED_FRAMES):
         self.bboxes = bboxes
+        self.roi = roi
         self.vid_w = vid_w
         self.vid_h = vid_h
         self.fps = fps
         self.gap = gap
         self.frame_count = 0
+        self.max_frames = max_frames
+        self.sum_dtype, self.sumsq_dtype, heat_dtype = _accumulator_dtypes(max_frames)
 
         # Sliding window (last gap+1 gray frames for diffs)
         self.gray_window = collections.deque(maxlen=gap + 1)
 
         # Cumulative heatmap (incremented on each diff)
-        self.cumulative_heat = np.zeros((vid_h, vid_w), dtype=np.float64)
+        self.cumulative_heat = np.zeros((vid_h, vid_w), dtype=heat_dtype)
 
         # Background mask (everything outside embryo regions)
         all_mask = np.zeros((vid_h, vid_w), dtype=np.uint8)
@@ -249,17 +1170,20 @@ class _StreamingAccumulator:
             br = max(bbw, bbh) // 2
             cv2.circle(all_mask, (bcx, bcy), int(br * 1.3), 255, -1)
 
-        self.bg_indices = all_mask == 0
-        self.bg_pixel_count = int(np.sum(self.bg_indices))
+        self.bg_index = _background_sample_index(all_mask, bg_budget)
+        self.bg_pixel_count = int(self.bg_index.size)
+        del all_mask
 
-        # Background Welford's accumulators
+        # Background integer accumulators
         self.bg_n = 0
-        self.bg_mean = None
-        self.bg_m2 = None
+        self.bg_std = 0.0
+        self.bg_sum = np.zeros(self.bg_pixel_count, dtype=self.sum_dtype)
+        self.bg_sumsq = np.zeros(self.bg_pixel_count, dtype=self.sumsq_dtype)
         self.bg_timeline = []
 
         # Per-embryo accumulators
         self.embryo_accs = []
+        px_parts, core_parts = [], []
         for bbox in bboxes:
             cx = int(bbox["x_percent"] / 100 * vid_w)
             cy = int(bbox["y_percent"] / 100 * vid_h)
@@ -267,21 +1191,6 @@ class _StreamingAccumulator:
             bh = int(bbox["height_percent"] / 100 * vid_h)
             radius = max(bw, bh) // 2
 
-            # Full embryo mask
-            mask = np.zeros((vid_h, vid_w), dtype=np.uint8)
-            cv2.circle(mask, (cx, cy), radius, 255, -1)
-            mask_indices = mask > 0
-
-            # Core mask (inner half)
-            inner_mask = np.zeros((vid_h, vid_w), dtype=np.uint8)
-            cv2.circle(inner_mask, (cx, cy), max(1, radius // 2), 255, -1)
-            inner_idx = inner_mask > 0
-
-            # Periphery mask
-            outer_mask = mask.copy()
-            outer_mask[inner_idx] = 0
-            outer_idx = outer_mask > 0
-
             # Crop bounds
             padding_ratio = 0.20
             size = max(bw, bh)
@@ -292,20 +1201,46 @@ class _StreamingAccumulator:
             crop_right = min(vid_w, cx + half)
             crop_bottom = min(vid_h, cy + half)
 
+            # Analysis window: padded crop ∪ circle bounds (ROI) or full frame
+            if roi:
+                win_top = max(0, min(crop_top, cy - radius))
+                win_left = max(0, min(crop_left, cx - radius))
+                win_bottom = min(vid_h, max(crop_bottom, cy + radius + 1))
+                win_right = min(vid_w, max(crop_right, cx + radius + 1))
+            else:
+                win_top, win_left, win_bottom, win_right = 0, 0, vid_h, vid_w
+            win_h = max(0, win_bottom - win_top)
+            win_w = max(0, win_right - win_left)
+            lcx, lcy = cx - win_left, cy - win_top  # Center in window coords
+
+            # Full embryo mask (window-local)
+            mask = np.zeros((win_h, win_w), dtype=np.uint8)
+            cv2.circle(mask, (lcx, lcy), radius, 255, -1)
+            mask_indices = mask > 0
+
+            # Core mask (inner half)
+            inner_mask = np.zeros((win_h, win_w), dtype=np.uint8)
+            cv2.circle(inner_mask, (lcx, lcy), max(1, radius // 2), 255, -1)
+            inner_idx = inner_mask > 0
+
+            # Periphery mask
+            outer_idx = mask_indices & ~inner_idx
+            del mask, inner_mask
+
+            # Flat frame indices of this embryo's pixels (row-major) + core flag
+            ys, xs = np.nonzero(mask_indices)
+            px_parts.append((ys + win_top) * vid_w + (xs + win_left))
+            core_parts.append(inner_idx[ys, xs])
+
             self.embryo_accs.append({
                 "cx": cx, "cy": cy, "radius": radius,
-                "mask": mask, "mask_indices": mask_indices,
-                "inner_idx": inner_idx, "outer_idx": outer_idx,
+                "win": (slice(win_top, win_bottom), slice(win_left, win_right)),
+                "lcx": lcx, "lcy": lcy,
+                "mask_indices": mask_indices,
                 "inner_count": int(np.sum(inner_idx)),
                 "outer_count": int(np.sum(outer_idx)),
-                # Welford's for full activity
-                "act_n": 0, "act_mean": None, "act_m2": None,
-                # Welford's for core
-                "core_n": 0, "core_mean": None, "core_m2": None,
-                # Welford's for periphery
-                "peri_n": 0, "peri_mean": None, "peri_m2": None,
-                # Mean intensity accumulator (for NSD)
-                "intensity_sum": 0.0, "intensity_count": 0,
+                # Filled by finalize() from the fused accumulators
+                "mean_std": 0.0, "core_std": 0.0, "peri_std": 0.0, "mean_intensity": 0.0,
                 # Diff timeline
                 "emb_timeline": [],
                 # Best crop tracking
@@ -314,8 +1249,21 @@ class _StreamingAccumulator:
                 "best_sharpness": -1.0, "best_crop": None,
             })
 
+        # Fused per-pixel accumulators over all embryos (label-sorted)
+        n_emb = len(self.embryo_accs)
+        self.px_counts = np.array([len(p) for p in px_parts], dtype=np.int64)
+        self.px_index = np.concatenate(px_parts) if px_parts else np.zeros(0, dtype=np.intp)
+        self.px_core = np.concatenate(core_parts) if core_parts else np.zeros(0, dtype=bool)
+        self.px_label = np.repeat(np.arange(n_emb), self.px_counts)
+        self.px_n = 0
+        self.px_sum = np.zeros(self.px_index.size, dtype=self.sum_dtype)
+        self.px_sumsq = np.zeros(self.px_index.size, dtype=self.sumsq_dtype)
+        del px_parts, core_parts
+
     def process_frame(self, color_frame):
         """Called once per sampled frame."""
+        if self.frame_count >= self.max_frames:
+            raise ValueError(f"More than max_frames={self.max_frames} frames fed")
         gray = cv2.cvtColor(color_frame, cv2.COLOR_BGR2GRAY)
 
         # 1. APPEND to sliding window FIRST (critical order!)
@@ -324,76 +1272,35 @@ class _StreamingAccumulator:
         # 2. Compute diff only when window is full
         if len(self.gray_window) == self.gap + 1:
             diff = cv2.absdiff(self.gray_window[0], self.gray_window[-1])
-            self.cumulative_heat += diff.astype(np.float64)
+            self.cumulative_heat += diff
 
             # Background diff timeline
             if self.bg_pixel_count > 100:
-                bg_diff_mean = float(np.mean(diff[self.bg_indices].astype(np.float32)))
+                bg_diff_mean = float(np.mean(diff.reshape(-1).take(self.bg_index).astype(np.float32)))
                 self.bg_timeline.append(bg_diff_mean)
 
-            # Per-embryo diff timeline
-            for acc in self.embryo_accs:
-                emb_diff = float(np.mean(diff[acc["mask_indices"]].astype(np.float32)))
-                acc["emb_timeline"].append(emb_diff)
+            # Per-embryo diff timeline (one gather + one segmented mean)
+            if self.embryo_accs:
+                emb_diffs = self._segment_means(diff.reshape(-1).take(self.px_index))
+                for acc, emb_diff in zip(self.embryo_accs, emb_diffs.tolist()):
+                    acc["emb_timeline"].append(emb_diff)
 
-        # 3. Background Welford's
+        # 3. Background sums (exact integers)
         if self.bg_pixel_count > 100:
-            pixels = gray[self.bg_indices].astype(np.float32)
+            pixels = gray.reshape(-1).take(self.bg_index)
             self.bg_n += 1
-            if self.bg_mean is None:
-                self.bg_mean = pixels.copy()
-                self.bg_m2 = np.zeros_like(pixels)
-            else:
-                delta = pixels - self.bg_mean
-                self.bg_mean += delta / self.bg_n
-                delta2 = pixels - self.bg_mean
-                self.bg_m2 += delta * delta2
+            self.bg_sum += pixels
+            self.bg_sumsq += np.multiply(pixels, pixels, dtype=np.uint16)
 
-        # 4. Per-embryo Welford's + best crop
-        for acc in self.embryo_accs:
-            # Full activity Welford's
-            pixels = gray[acc["mask_indices"]].astype(np.float32)
-            acc["act_n"] += 1
-            if acc["act_mean"] is None:
-                acc["act_mean"] = pixels.copy()
-                acc["act_m2"] = np.zeros_like(pixels)
-            else:
-                d = pixels - acc["act_mean"]
-                acc["act_mean"] += d / acc["act_n"]
-                d2 = pixels - acc["act_mean"]
-                acc["act_m2"] += d * d2
-
-            # Accumulate intensity for NSD
-            acc["intensity_sum"] += float(np.mean(pixels))
-            acc["intensity_count"] += 1
-
-            # Core Welford's
-            if acc["inner_count"] > 0:
-                core_pix = gray[acc["inner_idx"]].astype(np.float32)
-                acc["core_n"] += 1
-                if acc["core_mean"] is None:
-                    acc["core_mean"] = core_pix.copy()
-                    acc["core_m2"] = np.zeros_like(core_pix)
-                else:
-                    d = core_pix - acc["core_mean"]
-                    acc["core_mean"] += d / acc["core_n"]
-                    d2 = core_pix - acc["core_mean"]
-                    acc["core_m2"] += d * d2
-
-            # Periphery Welford's
-            if acc["outer_count"] > 0:
-                peri_pix = gray[acc["outer_idx"]].astype(np.float32)
-                acc["peri_n"] += 1
-                if acc["peri_mean"] is None:
-                    acc["peri_mean"] = peri_pix.copy()
-                    acc["peri_m2"] = np.zeros_like(peri_pix)
-                else:
-                    d = peri_pix - acc["peri_mean"]
-                    acc["peri_mean"] += d / acc["peri_n"]
-                    d2 = peri_pix - acc["peri_mean"]
-                    acc["peri_m2"] += d * d2
+        # 4. Fused embryo sums — all embryos, core + periphery in one update
+        if self.px_index.size > 0:
+            pixels = gray.reshape(-1).take(self.px_index)
+            self.px_n += 1
+            self.px_sum += pixels
+            self.px_sumsq += np.multiply(pixels, pixels, dtype=np.uint16)
 
-            # Best crop (highest Laplacian sharpness)
+        # 5. Best crop per embryo (highest Laplacian sharpness)
+        for acc in self.embryo_accs:
             cl, ct = acc["crop_left"], acc["crop_top"]
             cr, cb = acc["crop_right"], acc["crop_bottom"]
             crop = color_frame[ct:cb, cl:cr]
@@ -410,20 +1317,56 @@ class _StreamingAccumulator:
 
     def finalize(self):
         """Extract final results. Called once after all frames."""
+        results = list(self.iter_finalize())
+        return results, self.bg_std
+
+    def iter_finalize(self):
+        """Yield each embryo's final result as soon as it is computed.
+
+        Shared reductions (background noise, fused per-pixel stats) run on the
+        first next(); self.bg_std is set before the first embryo is yielded, so
+        downstream stages (encode, upload, Gemini) can start on embryo 0 while
+        the heatmaps of the others are still being built.
+        """
         # Background std
         bg_std = 0.0
-        if self.bg_n > 1 and self.bg_m2 is not None:
-            variance = self.bg_m2 / (self.bg_n - 1)  # Sample variance
+        if self.bg_n > 1:
+            variance = _variance_from_sums(self.bg_n, self.bg_sum, self.bg_sumsq, ddof=1)  # Sample variance
             bg_std = float(np.mean(np.sqrt(variance)))
-            del self.bg_mean, self.bg_m2
-            self.bg_mean = None
-            self.bg_m2 = None
+            del variance
+        self.bg_sum = None
+        self.bg_sumsq = None
 
-        results = []
-        for i, acc in enumerate(self.embryo_accs):
-            results.append(self._finalize_embryo(i, acc, bg_std))
+        # Embryo stats: segmented reductions over the fused per-pixel arrays
+        if self.px_n >= 2:
+            # Population variance to match np.std(axis=0) behavior
+            pixel_std = np.sqrt(_variance_from_sums(self.px_n, self.px_sum, self.px_sumsq))
+            mean_std = self._segment_means(pixel_std)
+            mean_intensity = self._segment_means(self.px_sum) / self.px_n
+            core_std = self._segment_means(pixel_std, self.px_core)
+            peri_std = self._segment_means(pixel_std, ~self.px_core)
+            for i, acc in enumerate(self.embryo_accs):
+                acc["mean_std"] = float(mean_std[i])
+                acc["mean_intensity"] = float(mean_intensity[i])
+                acc["core_std"] = float(core_std[i])
+                acc["peri_std"] = float(peri_std[i])
+            del pixel_std
+        self.px_sum = None
+        self.px_sumsq = None
+        self.bg_std = bg_std
 
-        return results, bg_std
+        for i, acc in enumerate(self.embryo_accs):
+            yield self._finalize_embryo(i, acc, bg_std)
+
+    def _segment_means(self, values: np.ndarray, select: np.ndarray | None = None) -> np.ndarray:
+        """Per-embryo mean of a per-pixel array (optionally restricted to a pixel subset)."""
+        n_emb = len(self.embryo_accs)
+        labels = self.px_label
+        if select is not None:
+            labels, values = labels[select], values[select]
+        sums = np.bincount(labels, weights=values, minlength=n_emb)
+        counts = np.bincount(labels, minlength=n_emb)
+        return sums / np.maximum(counts, 1)
 
     def _finalize_embryo(self, idx, acc, bg_std):
         """Compute final metrics for one embryo."""
@@ -431,31 +1374,25 @@ class _StreamingAccumulator:
         nsd = 0.0
         anr = 0.0
 
-        if acc["act_n"] >= 2 and acc["act_m2"] is not None:
-            # Population variance to match np.std(axis=0) behavior
-            variance = acc["act_m2"] / acc["act_n"]
-            pixel_std = np.sqrt(variance)
-            mean_std = float(np.mean(pixel_std))
-            compensated_std = max(0.0, mean_std - bg_std)
+        has_stats = self.px_n >= 2
+        if has_stats:
+            compensated_std = max(0.0, acc["mean_std"] - bg_std)
             activity_score = int(min(100, max(0, compensated_std * 100 / 15)))
 
             # NSD
-            mean_intensity = acc["intensity_sum"] / max(acc["intensity_count"], 1)
-            nsd = round(compensated_std / max(mean_intensity, 1.0), 6)
+            nsd = round(compensated_std / max(acc["mean_intensity"], 1.0), 6)
             # ANR
             anr = round(compensated_std / max(bg_std, 0.5), 3)
 
         # Core and periphery activity
         core_activity = 0
-        if acc["core_n"] >= 2 and acc["core_m2"] is not None:
-            core_var = acc["core_m2"] / acc["core_n"]
-            core_raw = float(np.mean(np.sqrt(core_var)))
+        if has_stats and acc["inner_count"] > 0:
+            core_raw = acc["core_std"]
             core_activity = int(min(100, max(0, max(0.0, core_raw - bg_std) * 100 / 15)))
 
         periphery_activity = 0
-        if acc["peri_n"] >= 2 and acc["peri_m2"] is not None:
-            peri_var = acc["peri_m2"] / acc["peri_n"]
-            peri_raw = float(np.mean(np.sqrt(peri_var)))
+        if has_stats and acc["outer_count"] > 0:
+            peri_raw = acc["peri_std"]
             periphery_activity = int(min(100, max(0, max(0.0, peri_raw - bg_std) * 100 / 15)))
 
         # Peak zone
@@ -489,20 +1426,18 @@ class _StreamingAccumulator:
             elif temporal_variability > 2.0:
                 temporal_pattern = "irregular"
 
-        # Symmetry (quadrant analysis)
-        cx, cy = acc["cx"], acc["cy"]
-        vid_h, vid_w = self.vid_h, self.vid_w
-        mask = acc["mask"]
+        # Symmetry (quadrant analysis, window-local — no full-frame masks)
+        lcx, lcy = acc["lcx"], acc["lcy"]
+        mask_indices = acc["mask_indices"]
+        heat_win = self.cumulative_heat[acc["win"]]
         quads = []
         for y_sl, x_sl in [
-            (slice(0, cy), slice(0, cx)),
-            (slice(0, cy), slice(cx, vid_w)),
-            (slice(cy, vid_h), slice(0, cx)),
-            (slice(cy, vid_h), slice(cx, vid_w)),
+            (slice(0, lcy), slice(0, lcx)),
+            (slice(0, lcy), slice(lcx, None)),
+            (slice(lcy, None), slice(0, lcx)),
+            (slice(lcy, None), slice(lcx, None)),
         ]:
-            q_mask = np.zeros((vid_h, vid_w), dtype=np.uint8)
-            q_mask[y_sl, x_sl] = mask[y_sl, x_sl]
-            quads.append(float(np.sum(self.cumulative_heat[q_mask > 0])))
+            quads.append(float(np.sum(heat_win[y_sl, x_sl][mask_indices[y_sl, x_sl]])))
 
         total_q = sum(quads)
         activity_symmetry = 1.0
@@ -537,12 +1472,7 @@ class _StreamingAccumulator:
             cv2.COLORMAP_JET)
 
         # Free heavy per-embryo arrays
-        acc["act_mean"] = None
-        acc["act_m2"] = None
-        acc["core_mean"] = None
-        acc["core_m2"] = None
-        acc["peri_mean"] = None
-        acc["peri_m2"] = None
+        acc["mask_indices"] = None
 
         return {
             "index": idx,
@@ -556,6 +1486,139 @@ class _StreamingAccumulator:
         }
 
 
+# ─── Job claim + context ─────────────────────────────────
+
+# False once the claim RPC is found missing (migration not applied yet)
+_claim_rpc_available = True
+
+
+def _claim_job(sb, queue_id: str) -> dict:
+    """Claim a queue job and load its context in one call (claim_embryo_analysis_job).
+
+    Returns {"outcome", "job", "media_path", "config", "gemini_api_key",
+    "expected_count"}; outcome is claimed / reclaimed_stale / reclaimed_failed,
+    or not_found / completed / busy / invalid_state (nothing claimed).
+    """
+    global _claim_rpc_available
+    if _claim_rpc_available:
+        try:
+            ctx = sb.rpc('claim_embryo_analysis_job', {
+                'p_queue_id': queue_id,
+                'p_stale_after_seconds': int(REQUEST_TIMEOUT_SECONDS),
+            }).execute().data
+            if "config" in ctx:  # Fresh reads: keep /classify's cached copies current
+                _config_cache.put(_cache_scope(sb), ctx["config"] or {})
+                _secrets_cache.put(_cache_scope(sb), ctx.get("gemini_api_key"))
+            return ctx
+        except Exception as e:
+            # PGRST202: function not in the schema cache, i.e. not deployed
+            if getattr(e, 'code', None) != 'PGRST202' and 'Could not find the function' not in str(e):
+                raise
+            logger.warning(f"claim_embryo_analysis_job unavailable, using sequential claim: {e}")
+            _claim_rpc_available = False
+    return _claim_job_sequential(sb, queue_id)
+
+
+def _claim_job_sequential(sb, queue_id: str) -> dict:
+    """Pre-RPC claim: the same rules and result as claim_embryo_analysis_job, one query at a time."""
+    claim_result = sb.table('embryo_analysis_queue').update({
+        'status': 'processing',
+        'started_at': datetime.utcnow().isoformat(),
+        'error_message': None,
+        'progress_message': 'Iniciando análise...',
+    }).eq('id', queue_id).eq('status', 'pending').execute()
+    outcome = "claimed"
+
+    if not claim_result.data:
+        # Job not in 'pending' state — check why
+        job_check = sb.table('embryo_analysis_queue').select(
+            'status, started_at'
+        ).eq('id', queue_id).maybe_single().execute()
+        if not job_check or not job_check.data:
+            return {"outcome": "not_found"}
+        status = job_check.data['status']
+        if status == 'completed':
+            return {"outcome": "completed", "status": status}
+        if status == 'processing':
+            started = job_check.data.get('started_at')
+            if started:
+                elapsed = time.time() - parse_timestamp(started).timestamp()
+                if elapsed < REQUEST_TIMEOUT_SECONDS:
+                    return {"outcome": "busy", "status": status}
+            outcome = "reclaimed_stale"
+            sb.table('embryo_analysis_queue').update({
+                'status': 'processing',
+                'started_at': datetime.utcnow().isoformat(),
+                'progress_message': 'Reprocessando (timeout anterior)...',
+            }).eq('id', queue_id).execute()
+        elif status == 'failed':
+            outcome = "reclaimed_failed"
+            sb.table('embryo_analysis_queue').update({
+                'status': 'processing',
+                'started_at': datetime.utcnow().isoformat(),
+                'error_message': None,
+                'progress_message': 'Reprocessando...',
+            }).eq('id', queue_id).execute()
+        else:
+            return {"outcome": "invalid_state", "status": status}
+
+    job = sb.table('embryo_analysis_queue').select(
+        'media_id, lote_fiv_acasalamento_id, '
+        'expected_count, manual_bboxes, embryo_offset'
+    ).eq('id', queue_id).single().execute().data
+    if not job:
+        return {"outcome": "not_found"}
+
+    media = sb.table('acasalamento_embrioes_media').select(
+        'arquivo_path'
+    ).eq('id', job['media_id']).maybe_single().execute()
+
+    expected_count = job.get('expected_count') or 0
+    # Fallback: if expected_count is 0, count embryos linked to this job
+    if expected_count == 0:
+        try:
+            ec_resp = sb.table('embrioes').select('id', count='exact', head=True).eq(
+                'queue_id', queue_id
+            ).execute()
+            expected_count = ec_resp.count or 0
+        except Exception as ec_err:
+            logger.warning(f"expected_count fallback query failed: {ec_err}")
+
+    return {
+        "outcome": outcome,
+        "job": job,
+        "media_path": (media.data or {}).get('arquivo_path') if media else None,
+        "config": _load_score_config(sb),
+        "gemini_api_key": _load_gemini_key(sb, ""),
+        "expected_count": expected_count,
+    }
+
+
+def _create_signed_video_url(sb, media_path: str) -> str:
+    signed = sb.storage.from_('embryo-videos').create_signed_url(media_path, 3600)
+    # Handle both camelCase (v1) and snake_case (v2) responses
+    video_url = None
+    if signed:
+        video_url = signed.get('signedURL') or signed.get('signed_url') or signed.get('signedUrl')
+    if not video_url:
+        raise HTTPException(500, f"Failed to generate signed URL for {media_path}")
+    return video_url
+
+
+def _prefetch_video_url(sb, queue_id: str) -> tuple[str, str] | None:
+    """(media_path, signed URL) looked up independently of the claim; None on any failure."""
+    if not _claim_rpc_available:
+        return None
+    try:
+        media_path = sb.rpc('embryo_analysis_media_path', {'p_queue_id': queue_id}).execute().data
+        if not media_path:
+            return None
+        return media_path, _create_signed_video_url(sb, media_path)
+    except Exception as e:
+        logger.warning(f"Signed URL prefetch failed for {queue_id}: {e}")
+        return None
+
+
 # ─── Main Pipeline ───────────────────────────────────────
 
 @app.post("/analyze")
@@ -576,6 +1639,7 @@ async def analyze(req: AnalyzeRequest, request: Request = None):
     # Auth check
     if request is not None:
         _check_api_key(request)
+    budget = _DeadlineBudget()  # Claim + context resolution count against the timeout
 
     # ─── Resolve job context from DB when queue_id-only ──────
     sb_url = req.supabase_url or os.environ.get("SUPABASE_URL", "")
@@ -592,121 +1656,44 @@ async def analyze(req: AnalyzeRequest, request: Request = None):
     if not effective_job_id:
         raise HTTPException(400, "queue_id or job_id is required")
 
+    progress = _ProgressReporter(sb, effective_job_id)
+
     # If queue_id mode (no video_url), resolve everything from DB
     if req.queue_id and not req.video_url:
         try:
-            # 1. Atomic claim (prevents duplicate processing across instances)
-            claim_result = sb.table('embryo_analysis_queue').update({
-                'status': 'processing',
-                'started_at': datetime.utcnow().isoformat(),
-                'error_message': None,
-                'progress_message': 'Iniciando análise...',
-            }).eq('id', req.queue_id).eq('status', 'pending').execute()
-
-            if not claim_result.data:
-                # Job not in 'pending' state — check why
-                job_check = sb.table('embryo_analysis_queue').select(
-                    'status, started_at'
-                ).eq('id', req.queue_id).single().execute()
-                if not job_check.data:
+            with ThreadPoolExecutor(max_workers=1) as sign_pool:
+                # The signed URL only needs the media path: create it while the claim runs
+                signed = sign_pool.submit(_prefetch_video_url, sb, req.queue_id)
+                ctx = _claim_job(sb, req.queue_id)
+                outcome = ctx["outcome"]
+                if outcome == "not_found":
                     raise HTTPException(404, f"Job not found: {req.queue_id}")
-                status = job_check.data['status']
-                if status == 'completed':
+                if outcome == "completed":
                     return {"message": "Already completed", "queue_id": req.queue_id}
-                if status == 'processing':
-                    started = job_check.data.get('started_at')
-                    if started:
-                        elapsed = time.time() - datetime.fromisoformat(
-                            started.replace('Z', '+00:00')
-                        ).timestamp()
-                        if elapsed < 300:
-                            return {"message": "Already processing by another instance", "queue_id": req.queue_id}
-                    # Stale (>5 min) — reclaim
-                    logger.warning(f"Job {req.queue_id} appears stale, reclaiming...")
-                    sb.table('embryo_analysis_queue').update({
-                        'status': 'processing',
-                        'started_at': datetime.utcnow().isoformat(),
-                        'progress_message': 'Reprocessando (timeout anterior)...',
-                    }).eq('id', req.queue_id).execute()
-                elif status == 'failed':
-                    sb.table('embryo_analysis_queue').update({
-                        'status': 'processing',
-                        'started_at': datetime.utcnow().isoformat(),
-                        'error_message': None,
-                        'progress_message': 'Reprocessando...',
-                    }).eq('id', req.queue_id).execute()
+                if outcome == "busy":
+                    return {"message": "Already processing by another instance", "queue_id": req.queue_id}
+                if outcome == "invalid_state":
+                    raise HTTPException(409, f"Job in unexpected state: {ctx.get('status')}")
+                if outcome == "reclaimed_stale":
+                    logger.warning(f"Job {req.queue_id} appeared stale, reclaimed")
+                logger.info(f"Job {req.queue_id} claimed successfully ({outcome})")
+
+                media_path = ctx.get("media_path")
+                if not media_path:
+                    raise HTTPException(404, f"Media not found for job {req.queue_id}")
+                prefetched = signed.result()
+                if prefetched and prefetched[0] == media_path:
+                    video_url = prefetched[1]
                 else:
-                    raise HTTPException(409, f"Job in unexpected state: {status}")
-
-            logger.info(f"Job {req.queue_id} claimed successfully")
-
-            # 2. Read job details
-            job_resp = sb.table('embryo_analysis_queue').select(
-                'media_id, lote_fiv_acasalamento_id, '
-                'expected_count, manual_bboxes, embryo_offset'
-            ).eq('id', req.queue_id).single().execute()
-            job = job_resp.data
-            if not job:
-                raise HTTPException(404, f"Job not found: {req.queue_id}")
-
-            # 3. Get media path
-            media_resp = sb.table('acasalamento_embrioes_media').select(
-                'arquivo_path'
-            ).eq('id', job['media_id']).single().execute()
-            media = media_resp.data
-            if not media:
-                raise HTTPException(404, f"Media not found for job {req.queue_id}")
-
-            # 4. Generate signed URL
-            _update_progress(sb, req.queue_id, "Gerando URL do vídeo...")
-            signed = sb.storage.from_('embryo-videos').create_signed_url(
-                media['arquivo_path'], 3600
-            )
-            # Handle both camelCase (v1) and snake_case (v2) responses
-            video_url = None
-            if signed:
-                video_url = signed.get('signedURL') or signed.get('signed_url') or signed.get('signedUrl')
-            if not video_url:
-                raise HTTPException(500, f"Failed to generate signed URL for {media['arquivo_path']}")
-
-            # 5. Get config (prompt, model) — non-critical, use defaults on failure
-            config = {}
-            try:
-                config_rows = sb.table('embryo_score_config').select(
-                    'calibration_prompt, model_name'
-                ).eq('active', True).order('created_at', desc=True).limit(1).execute()
-                if config_rows.data and len(config_rows.data) > 0:
-                    config = config_rows.data[0]
-            except Exception as cfg_err:
-                logger.warning(f"Could not load embryo_score_config (using defaults): {cfg_err}")
-
-            # 6. Get Gemini API key from secrets table (fallback to env var) — non-critical
-            try:
-                secret_rows = sb.table('embryo_score_secrets').select(
-                    'key_value'
-                ).eq('key_name', 'GEMINI_API_KEY').limit(1).execute()
-                if secret_rows.data and len(secret_rows.data) > 0:
-                    key_val = secret_rows.data[0].get('key_value')
-                    if key_val:
-                        gemini_key = key_val
-            except Exception as sec_err:
-                logger.warning(f"Could not load embryo_score_secrets (using env var): {sec_err}")
+                    video_url = _create_signed_video_url(sb, media_path)
 
             # Populate req fields for the rest of the pipeline
+            job = ctx["job"]
+            config = ctx.get("config") or {}
+            gemini_key = ctx.get("gemini_api_key") or gemini_key
             req.video_url = video_url
             req.job_id = req.queue_id
-            req.expected_count = job.get('expected_count') or 0
-            # Fallback: if expected_count is 0, count embryos linked to this job
-            if req.expected_count == 0:
-                try:
-                    ec_resp = sb.table('embrioes').select('id', count='exact', head=True).eq(
-                        'queue_id', req.queue_id
-                    ).execute()
-                    if ec_resp.count and ec_resp.count > 0:
-                        req.expected_count = ec_resp.count
-                        logger.info(f"expected_count fallback from DB: {req.expected_count}")
-                except Exception as ec_err:
-                    logger.warning(f"expected_count fallback query failed: {ec_err}")
+            req.expected_count = ctx.get("expected_count") or 0
             req.bboxes = job.get('manual_bboxes') or None
             req.gemini_api_key = gemini_key
             req.supabase_url = sb_url
@@ -718,9 +1705,11 @@ async def analyze(req: AnalyzeRequest, request: Request = None):
             req.embryo_offset = job.get('embryo_offset') or 0
 
         except HTTPException:
+            progress.close()
             raise
         except Exception as e:
             logger.error(f"Failed to resolve job context for {req.queue_id}: {e}")
+            progress.cancel()
             sb.table('embryo_analysis_queue').update({
                 'status': 'failed',
                 'error_message': f'Job context resolution failed: {str(e)[:500]}',
@@ -731,11 +1720,15 @@ async def analyze(req: AnalyzeRequest, request: Request = None):
 
     if not req.video_url:
         raise HTTPException(400, "video_url is required (or use queue_id mode)")
-    if not gemini_key:
+    defer = req.defer_classification
+    if defer is None:
+        defer = CLASSIFY_MODE == "deferred"
+    if defer and not (req.lote_fiv_acasalamento_id and req.media_id):
+        defer = False  # Nothing persisted for /classify to pick up
+    if not gemini_key and not defer:
         raise HTTPException(500, "Gemini API key not configured")
 
     _ensure_onnx()
-    _ensure_gemini(gemini_key)
 
     # Re-resolve sb in case credentials changed
     sb = _get_supabase(sb_url, sb_key)
@@ -743,12 +1736,14 @@ async def analyze(req: AnalyzeRequest, request: Request = None):
 
     # Global try/except: any crash marks job as failed with useful message
     tmp_path = None
+    clock = _StageClock()
     try:
         # 1. Download video
-        _update_progress(sb, effective_job_id, "Baixando vídeo...")
-        tmp_path = _download_video(req.video_url)
+        progress.update("Baixando vídeo...")
+        with clock.stage("download"):
+            tmp_path = _download_video(req.video_url)
 
-        _update_progress(sb, effective_job_id, "Extraindo frames...")
+        progress.update("Extraindo frames...")
         cap = cv2.VideoCapture(tmp_path)
         if not cap.isOpened():
             raise HTTPException(422, "Could not open video")
@@ -772,183 +1767,212 @@ async def analyze(req: AnalyzeRequest, request: Request = None):
             vid_w, vid_h = orig_w, orig_h
             scale = 1.0
 
-        # 2. PASS 1 — Detection (single frame from middle)
-        _update_progress(sb, effective_job_id, "Detectando embriões...")
-        det_frame_idx = total_frames // 2
-        cap.set(cv2.CAP_PROP_POS_FRAMES, det_frame_idx)
-        ret, det_frame = cap.read()
-        if not ret:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-            ret, det_frame = cap.read()
-        if not ret:
-            cap.release()
-            raise HTTPException(422, "Could not read detection frame")
-        if scale < 1.0:
-            det_frame = cv2.resize(det_frame, (vid_w, vid_h), interpolation=cv2.INTER_AREA)
+        # 2. Detection frame (middle of video) — served by the decode-once sampler
+        progress.update("Detectando embriões...")
+        sampler = _FrameSampler(
+            cap, _sample_frame_indices(total_frames, video_fps), det_index=total_frames // 2,
+            out_size=(vid_w, vid_h) if scale < 1.0 else None,
+        )
 
         # Detect embryos (use biologist-provided bboxes if available)
         if req.bboxes:
             bboxes = req.bboxes
             logger.info(f"Using {len(bboxes)} biologist-provided bboxes (skipping OpenCV)")
+            # Detection frame only feeds the plate upload — captured during the walk
         else:
-            bboxes = _detect_embryos(det_frame, req.expected_count)
+            with clock.stage("detect"):
+                det_frame = sampler.read_detection_frame()
+                if det_frame is None:
+                    cap.release()
+                    raise HTTPException(422, "Could not read detection frame")
+                bboxes = _detect_embryos(det_frame, req.expected_count)
             logger.info(f"OpenCV detected {len(bboxes)} embryos")
-        _update_progress(sb, effective_job_id, f"Detectados {len(bboxes)} embrião(ões)")
-
-        # Upload plate frame
-        plate_success, plate_buf = cv2.imencode('.jpg', det_frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
-        if plate_success:
-            _upload_to_storage(sb, f"{job_dir}/plate_frame.jpg", plate_buf.tobytes())
+            del det_frame
+        progress.update(f"Detectados {len(bboxes)} embrião(ões)")
 
         if not bboxes:
             cap.release()
+            with clock.stage("upload"), _StorageUploader(sb) as uploader:
+                _upload_plate_frame(uploader, job_dir, sampler.detection_frame)
+                _raise_failed_uploads(uploader.wait())
             return {
                 "plate_frame_path": f"{job_dir}/plate_frame.jpg",
                 "bboxes": [],
                 "embryos": [],
+                "timings": clock.log(effective_job_id),
+                "budget": budget.report([]),
             }
 
-        del det_frame  # Free detection frame
-
-        # 3. PASS 2 — Streaming analysis (O(1) memory per frame)
-        _update_progress(sb, effective_job_id, "Analisando cinética...")
-        sample_interval = max(1, round(video_fps / KINETIC_FPS))
-        sampled_indices = list(range(0, total_frames, sample_interval))
-        if len(sampled_indices) > MAX_SAMPLED_FRAMES:
-            step = len(sampled_indices) / MAX_SAMPLED_FRAMES
-            sampled_indices = [sampled_indices[int(i * step)] for i in range(MAX_SAMPLED_FRAMES)]
-
+        # Fit decode + kinetics into what the per-embryo stages leave of the budget
+        gemini_workers = _gemini_limiter(req.gemini_api_key).concurrency()
+        plan = budget.plan_video(total_frames, video_fps, (orig_w, orig_h), (vid_w, vid_h),
+                                 len(bboxes), gemini_workers)
+        if plan["degraded"]:
+            vid_w, vid_h = plan["work_size"]
+            logger.warning(
+                f"Job {effective_job_id}: {budget.remaining():.0f}s left — analyzing "
+                f"{plan['span_frames']}/{total_frames} frames at {vid_w}x{vid_h} "
+                f"(est {plan['est_video_s']:.0f}s of {plan['video_budget_s']:.0f}s)")
+            sampler.narrow(
+                _sample_frame_indices(plan["span_frames"], video_fps),
+                (vid_w, vid_h) if (vid_w, vid_h) != (orig_w, orig_h) else None)
+
+        # 3. Streaming analysis — decode thread feeds the accumulator through a
+        #    bounded queue (at most PIPELINE_QUEUE_DEPTH frames in flight)
+        progress.update("Analisando cinética...")
         gap = max(1, int(KINETIC_FPS))
-        accumulator = _StreamingAccumulator(bboxes, vid_w, vid_h, KINETIC_FPS, gap)
-
-        for idx in sampled_indices:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-            ret, frame = cap.read()
-            if not ret:
-                break
-            if scale < 1.0:
-                frame = cv2.resize(frame, (vid_w, vid_h), interpolation=cv2.INTER_AREA)
-            accumulator.process_frame(frame)
+        with clock.stage("accumulate"):
+            accumulator = _StreamingAccumulator(bboxes, vid_w, vid_h, KINETIC_FPS, gap)
+
+        decode_start = time.perf_counter()
+        decode_before = sampler.decode_seconds
+        n_samples = len(sampler.sampled_indices)
+        for _, frame in _iter_in_thread(sampler, name=f"decode-{effective_job_id}"):
+            with clock.stage("accumulate"):
+                accumulator.process_frame(frame)
+            progress.update_fraction("Analisando cinética...", accumulator.frame_count, n_samples)
             # frame is discarded on next iteration — O(1) memory
 
+        if sampler.detection_frame is None:
+            sampler.read_detection_frame()
         cap.release()
-        logger.info(f"Streamed {accumulator.frame_count} frames at {vid_w}x{vid_h}")
+        clock.record("decode", decode_start, time.perf_counter(),
+                     busy=sampler.decode_seconds - decode_before)
+        logger.info(
+            f"Streamed {accumulator.frame_count} frames at {vid_w}x{vid_h} "
+            f"(mode={sampler.mode}, decoded={sampler.frames_decoded}, "
+            f"decode={sampler.decode_seconds:.2f}s)")
+
+        if sampler.detection_frame is None:
+            del accumulator
+            raise HTTPException(422, "Could not read detection frame")
 
         if accumulator.frame_count < 2:
             del accumulator
             raise HTTPException(422, "Too few frames extracted")
+        frames_sampled = accumulator.frame_count
 
-        embryo_data, bg_std = accumulator.finalize()
-        del accumulator
-        gc.collect()
-
-        # 4. Per-embryo processing (encode, upload, DINOv2) with error isolation
-        start_time = time.time()
-        _update_progress(sb, effective_job_id, "Processando embriões...")
-
-        # Batch DINOv2 embeddings (1 call instead of N)
-        valid_crops = [(i, e["best_crop"]) for i, e in enumerate(embryo_data) if e.get("best_crop") is not None]
-        if valid_crops:
-            batch_embeddings = _get_embeddings_batch([c for _, c in valid_crops])
-            for j, (orig_idx, _) in enumerate(valid_crops):
-                embryo_data[orig_idx]["embedding"] = batch_embeddings[j]
+        # 4. Per-embryo stages, pipelined with error isolation:
+        #    finalize ─▶ encode (pool) ─▶ Gemini (pool sized from the key's quota)
+        #    Storage uploads and DINOv2 run alongside on their own pools; the
+        #    uploads are only awaited right before the DB save. Gemini
+        #    requests that would end past the budget are deferred, not attempted;
+        #    in deferred mode all of them are (see /classify).
+        gemini_deadline = budget.gemini_deadline(len(bboxes))
+        progress.update("Processando embriões...")
 
-        # Encode and upload per embryo
         embryo_results = []
-        for emb in embryo_data:
-            try:
-                best_crop = emb.get("best_crop")
-                heat_colored = emb.get("heat_colored")
-
-                if best_crop is None:
+        crops = []  # (index, best_crop) for the embedding stage
+        encode_futures = {}
+        gemini_futures = {}
+        deferred = []
+        with _StorageUploader(sb, clock=clock) as uploader, \
+                ThreadPoolExecutor(max_workers=PIPELINE_UPLOAD_WORKERS) as encode_pool, \
+                ThreadPoolExecutor(max_workers=1) as embed_pool, \
+                ThreadPoolExecutor(max_workers=gemini_workers) as gemini_pool:
+            plate_future = encode_pool.submit(_upload_plate_frame, uploader, job_dir, sampler.detection_frame)
+            sampler.detection_frame = None  # Free detection frame once encoded
+
+            # Each embryo goes to the encode pool as soon as finalize yields it
+            finalized = accumulator.iter_finalize()
+            while True:
+                with clock.stage("finalize"):
+                    emb = next(finalized, None)
+                if emb is None:
+                    break
+                if emb.get("best_crop") is None:
                     logger.warning(f"Embryo {emb['index']}: no crop available, skipping")
                     continue
-
-                success, crop_buf = cv2.imencode('.jpg', best_crop, [cv2.IMWRITE_JPEG_QUALITY, 90])
-                if not success:
-                    raise ValueError("Failed to encode crop JPEG")
-                crop_jpg = crop_buf.tobytes()
-
-                success, motion_buf = cv2.imencode('.jpg', heat_colored, [cv2.IMWRITE_JPEG_QUALITY, 85])
-                if not success:
-                    raise ValueError("Failed to encode motion JPEG")
-                motion_jpg = motion_buf.tobytes()
-
-                emb_dir = f"{job_dir}/embryo_{emb['index']}"
-                _upload_to_storage(sb, f"{emb_dir}/crop.jpg", crop_jpg)
-                _upload_to_storage(sb, f"{emb_dir}/motion.jpg", motion_jpg)
-
-                result = {
-                    "index": emb["index"],
-                    "bbox": bboxes[emb["index"]],
-                    "crop_image_path": f"{emb_dir}/crop.jpg",
-                    "motion_map_path": f"{emb_dir}/motion.jpg",
-                    "activity_score": emb["activity_score"],
-                    "nsd": emb["nsd"],
-                    "anr": emb["anr"],
-                    "bg_std": emb["bg_std"],
-                    "kinetic_profile": emb["kinetic_profile"],
-                    "embedding": emb.get("embedding", [0.0] * 384),
-                    "_crop_jpg": crop_jpg,
-                    "_motion_jpg": motion_jpg,
-                }
+                crops.append((emb["index"], emb["best_crop"]))
+                future = encode_pool.submit(
+                    _encode_and_upload_embryo, uploader, job_dir, emb, bboxes[emb["index"]], clock)
+                encode_futures[future] = emb["index"]
+            del finalized, accumulator, emb
+
+            # Batch DINOv2 embeddings (1 call instead of N), overlapping uploads + Gemini
+            embed_future = embed_pool.submit(
+                clock.timed("embed", _get_embeddings_batch), [c for _, c in crops])
+
+            # Gemini starts as soon as GEMINI_BATCH_SIZE embryos are encoded
+            classify = clock.timed("gemini", _classify_embryo_results)
+
+            def submit_group(group):
+                if not defer and budget.take_gemini_slot(len(bboxes), gemini_workers):
+                    gemini_futures[gemini_pool.submit(classify, group, req, gemini_deadline, sb)] = group
+                    return
+                for result in group:
+                    result.pop("_crop_jpg", None)
+                    result.pop("_motion_jpg", None)
+                    result["gemini_analysis"] = dict(_GEMINI_DEFERRED_RESULT)
+                    deferred.append(result["index"])
+
+            group = []
+            for future in as_completed(encode_futures):
+                idx = encode_futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Embryo {idx} processing failed: {e}")
+                    continue
                 embryo_results.append(result)
-
-            except Exception as e:
-                logger.error(f"Embryo {emb['index']} processing failed: {e}")
-                continue
-
-        # Free intermediate data
-        del embryo_data
-        gc.collect()
+                group.append(result)
+                if len(group) >= max(1, GEMINI_BATCH_SIZE):
+                    submit_group(group)
+                    group = []
+            if group:
+                submit_group(group)
+            if deferred and not defer:
+                logger.warning(f"Job {effective_job_id}: Gemini deferred for embryos {sorted(deferred)} "
+                               f"({budget.remaining():.0f}s left)")
+            logger.info(f"Encoded {len(embryo_results)}/{len(bboxes)} embryos")
+            if gemini_futures:
+                progress.update(f"Classificando {len(embryo_results)} embrião(ões) com IA...")
+
+            embeddings = dict(zip([i for i, _ in crops], embed_future.result()))
+            for result in embryo_results:
+                if result["index"] in embeddings:
+                    result["embedding"] = embeddings[result["index"]]
+
+            futures_wait(list(gemini_futures.keys()))
+            for future, group in gemini_futures.items():
+                try:
+                    analyses = future.result()
+                except Exception as e:
+                    logger.error(f"Gemini failed for embryos {[r['index'] for r in group]}: {e}")
+                    analyses = [{
+                        "classification": "Error",
+                        "reasoning": str(e)[:200],
+                        "confidence": "low",
+                    } for _ in group]
+                for result, analysis in zip(group, analyses):
+                    result["gemini_analysis"] = analysis
+
+            # Every image must be in Storage before rows point at it
+            plate_future.result()
+            with clock.stage("upload_wait"):
+                failed_uploads = uploader.wait()
+        if f"{job_dir}/plate_frame.jpg" in failed_uploads:
+            _raise_failed_uploads(failed_uploads)
+        if failed_uploads:
+            lost = {r["index"] for r in embryo_results
+                    if r["crop_image_path"] in failed_uploads or r["motion_map_path"] in failed_uploads}
+            logger.error(f"Embryos {sorted(lost)}: upload failed, dropping from results")
+            embryo_results = [r for r in embryo_results if r["index"] not in lost]
         logger.info(f"Processed {len(embryo_results)}/{len(bboxes)} embryos successfully")
 
-        # 5. Gemini (max_workers=1 to prevent rate limiting)
-        if time.time() - start_time > 250:
-            logger.warning("Approaching 300s timeout, skipping Gemini phase")
-            for r in embryo_results:
-                r.pop("_crop_jpg", None)
-                r.pop("_motion_jpg", None)
-                r["gemini_analysis"] = {
-                    "classification": "Pending",
-                    "reasoning": "Timeout — reprocesse quando possível",
-                    "confidence": "low",
-                }
-        else:
-            _update_progress(sb, effective_job_id, f"Classificando {len(embryo_results)} embrião(ões) com IA...")
-            if embryo_results:
-                with ThreadPoolExecutor(max_workers=1) as pool:
-                    gemini_futures = {
-                        pool.submit(
-                            _call_gemini_with_retry,
-                            embryo_results[i].pop("_crop_jpg"),
-                            embryo_results[i].pop("_motion_jpg"),
-                            req.gemini_api_key, req.prompt, req.model_name,
-                            embryo_results[i]["activity_score"],
-                            embryo_results[i]["kinetic_profile"],
-                            embryo_results[i]["nsd"],
-                            embryo_results[i]["anr"],
-                        ): i
-                        for i in range(len(embryo_results))
-                    }
-                    futures_wait(list(gemini_futures.keys()))
-                    for future in gemini_futures:
-                        idx = gemini_futures[future]
-                        try:
-                            embryo_results[idx]["gemini_analysis"] = future.result()
-                        except Exception as e:
-                            logger.error(f"Gemini failed for embryo {idx}: {e}")
-                            embryo_results[idx]["gemini_analysis"] = {
-                                "classification": "Error",
-                                "reasoning": str(e)[:200],
-                                "confidence": "low",
-                            }
+        # Free intermediate data; results keep detection order
+        embryo_results.sort(key=lambda r: r["index"])
+        del crops, embeddings
+        gc.collect()
 
         # ─── 6. Save scores directly to DB ─────────────────
-        _update_progress(sb, effective_job_id, "Salvando resultados...")
+        progress.update("Salvando resultados...")
+        classification_pending = False
         if req.lote_fiv_acasalamento_id and req.media_id:
             try:
-                _save_scores_to_db(sb, req, embryo_results, bboxes, job_dir)
+                with clock.stage("save"):
+                    classification_pending = _save_scores_to_db(
+                        sb, req, embryo_results, bboxes, job_dir, knn=not defer)
             except Exception as e:
                 logger.error(f"Failed to save scores to DB: {e}")
                 # Update queue with error but don't fail the response
@@ -961,11 +1985,20 @@ async def analyze(req: AnalyzeRequest, request: Request = None):
                 except Exception as db_err:
                     logger.error(f"CRITICAL: Could not update queue status to failed: {db_err}")
 
-        _update_progress(sb, effective_job_id, None)  # Clear progress on success
+        progress.close(None)  # Clear progress on success
+        _maybe_redrive_classifications(sb_url, sb_key)
+        timings = clock.log(effective_job_id)
+        budget.learn(timings, len(bboxes), len(embryo_results), sampler.frames_decoded,
+                     orig_w * orig_h / 1e6, frames_sampled, vid_w * vid_h / 1e6)
         return {
             "plate_frame_path": f"{job_dir}/plate_frame.jpg",
             "bboxes": bboxes,
             "embryos": embryo_results,
+            "timings": timings,
+            "budget": budget.report(sorted(deferred)),
+            # Saved with pending classification (deferred, deadline-cut or Gemini
+            # "Pending"): the caller triggers POST /classify, else the re-drive sweep does
+            "classification_pending": classification_pending,
         }
 
     except HTTPException:
@@ -973,6 +2006,7 @@ async def analyze(req: AnalyzeRequest, request: Request = None):
     except Exception as e:
         # Global catch: any unhandled crash marks job as failed with useful message
         logger.error(f"Pipeline crashed for job {effective_job_id}: {e}", exc_info=True)
+        progress.cancel()  # The failure update below clears progress_message
         try:
             sb.table('embryo_analysis_queue').update({
                 'status': 'failed',
@@ -984,10 +2018,301 @@ async def analyze(req: AnalyzeRequest, request: Request = None):
             pass
         raise HTTPException(500, f"Pipeline error: {str(e)[:200]}")
     finally:
+        progress.close()  # No-op after the paths above; flushes on early HTTP errors
         if tmp_path and os.path.exists(tmp_path):
             os.remove(tmp_path)
 
 
+# ─── Deferred classification ─────────────────────────────
+
+class ClassifyRequest(BaseModel):
+    queue_id: str
+    supabase_url: Optional[str] = None
+    supabase_key: Optional[str] = None
+
+
+def _claim_classification(sb, queue_id: str) -> str | None:
+    """Move the job's classification_status pending → processing. None if claimed, else why not."""
+    now = datetime.utcnow().isoformat()
+    claim = sb.table('embryo_analysis_queue').update({
+        'classification_status': 'processing',
+        'classification_started_at': now,
+    }).eq('id', queue_id).eq('classification_status', 'pending').execute()
+    if claim.data:
+        return None
+
+    job_check = sb.table('embryo_analysis_queue').select(
+        'classification_status, classification_started_at'
+    ).eq('id', queue_id).single().execute()
+    if not job_check.data:
+        raise HTTPException(404, f"Job not found: {queue_id}")
+    status = job_check.data.get('classification_status')
+    if status != 'processing':
+        return f"Nothing to classify (classification_status={status})"
+    started = job_check.data.get('classification_started_at')
+    if started:
+        elapsed = time.time() - parse_timestamp(started).timestamp()
+        if elapsed < REQUEST_TIMEOUT_SECONDS:
+            return "Already classifying on another instance"
+    logger.warning(f"Classification of {queue_id} appears stale, reclaiming...")
+    sb.table('embryo_analysis_queue').update({
+        'classification_started_at': now,
+    }).eq('id', queue_id).execute()
+    return None
+
+
+def _load_pending_scores(sb, queue_id: str) -> list[dict]:
+    """Current embryo_scores rows of this job still waiting for Gemini, in embryo order."""
+    embryos = sb.table('embrioes').select('id').eq(
+        'queue_id', queue_id
+    ).order('identificacao').execute().data or []
+    if not embryos:
+        return []
+    order = {e['id']: i for i, e in enumerate(embryos)}
+    rows = sb.table('embryo_scores').select(
+        f'id, embriao_id, crop_image_path, motion_map_path, kinetic_inputs, {_embedding_layout()[1]}, '
+        'kinetic_intensity, kinetic_harmony, kinetic_stability'
+    ).in_('embriao_id', list(order)).eq('is_current', True).eq(
+        'classification_status', 'pending'
+    ).execute().data or []
+    return sorted(rows, key=lambda r: order[r['embriao_id']])
+
+
+def _pending_knn_fields(sb, rows: list, job_id: str) -> list:
+    """KNN columns per pending score row (None without an embedding), in one lookup."""
+    queries, positions = [], []
+    column = _embedding_layout()[1]
+    for i, row in enumerate(rows):
+        embedding = row.get(column)
+        if isinstance(embedding, str):
+            embedding = json.loads(embedding)
+        if embedding:
+            positions.append(i)
+            queries.append((embedding, row.get("kinetic_intensity") or 0.0,
+                            row.get("kinetic_harmony") or 0.0, row.get("kinetic_stability") or 0.0))
+    fields = [None] * len(rows)
+    for i, knn_fields in zip(positions, _knn_score_fields_batch(sb, queries, job_id)):
+        fields[i] = knn_fields
+    return fields
+
+
+def _pending_score_to_result(row: dict, index: int, crop_jpg: bytes, motion_jpg: bytes) -> dict:
+    """Rebuild the per-embryo dict _classify_embryo_results expects from a stored score."""
+    inputs = row.get('kinetic_inputs') or {}
+    return {
+        "index": index,
+        "activity_score": inputs.get("activity_score", 0),
+        "nsd": inputs.get("nsd", row.get("kinetic_intensity") or 0.0),
+        "anr": inputs.get("anr", 0.0),
+        "kinetic_profile": inputs.get("kinetic_profile") or {},
+        "_crop_jpg": crop_jpg,
+        "_motion_jpg": motion_jpg,
+    }
+
+
+@app.post("/classify")
+def classify(req: ClassifyRequest, request: Request = None):
+    """Finish a job saved with pending classification (CLASSIFY_MODE=deferred,
+    or embryos /analyze deferred for lack of time).
+
+    Reads each pending embryo's stored crop + heatmap from the embryoscore
+    bucket, calls Gemini, runs the KNN lookup and completes its embryo_scores
+    row. Only I/O: meant for cheap instances, separate from the CPU-heavy
+    /analyze ones. Whatever doesn't fit the request budget stays pending for
+    the next call (the caller's retry or the re-drive sweep). Plain def —
+    FastAPI runs it in its thread pool.
+    """
+    if request is not None:
+        _check_api_key(request)
+    budget = _DeadlineBudget()
+    clock = _StageClock()
+
+    sb_url = req.supabase_url or os.environ.get("SUPABASE_URL", "")
+    sb_key = req.supabase_key or os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
+    if not sb_url or not sb_key:
+        raise HTTPException(500, "Supabase credentials not configured")
+    sb = _get_supabase(sb_url, sb_key)
+
+    skipped = _claim_classification(sb, req.queue_id)
+    if skipped:
+        return {"message": skipped, "queue_id": req.queue_id}
+
+    classified, still_pending = 0, 0
+    progress = _ProgressReporter(sb, req.queue_id)
+    try:
+        config = _load_score_config(sb)
+        gemini_key = _load_gemini_key(sb, os.environ.get("GEMINI_API_KEY", ""))
+        if not gemini_key:
+            raise HTTPException(500, "Gemini API key not configured")
+        creq = AnalyzeRequest(
+            queue_id=req.queue_id, job_id=req.queue_id, gemini_api_key=gemini_key,
+            prompt=config.get('calibration_prompt'),
+            model_name=config.get('model_name') or 'gemini-2.5-flash',
+        )
+
+        with clock.stage("load"):
+            _check_native_embeddings(sb)
+            rows = _load_pending_scores(sb, req.queue_id)
+        if rows:
+            progress.update(f"Classificando {len(rows)} embrião(ões) com IA...")
+
+        workers = _gemini_limiter(gemini_key).concurrency()
+        gemini_deadline = budget.gemini_deadline(len(rows))
+        classify_group = clock.timed("gemini", _classify_embryo_results)
+        download = clock.timed("download", _download_from_storage)
+        with ThreadPoolExecutor(max_workers=PIPELINE_UPLOAD_WORKERS) as io_pool, \
+                ThreadPoolExecutor(max_workers=workers) as gemini_pool:
+            fetches = {
+                io_pool.submit(lambda r: (download(sb, r['crop_image_path']),
+                                          download(sb, r['motion_map_path'])), row): i
+                for i, row in enumerate(rows)
+            }
+            # KNN needs only the stored embeddings: the whole job in one lookup,
+            # alongside the image downloads
+            knn_future = io_pool.submit(clock.timed("knn", _pending_knn_fields), sb, rows, req.queue_id)
+            gemini_futures, group = {}, []
+
+            def submit_group(group):
+                if budget.take_gemini_slot(len(rows), workers):
+                    gemini_futures[gemini_pool.submit(
+                        classify_group, group, creq, gemini_deadline, sb)] = group
+
+            for future in as_completed(fetches):
+                i = fetches[future]
+                try:
+                    crop_jpg, motion_jpg = future.result()
+                except Exception as e:
+                    logger.error(f"Embryo {i}: could not read stored images: {e}")
+                    continue
+                group.append(_pending_score_to_result(rows[i], i, crop_jpg, motion_jpg))
+                if len(group) >= max(1, GEMINI_BATCH_SIZE):
+                    submit_group(group)
+                    group = []
+            if group:
+                submit_group(group)
+
+            for future in as_completed(gemini_futures):
+                group = gemini_futures[future]
+                try:
+                    analyses = future.result()
+                except Exception as e:
+                    logger.error(f"Gemini failed for embryos {[r['index'] for r in group]}: {e}")
+                    continue  # Rows stay pending
+                for result, analysis in zip(group, analyses):
+                    fields = _gemini_score_fields(analysis)
+                    if fields["classification_status"] == "pending":
+                        continue
+                    row = rows[result["index"]]
+                    fields.update(knn_future.result()[result["index"]] or {})
+                    with clock.stage("save"):
+                        sb.table('embryo_scores').update(fields).eq('id', row['id']).execute()
+                    classified += 1
+                    progress.update(f"Classificados {classified}/{len(rows)} embrião(ões)...")
+
+        still_pending = len(rows) - classified
+        progress.cancel()  # Final update below clears progress_message
+        sb.table('embryo_analysis_queue').update({
+            'classification_status': 'pending' if still_pending else 'done',
+            'progress_message': None,
+        }).eq('id', req.queue_id).execute()
+        logger.info(f"Job {req.queue_id}: classified {classified}/{len(rows)}, {still_pending} still pending")
+        _maybe_redrive_classifications(sb_url, sb_key)
+        return {
+            "queue_id": req.queue_id,
+            "classified": classified,
+            "pending": still_pending,
+            "timings": clock.log(req.queue_id),
+            "budget": budget.report([]),
+        }
+    except Exception as e:
+        # Release the claim: the rows are untouched or completed one by one
+        progress.cancel()
+        try:
+            sb.table('embryo_analysis_queue').update({
+                'classification_status': 'pending',
+                'progress_message': None,
+            }).eq('id', req.queue_id).execute()
+        except Exception:
+            pass
+        if isinstance(e, HTTPException):
+            raise
+        logger.error(f"Classification crashed for job {req.queue_id}: {e}", exc_info=True)
+        raise HTTPException(500, f"Classification error: {str(e)[:200]}")
+
+
+def _stale_classification_jobs(sb, limit: int) -> list[str]:
+    """Oldest jobs still pending (or stuck processing) classification past the grace period."""
+    now = datetime.utcnow()
+    rows = sb.table('embryo_analysis_queue').select('id').in_(
+        'classification_status', ['pending', 'processing']
+    ).lt('completed_at', (now - timedelta(seconds=CLASSIFY_REDRIVE_AFTER_SECONDS)).isoformat()).gt(
+        'completed_at', (now - timedelta(hours=CLASSIFY_REDRIVE_MAX_AGE_HOURS)).isoformat()
+    ).order('completed_at').limit(limit).execute().data or []
+    return [row['id'] for row in rows]
+
+
+def _redrive_classifications(sb_url: str, sb_key: str, limit: int = CLASSIFY_REDRIVE_BATCH) -> list:
+    """One sweep: /classify for each stale job, one after the other. Instances may
+    sweep at the same time — _claim_classification lets only one through per job."""
+    sb = _get_supabase(sb_url, sb_key)
+    results = []
+    for queue_id in _stale_classification_jobs(sb, limit):
+        try:
+            results.append(classify(ClassifyRequest(
+                queue_id=queue_id, supabase_url=sb_url, supabase_key=sb_key)))
+        except Exception as e:
+            detail = getattr(e, 'detail', None) or str(e)
+            logger.warning(f"Re-drive of classification {queue_id} failed: {detail}")
+            results.append({"queue_id": queue_id, "error": str(detail)[:200]})
+    return results
+
+
+_redrive_lock = threading.Lock()
+_redrive_last = float("-inf")  # monotonic time of the last opportunistic sweep
+
+
+def _maybe_redrive_classifications(sb_url: str, sb_key: str):
+    """Opportunistic sweep after a request: background thread, at most once per interval."""
+    global _redrive_last
+    if CLASSIFY_REDRIVE_INTERVAL_SECONDS <= 0 or not sb_url or not sb_key:
+        return
+    with _redrive_lock:
+        now = time.monotonic()
+        if now - _redrive_last < CLASSIFY_REDRIVE_INTERVAL_SECONDS:
+            return
+        _redrive_last = now
+
+    def _sweep():
+        try:
+            results = _redrive_classifications(sb_url, sb_key)
+        except Exception as e:
+            logger.warning(f"Classification re-drive sweep failed: {e}")
+            return
+        if results:
+            logger.info(f"Classification re-drive: {results}")
+
+    threading.Thread(target=_sweep, name="classify-redrive", daemon=True).start()
+
+
+class RedriveRequest(BaseModel):
+    limit: int = CLASSIFY_REDRIVE_BATCH
+    supabase_url: Optional[str] = None
+    supabase_key: Optional[str] = None
+
+
+@app.post("/classify/redrive")
+def classify_redrive(req: RedriveRequest, request: Request = None):
+    """Classify the stale pending jobs now (one sweep), for a scheduler.
+    Plain def — FastAPI runs it in its thread pool."""
+    if request is not None:
+        _check_api_key(request)
+    sb_url = req.supabase_url or os.environ.get("SUPABASE_URL", "")
+    sb_key = req.supabase_key or os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
+    if not sb_url or not sb_key:
+        raise HTTPException(500, "Supabase credentials not configured")
+    return {"jobs": _redrive_classifications(sb_url, sb_key, max(0, req.limit))}
+
+
 # ═══════════════════════════════════════════════════════════
 # OCR — Report digitization via Gemini 2.0 Flash Vision
 # ═══════════════════════════════════════════════════════════
@@ -1455,33 +2780,35 @@ async def ocr_endpoint(req: OcrRequest):
 
     # 4. Call Gemini 3 Flash Vision
     model_name = "gemini-3-flash-preview"
-    gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={gemini_api_key}"
-
-    gemini_payload = {
-        "system_instruction": {"parts": [{"text": prompt}]},
-        "contents": [{
-            "parts": [
-                {"inline_data": {"mime_type": req.mime_type, "data": req.image_base64}},
-                {"text": "Extraia todos os dados desta foto de relatório de campo. Retorne no formato JSON especificado."},
-            ],
-        }],
-        "generation_config": {
-            "temperature": 0.1,
-            "max_output_tokens": 8192,
-            "response_mime_type": "application/json",
-            "response_schema": _get_ocr_response_schema(req.report_type),
-        },
+    parts = [
+        # Already base64 from the client — passed through untouched
+        {"inline_data": {"mime_type": req.mime_type, "data": req.image_base64}},
+        text_part("Extraia todos os dados desta foto de relatório de campo. Retorne no formato JSON especificado."),
+    ]
+    generation_config = {
+        "temperature": 0.1,
+        "max_output_tokens": 8192,
+        "response_mime_type": "application/json",
+        "response_schema": _get_ocr_response_schema(req.report_type),
     }
 
+    # OCR has its own key (and quota) unless it falls back to GEMINI_API_KEY
+    limiter = _gemini_limiter(gemini_api_key, GEMINI_OCR_RPM, GEMINI_OCR_TPM)
+    admitted = await asyncio.to_thread(limiter.acquire, GEMINI_EST_TOKENS, time.time() + 30)
+    if not admitted:
+        raise HTTPException(429, "Gemini rate limit — tente novamente em instantes")
     try:
-        gemini_resp = http_requests.post(gemini_url, json=gemini_payload, timeout=45)
-    except http_requests.exceptions.Timeout:
+        gemini_data = await _get_gemini_http().agenerate_content(
+            model_name, gemini_api_key, parts,
+            generation_config=generation_config, system_instruction=prompt, timeout=45)
+    except httpx.TimeoutException:
         raise HTTPException(504, "Gemini timeout (45s)")
+    except GeminiHTTPError as e:
+        if e.code == 429:
+            limiter.pause(retry_delay(e) or 10)
+        raise HTTPException(502, str(e))
 
-    if not gemini_resp.ok:
-        raise HTTPException(502, f"Gemini API error ({gemini_resp.status_code}): {gemini_resp.text[:500]}")
-
-    gemini_data = gemini_resp.json()
+    limiter.settle(GEMINI_EST_TOKENS, total_tokens(gemini_data))
     candidate = (gemini_data.get("candidates") or [{}])[0]
     raw_text = (candidate.get("content", {}).get("parts") or [{}])[0].get("text", "")
     finish_reason = candidate.get("finishReason", "UNKNOWN")
@@ -1608,6 +2935,7 @@ async def analyze_activity(request_data: dict = {}):
     output_size = request_data.get("output_size", 400)
     overlay_opacity = request_data.get("overlay_opacity", 0.4)
     skip_composites = request_data.get("skip_composites", False)
+    bg_sample_budget = request_data.get("bg_sample_budget", BG_SAMPLE_BUDGET)
 
     if not video_url:
         raise HTTPException(400, "video_url is required")
@@ -1648,7 +2976,7 @@ async def analyze_activity(request_data: dict = {}):
             raise HTTPException(422, "Too few frames")
 
         bg_std, bg_timeline, wide_diffs = _compute_background_noise(
-            gray_frames, bboxes, vid_w, vid_h, fps)
+            gray_frames, bboxes, vid_w, vid_h, fps, bg_sample_budget)
 
         embryo_results = []
         activity_scores = []
@@ -1933,8 +3261,13 @@ def _detect_embryos_opencv(frame: np.ndarray, expected_count: int = 0) -> list[d
 def _compute_background_noise(
     gray_frames: list, bboxes: list[dict],
     vid_w: int, vid_h: int, fps: float,
+    bg_budget: int = BG_SAMPLE_BUDGET,
 ) -> tuple[float, list[float], list[np.ndarray]]:
-    """Compute camera noise floor and per-frame background motion."""
+    """Compute camera noise floor and per-frame background motion.
+
+    Background pixels come from _background_sample_index (sparse grid, at most
+    bg_budget pixels; 0 = every background pixel).
+    """
     gap = max(1, int(fps))
     wide_diffs = []
     for i in range(gap, len(gray_frames)):
@@ -1950,17 +3283,17 @@ def _compute_background_noise(
         br = max(bbw, bbh) // 2
         cv2.circle(all_mask, (bcx, bcy), int(br * 1.3), 255, -1)
 
-    bg_indices = all_mask == 0
+    bg_index = _background_sample_index(all_mask, bg_budget)
     bg_std = 0.0
     bg_timeline = [0.0] * len(wide_diffs)
 
-    if int(np.sum(bg_indices)) > 100:
+    if bg_index.size > 100:
         # Welford's online variance — O(1) extra memory instead of O(N*pixels)
         n = 0
         mean_acc = None
         m2_acc = None
         for g in gray_frames:
-            pixels = g[bg_indices].astype(np.float32)
+            pixels = g.reshape(-1).take(bg_index).astype(np.float32)
             n += 1
             if mean_acc is None:
                 mean_acc = pixels.copy()
@@ -1976,7 +3309,7 @@ def _compute_background_noise(
         del mean_acc, m2_acc
 
         bg_timeline = [
-            float(np.mean(wd[bg_indices].astype(np.float32)))
+            float(np.mean(wd.reshape(-1).take(bg_index).astype(np.float32)))
             for wd in wide_diffs
         ]
 
@@ -2092,34 +3425,166 @@ def _compute_temporal_stability(profile: dict) -> float:
 
 
 
+# ─── Gemini rate limiting and result cache (gemini_quota.py) ───
+
+_gemini_limiters: dict[str, GeminiRateLimiter] = {}
+_gemini_limiters_lock = threading.Lock()
+
+
+def _gemini_limiter(api_key: str, rpm: int = GEMINI_RPM, tpm: int = GEMINI_TPM) -> GeminiRateLimiter:
+    """The limiter for this API key (created on first use with the given quota)."""
+    with _gemini_limiters_lock:
+        limiter = _gemini_limiters.get(api_key)
+        if limiter is None:
+            limiter = _gemini_limiters[api_key] = GeminiRateLimiter(
+                rpm, tpm, GEMINI_CALL_SECONDS, GEMINI_MAX_CONCURRENCY)
+        return limiter
+
+
+_gemini_cache = GeminiResultCache(GEMINI_CACHE_SIZE, GEMINI_CACHE_TABLE)
+
+
+_GEMINI_TIMEOUT_RESULT = {
+    "classification": "Pending",
+    "reasoning": "Timeout — reprocesse quando possível",
+    "confidence": "low",
+}
+
+_GEMINI_DEFERRED_RESULT = {
+    "classification": "Pending",
+    "reasoning": "Classificação pendente — etapa /classify",
+    "confidence": "low",
+}
+
+_GEMINI_UNAVAILABLE_RESULT = {
+    "classification": "Pending",
+    "reasoning": "Gemini indisponível — reprocesse quando possível",
+    "confidence": "low",
+    "stage_code": None,
+    "quality_grade": None,
+    "visual_features": None,
+    "kinetic_assessment": None,
+}
+
+
+def _gemini_retry(call, api_key: str, max_retries: int = 3):
+    """Run call() under the Gemini retry policy; re-raises the last error.
+
+    429s wait for the server's retry hint (and pause the key for every worker);
+    other errors back off exponentially with jitter. GeminiDeadlineExceeded is
+    never retried.
+    """
+    for attempt in range(max_retries):
+        try:
+            return call()
+        except GeminiDeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.warning(f"Gemini attempt {attempt+1}/{max_retries}: {e}")
+            if attempt == max_retries - 1:
+                raise
+            if is_rate_limit_error(e):
+                delay = retry_delay(e) or 2 ** (attempt + 1)
+                _gemini_limiter(api_key).pause(delay)
+            else:
+                delay = 2 ** attempt
+            time.sleep(delay + random.uniform(0, 0.5))
+
+
 def _call_gemini_with_retry(
     crop_jpg: bytes, motion_jpg: bytes,
     api_key: str, prompt: str | None, model_name: str,
     activity_score: int, kinetic_profile: dict,
     nsd: float, anr: float,
     max_retries: int = 3,
+    deadline: float | None = None,
 ) -> dict:
-    """Call Gemini with exponential backoff retry."""
-    for attempt in range(max_retries):
-        try:
-            return _analyze_with_gemini(
+    """Call Gemini through the key's rate limiter, with retry (see _gemini_retry)."""
+    try:
+        return _gemini_retry(
+            lambda: _analyze_with_gemini(
                 crop_jpg, motion_jpg, api_key, prompt, model_name,
-                activity_score, kinetic_profile, nsd, anr,
+                activity_score, kinetic_profile, nsd, anr, deadline=deadline,
+            ),
+            api_key, max_retries,
+        )
+    except GeminiDeadlineExceeded as e:
+        logger.warning(f"Gemini skipped: {e}")
+        return dict(_GEMINI_TIMEOUT_RESULT)
+    except Exception:
+        return dict(_GEMINI_UNAVAILABLE_RESULT)
+
+
+def _classify_embryo_results(results: list[dict], req: AnalyzeRequest, deadline: float,
+                             sb=None) -> list[dict]:
+    """Gemini stage for a group of uploaded embryos. Consumes their JPEG bytes.
+
+    Embryos found in the result cache skip Gemini. The rest go out as a single
+    batched request when more than one remains; embryos the batch doesn't
+    answer fall back to one call each. The deadline is checked when the call
+    actually starts (it may have queued behind other groups).
+    """
+    items = [{
+        "index": r["index"],
+        "crop_jpg": r.pop("_crop_jpg", None),
+        "motion_jpg": r.pop("_motion_jpg", None),
+        "activity_score": r["activity_score"],
+        "kinetic_profile": r["kinetic_profile"],
+        "nsd": r["nsd"],
+        "anr": r["anr"],
+    } for r in results]
+    template = req.prompt or DEFAULT_GEMINI_PROMPT
+    keys = {it["index"]: _gemini_cache.key(
+        it["crop_jpg"], it["motion_jpg"],
+        _render_gemini_prompt(template, it["activity_score"], it["kinetic_profile"], it["nsd"], it["anr"]),
+        req.model_name,
+    ) for it in items}
+    batch_keys = {it["index"]: _gemini_cache.key(
+        it["crop_jpg"], it["motion_jpg"], _batch_cache_prompt(template, it), req.model_name,
+    ) for it in items}
+    answered = {}
+    for it in items:
+        hit = _gemini_cache.get([keys[it["index"]], batch_keys[it["index"]]], sb)
+        if hit is not None:
+            answered[it["index"]] = hit
+    if answered:
+        logger.info(f"Gemini cache hit for embryos {sorted(answered)}")
+    todo = [it for it in items if it["index"] not in answered]
+    if todo and time.time() > deadline:
+        logger.warning(f"Embryos {[it['index'] for it in todo]}: past the Gemini deadline, skipping")
+        return [answered.get(it["index"]) or dict(_GEMINI_TIMEOUT_RESULT) for it in items]
+
+    fresh = {}
+    if len(todo) > 1:
+        try:
+            fresh = _gemini_retry(
+                lambda: _analyze_batch_with_gemini(
+                    todo, req.gemini_api_key, req.prompt, req.model_name, deadline=deadline),
+                req.gemini_api_key, max_retries=2,
             )
+        except GeminiDeadlineExceeded as e:
+            logger.warning(f"Gemini batch skipped: {e}")
+            return [answered.get(it["index"]) or dict(_GEMINI_TIMEOUT_RESULT) for it in items]
         except Exception as e:
-            logger.warning(f"Gemini attempt {attempt+1}/{max_retries}: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)
-                continue
-            return {
-                "classification": "Pending",
-                "reasoning": "Gemini indisponível — reprocesse quando possível",
-                "confidence": "low",
-                "stage_code": None,
-                "quality_grade": None,
-                "visual_features": None,
-                "kinetic_assessment": None,
-            }
+            logger.warning(f"Gemini batch of {len(todo)} failed, falling back to single calls: {e}")
+        missing = [it["index"] for it in todo if it["index"] not in fresh]
+        if missing:
+            logger.warning(f"Gemini batch missing embryos {missing}, retrying them one by one")
+
+    for it in todo:
+        analysis = fresh.get(it["index"])
+        key = batch_keys[it["index"]]
+        if analysis is None:
+            analysis = _call_gemini_with_retry(
+                it["crop_jpg"], it["motion_jpg"],
+                req.gemini_api_key, req.prompt, req.model_name,
+                it["activity_score"], it["kinetic_profile"], it["nsd"], it["anr"],
+                deadline=deadline,
+            )
+            key = keys[it["index"]]
+        _gemini_cache.put(key, analysis, req.model_name, sb)
+        answered[it["index"]] = analysis
+    return [answered[it["index"]] for it in items]
 
 
 
@@ -2128,33 +3593,78 @@ def _call_gemini_with_retry(
 # DINOv2 EMBEDDING (ONNX)
 # ═══════════════════════════════════════════════════════════
 
-def _get_embedding(image: np.ndarray) -> list[float]:
-    """Generate DINOv2 embedding via ONNX Runtime. Returns 384-dim vector."""
-    if ort_session is None:
-        return [0.0] * 384
+_IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+_IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def _onnx_signature() -> dict:
+    """Input/output names and batch axis of the loaded DINOv2 graph, read once per session."""
+    global _ort_signature
+    if _ort_signature is None:
+        inputs = {inp.name: inp for inp in ort_session.get_inputs()}
+        image = inputs.get("image") or next(iter(inputs.values()))
+        batch = image.shape[0]
+        _ort_signature = {
+            "image": image.name,
+            # DINOv2 masks: (batch, num_patches) bool — False = visible (no masking)
+            "masks": "masks" in inputs,
+            "num_patches": (EMBED_INPUT_SIZE // 14) ** 2,  # 256 for ViT-S/14
+            # int = static batch (every run must be exactly that size); None = dynamic
+            "batch": batch if isinstance(batch, int) and batch > 0 else None,
+        }
+    return _ort_signature
+
+
+def _preprocess_for_dino(images: list[np.ndarray]) -> np.ndarray:
+    """BGR crops -> (N, 3, 224, 224) float32, ImageNet-normalized RGB.
+
+    Resize stays PIL bicubic per crop so embeddings match the reference atlas
+    (resampling is per-channel, so resizing BGR then flipping equals flipping
+    first). Channel flip, normalization and NCHW transpose run once over the
+    whole stack.
+    """
+    size = (EMBED_INPUT_SIZE, EMBED_INPUT_SIZE)
+    resized = np.empty((len(images), EMBED_INPUT_SIZE, EMBED_INPUT_SIZE, 3), dtype=np.uint8)
+    for i, img in enumerate(images):
+        resized[i] = np.asarray(Image.fromarray(img).resize(size, Image.BICUBIC))
+    batch = resized[..., ::-1].astype(np.float32)  # BGR -> RGB
+    batch *= 1.0 / (255.0 * _IMAGENET_STD)
+    batch -= _IMAGENET_MEAN / _IMAGENET_STD
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
 
-    # Preprocess: BGR->RGB, resize 224x224, normalize ImageNet
-    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    img = Image.fromarray(rgb).resize((224, 224))
-    arr = np.array(img, dtype=np.float32) / 255.0
-    arr = (arr - np.array([0.485, 0.456, 0.406])) / np.array([0.229, 0.224, 0.225])
-    arr = arr.transpose(2, 0, 1)[np.newaxis].astype(np.float32)  # (1, 3, 224, 224)
 
-    # Build input feed dynamically based on what the model expects
-    input_feed = {"image": arr}
-    input_names = [inp.name for inp in ort_session.get_inputs()]
-    if "masks" in input_names:
-        # DINOv2 masks: (batch, num_patches) bool — False = visible (no masking)
-        num_patches = (224 // 14) ** 2  # 256 for ViT-S/14
-        input_feed["masks"] = np.zeros((1, num_patches), dtype=bool)
+def _get_embedding(image: np.ndarray) -> list[float]:
+    """Generate DINOv2 embedding via ONNX Runtime. Returns 384-dim vector."""
+    return _get_embeddings_batch([image])[0]
 
-    result = ort_session.run(None, input_feed)
-    return result[0][0].tolist()
 
+def _get_embeddings_batch(images: list[np.ndarray], batch_size: int | None = None) -> list[list[float]]:
+    """Generate DINOv2 embeddings for a list of images, batch_size crops per run.
 
-def _get_embeddings_batch(images: list[np.ndarray]) -> list[list[float]]:
-    """Generate DINOv2 embeddings for a list of images."""
-    return [_get_embedding(img) for img in images]
+    A graph exported with a static batch axis fixes the chunk size; the last
+    chunk is zero-padded and the padding rows are dropped.
+    """
+    if ort_session is None:
+        return [[0.0] * 384 for _ in images]
+    if not images:
+        return []
+
+    sig = _onnx_signature()
+    chunk = sig["batch"] or max(1, batch_size or EMBED_BATCH_SIZE)
+    pixels = _preprocess_for_dino(images)
+
+    embeddings = []
+    for start in range(0, len(pixels), chunk):
+        part = pixels[start:start + chunk]
+        n = len(part)
+        if sig["batch"] and n < chunk:
+            part = np.concatenate([part, np.zeros((chunk - n,) + part.shape[1:], dtype=part.dtype)])
+        input_feed = {sig["image"]: part}
+        if sig["masks"]:
+            input_feed["masks"] = np.zeros((len(part), sig["num_patches"]), dtype=bool)
+        result = ort_session.run(None, input_feed)
+        embeddings.extend(result[0][:n].tolist())
+    return embeddings
 
 
 # ═══════════════════════════════════════════════════════════
@@ -2246,39 +3756,192 @@ def _extract_json_from_text(text: str) -> dict:
     raise ValueError(f"Could not extract JSON from response: {text[:300]}")
 
 
+_GEMINI_PROMPT_FIELDS = (
+    "activity_score", "nsd", "anr", "kinetic_quality", "core_activity",
+    "periphery_activity", "peak_zone", "temporal_pattern", "symmetry",
+)
+
+GEMINI_BATCH_HEADER = """Voce recebera {count} embrioes do mesmo video, identificados como EMBRIAO <indice>.
+Para CADA embriao ha duas imagens (IMAGEM 1 = melhor frame, IMAGEM 2 = mapa de calor cinetico)
+e os dados cineticos medidos DAQUELE embriao, logo apos as imagens.
+
+Avalie cada embriao de forma INDEPENDENTE (nao compare nem normalize entre eles),
+seguindo as instrucoes abaixo. Responda com um array JSON com exatamente um objeto
+por embriao, no formato descrito, com "embryo_index" igual ao indice informado.
+
+"""
+
+
+def _render_gemini_prompt(template: str, activity_score: int, kinetic_profile: dict,
+                          nsd: float, anr: float) -> str:
+    """Fill the per-embryo placeholders of a (default or calibration) prompt."""
+    prompt = template
+    prompt = prompt.replace("{activity_score}", str(activity_score))
+    prompt = prompt.replace("{nsd}", str(nsd))
+    prompt = prompt.replace("{anr}", str(anr))
+    prompt = prompt.replace("{kinetic_quality}", "N/A")  # Legacy fallback for custom prompts
+    prompt = prompt.replace("{core_activity}", str(kinetic_profile.get("core_activity", 0)))
+    prompt = prompt.replace("{periphery_activity}", str(kinetic_profile.get("periphery_activity", 0)))
+    prompt = prompt.replace("{peak_zone}", str(kinetic_profile.get("peak_zone", "unknown")))
+    prompt = prompt.replace("{temporal_pattern}", str(kinetic_profile.get("temporal_pattern", "unknown")))
+    prompt = prompt.replace("{symmetry}", str(kinetic_profile.get("activity_symmetry", 1.0)))
+    return prompt
+
+
+def _kinetic_data_block(activity_score: int, kinetic_profile: dict, nsd: float, anr: float) -> str:
+    """The measured-kinetics lines of DEFAULT_GEMINI_PROMPT, for one embryo of a batch."""
+    return _render_gemini_prompt(
+        "DADOS CINETICOS MEDIDOS (computacional, NAO visual):\n"
+        "- Activity score: {activity_score}/100\n"
+        "- NSD (desvio padrao normalizado): {nsd} (mais = mais ativo; embrioes mortos <5x menos)\n"
+        "- ANR (razao atividade/ruido): {anr} (>2 = atividade real acima do ruido de camera)\n"
+        "- Core activity: {core_activity}/100\n"
+        "- Periphery activity: {periphery_activity}/100\n"
+        "- Peak zone: {peak_zone}\n"
+        "- Temporal pattern: {temporal_pattern}\n"
+        "- Symmetry: {symmetry}",
+        activity_score, kinetic_profile, nsd, anr)
+
+
+def _batch_instructions(template: str) -> str:
+    """A prompt template without its per-embryo data lines (sent once per batch)."""
+    placeholder_line = r"^.*\{(" + "|".join(_GEMINI_PROMPT_FIELDS) + r")\}.*(\n|$)"
+    return re.sub(placeholder_line, "", template, flags=re.MULTILINE)
+
+
+def _batch_cache_prompt(template: str, item: dict) -> str:
+    """Everything a batched call asks about one embryo — header, instructions, its data
+    block and the response schema. Result-cache key text for answers from a batch."""
+    return "\n".join((
+        GEMINI_BATCH_HEADER,
+        _batch_instructions(template),
+        _kinetic_data_block(item["activity_score"], item["kinetic_profile"], item["nsd"], item["anr"]),
+        json.dumps(_get_gemini_batch_response_schema(), sort_keys=True),
+    ))
+
+
+def _get_gemini_batch_response_schema() -> dict:
+    """Array of per-embryo assessments (same fields as the single-embryo JSON)."""
+    quality = {"type": "STRING", "enum": ["good", "fair", "poor"]}
+    return {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "embryo_index": {"type": "INTEGER"},
+                "classification": {
+                    "type": "STRING",
+                    "description": "BE, BN, BX, BL, BI, Mo ou Dg",
+                },
+                "stage_code": {"type": "INTEGER", "nullable": True},
+                "quality_grade": {"type": "INTEGER", "nullable": True},
+                "reasoning": {"type": "STRING"},
+                "visual_features": {
+                    "type": "OBJECT",
+                    "properties": {
+                        "mci_quality": quality,
+                        "trophectoderm_quality": quality,
+                        "zona_pellucida_intact": {"type": "BOOLEAN"},
+                        "extruded_cells": {"type": "BOOLEAN"},
+                        "debris_in_zona": {"type": "BOOLEAN"},
+                        "dark_cytoplasm": {"type": "BOOLEAN"},
+                        "shape": {"type": "STRING", "enum": ["spherical", "oval", "irregular"]},
+                    },
+                },
+                "kinetic_assessment": {"type": "STRING"},
+                "confidence": {"type": "STRING", "enum": ["high", "medium", "low"]},
+            },
+            "required": ["embryo_index", "classification", "reasoning", "confidence"],
+        },
+    }
+
+
+def _analyze_batch_with_gemini(
+    items: list[dict], api_key: str, custom_prompt: str | None, model_name: str,
+    deadline: float | None = None,
+) -> dict[int, dict]:
+    """One Gemini call for several embryos. Returns {embryo index: assessment}.
+
+    The prompt's instructions go out once; its per-embryo data lines are
+    dropped and sent after each embryo's labeled image pair instead. Entries
+    the model omits (or labels with an unknown index) are simply absent.
+    """
+    try:
+        instructions = _batch_instructions(custom_prompt or DEFAULT_GEMINI_PROMPT)
+        parts = [text_part(GEMINI_BATCH_HEADER.replace("{count}", str(len(items))) + instructions)]
+        for it in items:
+            parts += [
+                text_part(f"EMBRIAO {it['index']} — IMAGEM 1 (melhor frame):"),
+                jpeg_part(it["crop_jpg"]),
+                text_part(f"EMBRIAO {it['index']} — IMAGEM 2 (mapa de calor cinetico):"),
+                jpeg_part(it["motion_jpg"]),
+                text_part(f"EMBRIAO {it['index']} — " + _kinetic_data_block(
+                    it["activity_score"], it["kinetic_profile"], it["nsd"], it["anr"])),
+            ]
+
+        limiter = _gemini_limiter(api_key)
+        est_tokens = GEMINI_EST_TOKENS * len(items)
+        if not limiter.acquire(est_tokens, deadline):
+            raise GeminiDeadlineExceeded("rate-limit wait exceeds job deadline")
+        response = _get_gemini_http().generate_content(
+            model_name, api_key, parts,
+            generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": _get_gemini_batch_response_schema(),
+            },
+            timeout=30 + 10 * (len(items) - 1),
+        )
+        limiter.settle(est_tokens, total_tokens(response))
+
+        raw_text = response_text(response)
+        logger.info(f"Gemini batch raw response ({len(raw_text)} chars, {len(items)} embryos)")
+        entries = json.loads(raw_text)
+        if isinstance(entries, dict):  # Tolerate {"embryos": [...]}-style wrapping
+            entries = next((v for v in entries.values() if isinstance(v, list)), [entries])
+
+        wanted = {it["index"] for it in items}
+        answered = {}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            try:
+                idx = int(entry.pop("embryo_index"))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if idx in wanted and entry.get("classification"):
+                entry.setdefault("reasoning", "")
+                answered[idx] = entry
+        return answered
+
+    except Exception as e:
+        logger.error(f"Gemini batch error: {type(e).__name__}: {e}")
+        raise
+
+
 def _analyze_with_gemini(
     crop_jpg: bytes, motion_jpg: bytes,
     api_key: str, custom_prompt: str | None,
     model_name: str,
     activity_score: int, kinetic_profile: dict,
     nsd: float, anr: float,
+    deadline: float | None = None,
 ) -> dict:
     """Call Gemini with best frame + heatmap + kinetic data."""
     try:
-        _ensure_gemini(api_key)
-
-        prompt_template = custom_prompt or DEFAULT_GEMINI_PROMPT
-        prompt = prompt_template
-        prompt = prompt.replace("{activity_score}", str(activity_score))
-        prompt = prompt.replace("{nsd}", str(nsd))
-        prompt = prompt.replace("{anr}", str(anr))
-        prompt = prompt.replace("{kinetic_quality}", "N/A")  # Legacy fallback for custom prompts
-        prompt = prompt.replace("{core_activity}", str(kinetic_profile.get("core_activity", 0)))
-        prompt = prompt.replace("{periphery_activity}", str(kinetic_profile.get("periphery_activity", 0)))
-        prompt = prompt.replace("{peak_zone}", str(kinetic_profile.get("peak_zone", "unknown")))
-        prompt = prompt.replace("{temporal_pattern}", str(kinetic_profile.get("temporal_pattern", "unknown")))
-        prompt = prompt.replace("{symmetry}", str(kinetic_profile.get("activity_symmetry", 1.0)))
-
-        crop_image = Image.open(io.BytesIO(crop_jpg))
-        motion_image = Image.open(io.BytesIO(motion_jpg))
-
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(
-            [prompt, crop_image, motion_image],
-            request_options={"timeout": 30}
+        prompt = _render_gemini_prompt(
+            custom_prompt or DEFAULT_GEMINI_PROMPT, activity_score, kinetic_profile, nsd, anr)
+
+        limiter = _gemini_limiter(api_key)
+        if not limiter.acquire(GEMINI_EST_TOKENS, deadline):
+            raise GeminiDeadlineExceeded("rate-limit wait exceeds job deadline")
+        response = _get_gemini_http().generate_content(
+            model_name, api_key,
+            [text_part(prompt), jpeg_part(crop_jpg), jpeg_part(motion_jpg)],
+            timeout=30,
         )
+        limiter.settle(GEMINI_EST_TOKENS, total_tokens(response))
 
-        raw_text = response.text
+        raw_text = response_text(response)
         logger.info(f"Gemini raw response ({len(raw_text)} chars): {raw_text[:200]}")
 
         result = _extract_json_from_text(raw_text)
@@ -2326,76 +3989,486 @@ def _map_quality_grade_to_classification(quality_grade, iets_code: str) -> str:
         return "Regular"
 
 
-def _do_knn_lookup(sb, embedding: list, kinetic_intensity: float,
-                   kinetic_harmony: float, kinetic_stability: float,
-                   min_refs: int = 5) -> dict:
-    """KNN lookup via match_embryos_v2 RPC. Returns classification + votes."""
-    if not embedding or all(v == 0 for v in embedding):
-        return {"combined_source": "insufficient", "combined_classification": None,
-                "knn_classification": None, "knn_confidence": None, "knn_votes": {}}
+# ─── Atlas KNN index ─────────────────────────────────────
+
+# match_embryos_v2 arguments used by the pipeline (the local index reproduces them)
+_KNN_PARAMS = {"match_count": 10, "visual_top_n": 30, "alpha": 0.7, "beta": 0.3, "min_similarity": 0.50}
+# embryo_references / embryo_scores column per embedding model
+_EMBEDDING_COLUMNS = {"dinov2_vits14": "embedding_vits14", "dinov2_vitb14": "embedding_vitb14"}
+
+
+# None until probed; False once embryo_scores turned out to lack the native columns
+# (native_embeddings migration not applied): this process then writes the padded layout,
+# which that migration's trigger routes into the model column once it is applied
+_native_embeddings_available = None
+
+
+def _embedding_layout() -> tuple:
+    """(model, column, dim) the pipeline stores and searches: its model's native
+    column, or (None, "embedding", 768) for the legacy zero-padded layout."""
+    if EMBEDDING_STORAGE == "padded" or _native_embeddings_available is False:
+        return None, "embedding", 768
+    return EMBEDDING_MODEL, _EMBEDDING_COLUMNS[EMBEDDING_MODEL], EMBEDDING_DIM
+
+
+def _native_column_error(err: Exception) -> bool:
+    """True when a PostgREST error names a native embedding column."""
+    msg = str(err)
+    return "embedding_model" in msg or any(c in msg for c in _EMBEDDING_COLUMNS.values())
+
+
+def _fall_back_to_padded(reason) -> None:
+    """Switch to the padded layout: writes, the projection and the atlas index follow."""
+    global _native_embeddings_available, _embedding_projection
+    if _native_embeddings_available is False:
+        return
+    logger.warning(f"Native embedding columns not found (apply 20261016000700_native_embeddings.sql); "
+                   f"storing zero-padded vector(768) embeddings: {reason}")
+    _native_embeddings_available = False
+    _embedding_projection = _load_embedding_projection()
+    model, column, dim = _embedding_layout()
+    _atlas_index.retarget(dim, column, model, _embedding_projection)
+
+
+def _check_native_embeddings(sb) -> None:
+    """Native storage: probe embryo_scores once for the model columns before the first
+    save. save_embryo_analysis_results ignores unknown keys, so without this probe a
+    database lacking the migration would silently drop every embedding."""
+    global _native_embeddings_available
+    if EMBEDDING_STORAGE == "padded" or _native_embeddings_available is not None:
+        return
+    _, column, _ = _embedding_layout()
+    try:
+        sb.table('embryo_scores').select(f'embedding_model, {column}').limit(1).execute()
+    except Exception as e:
+        if not _native_column_error(e):
+            logger.warning(f"Native embedding column probe failed, retrying on the next save: {e}")
+            return
+        _fall_back_to_padded(e)
+        return
+    _native_embeddings_available = True
+
+
+def _to_padded_layout(record: dict) -> dict:
+    """A record written with the native layout, rewritten for the legacy embedding column."""
+    record.pop("embedding_model", None)
+    for column in _EMBEDDING_COLUMNS.values():
+        value = record.pop(column, None)
+        if value is not None:
+            values = json.loads(value)
+            record["embedding"] = json.dumps(values + [0.0] * (768 - len(values)))
+    return record
+
+
+def _load_embedding_projection() -> EmbeddingProjection | None:
+    """EMBEDDING_PROJECTION_PATH, when it was fit for the embeddings the pipeline stores."""
+    if not EMBEDDING_PROJECTION_PATH:
+        return None
+    try:
+        projection = EmbeddingProjection.load(EMBEDDING_PROJECTION_PATH)
+    except (OSError, KeyError, ValueError) as e:
+        logger.error(f"Embedding projection {EMBEDDING_PROJECTION_PATH} not loaded: {e}")
+        return None
+    model, _, dim = _embedding_layout()
+    if projection.model != model or projection.source_dim != dim:
+        logger.error(f"Embedding projection {projection.version} is for {projection.model} "
+                     f"({projection.source_dim}-d), the pipeline stores {model} ({dim}-d); ignoring it")
+        return None
+    logger.info(f"Embedding projection {projection.version}: {dim} → {projection.dim} dims")
+    return projection
+
+
+# Import-time layout is native until _check_native_embeddings probes the database;
+# _fall_back_to_padded retargets the projection and the index if it must
+_atlas_model, _atlas_column, _atlas_dim = _embedding_layout()
+_embedding_projection = _load_embedding_projection()
+
+
+def _db_projection() -> EmbeddingProjection | None:
+    """The loaded projection when its vectors fit the embedding_reduced column."""
+    if _embedding_projection is not None and _embedding_projection.dim == REDUCED_EMBEDDING_DIM:
+        return _embedding_projection
+    return None
+
+
+_atlas_index = AtlasIndex(dim=_atlas_dim, dtype=np.float16 if ATLAS_INDEX_DTYPE == "float16" else np.float32,
+                          sync_every=ATLAS_SYNC_SECONDS, column=_atlas_column, model=_atlas_model,
+                          projection=_embedding_projection, candidate_factor=PROJECTION_CANDIDATE_FACTOR,
+                          projection_min_refs=PROJECTION_MIN_REFS,
+                          page_size=ATLAS_PAGE_SIZE, sync_overlap=ATLAS_SYNC_OVERLAP_SECONDS,
+                          snapshot_path=ATLAS_SNAPSHOT_PATH)
+
+
+def _load_atlas_index():
+    """Startup: probe the embedding layout (the index mirrors the column the pipeline
+    stores), then the snapshot (serves at once), then a sync against the env project."""
+    url = os.environ.get("SUPABASE_URL", "")
+    key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
+    try:
+        sb = _get_supabase(url, key) if url and key else None
+        if sb is not None:
+            _check_native_embeddings(sb)
+        if ATLAS_SNAPSHOT_PATH and os.path.exists(ATLAS_SNAPSHOT_PATH):
+            _atlas_index.load_npz(ATLAS_SNAPSHOT_PATH, scope=url or None)
+        if sb is not None:
+            _atlas_index.sync(sb)
+    except Exception as e:
+        logger.error(f"Atlas index load failed (KNN uses the match_embryos_batch RPC until the first sync): {e}")
+
+
+@app.on_event("startup")
+def _start_atlas_load():
+    if KNN_BACKEND == "local":
+        threading.Thread(target=_load_atlas_index, name="atlas-load", daemon=True).start()
+
+
+# ─── KNN lookup ──────────────────────────────────────────
+
+def _knn_insufficient(total_refs: int | None = None) -> dict:
+    result = {"combined_source": "insufficient", "combined_classification": None,
+              "knn_classification": None, "knn_confidence": None, "knn_votes": {}}
+    if total_refs is not None:
+        result["knn_real_bovine_count"] = total_refs
+    return result
+
+
+def _knn_vote(neighbors: list, total_refs: int) -> dict:
+    """Classification + votes from match_embryos_v2 neighbors."""
+    if not neighbors:
+        return _knn_insufficient(total_refs)
+
+    # Weighted voting by composite_score
+    votes: dict[str, float] = {}
+    for n in neighbors:
+        cls = n.get("classification") or "Unknown"
+        weight = n.get("composite_score", 0.5)
+        votes[cls] = votes.get(cls, 0) + weight
+
+    sorted_votes = sorted(votes.items(), key=lambda x: -x[1])
+    top_cls = sorted_votes[0][0]
+    total_weight = sum(v for _, v in sorted_votes)
+    confidence = round((sorted_votes[0][1] / max(total_weight, 0.01)) * 100)
+
+    # Integer vote counts for display
+    int_votes = {}
+    for n in neighbors:
+        cls = n.get("classification") or "Unknown"
+        int_votes[cls] = int_votes.get(cls, 0) + 1
+
+    return {
+        "combined_source": "knn",
+        "combined_classification": top_cls,
+        "combined_confidence": confidence,
+        "knn_classification": top_cls,
+        "knn_confidence": confidence,
+        "knn_votes": int_votes,
+        "knn_real_bovine_count": total_refs,
+        "knn_neighbor_ids": [n["id"] for n in neighbors],
+    }
+
+
+def _knn_lookup_batch(sb, queries: list, min_refs: int = 5, job_id: str | None = None) -> list:
+    """KNN for (embedding, kinetic_intensity, kinetic_harmony, kinetic_stability)
+    queries: one matmul on the in-memory atlas when it is loaded, else one
+    match_embryos_batch call (see _match_embryos_remote)."""
+    results = [_knn_insufficient() for _ in queries]
+    todo = [i for i, q in enumerate(queries) if q[0] and any(v != 0 for v in q[0])]
+    if not todo:
+        return results
+
+    try:
+        if KNN_BACKEND == "local" and _atlas_index.ready_for(sb):
+            total_refs = _atlas_index.n
+            if total_refs < min_refs:
+                return [_knn_insufficient(total_refs) if i in todo else r for i, r in enumerate(results)]
+            matches = _atlas_index.match_batch([queries[i][0] for i in todo],
+                                               [queries[i][1:] for i in todo], **_KNN_PARAMS)
+        else:
+            total_refs, matches = _match_embryos_remote(sb, [queries[i] for i in todo], min_refs, job_id)
+            if total_refs < min_refs:
+                return [_knn_insufficient(total_refs) if i in todo else r for i, r in enumerate(results)]
+    except Exception as e:
+        logger.warning(f"KNN lookup failed: {e}")
+        return results
+
+    for i, neighbors in zip(todo, matches):
+        if neighbors is not None:
+            results[i] = _knn_vote(neighbors, total_refs)
+    return results
+
+
+# False once match_embryos_batch is found missing (migration not applied yet)
+_knn_batch_rpc_available = True
+# embryo_references count per (project, job): one count per job on the per-query path
+_knn_ref_counts = _TTLCache("knn_ref_count", REQUEST_TIMEOUT_SECONDS, max_stale=REQUEST_TIMEOUT_SECONDS)
 
+
+def _match_embryos_remote(sb, queries: list, min_refs: int, job_id: str | None = None) -> tuple:
+    """(reference count, neighbors per query) from Postgres.
+
+    One match_embryos_batch call returns both. Without that function: the
+    count (cached for the job), then match_embryos_v2 per query unless the
+    atlas is below min_refs. A failed per-query call yields None.
+    """
+    global _knn_batch_rpc_available
+    model = _embedding_layout()[0]
+    count_key = (_cache_scope(sb), job_id)
+    if _knn_batch_rpc_available:
+        params = {
+            "query_embeddings": [str(q[0]) for q in queries],
+            "query_kinetics": [list(q[1:]) for q in queries],
+            **_KNN_PARAMS,
+            **({"query_model": model} if model else {}),
+        }
+        if _db_projection() is not None:
+            # Shortlist on the embedding_reduced HNSW index, re-rank at full dimension
+            params.update({
+                "query_projection": _embedding_projection.version,
+                "query_reduced": [_reduced_embedding_fields(q[0])["embedding_reduced"] for q in queries],
+                "candidate_count": _KNN_PARAMS["visual_top_n"] * PROJECTION_CANDIDATE_FACTOR,
+            })
+        try:
+            data = sb.rpc('match_embryos_batch', params).execute().data or {}
+        except Exception as e:
+            # PGRST202: function not in the schema cache, i.e. not deployed
+            if getattr(e, 'code', None) != 'PGRST202' and 'Could not find the function' not in str(e):
+                raise
+            logger.warning(f"match_embryos_batch unavailable, one match_embryos_v2 call per embryo: {e}")
+            _knn_batch_rpc_available = False
+        else:
+            total_refs = data.get("total_refs") or 0
+            if job_id:
+                _knn_ref_counts.put(count_key, total_refs)
+            return total_refs, data.get("neighbors") or [[] for _ in queries]
+
+    def _count():
+        query = sb.table('embryo_references').select('id', count='exact', head=True)
+        if model:
+            query = query.eq('embedding_model', model)  # Only this model's refs are comparable
+        return query.execute().count or 0
+    total_refs = _knn_ref_counts.get(count_key, _count) if job_id else _count()
+    if total_refs < min_refs:
+        return total_refs, []
+    return total_refs, [_match_embryos_rpc(sb, *q) for q in queries]
+
+
+def _match_embryos_rpc(sb, embedding: list, kinetic_intensity, kinetic_harmony,
+                       kinetic_stability) -> list | None:
+    """match_embryos_v3 (model column) or match_embryos_v2 (legacy column) neighbors
+    for one embedding; None when the call fails."""
+    model = _embedding_layout()[0]
     try:
-        ref_count = sb.table('embryo_references').select('id', count='exact', head=True).execute()
-        total_refs = ref_count.count or 0
-        if total_refs < min_refs:
-            return {"combined_source": "insufficient", "combined_classification": None,
-                    "knn_classification": None, "knn_confidence": None, "knn_votes": {},
-                    "knn_real_bovine_count": total_refs}
-
-        resp = sb.rpc('match_embryos_v2', {
+        return sb.rpc('match_embryos_v3' if model else 'match_embryos_v2', {
+            **({"query_model": model} if model else {}),
             "query_embedding": str(embedding),
             "query_kinetic_intensity": kinetic_intensity,
             "query_kinetic_harmony": kinetic_harmony,
             "query_kinetic_stability": kinetic_stability,
-            "match_count": 10,
-            "visual_top_n": 30,
-            "alpha": 0.7,
-            "beta": 0.3,
-            "min_similarity": 0.50,
-        }).execute()
-
-        neighbors = resp.data or []
-        if not neighbors:
-            return {"combined_source": "insufficient", "combined_classification": None,
-                    "knn_classification": None, "knn_confidence": None, "knn_votes": {},
-                    "knn_real_bovine_count": total_refs}
-
-        # Weighted voting by composite_score
-        votes: dict[str, float] = {}
-        for n in neighbors:
-            cls = n.get("classification") or "Unknown"
-            weight = n.get("composite_score", 0.5)
-            votes[cls] = votes.get(cls, 0) + weight
-
-        sorted_votes = sorted(votes.items(), key=lambda x: -x[1])
-        top_cls = sorted_votes[0][0]
-        total_weight = sum(v for _, v in sorted_votes)
-        confidence = round((sorted_votes[0][1] / max(total_weight, 0.01)) * 100)
-
-        # Integer vote counts for display
-        int_votes = {}
-        for n in neighbors:
-            cls = n.get("classification") or "Unknown"
-            int_votes[cls] = int_votes.get(cls, 0) + 1
-
-        return {
-            "combined_source": "knn",
-            "combined_classification": top_cls,
-            "combined_confidence": confidence,
-            "knn_classification": top_cls,
-            "knn_confidence": confidence,
-            "knn_votes": int_votes,
-            "knn_real_bovine_count": total_refs,
-            "knn_neighbor_ids": [n["id"] for n in neighbors],
-        }
+            **_KNN_PARAMS,
+        }).execute().data or []
     except Exception as e:
         logger.warning(f"KNN lookup failed: {e}")
-        return {"combined_source": "insufficient", "combined_classification": None,
-                "knn_classification": None, "knn_confidence": None, "knn_votes": {}}
+        return None
+
+
+# ── Allowed enum values (must match DB CHECK constraints) ──
+VALID_CLASSIFICATIONS = {"Excelente", "Bom", "Regular", "Borderline", "Inviavel"}
+VALID_CONFIDENCES = {"high", "medium", "low"}
+VALID_TRANSFER_RECS = {"priority", "recommended", "conditional", "second_opinion", "discard"}
+REC_MAP = {
+    "Excelente": "priority",
+    "Bom": "recommended",
+    "Regular": "conditional",
+    "Borderline": "second_opinion",
+    "Inviavel": "discard",
+}
+
+
+# Columns newer than some deployed schemas: dropped (with a warning) when the insert rejects them.
+# Native embedding columns are not dropped but rewritten to the padded layout (_to_padded_layout).
+_OPTIONAL_SCORE_COLUMNS = ("gemini_classification", "classification_status", "kinetic_inputs",
+                           "embedding_projection", "embedding_reduced",
+                           "embedding_model", *_EMBEDDING_COLUMNS.values())
+
+
+def _gemini_score_fields(gemini: dict) -> dict:
+    """embryo_scores columns derived from one Gemini assessment (validated enums).
+
+    A "Pending" assessment (deferred, timed out or Gemini unavailable) yields
+    classification_status 'pending', which /classify picks up later.
+    """
+    iets_code = gemini.get("classification") or "Unknown"
+    quality_grade = gemini.get("quality_grade")
+    assessed = iets_code not in ("Error", "Unknown", "Pending")
+
+    # ── Fix #2: Validate confidence enum ──
+    confidence_str = (gemini.get("confidence") or "low").lower().strip()
+    if confidence_str not in VALID_CONFIDENCES:
+        logger.warning(f"Invalid confidence '{confidence_str}' from Gemini, defaulting to 'low'")
+        confidence_str = "low"
+    ai_conf = 0.9 if confidence_str == "high" else 0.6 if confidence_str == "medium" else 0.3
+
+    # ── Fix #4: Validate classification enum ──
+    db_classification = _map_quality_grade_to_classification(quality_grade, iets_code)
+    if db_classification not in VALID_CLASSIFICATIONS:
+        logger.warning(f"Invalid classification '{db_classification}', defaulting to 'Regular'")
+        db_classification = "Regular"
+
+    # ── Fix #4: Validate transfer_recommendation enum ──
+    transfer_rec = REC_MAP.get(db_classification, "conditional")
+    if transfer_rec not in VALID_TRANSFER_RECS:
+        transfer_rec = "conditional"
+
+    return {
+        # Required NOT NULL columns — all validated against CHECK constraints
+        "classification": db_classification,
+        "confidence": confidence_str,
+        "embryo_score": round(ai_conf * 100),
+        "transfer_recommendation": transfer_rec,
+        # ── Fix #1: Save gemini_classification (IETS code) ──
+        "gemini_classification": iets_code if assessed else None,
+        "gemini_reasoning": gemini.get("reasoning"),
+        "stage_code": gemini.get("stage_code"),
+        "quality_grade": quality_grade,
+        "visual_features": gemini.get("visual_features") or None,
+        "ai_confidence": ai_conf,
+        # Summary includes IETS code for reference
+        "reasoning": f"Gemini: {iets_code} (grau {quality_grade})" if assessed else "Pendente",
+        "classification_status": "pending" if iets_code == "Pending" else "done",
+    }
+
+
+def _knn_score_fields_batch(sb, queries: list, job_id: str | None = None) -> list:
+    """embryo_scores KNN / combined columns for (stored embedding, kinetic
+    intensity, harmony, stability) queries, answered together."""
+    return [{
+        "combined_source": knn_result.get("combined_source"),
+        "combined_classification": knn_result.get("combined_classification"),
+        "combined_confidence": knn_result.get("combined_confidence"),
+        "knn_classification": knn_result.get("knn_classification"),
+        "knn_confidence": knn_result.get("knn_confidence"),
+        "knn_votes": knn_result.get("knn_votes"),
+        "knn_real_bovine_count": knn_result.get("knn_real_bovine_count"),
+    } for knn_result in _knn_lookup_batch(sb, queries, job_id=job_id)]
+
+
+def _stored_embedding(emb: dict) -> list | None:
+    """The embryo's embedding as stored (see _embedding_layout); None if absent or all zeros."""
+    embedding = emb.get("embedding") or []
+    if not embedding or all(v == 0 for v in embedding):
+        return None
+    dim = _embedding_layout()[2]
+    if len(embedding) < dim:
+        embedding = embedding + [0.0] * (dim - len(embedding))
+    return embedding
+
+
+def _score_record(emb: dict) -> dict:
+    """embryo_scores columns (without KNN) for one embryo result, keyed by its detection "index"."""
+    record = {
+        "index": emb["index"],
+        **_gemini_score_fields(emb.get("gemini_analysis") or {}),
+        # Storage paths
+        "crop_image_path": emb.get("crop_image_path"),
+        "motion_map_path": emb.get("motion_map_path"),
+        # Kinetics — NSD-based (scientific: PMC5695959, PMC9089758)
+        "kinetic_intensity": emb.get("nsd", 0.0),
+        "kinetic_harmony": (emb.get("kinetic_profile") or {}).get("activity_symmetry", 0.0),
+        "kinetic_stability": _compute_temporal_stability(emb.get("kinetic_profile") or {}),
+        "kinetic_bg_noise": emb.get("bg_std"),
+        # Gemini prompt inputs, so /classify can rebuild the prompt later
+        "kinetic_inputs": {
+            "activity_score": emb.get("activity_score", 0),
+            "nsd": emb.get("nsd", 0.0),
+            "anr": emb.get("anr", 0.0),
+            "kinetic_profile": emb.get("kinetic_profile") or {},
+        },
+    }
+
+    # Embedding: the model's column (or legacy padded 768), serialized as JSON string
+    embedding = _stored_embedding(emb)
+    if embedding:
+        model, column, _ = _embedding_layout()
+        record[column] = json.dumps(embedding)
+        if model:
+            record["embedding_model"] = model
+        if _db_projection() is not None:
+            record.update(_reduced_embedding_fields(embedding))
+    return record
+
+
+def _reduced_embedding_fields(embedding: list) -> dict:
+    """embedding_projection + embedding_reduced for one stored embedding (the atlas
+    trigger copies them into embryo_references with the embedding)."""
+    vec = np.asarray(embedding, dtype=np.float32)
+    reduced = _embedding_projection.project(vec / np.linalg.norm(vec))
+    return {
+        "embedding_projection": _embedding_projection.version,
+        "embedding_reduced": json.dumps(np.round(reduced, 6).tolist()),
+    }
 
 
-def _save_scores_to_db(sb, req, embryo_results: list, bboxes: list, job_dir: str):
-    """Save embryo scores directly to Supabase DB. Called from Cloud Run."""
+def _score_records(sb, embryo_results: list, knn: bool, job_id: str | None = None) -> list:
+    """_score_record per embryo plus, with knn, the whole plate's KNN columns in one lookup."""
+    records = [_score_record(emb) for emb in embryo_results]
+    if knn:
+        with_embedding = [(record, _stored_embedding(emb))
+                          for record, emb in zip(records, embryo_results)]
+        with_embedding = [(record, e) for record, e in with_embedding if e]
+        fields = _knn_score_fields_batch(sb, [
+            (e, record["kinetic_intensity"], record["kinetic_harmony"], record["kinetic_stability"])
+            for record, e in with_embedding], job_id)
+        for (record, _), knn_fields in zip(with_embedding, fields):
+            record.update(knn_fields)
+    return records
+
+
+# False once save_embryo_analysis_results is found missing (migration not applied yet)
+_save_rpc_available = True
+
+
+def _save_scores_to_db(sb, req, embryo_results: list, bboxes: list, job_dir: str,
+                       knn: bool = True):
+    """Save embryo scores directly to Supabase DB. Called from Cloud Run.
+
+    One save_embryo_analysis_results call does the insert, the is_current fence,
+    the atlas upsert and the job completion in a single transaction.
+    knn=False leaves the KNN columns to /classify (deferred classification).
+    Returns True when saved scores are left pending classification.
+    """
+    global _save_rpc_available
+    _check_native_embeddings(sb)
+    records = _score_records(sb, embryo_results, knn, req.job_id)
+    if _save_rpc_available:
+        try:
+            result = sb.rpc('save_embryo_analysis_results', {
+                'p_queue_id': req.job_id,
+                'p_result': {
+                    'plate_frame_path': f"{job_dir}/plate_frame.jpg",
+                    'detected_bboxes': bboxes,
+                    'media_id': req.media_id,
+                    'scores': records,
+                },
+            }).execute().data or {}
+        except Exception as e:
+            # PGRST202: function not in the schema cache, i.e. not deployed
+            if getattr(e, 'code', None) != 'PGRST202' and 'Could not find the function' not in str(e):
+                raise
+            logger.warning(f"save_embryo_analysis_results unavailable, saving step by step: {e}")
+            _save_rpc_available = False
+        else:
+            if result.get("skipped"):
+                logger.warning(f"No DB embryo at indices {result['skipped']}")
+            if result.get("atlas_error"):
+                logger.warning(f"Batch atlas upsert failed: {result['atlas_error']}")
+            logger.info(f"Saved {result.get('saved', 0)} scores to DB for job {req.job_id} "
+                        f"(atlas {result.get('atlas', 0)})")
+            return bool(result.get("classification_pending"))
+    return _save_scores_sequential(sb, req, records, bboxes, job_dir)
+
+
+def _save_scores_sequential(sb, req, records: list, bboxes: list, job_dir: str) -> bool:
+    """Pre-RPC save: the same writes as save_embryo_analysis_results, one request at a time."""
     # Fetch embryos linked to THIS job (by queue_id) — each video has its own set
     resp = sb.table('embrioes').select('id, classificacao').eq(
         'queue_id', req.job_id
@@ -2408,113 +4481,29 @@ def _save_scores_to_db(sb, req, embryo_results: list, bboxes: list, job_dir: str
         'detected_bboxes': bboxes,
     }).eq('id', req.job_id).execute()
 
-    if not embryo_results:
+    if not records:
         sb.table('embryo_analysis_queue').update({
             'status': 'completed',
             'completed_at': datetime.utcnow().isoformat(),
             'error_log': 'No embryos detected',
         }).eq('id', req.job_id).execute()
-        return
-
-    # ── Allowed enum values (must match DB CHECK constraints) ──
-    VALID_CLASSIFICATIONS = {"Excelente", "Bom", "Regular", "Borderline", "Inviavel"}
-    VALID_CONFIDENCES = {"high", "medium", "low"}
-    VALID_TRANSFER_RECS = {"priority", "recommended", "conditional", "second_opinion", "discard"}
-    REC_MAP = {
-        "Excelente": "priority",
-        "Bom": "recommended",
-        "Regular": "conditional",
-        "Borderline": "second_opinion",
-        "Inviavel": "discard",
-    }
+        return False
 
     scores_to_insert = []
-    for emb in embryo_results:
-        db_idx = emb["index"]
+    for record in records:
+        score_record = dict(record)
+        db_idx = score_record.pop("index")
         if db_idx >= len(existing_embryos):
             logger.warning(f"No DB embryo at index {db_idx}")
             continue
-        emb_id = existing_embryos[db_idx]["id"]
-
-        gemini = emb.get("gemini_analysis") or {}
-        iets_code = gemini.get("classification") or "Unknown"
-        quality_grade = gemini.get("quality_grade")
-
-        # ── Fix #2: Validate confidence enum ──
-        confidence_str = (gemini.get("confidence") or "low").lower().strip()
-        if confidence_str not in VALID_CONFIDENCES:
-            logger.warning(f"Invalid confidence '{confidence_str}' from Gemini, defaulting to 'low'")
-            confidence_str = "low"
-        ai_conf = 0.9 if confidence_str == "high" else 0.6 if confidence_str == "medium" else 0.3
-
-        # ── Fix #4: Validate classification enum ──
-        db_classification = _map_quality_grade_to_classification(quality_grade, iets_code)
-        if db_classification not in VALID_CLASSIFICATIONS:
-            logger.warning(f"Invalid classification '{db_classification}', defaulting to 'Regular'")
-            db_classification = "Regular"
-
-        # ── Fix #4: Validate transfer_recommendation enum ──
-        transfer_rec = REC_MAP.get(db_classification, "conditional")
-        if transfer_rec not in VALID_TRANSFER_RECS:
-            transfer_rec = "conditional"
-
-        score_record = {
-            "embriao_id": emb_id,
-            "media_id": req.media_id,
-            "is_current": True,
-            # Required NOT NULL columns — all validated against CHECK constraints
-            "classification": db_classification,
-            "confidence": confidence_str,
-            "embryo_score": round(ai_conf * 100),
-            "transfer_recommendation": transfer_rec,
-            # Storage paths
-            "crop_image_path": emb.get("crop_image_path"),
-            "motion_map_path": emb.get("motion_map_path"),
-            # Kinetics — NSD-based (scientific: PMC5695959, PMC9089758)
-            "kinetic_intensity": emb.get("nsd", 0.0),
-            "kinetic_harmony": (emb.get("kinetic_profile") or {}).get("activity_symmetry", 0.0),
-            "kinetic_stability": _compute_temporal_stability(emb.get("kinetic_profile") or {}),
-            "kinetic_bg_noise": emb.get("bg_std"),
-            # ── Fix #1: Save gemini_classification (IETS code) ──
-            "gemini_classification": iets_code if iets_code not in ("Error", "Unknown") else None,
-            "gemini_reasoning": gemini.get("reasoning"),
-            "stage_code": gemini.get("stage_code"),
-            "quality_grade": quality_grade,
-            "visual_features": gemini.get("visual_features") or None,
-            "ai_confidence": ai_conf,
-            # Summary includes IETS code for reference
-            "reasoning": f"Gemini: {iets_code} (grau {quality_grade})" if iets_code not in ("Error", "Unknown") else "Pendente",
-        }
+        score_record["embriao_id"] = existing_embryos[db_idx]["id"]
+        score_record["media_id"] = req.media_id
+        score_record["is_current"] = True
 
         # Auto-copy biologist classification from embrioes table (if already classified via quick-classify)
-        existing_class = existing_embryos[db_idx].get("classificacao") if db_idx < len(existing_embryos) else None
+        existing_class = existing_embryos[db_idx].get("classificacao")
         if existing_class and existing_class in ("BE", "BN", "BX", "BL", "BI", "Mo", "Dg"):
             score_record["biologist_classification"] = existing_class
-
-        # Embedding: pad to 768 for pgvector, serialize as JSON string
-        embedding = emb.get("embedding") or []
-        if embedding and any(v != 0 for v in embedding):
-            if len(embedding) < 768:
-                embedding = embedding + [0.0] * (768 - len(embedding))
-            score_record["embedding"] = json.dumps(embedding)
-
-            # KNN lookup with padded embedding
-            knn_result = _do_knn_lookup(
-                sb, embedding,
-                score_record.get("kinetic_intensity", 0.0),
-                score_record.get("kinetic_harmony", 0.0),
-                score_record.get("kinetic_stability", 0.0),
-            )
-            score_record.update({
-                "combined_source": knn_result.get("combined_source"),
-                "combined_classification": knn_result.get("combined_classification"),
-                "combined_confidence": knn_result.get("combined_confidence"),
-                "knn_classification": knn_result.get("knn_classification"),
-                "knn_confidence": knn_result.get("knn_confidence"),
-                "knn_votes": knn_result.get("knn_votes"),
-                "knn_real_bovine_count": knn_result.get("knn_real_bovine_count"),
-            })
-
         scores_to_insert.append(score_record)
 
     if scores_to_insert:
@@ -2526,10 +4515,17 @@ def _save_scores_to_db(sb, req, embryo_results: list, bboxes: list, job_dir: str
             sb.table('embryo_scores').insert(scores_to_insert).execute()
         except Exception as insert_err:
             err_msg = str(insert_err)
-            if 'gemini_classification' in err_msg:
-                logger.warning("gemini_classification column not found, retrying without it")
+            missing = [c for c in _OPTIONAL_SCORE_COLUMNS if c in err_msg]
+            if missing:
+                logger.warning(f"{missing} column(s) not found, retrying without them")
+                native = _native_column_error(insert_err)
+                if native:
+                    _fall_back_to_padded(insert_err)
                 for s in scores_to_insert:
-                    s.pop("gemini_classification", None)
+                    if native:
+                        _to_padded_layout(s)
+                    for c in missing:
+                        s.pop(c, None)
                 sb.table('embryo_scores').insert(scores_to_insert).execute()
             else:
                 raise
@@ -2542,14 +4538,16 @@ def _save_scores_to_db(sb, req, embryo_results: list, bboxes: list, job_dir: str
 
         # 3. Auto-populate embryo_references atlas (batch upsert)
         atlas_records = []
+        model, column, _ = _embedding_layout()
         for score_rec in scores_to_insert:
             bio_class = score_rec.get("biologist_classification")
-            emb_embedding = score_rec.get("embedding")
+            emb_embedding = score_rec.get(column)
             if bio_class and emb_embedding:
                 atlas_records.append({
                     "embriao_id": score_rec["embriao_id"],
                     "classification": bio_class,
-                    "embedding": emb_embedding,
+                    column: emb_embedding,
+                    **({"embedding_model": model} if model else {}),
                     "kinetic_intensity": score_rec.get("kinetic_intensity"),
                     "kinetic_harmony": score_rec.get("kinetic_harmony"),
                     "kinetic_stability": score_rec.get("kinetic_stability"),
@@ -2567,13 +4565,21 @@ def _save_scores_to_db(sb, req, embryo_results: list, bboxes: list, job_dir: str
             except Exception as ref_err:
                 logger.warning(f"Batch atlas upsert failed: {ref_err}")
 
-    # Mark job complete
-    sb.table('embryo_analysis_queue').update({
-        'status': 'completed',
-        'completed_at': datetime.utcnow().isoformat(),
-    }).eq('id', req.job_id).execute()
+    # Mark job complete (classification may still be pending for /classify)
+    pending = any(s.get("classification_status") == "pending" for s in scores_to_insert)
+    completed = {'status': 'completed', 'completed_at': datetime.utcnow().isoformat()}
+    try:
+        sb.table('embryo_analysis_queue').update(
+            {**completed, 'classification_status': 'pending' if pending else 'done'}
+        ).eq('id', req.job_id).execute()
+    except Exception as e:
+        if 'classification_status' not in str(e):
+            raise
+        logger.warning("embryo_analysis_queue.classification_status not found, completing without it")
+        sb.table('embryo_analysis_queue').update(completed).eq('id', req.job_id).execute()
 
     logger.info(f"Saved {len(scores_to_insert)} scores to DB for job {req.job_id}")
+    return pending
 
 
 # ═══════════════════════════════════════════════════════════
@@ -2600,22 +4606,128 @@ def _download_video(url: str, retries: int = 2) -> str:
     raise last_err
 
 
-def _upload_to_storage(sb, path: str, data: bytes, retries: int = 3):
-    """Upload bytes to Supabase Storage embryoscore bucket with retry."""
+def _upload_to_storage(sb, path: str, data: bytes, retries: int = 3,
+                       content_type: str = "image/jpeg"):
+    """Upload bytes to Supabase Storage embryoscore bucket with jittered retry."""
     for attempt in range(retries):
         try:
             sb.storage.from_("embryoscore").upload(
-                path, data, {"content-type": "image/jpeg", "upsert": "true"})
+                path, data, {"content-type": content_type, "upsert": "true"})
             return
         except Exception as e:
             if attempt < retries - 1:
-                time.sleep(1 * (attempt + 1))
-                logger.warning(f"Upload retry {attempt+1} for {path}: {e}")
+                # Full jitter: parallel uploads failing together don't retry in lockstep
+                delay = random.uniform(0, STORAGE_RETRY_BASE_SECONDS * 2 ** attempt)
+                logger.warning(f"Upload retry {attempt+1} for {path} in {delay:.2f}s: {e}")
+                time.sleep(delay)
             else:
                 logger.error(f"Upload FAILED after {retries} tries: {path}: {e}")
                 raise
 
 
+class _StorageUploader:
+    """Bounded pool of Storage uploads shared by one request.
+
+    submit() queues a (path, bytes, content type) job and returns its future
+    at once; wait() blocks until everything submitted so far has finished and
+    returns {path: error} for uploads that failed every retry. With uploads
+    overlapping, upload wall time tends to the slowest single file rather than
+    the sum of all of them.
+    """
+
+    def __init__(self, sb, max_workers: int = STORAGE_UPLOAD_CONCURRENCY,
+                 clock: _StageClock | None = None, retries: int = 3):
+        self._sb = sb
+        self._retries = retries
+        self._upload = clock.timed("upload", _upload_to_storage) if clock else _upload_to_storage
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage-upload")
+        self._lock = threading.Lock()
+        self._futures: dict = {}
+
+    def submit(self, path: str, data: bytes, content_type: str = "image/jpeg"):
+        future = self._pool.submit(self._upload, self._sb, path, data, self._retries, content_type)
+        with self._lock:
+            self._futures[future] = path
+        return future
+
+    def wait(self) -> dict[str, Exception]:
+        with self._lock:
+            futures = dict(self._futures)
+        futures_wait(list(futures))
+        return {path: f.exception() for f, path in futures.items() if f.exception() is not None}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # On error, queued uploads are dropped; the ones already running finish
+        self._pool.shutdown(wait=True, cancel_futures=exc_type is not None)
+        return False
+
+
+def _raise_failed_uploads(failed: dict[str, Exception]):
+    if failed:
+        path, err = next(iter(failed.items()))
+        raise RuntimeError(f"Storage upload failed for {path}: {err}") from err
+
+
+def _download_from_storage(sb, path: str, retries: int = 3) -> bytes:
+    """Read bytes back from the embryoscore bucket with retry."""
+    for attempt in range(retries):
+        try:
+            return sb.storage.from_("embryoscore").download(path)
+        except Exception as e:
+            if attempt < retries - 1:
+                time.sleep(1 * (attempt + 1))
+                logger.warning(f"Download retry {attempt+1} for {path}: {e}")
+            else:
+                logger.error(f"Download FAILED after {retries} tries: {path}: {e}")
+                raise
+
+
+def _upload_plate_frame(uploader: _StorageUploader, job_dir: str, frame: np.ndarray | None):
+    """Encode the detection frame and queue it as {job_dir}/plate_frame.jpg."""
+    if frame is None:
+        return
+    success, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    if success:
+        uploader.submit(f"{job_dir}/plate_frame.jpg", buf.tobytes())
+
+
+def _encode_and_upload_embryo(uploader: _StorageUploader, job_dir: str, emb: dict, bbox: dict,
+                              clock: _StageClock) -> dict:
+    """Encode one finalized embryo's crop + motion map, queue both uploads, build its result."""
+    with clock.stage("encode"):
+        success, crop_buf = cv2.imencode('.jpg', emb["best_crop"], [cv2.IMWRITE_JPEG_QUALITY, 90])
+        if not success:
+            raise ValueError("Failed to encode crop JPEG")
+        crop_jpg = crop_buf.tobytes()
+
+        success, motion_buf = cv2.imencode('.jpg', emb["heat_colored"], [cv2.IMWRITE_JPEG_QUALITY, 85])
+        if not success:
+            raise ValueError("Failed to encode motion JPEG")
+        motion_jpg = motion_buf.tobytes()
+
+    emb_dir = f"{job_dir}/embryo_{emb['index']}"
+    uploader.submit(f"{emb_dir}/crop.jpg", crop_jpg)
+    uploader.submit(f"{emb_dir}/motion.jpg", motion_jpg)
+
+    return {
+        "index": emb["index"],
+        "bbox": bbox,
+        "crop_image_path": f"{emb_dir}/crop.jpg",
+        "motion_map_path": f"{emb_dir}/motion.jpg",
+        "activity_score": emb["activity_score"],
+        "nsd": emb["nsd"],
+        "anr": emb["anr"],
+        "bg_std": emb["bg_std"],
+        "kinetic_profile": emb["kinetic_profile"],
+        "embedding": [0.0] * 384,  # Filled in by the embedding stage
+        "_crop_jpg": crop_jpg,
+        "_motion_jpg": motion_jpg,
+    }
+
+
 def _extract_crop_from_frame(
     frame: np.ndarray, bbox: dict,
     fw: int, fh: int, padding: float, output_size: int,
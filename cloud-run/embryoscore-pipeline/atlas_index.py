@@ -0,0 +1,440 @@
+"""
+In-memory KNN index over the embryo_references atlas.
+
+AtlasIndex mirrors one embedding column of one Supabase project and answers
+match_embryos_v2/v3 for a whole plate with one matrix multiply (app.py
+KNN_BACKEND="local"). It only needs a supabase-py client for its syncs, so it
+can be built and tested without the rest of the pipeline.
+"""
+
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Fractional seconds as PostgREST returns them: Postgres drops trailing zeros
+_FRACTION = re.compile(r"\.(\d+)")
+
+
+def parse_timestamp(value: str) -> datetime:
+    """PostgREST timestamptz → aware datetime.
+
+    Postgres trims trailing zeros from the fraction ("12:00:00.12345+00:00"),
+    which datetime.fromisoformat only accepts from Python 3.11 on (the image
+    runs 3.10): the fraction is padded (or cut) to microseconds first.
+    """
+    value = _FRACTION.sub(lambda m: "." + m.group(1)[:6].ljust(6, "0"), value.replace("Z", "+00:00"), count=1)
+    return datetime.fromisoformat(value)
+
+
+def project_scope(sb) -> str:
+    """Identity of the Supabase project behind a client (its URL)."""
+    return str(getattr(sb, "supabase_url", id(sb)))
+
+
+class AtlasIndex:
+    """In-memory mirror of embryo_references that answers match_embryos_v2/v3 locally.
+
+    Embeddings are kept L2-normalized in one contiguous (capacity x dim) matrix,
+    float32 or float16, next to the kinetic columns (NaN = NULL), so a whole
+    plate is one matrix multiply. It mirrors one embedding column (and, for a
+    model column, only that model's rows) of one Supabase project: a
+    full load by id keyset, then incremental syncs by (updated_at, id) from the
+    watermark minus an overlap window (upserts by id are idempotent). A row
+    count below the mirror's after a sync means deletes: full reload. Syncs run
+    in a background thread once the index is older than sync_every; lookups
+    never wait for them. save_npz/load_npz persist it across restarts. With a
+    projection, a reduced copy of every row is kept as well (float32) and, from
+    projection_min_refs rows on, queries shortlist candidates on it before the
+    exact cosine re-rank.
+    """
+
+    _GROW_MIN = 1024
+    _MATMUL_ROWS = 8192  # float16 rows are upcast per block, not all at once
+
+    def __init__(self, dim: int = 768, dtype=np.float32, sync_every: float = 30.0,
+                 column: str = "embedding", model: str | None = None, projection=None,
+                 candidate_factor: int = 4, projection_min_refs: int = 0, page_size: int = 1000,
+                 sync_overlap: float = 120.0, snapshot_path: str = ""):
+        self.dim = dim
+        self.projection = projection              # EmbeddingProjection-like: dim, version, project()
+        self.candidate_factor = candidate_factor  # Shortlist = visual_top_n * candidate_factor
+        self.projection_min_refs = projection_min_refs  # Exact search below this many rows
+        self.page_size = page_size                # PostgREST max-rows
+        self.sync_overlap = sync_overlap          # Re-read window (s) for late commits with older updated_at
+        self.snapshot_path = snapshot_path        # save_npz target after each sync ("" = none)
+        self.column = column
+        self.model = model
+        self.dtype = np.dtype(dtype)
+        self.sync_every = sync_every
+        self._lock = threading.Lock()       # Guards the arrays and counters
+        self._sync_lock = threading.Lock()  # One load/sync at a time
+        self.scope = None                   # project_scope of the mirrored project
+        self.ready = False                  # Loaded (from the DB or a snapshot)
+        self.watermark = None               # (updated_at, id) of the newest row seen
+        self.incremental = True             # False while updated_at is missing (count-only syncs)
+        self.synced_at = None               # monotonic time of the last sync attempt
+        self.loads = self.syncs = self.sync_errors = self.queries = 0
+        self._install(self._empty_arrays(0), [], [])
+
+    # ── Storage ──
+
+    def _empty_arrays(self, capacity: int) -> tuple:
+        kin = np.full((capacity, 3), np.nan, dtype=np.float32)
+        reduced = np.zeros((capacity, self.projection.dim if self.projection else 0), dtype=np.float32)
+        return np.zeros((capacity, self.dim), dtype=self.dtype), np.zeros(capacity, dtype=bool), kin, reduced
+
+    def _install(self, arrays: tuple, ids: list, classes: list):
+        self._emb, self._valid, self._kin, self._red = arrays
+        self._ids = ids
+        self._cls = classes
+        self._row = {ref_id: i for i, ref_id in enumerate(ids)}
+        self.n = len(ids)
+
+    def _grow(self, needed: int):
+        capacity = max(needed, 2 * len(self._emb), self._GROW_MIN)
+        emb, valid, kin, reduced = self._empty_arrays(capacity)
+        emb[:self.n], valid[:self.n], kin[:self.n] = self._emb[:self.n], self._valid[:self.n], self._kin[:self.n]
+        reduced[:self.n] = self._red[:self.n]
+        self._emb, self._valid, self._kin, self._red = emb, valid, kin, reduced
+
+    def _project(self, arrays: tuple, rows):
+        """Refresh the reduced copy of `rows` (a slice or index array) from the embeddings."""
+        if self.projection is not None:
+            arrays[3][rows] = self.projection.project(arrays[0][rows])
+
+    def _parse(self, row: dict) -> tuple:
+        """(id, classification, unit vector or None, kinetics) for one PostgREST row."""
+        vec = row.get(self.column)
+        if isinstance(vec, str):
+            vec = json.loads(vec)  # pgvector arrives as "[0.1,0.2,...]"
+        if vec is not None:
+            vec = np.asarray(vec, dtype=np.float32)
+            norm = float(np.linalg.norm(vec)) if vec.shape == (self.dim,) else 0.0
+            # pgvector cosine distance is NaN for a zero vector: never a neighbor
+            vec = vec / norm if norm > 0 and math.isfinite(norm) else None
+        kin = [row.get(c) for c in ("kinetic_intensity", "kinetic_harmony", "kinetic_stability")]
+        return (row["id"], row.get("classification"), vec,
+                [np.nan if v is None else float(v) for v in kin])
+
+    @staticmethod
+    def _put(arrays: tuple, classes: list, i: int, parsed: tuple):
+        emb, valid, kin = arrays[:3]
+        _, cls, vec, kinetics = parsed
+        classes[i] = cls
+        valid[i] = vec is not None
+        if vec is not None:
+            emb[i] = vec
+        kin[i] = kinetics
+
+    def _upsert(self, parsed_rows: list) -> int:
+        with self._lock:
+            added = [p for p in parsed_rows if p[0] not in self._row]
+            if self.n + len(added) > len(self._emb):
+                self._grow(self.n + len(added))
+            rows = []
+            for parsed in parsed_rows:
+                i = self._row.get(parsed[0])
+                if i is None:
+                    i = self._row[parsed[0]] = self.n
+                    self._ids.append(parsed[0])
+                    self._cls.append(None)
+                    self.n += 1
+                self._put((self._emb, self._valid, self._kin), self._cls, i, parsed)
+                rows.append(i)
+            self._project((self._emb, self._valid, self._kin, self._red), np.array(rows, dtype=np.intp))
+        return len(parsed_rows)
+
+    def retarget(self, dim: int, column: str, model: str | None, projection=None):
+        """Mirror another embedding column from now on (e.g. the padded fallback).
+        Drops every row; the next ready_for() starts a full load."""
+        with self._sync_lock:  # A running sync would install the old layout
+            with self._lock:
+                self.dim, self.column, self.model, self.projection = dim, column, model, projection
+                self._install(self._empty_arrays(0), [], [])
+                self.ready = False
+                self.watermark = None
+                self.incremental = True
+                self.synced_at = None
+        logger.info(f"Atlas index now mirrors {column} ({dim}-d)")
+
+    # ── Sync ──
+
+    def ready_for(self, sb) -> bool:
+        """True when the index mirrors sb's project and can answer; kicks a
+        background sync when it is stale (the first project seen is adopted)."""
+        scope = project_scope(sb)
+        with self._lock:
+            if self.scope is None:
+                self.scope = scope
+            if self.scope != scope:
+                return False
+            ready = self.ready
+            stale = self.synced_at is None or time.monotonic() - self.synced_at >= self.sync_every
+        if stale and not self._sync_lock.locked():
+            threading.Thread(target=self.sync, args=(sb,), name="atlas-sync", daemon=True).start()
+        return ready
+
+    def sync(self, sb):
+        """Bring the mirror up to date: full load the first time (or after deletes),
+        else only the rows changed since the watermark. Errors keep the old state."""
+        if not self._sync_lock.acquire(blocking=False):
+            return  # Another sync is running
+        try:
+            with self._lock:
+                if self.scope is not None and self.scope != project_scope(sb):
+                    return  # Mirrors another project
+                self.scope = project_scope(sb)
+                self.synced_at = time.monotonic()
+            t0 = time.time()
+            if self.watermark is None and self.incremental:
+                changed = self._full_load(sb)
+            else:
+                changed = self._fetch_changes(sb) if self.incremental else 0
+                total = self._query(sb, 'id', count='exact', head=True).execute().count or 0
+                # Counted after the scan: fewer rows than mirrored means deletes. With
+                # count-only syncs (no updated_at) any difference means a change.
+                if total < self.n or (not self.incremental and total != self.n):
+                    logger.info(f"Atlas index: {self.n} mirrored vs {total} in DB, reloading")
+                    changed = self._full_load(sb)
+            with self._lock:
+                self.ready = True
+                self.syncs += 1
+            if changed:
+                logger.info(f"Atlas index synced: {changed} row(s) in {time.time() - t0:.2f}s, {self.n} refs")
+                if self.snapshot_path:
+                    self.save_npz(self.snapshot_path)
+        except Exception as e:
+            with self._lock:
+                self.sync_errors += 1
+            logger.warning(f"Atlas index sync failed (serving {self.n} refs): {e}")
+        finally:
+            self._sync_lock.release()
+
+    def _query(self, sb, columns: str, **kwargs):
+        """embryo_references select restricted to this index's model."""
+        query = sb.table('embryo_references').select(columns, **kwargs)
+        return query.eq('embedding_model', self.model) if self.model else query
+
+    def _columns(self, with_updated_at: bool = True) -> str:
+        columns = f"id, classification, {self.column}, kinetic_intensity, kinetic_harmony, kinetic_stability"
+        return f"{columns}, updated_at" if with_updated_at else columns
+
+    def _full_load(self, sb) -> int:
+        with_updated_at = True
+        parsed, watermark, last_id = [], None, None
+        while True:
+            query = self._query(sb, self._columns(with_updated_at))
+            if last_id is not None:
+                query = query.gt('id', last_id)
+            try:
+                rows = query.order('id').limit(self.page_size).execute().data or []
+            except Exception as e:
+                if 'updated_at' not in str(e) or not with_updated_at:
+                    raise
+                logger.warning("embryo_references.updated_at not found (apply "
+                               "20261016000400_embryo_references_updated_at.sql); atlas syncs by row count only")
+                with_updated_at = False
+                continue
+            for row in rows:
+                parsed.append(self._parse(row))
+                if row.get("updated_at"):
+                    key = (parse_timestamp(row["updated_at"]), row["id"])
+                    watermark = max(watermark, key) if watermark else key
+            if len(rows) < self.page_size:
+                break
+            last_id = rows[-1]["id"]
+
+        # Fill new arrays outside the lock, then swap: queries keep running meanwhile
+        arrays = self._empty_arrays(max(len(parsed), self._GROW_MIN))
+        classes = [None] * len(parsed)
+        for i, p in enumerate(parsed):
+            self._put(arrays, classes, i, p)
+        self._project(arrays, slice(0, len(parsed)))
+        with self._lock:
+            self._install(arrays, [p[0] for p in parsed], classes)
+            self.watermark = watermark
+            self.incremental = with_updated_at
+            self.loads += 1
+        return len(parsed)
+
+    def _fetch_changes(self, sb) -> int:
+        """Rows with updated_at past watermark - overlap, by (updated_at, id) keyset."""
+        since = self.watermark[0] - timedelta(seconds=self.sync_overlap)
+        after, changed = None, 0
+        while True:
+            query = self._query(sb, self._columns())
+            if after is None:
+                query = query.gte('updated_at', since.isoformat())
+            else:
+                ts, ref_id = after
+                query = query.or_(f'updated_at.gt."{ts}",and(updated_at.eq."{ts}",id.gt.{ref_id})')
+            rows = query.order('updated_at').order('id').limit(self.page_size).execute().data or []
+            changed += self._upsert([self._parse(row) for row in rows])
+            for row in rows:
+                self.watermark = max(self.watermark, (parse_timestamp(row["updated_at"]), row["id"]))
+            if len(rows) < self.page_size:
+                return changed
+            after = (rows[-1]["updated_at"], rows[-1]["id"])
+
+    # ── Snapshot ──
+
+    def save_npz(self, path: str):
+        with self._lock:
+            n = self.n
+            data = {
+                "embeddings": self._emb[:n].copy(),
+                "valid": self._valid[:n].copy(),
+                "kinetics": self._kin[:n].copy(),
+                "ids": np.array(self._ids, dtype=str),
+                "classes": np.array([c or "" for c in self._cls], dtype=str),
+                "watermark": np.array([self.watermark[0].isoformat(), self.watermark[1]]
+                                      if self.watermark else [], dtype=str),
+                "scope": np.array(self.scope or ""),
+                "column": np.array(self.column),
+            }
+        tmp = f"{path}.tmp.npz"
+        try:
+            np.savez(tmp, **data)
+            os.replace(tmp, path)  # Readers never see a partial file
+        except OSError as e:
+            logger.warning(f"Atlas snapshot not written to {path}: {e}")
+
+    def load_npz(self, path: str, scope: str | None = None) -> bool:
+        """Load a save_npz snapshot; refused when it was taken from another project."""
+        with np.load(path) as data:
+            if scope and str(data["scope"]) != scope:
+                logger.warning(f"Atlas snapshot {path} is from another project, ignoring it")
+                return False
+            emb = data["embeddings"]
+            column = str(data["column"]) if "column" in data.files else "embedding"
+            if column != self.column or emb.shape[1] != self.dim:
+                logger.warning(f"Atlas snapshot {path} holds {column} ({emb.shape[1]}-d), "
+                               f"expected {self.column} ({self.dim}-d); ignoring it")
+                return False
+            n = len(emb)
+            arrays = self._empty_arrays(max(n, self._GROW_MIN))
+            arrays[0][:n], arrays[1][:n], arrays[2][:n] = emb, data["valid"], data["kinetics"]
+            self._project(arrays, slice(0, n))
+            ids = data["ids"].tolist()
+            classes = [c or None for c in data["classes"].tolist()]
+            wm = data["watermark"].tolist()
+            snapshot_scope = str(data["scope"]) or None
+        with self._lock:
+            self._install(arrays, ids, classes)
+            self.watermark = (parse_timestamp(wm[0]), wm[1]) if wm else None
+            self.incremental = bool(wm) or n == 0
+            self.scope = self.scope or snapshot_scope
+            self.ready = True
+        logger.info(f"Atlas index: {n} refs loaded from snapshot {path}")
+        return True
+
+    # ── Query ──
+
+    def match_batch(self, embeddings, kinetics, match_count: int = 10, visual_top_n: int = 30,
+                    alpha: float = 0.7, beta: float = 0.3, min_similarity: float = 0.50,
+                    candidate_factor: int | None = None) -> list:
+        """match_embryos_v2 for every query row in one matmul.
+
+        Per query: the visual_top_n refs by cosine similarity above
+        min_similarity, re-ranked by alpha * vis + beta * kin (vis when either
+        side has no kinetic_intensity), best match_count first. Exact search,
+        where the RPC walks an approximate HNSW index; with a projection and at
+        least projection_min_refs rows, only the visual_top_n * candidate_factor
+        rows nearest in the reduced space are scored. kinetics: one (intensity, harmony, stability) triple per
+        query, None = NULL.
+        """
+        q = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(q, axis=1)
+        q = q / np.where(norms > 0, norms, 1.0)[:, None]
+        qk = np.array([[np.nan if v is None else v for v in k] for k in kinetics],
+                      dtype=np.float32).reshape(-1, 3)
+        with self._lock:
+            n = self.n
+            self.queries += len(q)
+            if n == 0 or len(q) == 0:
+                return [[] for _ in range(len(q))]
+            shortlist = visual_top_n * (candidate_factor or self.candidate_factor)
+            if self.projection is not None and self.projection_min_refs <= n and shortlist < n:
+                top, vis = self._shortlist(q, n, visual_top_n, shortlist)
+            else:
+                top, vis = self._exact(q, n, visual_top_n)
+            vis[norms == 0] = -np.inf
+            ref_kin = self._kin[top]  # (queries, k, 3)
+            ids, classes = self._ids, self._cls
+        keep = vis > min_similarity
+        has_kin = ~np.isnan(ref_kin[..., 0]) & ~np.isnan(qk[:, None, 0])
+        diff = np.abs(np.nan_to_num(ref_kin) - np.nan_to_num(qk)[:, None, :]).sum(axis=2)
+        kin_sim = np.where(has_kin, 1.0 - diff / 3.0, 0.0)
+        comp = np.where(keep, alpha * vis + beta * np.where(has_kin, kin_sim, vis), -np.inf)
+        order = np.argsort(-comp, axis=1, kind="stable")[:, :match_count]
+
+        results = []
+        for b in range(len(q)):
+            neighbors = []
+            for j in order[b]:
+                if not keep[b, j]:
+                    break  # Sorted: the rest failed min_similarity too
+                r = top[b, j]
+                neighbors.append({
+                    "id": ids[r],
+                    "classification": classes[r],
+                    "visual_similarity": float(vis[b, j]),
+                    "kinetic_similarity": float(kin_sim[b, j]),
+                    "composite_score": float(comp[b, j]),
+                })
+            results.append(neighbors)
+        return results
+
+    def _exact(self, q: np.ndarray, n: int, visual_top_n: int) -> tuple:
+        """(row indices, cosine) of the visual_top_n nearest rows per query, by blocks.
+
+        WHERE vis > min_similarity ORDER BY distance LIMIT visual_top_n: the
+        filter is monotone in vis, so top-k first then filter is the same set.
+        """
+        sims = np.empty((len(q), n), dtype=np.float32)
+        for start in range(0, n, self._MATMUL_ROWS):
+            block = self._emb[start:min(n, start + self._MATMUL_ROWS)]
+            sims[:, start:start + len(block)] = q @ block.astype(np.float32, copy=False).T
+        sims[:, ~self._valid[:n]] = -np.inf
+        k = min(visual_top_n, n)
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        return top, np.take_along_axis(sims, top, axis=1)
+
+    def _shortlist(self, q: np.ndarray, n: int, visual_top_n: int, shortlist: int) -> tuple:
+        """_exact over only the `shortlist` rows nearest each query in the reduced space."""
+        red = self._red[:n]
+        # Nearest by L2: max of r·q - |r|²/2
+        score = self.projection.project(q) @ red.T - 0.5 * np.einsum("ij,ij->i", red, red)
+        score[:, ~self._valid[:n]] = -np.inf
+        cand = np.argpartition(-score, shortlist - 1, axis=1)[:, :shortlist]
+        sims = (self._emb[cand].astype(np.float32, copy=False) @ q[:, :, None])[..., 0]
+        sims[~self._valid[cand]] = -np.inf
+        k = min(visual_top_n, shortlist)
+        pick = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        return np.take_along_axis(cand, pick, axis=1), np.take_along_axis(sims, pick, axis=1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "refs": self.n,
+                "dtype": self.dtype.name,
+                "matrix_mb": round((self._emb.nbytes + self._red.nbytes) / 1e6, 1),
+                "projection": self.projection.version if self.projection else None,
+                "watermark": self.watermark[0].isoformat() if self.watermark else None,
+                "incremental": self.incremental,
+                "sync_age_s": round(time.monotonic() - self.synced_at, 1) if self.synced_at else None,
+                "loads": self.loads,
+                "syncs": self.syncs,
+                "sync_errors": self.sync_errors,
+                "queries": self.queries,
+            }
@@ -0,0 +1,1629 @@
+"""
+EmbryoScore Pipeline — local benchmarks.
+
+Run LOCALLY (not in Cloud Run), from this directory, with requirements.txt
+installed and ffmpeg on PATH (used to synthesize long-GOP test videos):
+
+    python benchmark.py decode                    # synthetic 30/60 fps, GOP 250
+    python benchmark.py decode --video a.mp4 b.mp4
+    python benchmark.py accumulator --embryos 30 --height 1080
+    python benchmark.py accumulator --baseline /path/to/older/checkout/cloud-run/embryoscore-pipeline --check
+    python benchmark.py background --video plate1.mp4 plate2.mp4   # exits 1 if out of tolerance
+    python benchmark.py embed --model dinov2_vits14.onnx --baseline /path/to/older/checkout/cloud-run/embryoscore-pipeline
+    python benchmark.py models --variants dinov2_vits14.onnx dinov2_vits14.int8-dynamic.onnx \
+        --crops-dir crops/ --atlas embryo_references.json --check
+    python benchmark.py gemini --embryos 30 --rpm 60 --latency 4
+    python benchmark.py gemini-http --calls 200 --in-flight 32
+    python benchmark.py coldstart --model dinov2_vits14.onnx --ort-model dinov2_vits14.ort --baseline ...
+    python benchmark.py stages --embryos 10 --baseline /path/to/older/checkout/cloud-run/embryoscore-pipeline
+    python benchmark.py stages --embryos 20 --defer     # CPU instance time in deferred mode
+    python benchmark.py claim --rt 0.04 --baseline /path/to/older/checkout/cloud-run/embryoscore-pipeline
+    python benchmark.py uploads --embryos 5 20 --concurrency 8
+    python benchmark.py progress --frames 300 --db-latency 0.08
+    python benchmark.py config-cache --jobs 200 --ttl 1
+    python benchmark.py save --embryos 5 30
+    python benchmark.py knn --embryos 10 30 --baseline /path/to/older/checkout/cloud-run/embryoscore-pipeline
+    python benchmark.py embedding-storage --refs 1000 10000
+    python benchmark.py projection --refs 10000 50000 --dim 64 128
+    python benchmark.py atlas --refs 1000 10000 50000 --embryos 30
+
+Each subcommand prints a plain-text table; numbers go in the PR/commit body.
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import http.server
+import importlib.util
+import inspect
+import io
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import app as pipeline
+from atlas_index import AtlasIndex
+
+
+# ─── Helpers ─────────────────────────────────────────────
+
+def _make_video(path: str, fps: int, seconds: int, gop: int,
+                width: int = 1280, height: int = 720, codec: str = "libx264") -> str:
+    """Synthesize a phone-like long-GOP video with ffmpeg's testsrc2."""
+    ffmpeg = os.environ.get("FFMPEG") or shutil.which("ffmpeg")
+    if not ffmpeg:
+        raise SystemExit("ffmpeg not found (set FFMPEG=/path/to/ffmpeg)")
+    subprocess.run([
+        ffmpeg, "-y", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}",
+        "-t", str(seconds), "-c:v", codec, "-g", str(gop), "-keyint_min", str(gop),
+        "-sc_threshold", "0", "-pix_fmt", "yuv420p", path,
+    ], check=True)
+    return path
+
+
+def _load_baseline(directory: str):
+    """Import app.py from another checkout (e.g. a git worktree) for before/after runs."""
+    spec = importlib.util.spec_from_file_location(
+        "baseline_app", os.path.join(directory, "app.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _open(path: str):
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise SystemExit(f"Could not open {path}")
+    return cap
+
+
+def _video_info(path: str) -> tuple[float, int, int, int]:
+    cap = _open(path)
+    info = (cap.get(cv2.CAP_PROP_FPS) or 30.0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+            int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    cap.release()
+    return info
+
+
+# ─── decode: seek-per-sample vs decode-once ──────────────
+
+def _time_sampler(path: str, mode: str) -> tuple[float, int, int]:
+    fps, total, _, _ = _video_info(path)
+    indices = pipeline._sample_frame_indices(total, fps)
+    cap = _open(path)
+    sampler = pipeline._FrameSampler(cap, indices, det_index=total // 2, mode=mode)
+    t0 = time.perf_counter()
+    # Same order as analyze(): detection frame first, then the sampled walk
+    sampler.read_detection_frame()
+    served = sum(1 for _ in sampler)
+    elapsed = time.perf_counter() - t0
+    cap.release()
+    return elapsed, served, sampler.frames_decoded
+
+
+def bench_decode(args):
+    videos = list(args.video or [])
+    tmpdir = None
+    if not videos:
+        tmpdir = tempfile.mkdtemp(prefix="es-bench-")
+        for fps in (30, 60):
+            videos.append(_make_video(
+                os.path.join(tmpdir, f"synthetic_{fps}fps_gop{args.gop}.mp4"),
+                fps, args.seconds, args.gop, codec=args.codec))
+
+    print(f"{'video':<36} {'fps':>5} {'frames':>7} {'mode':>11} {'served':>7} "
+          f"{'decoded':>8} {'seconds':>8}")
+    try:
+        for path in videos:
+            fps, total, _, _ = _video_info(path)
+            results = {}
+            for mode in ("seek", "sequential"):
+                best = min(_time_sampler(path, mode) for _ in range(args.repeat))
+                results[mode] = best
+                print(f"{os.path.basename(path):<36} {fps:>5.0f} {total:>7} {mode:>11} "
+                      f"{best[1]:>7} {best[2]:>8} {best[0]:>8.2f}")
+            speedup = results["seek"][0] / max(results["sequential"][0], 1e-9)
+            print(f"{'':<36} {'':>5} {'':>7} {'speedup':>11} {speedup:>7.1f}x")
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# ─── accumulator: full-frame vs ROI-local kinetics ───────
+
+def _plate_bboxes(n: int, width: int, height: int, diameter_ratio: float = 0.06) -> list[dict]:
+    """n embryos on a regular grid, as percentage bboxes (detector output format)."""
+    cols = max(1, math.ceil(math.sqrt(n * width / height)))
+    rows = max(1, math.ceil(n / cols))
+    d_px = diameter_ratio * width
+    bboxes = []
+    for i in range(n):
+        r, c = divmod(i, cols)
+        bboxes.append({
+            "x_percent": (c + 0.5) / cols * 100,
+            "y_percent": (r + 0.5) / rows * 100,
+            "width_percent": d_px / width * 100,
+            "height_percent": d_px / height * 100,
+        })
+    return bboxes
+
+
+def _synthetic_frames(n_frames: int, width: int, height: int, bboxes: list[dict], seed: int = 0):
+    """Vignetted plate with dark embryos, per-frame sensor noise and embryo flicker."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    r2 = ((xx - width / 2) ** 2 + (yy - height / 2) ** 2) / ((width / 2) ** 2 + (height / 2) ** 2)
+    base = (215 - 60 * r2).astype(np.uint8)
+    del yy, xx, r2
+    for b in bboxes:
+        cx, cy = int(b["x_percent"] / 100 * width), int(b["y_percent"] / 100 * height)
+        r = int(b["width_percent"] / 100 * width) // 2
+        cv2.circle(base, (cx, cy), r, 90, -1)
+    for _ in range(n_frames):
+        noise = rng.normal(0, 2.0, size=(height, width)).astype(np.int16)
+        frame = np.clip(base.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        for b in bboxes[::2]:  # half the embryos "move"
+            cx, cy = int(b["x_percent"] / 100 * width), int(b["y_percent"] / 100 * height)
+            r = int(b["width_percent"] / 100 * width) // 4
+            cv2.circle(frame, (cx + int(rng.integers(-3, 4)), cy), r, int(rng.integers(60, 120)), -1)
+        yield cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def _run_accumulator(module, frames: list, bboxes: list[dict], width: int, height: int, **kwargs):
+    gap = max(1, int(module.KINETIC_FPS))
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    acc = module._StreamingAccumulator(bboxes, width, height, module.KINETIC_FPS, gap, **kwargs)
+    t_init = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for f in frames:
+        acc.process_frame(f)
+    t_frames = time.perf_counter() - t0
+    results, bg_std = acc.finalize()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return results, bg_std, t_init, t_frames / max(len(frames), 1), peak
+
+
+def _metric_diff(a: list[dict], b: list[dict], estimate: bool = False) -> float:
+    """Largest absolute difference across the numeric metrics of two result lists.
+
+    estimate=True compares a run whose background noise floor is estimated
+    (sparse grid) with an exact one: float metrics by relative difference, and
+    every metric may sit one rounding unit apart (a slightly different bg_std
+    can move a value across a rounding boundary).
+    """
+    def num(x, y, unit=0.0):
+        x, y = float(x), float(y)
+        return max(0.0, abs(x - y) - unit) / max(abs(x), 1e-6) if estimate else abs(x - y)
+
+    def step(x, y):
+        return max(0, abs(x - y) - 1) if estimate else abs(x - y)
+
+    worst = 0.0
+    for ra, rb in zip(a, b):
+        worst = max(worst, step(ra["activity_score"], rb["activity_score"]))
+        for key, unit in (("nsd", 1e-6), ("anr", 1e-3), ("bg_std", 0.0)):
+            worst = max(worst, num(ra[key], rb[key], unit))
+        ka, kb = ra["kinetic_profile"], rb["kinetic_profile"]
+        for key in ("core_activity", "periphery_activity"):
+            worst = max(worst, step(ka[key], kb[key]))
+        for key in ("temporal_variability", "activity_symmetry"):
+            worst = max(worst, num(ka[key], kb[key], 0.01))
+        for va, vb in zip(ka["activity_timeline"], kb["activity_timeline"]):
+            worst = max(worst, step(va, vb))
+        if ka["peak_zone"] != kb["peak_zone"] or ka["temporal_pattern"] != kb["temporal_pattern"]:
+            worst = float("inf")
+        if ka["focal_activity_detected"] != kb["focal_activity_detected"]:
+            worst = float("inf")
+        # Motion maps are uint8 images: any difference shows up in gray levels
+        heat_a, heat_b = ra["heat_colored"].astype(np.int16), rb["heat_colored"].astype(np.int16)
+        worst = max(worst, float(np.abs(heat_a - heat_b).max()))
+    return worst
+
+
+# bg_budget=0: exact background noise floor (every background pixel), so these
+# modes must match the reference to --tolerance. "roi+sparse-bg" is the production
+# default (BG_SAMPLE_BUDGET grid): an estimate, checked against --bg-tolerance
+ACCUMULATOR_MODES = {
+    "full-frame": {"roi": False, "bg_budget": 0},
+    "roi": {"roi": True, "bg_budget": 0},
+    "roi+sparse-bg": {"roi": True},
+}
+
+
+def bench_accumulator(args):
+    width = int(round(args.height * 16 / 9))
+    runs = [(mode, pipeline, ACCUMULATOR_MODES[mode]) for mode in args.modes]
+    if args.baseline:
+        baseline = _load_baseline(args.baseline)
+        # Checkouts with the sparse background grid: run their exact path
+        exact = "bg_budget" in inspect.signature(baseline._StreamingAccumulator).parameters
+        runs.insert(0, ("baseline", baseline, {"bg_budget": 0} if exact else {}))
+    print(f"{'embryos':>7} {'res':>10} {'mode':>13} {'init ms':>8} {'ms/frame':>9} "
+          f"{'peak MB':>8} {'max |diff|':>10}")
+    failures = []
+    if args.kinetics_only:
+        # Best-crop tracking resizes every crop to OUTPUT_SIZE per frame; shrink it
+        # so the timings isolate the kinetics math (metrics are unaffected)
+        for _, module, _ in runs:
+            module.OUTPUT_SIZE = 8
+    for n in args.embryos:
+        bboxes = _plate_bboxes(n, width, args.height)
+        frames = list(_synthetic_frames(args.frames, width, args.height, bboxes))
+        reference = None
+        for mode, module, kwargs in runs:
+            results, _, t_init, t_frame, peak = _run_accumulator(
+                module, frames, bboxes, width, args.height, **kwargs)
+            if reference is None:
+                reference = results
+            estimate = module is pipeline and kwargs.get("bg_budget", pipeline.BG_SAMPLE_BUDGET) != 0
+            diff = _metric_diff(reference, results, estimate=estimate)
+            tolerance = args.bg_tolerance if estimate else args.tolerance
+            if diff > tolerance:
+                failures.append(f"{mode} ({n} embryos): {diff:.4g} > {tolerance:g}")
+            print(f"{n:>7} {f'{width}x{args.height}':>10} {mode:>13} {t_init * 1e3:>8.1f} "
+                  f"{t_frame * 1e3:>9.2f} {peak / 1e6:>8.1f} {diff:>10.4g}")
+    if args.check:
+        if failures:
+            print("Parity check FAILED: " + "; ".join(failures))
+            sys.exit(1)
+        print(f"Parity check passed (exact modes <= {args.tolerance:g}, "
+              f"sparse background <= {args.bg_tolerance:g} relative / one integer step)")
+
+
+# ─── background: sparse grid vs every background pixel ───
+
+def _load_gray_frames(path: str) -> tuple[list, list[dict], int, int, float]:
+    """Sampled gray frames at /analyze resolution + OpenCV-detected bboxes."""
+    fps, total, orig_w, orig_h = _video_info(path)
+    scale = min(1.0, pipeline.MAX_FRAME_HEIGHT / orig_h, pipeline.MAX_WIDTH / orig_w)
+    vid_w, vid_h = int(orig_w * scale), int(orig_h * scale)
+    cap = _open(path)
+    sampler = pipeline._FrameSampler(
+        cap, pipeline._sample_frame_indices(total, fps), det_index=total // 2,
+        out_size=(vid_w, vid_h) if scale < 1.0 else None)
+    bboxes = pipeline._detect_embryos_opencv(sampler.read_detection_frame())
+    grays = [cv2.cvtColor(f, cv2.COLOR_BGR2GRAY) for _, f in sampler]
+    cap.release()
+    return grays, bboxes, vid_w, vid_h, pipeline.KINETIC_FPS
+
+
+def bench_background(args):
+    inputs = []
+    for path in args.video or []:
+        inputs.append((os.path.basename(path), *_load_gray_frames(path)))
+    if not inputs:
+        width, height = 1280, 720
+        for n in (2, 12):
+            bboxes = _plate_bboxes(n, width, height)
+            grays = [cv2.cvtColor(f, cv2.COLOR_BGR2GRAY)
+                     for f in _synthetic_frames(args.frames, width, height, bboxes, seed=n)]
+            inputs.append((f"synthetic_{n}_embryos", grays, bboxes, width, height,
+                           pipeline.KINETIC_FPS))
+
+    print(f"{'input':<28} {'budget':>7} {'pixels':>8} {'bg_std':>8} {'rel err':>8} "
+          f"{'tl max err':>10} {'ms/frame':>9}")
+    failures = 0
+    for name, grays, bboxes, w, h, fps in inputs:
+        full_std = full_tl = None
+        for budget in [0] + args.budgets:
+            t0 = time.perf_counter()
+            bg_std, bg_tl, _ = pipeline._compute_background_noise(grays, bboxes, w, h, fps, budget)
+            elapsed = (time.perf_counter() - t0) / len(grays)
+            mask = np.zeros((h, w), dtype=np.uint8)
+            n_px = pipeline._background_sample_index(mask, budget).size if budget else w * h
+            if budget == 0:
+                full_std, full_tl = bg_std, bg_tl
+                rel, tl_err = 0.0, 0.0
+            else:
+                rel = abs(bg_std - full_std) / max(full_std, 1e-6)
+                tl_err = max((abs(a - b) for a, b in zip(bg_tl, full_tl)), default=0.0)
+                if rel > args.tolerance or tl_err > args.timeline_tolerance:
+                    failures += 1
+            print(f"{name:<28} {budget or 'all':>7} {n_px:>8} {bg_std:>8.4f} {rel:>8.2%} "
+                  f"{tl_err:>10.4f} {elapsed * 1e3:>9.2f}")
+    if failures:
+        print(f"{failures} estimate(s) outside tolerance "
+              f"(bg_std {args.tolerance:.0%}, timeline {args.timeline_tolerance})")
+        sys.exit(1)
+    print("All sparse estimates within tolerance.")
+
+
+# ─── embed: batched DINOv2 inference ───
+
+def _embryo_crops(n: int, seed: int = 0) -> list[np.ndarray]:
+    """n OUTPUT_SIZE BGR crops of vignetted synthetic plates (best_crop format)."""
+    size = pipeline.OUTPUT_SIZE
+    bboxes = _plate_bboxes(1, size, size, diameter_ratio=0.6)
+    frames = _synthetic_frames(n, size, size, bboxes, seed=seed)
+    # Warm tint (B < G < R) so a channel-order mistake shows up in the parity column
+    tint = np.array([0.8, 0.95, 1.1], dtype=np.float32)
+    return [np.clip(f * tint, 0, 255).astype(np.uint8) for f in frames]
+
+
+def _load_model(module, path: str):
+    module.ONNX_MODEL_PATH = path
+    if hasattr(module, "ONNX_ORT_MODEL_PATH"):
+        module.ONNX_ORT_MODEL_PATH = ""  # Load exactly `path` (.onnx or .ort)
+        module.ONNX_FP32_PATHS = ()
+    module.ort_session = None
+    module._ensure_onnx()
+    if module.ort_session is None:
+        raise SystemExit(f"Could not load {path}")
+
+
+def _cosine(a, b) -> float:
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-12))
+
+
+def bench_embed(args):
+    _load_model(pipeline, args.model)
+    baseline = None
+    if args.baseline:
+        baseline = _load_baseline(args.baseline)
+        _load_model(baseline, args.model)
+    print(f"{'crops':>5} {'variant':>12} {'total ms':>9} {'ms/embryo':>10} {'min cos':>8}")
+    for n in args.crops:
+        crops = _embryo_crops(n)
+        runs = []
+        if baseline is not None:
+            runs.append(("baseline", baseline._get_embeddings_batch, {}))
+        runs += [(f"batch={b}", pipeline._get_embeddings_batch, {"batch_size": b})
+                 for b in args.batch_sizes]
+        reference = None
+        for name, fn, kwargs in runs:
+            fn(crops[:1], **kwargs)  # warm-up
+            best = float("inf")
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                out = fn(crops, **kwargs)
+                best = min(best, time.perf_counter() - t0)
+            if reference is None:
+                reference = out
+            cos = min(_cosine(a, b) for a, b in zip(reference, out))
+            print(f"{n:>5} {name:>12} {best * 1e3:>9.1f} {best * 1e3 / n:>10.2f} {cos:>8.5f}")
+
+
+# ─── models: fp32 vs INT8 variants — fidelity, KNN agreement, latency ───
+
+def _load_crops_dir(directory: str) -> tuple[list[str], list[np.ndarray]]:
+    names, crops = [], []
+    for name in sorted(os.listdir(directory)):
+        img = cv2.imread(os.path.join(directory, name), cv2.IMREAD_COLOR)
+        if img is not None:
+            names.append(os.path.splitext(name)[0])
+            crops.append(img)
+    return names, crops
+
+
+def _load_atlas(path: str, dim: int) -> tuple[list[str], list[str], np.ndarray]:
+    """embryo_references export (JSON array or JSONL of id, classification, embedding).
+
+    Stored vectors are 768-dim, zero-padded from DINOv2's native dim; only the
+    first `dim` components carry signal.
+    """
+    with open(path) as f:
+        text = f.read().strip()
+    rows = json.loads(text) if text.startswith("[") else [json.loads(l) for l in text.splitlines() if l]
+    ids, classes, vectors = [], [], []
+    for row in rows:
+        emb = row["embedding"]
+        if isinstance(emb, str):
+            emb = json.loads(emb)
+        ids.append(str(row["id"]))
+        classes.append(row.get("classification") or "Unknown")
+        vectors.append(np.asarray(emb[:dim], dtype=np.float32))
+    return ids, classes, np.stack(vectors)
+
+
+def _unit(x: np.ndarray) -> np.ndarray:
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def _top1(queries: np.ndarray, atlas: np.ndarray, exclude: list[int | None]) -> np.ndarray:
+    """Index of the most cosine-similar atlas row per query, skipping `exclude[i]`."""
+    sims = _unit(queries) @ _unit(atlas).T
+    for i, j in enumerate(exclude):
+        if j is not None:
+            sims[i, j] = -np.inf
+    return np.argmax(sims, axis=1)
+
+
+def bench_models(args):
+    if args.crops_dir:
+        names, crops = _load_crops_dir(args.crops_dir)
+    else:
+        crops = _embryo_crops(args.crops)
+        names = [str(i) for i in range(len(crops))]
+    if not crops:
+        raise SystemExit("No crops to embed")
+
+    results = []
+    for path in args.variants:
+        _load_model(pipeline, path)
+        emb = np.asarray(pipeline._get_embeddings_batch(crops), dtype=np.float32)
+        single = []
+        for crop in crops[:args.latency_samples]:
+            t0 = time.perf_counter()
+            pipeline._get_embeddings_batch([crop], batch_size=1)
+            single.append(time.perf_counter() - t0)
+        results.append((path, emb, float(np.median(single))))
+
+    ref = results[0][1]
+    if args.atlas:
+        atlas_ids, atlas_classes, atlas = _load_atlas(args.atlas, ref.shape[1])
+        # A crop named <reference id>.jpg is excluded from its own neighbour search
+        pos = {rid: i for i, rid in enumerate(atlas_ids)}
+        exclude = [pos.get(n) for n in names]
+    else:
+        # No export: leave-one-out over the fp32 embeddings of the crops themselves
+        atlas_classes, atlas = names, ref
+        exclude = list(range(len(crops)))
+    ref_top1 = _top1(ref, atlas, exclude)
+
+    print(f"{len(crops)} crops, atlas of {len(atlas)} ({'export' if args.atlas else 'leave-one-out'})")
+    print(f"{'variant':<36} {'MB':>6} {'ms/img':>7} {'mean cos':>9} {'min cos':>8} "
+          f"{'top-1 id':>9} {'top-1 cls':>10}")
+    failures = 0
+    for path, emb, latency in results:
+        cos = np.sum(_unit(emb) * _unit(ref), axis=1)
+        top1 = _top1(emb, atlas, exclude)
+        same_id = float(np.mean(top1 == ref_top1))
+        same_cls = float(np.mean([atlas_classes[a] == atlas_classes[b] for a, b in zip(top1, ref_top1)]))
+        print(f"{os.path.basename(path):<36} {os.path.getsize(path) / 1e6:>6.1f} {latency * 1e3:>7.1f} "
+              f"{cos.mean():>9.5f} {cos.min():>8.5f} {same_id:>9.1%} {same_cls:>10.1%}")
+        if cos.min() < args.min_cosine or same_cls < args.min_agreement:
+            failures += 1
+    if args.check and failures:
+        print(f"{failures} variant(s) below --min-cosine {args.min_cosine} "
+              f"or --min-agreement {args.min_agreement}")
+        sys.exit(1)
+
+
+# ─── gemini: classification throughput against a simulated quota ───
+
+class ResourceExhausted(Exception):
+    """Same class name as google.api_core's 429 error."""
+
+
+class _FakeGeminiServer:
+    """GeminiClient.generate_content with fixed latency and a sliding-window RPM quota
+    (429 + retry hint).
+
+    Batched requests (parts labeled "EMBRIAO <i>") get a JSON array back, with
+    `drop_rate` of the entries omitted to exercise the single-call fallback.
+    Prompt tokens are estimated as chars / 4 + 258 per image.
+    """
+
+    def __init__(self, rpm: int, latency: float, drop_rate: float = 0.0):
+        self.rpm, self.latency, self.drop_rate = rpm, latency, drop_rate
+        self.lock = threading.Lock()
+        self.accepted = collections.deque()
+        self.rejected = 0
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.rng = np.random.default_rng(0)
+
+    def generate_content(self, model_name, api_key, parts, generation_config=None,
+                         system_instruction=None, timeout=30):
+        with self.lock:
+            now = time.monotonic()
+            while self.accepted and now - self.accepted[0] > 60:
+                self.accepted.popleft()
+            if len(self.accepted) >= self.rpm:
+                self.rejected += 1
+                retry = 60 - (now - self.accepted[0])
+                raise ResourceExhausted(f"429 Quota exceeded. Please retry in {retry:.1f}s.")
+            self.accepted.append(now)
+            self.requests += 1
+            texts = [p["text"] for p in parts if "text" in p]
+            tokens = sum(len(t) for t in texts) // 4 + 258 * (len(parts) - len(texts))
+            self.prompt_tokens += tokens
+            labels = sorted({int(m) for t in texts for m in re.findall(r"EMBRIAO (\d+) — IMAGEM 1", t)})
+            keep = [i for i in labels if self.rng.random() >= self.drop_rate]
+        time.sleep(self.latency)
+        answer = {"classification": "BN", "reasoning": "ok", "confidence": "high"}
+        text = json.dumps([dict(answer, embryo_index=i) for i in keep] if labels else answer)
+        return {"candidates": [{"content": {"parts": [{"text": text}]}, "finishReason": "STOP"}],
+                "usageMetadata": {"totalTokenCount": tokens + 300 * max(1, len(labels))}}
+
+
+def bench_gemini(args):
+    """Each mode starts with an empty result cache; "reprocess" reruns the same
+    embryos against the cache the "limiter" run filled (identical video)."""
+    crops = [cv2.imencode(".jpg", c)[1].tobytes() for c in _embryo_crops(args.embryos)]
+    req = pipeline.AnalyzeRequest(gemini_api_key="bench", model_name="bench")
+    pipeline.GEMINI_CALL_SECONDS = args.latency
+    print(f"{args.embryos} embryos, quota {args.rpm} RPM, {args.latency}s per call")
+    print(f"{'mode':>10} {'K':>3} {'workers':>8} {'wall s':>8} {'requests':>9} {'prompt tok':>11} "
+          f"{'429s':>5} {'pending':>8}")
+    modes = [("serial", 1), ("limiter", 1), ("reprocess", 1)] + [("batched", k) for k in args.batch_sizes]
+    filled_cache = None
+    for mode, k in modes:
+        if mode == "reprocess":
+            pipeline._gemini_cache = filled_cache
+        else:
+            pipeline._gemini_cache = pipeline.GeminiResultCache(table="")
+        if mode == "limiter":
+            filled_cache = pipeline._gemini_cache
+        server = _FakeGeminiServer(args.server_rpm or args.rpm, args.latency, args.drop_rate)
+        pipeline.gemini_http = server
+        limiter = pipeline.GeminiRateLimiter(
+            args.rpm if mode != "serial" else 10 ** 6, pipeline.GEMINI_TPM,
+            args.latency, pipeline.GEMINI_MAX_CONCURRENCY)
+        pipeline._gemini_limiters["bench"] = limiter
+        workers = limiter.concurrency() if mode != "serial" else 1
+        results = [{"index": i, "_crop_jpg": crop, "_motion_jpg": crop, "activity_score": 50,
+                    "kinetic_profile": {}, "nsd": 1.0, "anr": 1.0} for i, crop in enumerate(crops)]
+        groups = [results[i:i + k] for i in range(0, len(results), k)]
+        deadline = time.time() + args.deadline
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            analyses = [a for batch in pool.map(
+                lambda g: pipeline._classify_embryo_results(g, req, deadline), groups) for a in batch]
+        wall = time.perf_counter() - t0
+        pending = sum(a["classification"] == "Pending" for a in analyses)
+        print(f"{mode:>10} {k:>3} {workers:>8} {wall:>8.1f} {server.requests:>9} "
+              f"{server.prompt_tokens:>11} {server.rejected:>5} {pending:>8}")
+    print(f"cache after reprocess: {filled_cache.snapshot()}")
+
+
+# ─── gemini-http: per-call client overhead, model time excluded ───
+
+class _InstantGeminiHandler(http.server.BaseHTTPRequestHandler):
+    """Answers generateContent immediately (or after server.latency), keep-alive."""
+    protocol_version = "HTTP/1.1"
+    _BODY = json.dumps({
+        "candidates": [{"content": {"parts": [{"text": '{"classification": "BN"}'}]},
+                        "finishReason": "STOP"}],
+        "usageMetadata": {"totalTokenCount": 1500},
+    }).encode()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self._BODY)))
+        self.end_headers()
+        self.wfile.write(self._BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_tls_server(tmpdir: str, latency: float):
+    """Local HTTPS server with a throwaway self-signed cert (openssl CLI)."""
+    cert, key = os.path.join(tmpdir, "cert.pem"), os.path.join(tmpdir, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _InstantGeminiHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert, key)
+    server.socket = ctx.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"https://127.0.0.1:{server.server_address[1]}/v1beta"
+
+
+def _legacy_gemini_call(base_url: str, crop_jpg: bytes, motion_jpg: bytes, prompt: str):
+    """Old path: decode to PIL, SDK re-encodes each image, one-shot HTTPS request."""
+    import requests
+    from PIL import Image
+    parts = [{"text": prompt}]
+    for jpg in (crop_jpg, motion_jpg):
+        img = Image.open(io.BytesIO(jpg))
+        buf = io.BytesIO()
+        img.save(buf, format=img.format)  # What the SDK does with a PIL image
+        parts.append({"inline_data": {"mime_type": "image/jpeg",
+                                      "data": base64.b64encode(buf.getvalue()).decode()}})
+    resp = requests.post(f"{base_url}/models/bench:generateContent?key=bench",
+                         json={"contents": [{"parts": parts}]}, timeout=30, verify=False)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def bench_gemini_http(args):
+    import urllib3
+    from gemini_client import GeminiClient, jpeg_part, response_text, text_part
+    urllib3.disable_warnings()
+
+    crop, motion = (cv2.imencode(".jpg", c)[1].tobytes() for c in _embryo_crops(2))
+    prompt = pipeline._render_gemini_prompt(pipeline.DEFAULT_GEMINI_PROMPT, 50, {}, 1.0, 1.0)
+    tmpdir = tempfile.mkdtemp(prefix="gemini-http-")
+    server, base_url = _start_tls_server(tmpdir, 0.0)
+    try:
+        client = GeminiClient(base_url=base_url, verify=False)
+
+        def pooled():
+            data = client.generate_content(
+                "bench", "bench", [text_part(prompt), jpeg_part(crop), jpeg_part(motion)])
+            return response_text(data)
+
+        print(f"{args.calls} sequential calls, local TLS server, 0 ms model time "
+              f"(payload {len(crop) + len(motion)} B of JPEG)")
+        print(f"{'client':>22} {'mean ms':>8} {'p50 ms':>7} {'p95 ms':>7}")
+        for name, call in (("legacy (PIL+SDK+new)", lambda: _legacy_gemini_call(base_url, crop, motion, prompt)),
+                           ("pooled (bytes+reuse)", pooled)):
+            call()  # Connection / import warm-up outside the timing
+            lat = []
+            for _ in range(args.calls):
+                t = time.perf_counter()
+                call()
+                lat.append((time.perf_counter() - t) * 1000)
+            print(f"{name:>22} {np.mean(lat):>8.2f} {np.percentile(lat, 50):>7.2f} "
+                  f"{np.percentile(lat, 95):>7.2f}")
+        client.close()
+    finally:
+        server.shutdown()
+
+    # In-flight capacity from ONE calling thread against a slow server
+    server, base_url = _start_tls_server(tmpdir, args.server_latency)
+    try:
+        client = GeminiClient(base_url=base_url, verify=False, max_connections=args.in_flight)
+
+        async def burst():
+            await asyncio.gather(*(client.agenerate_content(
+                "bench", "bench", [text_part(prompt), jpeg_part(crop), jpeg_part(motion)])
+                for _ in range(args.in_flight)))
+
+        t0 = time.perf_counter()
+        asyncio.run(burst())
+        wall = time.perf_counter() - t0
+        print(f"{args.in_flight} concurrent calls from one thread, {args.server_latency}s server "
+              f"latency: wall {wall:.2f}s (serial would be {args.in_flight * args.server_latency:.1f}s)")
+        client.close()
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# ─── coldstart: process start → /health ready → first embeddings ───
+
+_COLDSTART_CHILD = r"""
+import json, os, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import numpy as np
+import app
+app.ONNX_MODEL_PATH = sys.argv[2]
+if hasattr(app, "ONNX_ORT_MODEL_PATH"):
+    app.ONNX_ORT_MODEL_PATH = sys.argv[3]
+t_import = time.perf_counter()
+if hasattr(app, "_warm_up_onnx"):
+    app._warm_up_onnx()  # What the startup hook runs before /health turns 200
+t_ready = time.perf_counter()
+crops = [np.random.default_rng(i).integers(0, 255, (app.OUTPUT_SIZE, app.OUTPUT_SIZE, 3), dtype=np.uint8)
+         for i in range(int(sys.argv[4]))]
+lat = []
+for _ in range(2):
+    t = time.perf_counter()
+    app._ensure_onnx()
+    app._get_embeddings_batch(crops)
+    lat.append(time.perf_counter() - t)
+print(json.dumps({"import": t_import - t0, "ready": t_ready - t0, "first": lat[0], "second": lat[1]}))
+"""
+
+
+def bench_coldstart(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    variants = []
+    if args.baseline:
+        variants.append(("baseline", os.path.abspath(args.baseline), ""))
+    variants.append(("onnx", here, ""))  # "" = no ORT artifact
+    if args.ort_model:
+        variants.append(("ort", here, os.path.abspath(args.ort_model)))
+    model = os.path.abspath(args.model)
+    print(f"{'variant':>9} {'import s':>9} {'ready s':>8} {'1st req s':>10} {'2nd req s':>10} "
+          f"{'ready+1st':>10}")
+    for name, directory, ort_model in variants:
+        rows = []
+        for _ in range(args.repeat):
+            out = subprocess.run(
+                [sys.executable, "-c", _COLDSTART_CHILD, directory, model, ort_model, str(args.crops)],
+                check=True, capture_output=True, text=True).stdout
+            rows.append(json.loads(out.strip().splitlines()[-1]))
+        med = {k: float(np.median([r[k] for r in rows])) for k in rows[0]}
+        print(f"{name:>9} {med['import']:>9.2f} {med['ready']:>8.2f} {med['first']:>10.2f} "
+              f"{med['second']:>10.2f} {med['ready'] + med['first']:>10.2f}")
+
+
+# ─── stages: end-to-end /analyze wall clock with simulated network ───
+
+class _FakeQuery:
+    """Chainable stand-in for a supabase-py query builder; every call is a no-op."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        time.sleep(self.latency)
+        return type("Resp", (), {"data": [], "count": 0})()
+
+
+class _FakeBucket:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def upload(self, path, data, options=None):
+        time.sleep(self.latency)
+
+
+class _FakeSupabase:
+    """Supabase client with fixed per-call latency (DB query / Storage upload)."""
+
+    def __init__(self, db_latency: float, upload_latency: float):
+        self.db_latency = db_latency
+        self.storage = type("Storage", (), {
+            "from_": staticmethod(lambda bucket: _FakeBucket(upload_latency))})()
+
+    def table(self, name):
+        return _FakeQuery(self.db_latency)
+
+
+def _patch_network(module, video: str, args):
+    """Swap the module's network edges for fixed-latency fakes (local run only)."""
+    fake_sb = _FakeSupabase(args.db_latency, args.upload_latency)
+
+    def _download(url, retries=2):
+        time.sleep(args.download_latency)
+        fd, path = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+        shutil.copyfile(video, path)
+        return path
+
+    module._get_supabase = lambda url, key: fake_sb
+    module._download_video = _download
+    if hasattr(module, "_get_gemini_http"):
+        # Transport level: batching, the limiter, retries and the result cache all run
+        module.gemini_http = _FakeGeminiServer(10 ** 9, args.gemini_latency)
+        cache_cls = getattr(module, "GeminiResultCache", None) or module._GeminiResultCache
+        module._gemini_cache = cache_cls(table="")
+        module._gemini_limiters.clear()
+    else:  # Checkouts from before the shared Gemini client
+        def _gemini(*a, **kw):
+            time.sleep(args.gemini_latency)
+            return {"classification": "BN", "reasoning": "benchmark", "confidence": "high"}
+
+        module._ensure_gemini = lambda key: None
+        module._call_gemini_with_retry = _gemini
+
+
+def bench_stages(args):
+    width = int(round(args.height * 16 / 9))
+    tmpdir = tempfile.mkdtemp(prefix="embryoscore-stages-")
+    try:
+        video = args.video or _make_video(
+            os.path.join(tmpdir, "plate.mp4"), 30, args.seconds, 250, width, args.height)
+        runs = [("current", pipeline)]
+        if args.baseline:
+            runs.insert(0, ("baseline", _load_baseline(args.baseline)))
+        print(f"network: download {args.download_latency}s, upload {args.upload_latency}s/file, "
+              f"db {args.db_latency}s/query, gemini {args.gemini_latency}s/call")
+        for n in args.embryos:
+            bboxes = _plate_bboxes(n, width, args.height)
+            for name, module in runs:
+                _patch_network(module, video, args)
+                if args.budget:
+                    module.REQUEST_TIMEOUT_SECONDS = args.budget
+                req = module.AnalyzeRequest(
+                    video_url="file://bench", job_id="bench", gemini_api_key="bench",
+                    supabase_url="http://bench", supabase_key="bench", bboxes=bboxes)
+                if args.defer:
+                    # Saving is what makes /analyze stop before Gemini (fake DB: no rows)
+                    req.defer_classification = True
+                    req.lote_fiv_acasalamento_id = req.media_id = "bench"
+                t0 = time.perf_counter()
+                result = asyncio.run(module.analyze(req))
+                wall = time.perf_counter() - t0
+                print(f"{n:>3} embryos  {name:<9} wall {wall:6.2f}s  "
+                      f"embryos={len(result['embryos'])}")
+                timings = result.get("timings")
+                if timings:
+                    print(f"{'':>16}parallelism {timings['parallelism']:.2f} "
+                          f"(stage busy {timings['stage_busy_s']:.2f}s)")
+                    for stage, st in timings["stages"].items():
+                        print(f"{'':>16}{stage:<11} {st['start_s']:6.2f} → {st['end_s']:6.2f}s  "
+                              f"busy {st['busy_s']:6.2f}s  calls {st['calls']}")
+                if result.get("budget"):
+                    b = result["budget"]
+                    print(f"{'':>16}budget {b['limit_s']}s, {b['remaining_s']}s left, "
+                          f"plan {b['plan']}, deferred {b['deferred_classification']}")
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+# ─── claim: queue_id job context resolution → first byte of the video ───
+
+class _StopAtDownload(Exception):
+    pass
+
+
+class _ContextQuery:
+    """Answers the job-context reads/writes of /analyze after one round trip each."""
+
+    def __init__(self, sb, table: str):
+        self.sb, self.table, self.one = sb, table, False
+        self.count_mode = None
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def select(self, *args, count=None, **kwargs):
+        self.count_mode = count
+        return self
+
+    def single(self):
+        self.one = True
+        return self
+
+    maybe_single = single
+
+    def execute(self):
+        self.sb.call(self.table)
+        row = self.sb.rows.get(self.table, {})
+        data = row if self.one else [row]
+        return type("Resp", (), {"data": data, "count": self.sb.embryos if self.count_mode else None})()
+
+
+class _ContextSupabase:
+    def __init__(self, rt: float, rpc_extra: float, expected_count: int):
+        self.rt, self.rpc_extra, self.embryos = rt, rpc_extra, 6
+        self.calls: list[str] = []
+        self._lock = threading.Lock()
+        job = {"status": "pending", "media_id": "m1", "lote_fiv_acasalamento_id": "l1",
+               "expected_count": expected_count, "manual_bboxes": None, "embryo_offset": 0}
+        self.rows = {
+            "embryo_analysis_queue": job,
+            "acasalamento_embrioes_media": {"arquivo_path": "videos/plate.mp4"},
+            "embryo_score_config": {"calibration_prompt": None, "model_name": "gemini-2.5-flash"},
+            "embryo_score_secrets": {"key_value": "bench"},
+        }
+        sb = self
+        self.storage = type("Storage", (), {"from_": staticmethod(lambda bucket: type("Bucket", (), {
+            "create_signed_url": staticmethod(lambda path, ttl: (
+                sb.call("sign"), {"signedURL": f"https://bench/{path}?token=t"})[1]),
+        })())})()
+
+    def call(self, name: str, extra: float = 0.0):
+        with self._lock:
+            self.calls.append(name)
+        time.sleep(self.rt + extra)
+
+    def table(self, name):
+        return _ContextQuery(self, name)
+
+    def rpc(self, name, params):
+        sb = self
+
+        class _Rpc:
+            def execute(self):
+                if name == "claim_embryo_analysis_job":
+                    sb.call(name, sb.rpc_extra)
+                    job = dict(sb.rows["embryo_analysis_queue"])
+                    return type("Resp", (), {"data": {
+                        "outcome": "claimed", "job": job,
+                        "media_path": sb.rows["acasalamento_embrioes_media"]["arquivo_path"],
+                        "config": sb.rows["embryo_score_config"], "gemini_api_key": "bench",
+                        "expected_count": job["expected_count"] or sb.embryos}})()
+                sb.call(name)
+                return type("Resp", (), {"data": sb.rows["acasalamento_embrioes_media"]["arquivo_path"]})()
+        return _Rpc()
+
+
+def bench_claim(args):
+    runs = [("sequential", pipeline, False), ("rpc-serial", pipeline, True), ("rpc", pipeline, True)]
+    prefetch = pipeline._prefetch_video_url
+    if args.baseline:
+        runs.insert(0, ("baseline", _load_baseline(args.baseline), None))
+    print(f"{args.rt * 1e3:.0f} ms per Supabase round trip, claim RPC +{args.rpc_extra * 1e3:.0f} ms "
+          f"server time, expected_count={args.expected_count}, {args.repeat} runs")
+    print(f"{'mode':<11} {'calls':>5} {'to download s':>13} {'TTFB s':>7}  sequence")
+    logging.disable(logging.ERROR)  # The stop at the download is logged as a pipeline crash
+    for name, module, rpc in runs:
+        times, calls = [], []
+        for _ in range(args.repeat):
+            sb = _ContextSupabase(args.rt, args.rpc_extra, args.expected_count)
+            if rpc is not None:
+                module._claim_rpc_available = rpc
+            started = {}
+
+            def _download(url, retries=2):
+                started["t"] = time.perf_counter()
+                raise _StopAtDownload()
+
+            module._get_supabase = lambda url, key: sb
+            module._download_video = _download
+            module._ensure_onnx = lambda: None
+            if hasattr(module, "_ensure_gemini"):
+                module._ensure_gemini = lambda key: None
+            if module is pipeline:
+                # rpc-serial: sign only after the claim returns the media path
+                module._prefetch_video_url = (lambda sb, queue_id: None) if name == "rpc-serial" else prefetch
+            req = module.AnalyzeRequest(queue_id="q1", supabase_url="http://bench", supabase_key="bench")
+            t0 = time.perf_counter()
+            try:
+                asyncio.run(module.analyze(req))
+            except Exception:
+                pass  # analyze reports the stop as a pipeline failure
+            times.append(started["t"] - t0)
+            calls = list(sb.calls)
+        to_download = float(np.median(times))
+        # The video's first byte is one more round trip (the signed GET) away
+        print(f"{name:<11} {len(calls):>5} {to_download:>13.3f} {to_download + args.rt:>7.3f}  "
+              f"{' → '.join(calls[:10])}")
+    logging.disable(logging.NOTSET)
+
+
+# ─── config-cache: embryo_score_config / secrets lookups per job ───
+
+class _ConfigSupabase:
+    """embryo_score_config + embryo_score_secrets behind a fixed round trip; edit() changes the prompt."""
+
+    supabase_url = "http://bench"
+
+    def __init__(self, rt: float):
+        self.rt, self.reads, self.prompt = rt, 0, "v1"
+
+    def edit(self, prompt: str):
+        self.prompt = prompt
+
+    def table(self, name):
+        sb = self
+        row = ({"key_value": "bench"} if name == "embryo_score_secrets"
+               else {"calibration_prompt": None, "model_name": "gemini-2.5-flash"})
+
+        class _Q(_FakeQuery):
+            def execute(self):
+                time.sleep(sb.rt)
+                sb.reads += 1
+                if "model_name" in row:
+                    row["calibration_prompt"] = sb.prompt
+                return type("Resp", (), {"data": [row]})()
+        return _Q(0.0)
+
+
+def bench_config_cache(args):
+    print(f"{args.jobs} jobs every {args.interval * 1e3:.0f} ms, {args.rt * 1e3:.0f} ms per query, "
+          f"prompt edited after job {args.jobs // 2}")
+    print(f"{'mode':<14} {'blocked/job ms':>14} {'p99 ms':>7} {'DB reads':>8} {'edit visible after s':>20}")
+    for name, ttl in (("uncached", 0.0), (f"ttl {args.ttl:g}s", args.ttl)):
+        for cache in (pipeline._config_cache, pipeline._secrets_cache):
+            cache.ttl, cache.max_stale = ttl, ttl * pipeline.CACHE_MAX_STALE_FACTOR
+            cache.invalidate()
+        sb = _ConfigSupabase(args.rt)
+        blocked, edited_at, seen_after = [], None, None
+        for job in range(args.jobs):
+            if job == args.jobs // 2:
+                sb.edit("v2")
+                edited_at = time.perf_counter()
+            t = time.perf_counter()
+            config = pipeline._load_score_config(sb)
+            pipeline._load_gemini_key(sb, "")
+            blocked.append(time.perf_counter() - t)
+            if edited_at and seen_after is None and config.get("calibration_prompt") == "v2":
+                seen_after = time.perf_counter() - edited_at
+            time.sleep(args.interval)
+        print(f"{name:<14} {np.mean(blocked) * 1e3:>14.2f} {np.percentile(blocked, 99) * 1e3:>7.1f} "
+              f"{sb.reads:>8} {seen_after if seen_after is not None else float('nan'):>20.2f}")
+
+
+# ─── save: score persistence round trips per job ───
+
+class _RecordingQuery(_ContextQuery):
+    def execute(self):
+        self.sb.call(self.table)
+        rows = self.sb.rows.get(self.table, [])
+        return type("Resp", (), {"data": rows, "count": len(rows) if self.count_mode else None})()
+
+
+class _RecordingSupabase(_ContextSupabase):
+    """Counts every table / RPC round trip; answers the save + KNN reads with canned rows."""
+
+    def __init__(self, rt: float, n_embryos: int, n_refs: int = 200):
+        super().__init__(rt, 0.0, n_embryos)
+        self.rows = {
+            "embrioes": [{"id": f"e{i}", "classificacao": "BN" if i % 3 == 0 else None}
+                         for i in range(n_embryos)],
+            "embryo_references": [{"id": f"r{i}"} for i in range(n_refs)],
+        }
+        self.neighbors = [{"id": f"r{i}", "classification": "BN", "composite_score": 0.8}
+                          for i in range(10)]
+        self.search = 0.0  # Server time per KNN query
+
+    def table(self, name):
+        return _RecordingQuery(self, name)
+
+    def rpc(self, name, params):
+        sb = self
+
+        class _Rpc:
+            def execute(self):
+                sb.call(name)
+                if name == "save_embryo_analysis_results":
+                    scores = params["p_result"]["scores"]
+                    data = {"saved": len(scores), "skipped": [], "atlas": 0}
+                elif name == "match_embryos_batch":
+                    time.sleep(sb.search * len(params["query_embeddings"]))
+                    data = {"total_refs": len(sb.rows["embryo_references"]),
+                            "neighbors": [sb.neighbors] * len(params["query_embeddings"])}
+                else:
+                    time.sleep(sb.search)
+                    data = sb.neighbors
+                return type("Resp", (), {"data": data})()
+        return _Rpc()
+
+
+def _bench_results(n: int) -> list[dict]:
+    rng = np.random.default_rng(n)
+    return [{
+        "index": i, "crop_image_path": f"analysis/bench/embryo_{i}/crop.jpg",
+        "motion_map_path": f"analysis/bench/embryo_{i}/motion.jpg",
+        "nsd": 0.1, "anr": 0.2, "bg_std": 1.0, "activity_score": 40,
+        "kinetic_profile": {"activity_symmetry": 0.5},
+        "embedding": rng.standard_normal(384).astype(np.float32).tolist(),
+        "gemini_analysis": {"classification": "BN", "quality_grade": 1, "confidence": "high"},
+    } for i in range(n)]
+
+
+def bench_save(args):
+    print(f"{args.rt * 1e3:.0f} ms per Supabase round trip")
+    print(f"{'embryos':>7} {'knn':>5} {'mode':<11} {'round trips':>11} {'wall s':>7}")
+    pipeline.KNN_BACKEND = "rpc"  # Count the per-embryo KNN round trips
+    for n in args.embryos:
+        results = _bench_results(n)
+        req = pipeline.AnalyzeRequest(job_id="bench", media_id="m1", lote_fiv_acasalamento_id="l1")
+        for knn in (False, True):
+            for name, rpc in (("sequential", False), ("rpc", True)):
+                pipeline._save_rpc_available = rpc
+                sb = _RecordingSupabase(args.rt, n)
+                t0 = time.perf_counter()
+                pipeline._save_scores_to_db(sb, req, [dict(r) for r in results], [], "analysis/bench",
+                                            knn=knn)
+                wall = time.perf_counter() - t0
+                print(f"{n:>7} {str(knn):>5} {name:<11} {len(sb.calls):>11} {wall:>7.2f}")
+    pipeline._save_rpc_available = True
+
+
+def bench_knn(args):
+    runs = [("per-embryo", pipeline, False), ("batch", pipeline, True)]
+    if args.baseline:
+        runs.insert(0, ("baseline", _load_baseline(args.baseline), None))
+    print(f"{args.rt * 1e3:.0f} ms per Supabase round trip, {args.search * 1e3:.0f} ms server time "
+          f"per KNN query; save RPC disabled so only the KNN calls differ")
+    print(f"{'embryos':>7} {'mode':<11} {'knn round trips':>15} {'knn wall s':>10}")
+    for n in args.embryos:
+        results = _bench_results(n)
+        req = pipeline.AnalyzeRequest(job_id=f"bench-{n}", media_id="m1", lote_fiv_acasalamento_id="l1")
+        for name, module, batch in runs:
+            module.KNN_BACKEND = "rpc"
+            module._save_rpc_available = False
+            if batch is not None:
+                module._knn_batch_rpc_available = batch
+                module._knn_ref_counts.invalidate()
+            sb = _RecordingSupabase(args.rt, n)
+            sb.search = args.search
+            t0 = time.perf_counter()
+            module._score_records(sb, [dict(r) for r in results], True, req.job_id) if batch is not None \
+                else [module._score_record(dict(r), sb, True) for r in results]
+            wall = time.perf_counter() - t0
+            knn_calls = [c for c in sb.calls if c == "embryo_references" or c.startswith("match_embryos")]
+            print(f"{n:>7} {name:<11} {len(knn_calls):>15} {wall:>10.2f}")
+
+
+# ─── atlas: in-memory KNN index vs match_embryos_v2 ───
+
+class _AtlasSupabase:
+    """embryo_references as PostgREST pages (pgvector as text), for the index's full load."""
+
+    supabase_url = "http://bench"
+
+    def __init__(self, rows: list):
+        self.rows = sorted(rows, key=lambda r: r["id"])
+
+    def table(self, name):
+        sb = self
+
+        class _Q(_FakeQuery):
+            def __init__(self):
+                super().__init__(0.0)
+                self.after, self.n, self.head = None, None, False
+
+            def select(self, *args, count=None, head=False, **kwargs):
+                self.head = head
+                return self
+
+            def gt(self, column, value):
+                self.after = value
+                return self
+
+            def limit(self, n):
+                self.n = n
+                return self
+
+            def execute(self):
+                if self.head:
+                    return type("Resp", (), {"data": [], "count": len(sb.rows)})()
+                rows = [r for r in sb.rows if self.after is None or r["id"] > self.after][:self.n]
+                return type("Resp", (), {"data": rows})()
+        return _Q()
+
+
+def _atlas_rows(n: int, rng) -> list:
+    """DINOv2-like refs: 384-d clustered by class, zero-padded to 768; 10% without kinetics."""
+    classes = ["BE", "BN", "BX", "BL", "BI", "Mo", "Dg"]
+    centers = rng.standard_normal((len(classes), 384)).astype(np.float32)
+    rows = []
+    for i in range(n):
+        c = i % len(classes)
+        vec = centers[c] + 0.9 * rng.standard_normal(384).astype(np.float32)
+        kin = rng.random(3).round(4).tolist() if rng.random() > 0.1 else [None] * 3
+        rows.append({
+            "id": f"{i:08d}-ref", "classification": classes[c],
+            "embedding": json.dumps(np.concatenate([vec, np.zeros(384, np.float32)]).round(6).tolist()),
+            "kinetic_intensity": kin[0], "kinetic_harmony": kin[1], "kinetic_stability": kin[2],
+            "updated_at": "2026-10-16T12:00:00+00:00",
+        })
+    return rows, centers
+
+
+def _match_embryos_v2_reference(rows_vec, rows_kin, ids, query, qkin, p):
+    """Row-by-row transcription of the SQL (float64), the parity reference."""
+    qn = query / np.linalg.norm(query)
+    cand = []
+    for vec, kin, ref_id in zip(rows_vec, rows_kin, ids):
+        vis = float(vec @ qn / np.linalg.norm(vec))
+        if vis > p["min_similarity"]:
+            cand.append((vis, kin, ref_id))
+    cand = sorted(cand, key=lambda c: -c[0])[:p["visual_top_n"]]
+    scored = []
+    for vis, kin, ref_id in cand:
+        if qkin[0] is None or kin[0] is None:
+            comp = p["alpha"] * vis + p["beta"] * vis
+        else:
+            kin_sim = 1.0 - sum(abs((a or 0) - (b or 0)) for a, b in zip(kin, qkin)) / 3.0
+            comp = p["alpha"] * vis + p["beta"] * kin_sim
+        scored.append((comp, ref_id))
+    return [ref_id for _, ref_id in sorted(scored, key=lambda s: -s[0])[:p["match_count"]]]
+
+
+def bench_atlas(args):
+    rng = np.random.default_rng(0)
+    p = pipeline._KNN_PARAMS
+    print(f"{args.embryos} queries per plate; RPC path = 1 count + 1 match_embryos_v2 per embryo "
+          f"at {args.rt * 1e3:.0f} ms each (server search time not included)")
+    print(f"{'refs':>6} {'dtype':<8} {'matrix MB':>9} {'load s':>7} {'npz s':>6} {'plate ms':>8} "
+          f"{'per emb ms':>10} {'top-10 parity':>13} {'rpc plate s':>11}")
+    for n in args.refs:
+        rows, centers = _atlas_rows(n, rng)
+        queries = [np.concatenate([centers[i % len(centers)] + 0.9 * rng.standard_normal(384),
+                                   np.zeros(384)]).astype(np.float32) for i in range(args.embryos)]
+        qkin = [tuple(rng.random(3).round(4).tolist()) for _ in queries]
+        vecs = [np.array(json.loads(r["embedding"]), dtype=np.float64) for r in rows[:args.parity_refs]]
+        kins = [(r["kinetic_intensity"], r["kinetic_harmony"], r["kinetic_stability"])
+                for r in rows[:args.parity_refs]]
+        ids = [r["id"] for r in rows[:args.parity_refs]]
+        for dtype in (np.float32, np.float16):
+            index = AtlasIndex(dtype=dtype)
+            t0 = time.perf_counter()
+            index.sync(_AtlasSupabase(rows))
+            load = time.perf_counter() - t0
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "atlas.npz")
+                index.save_npz(path)
+                t0 = time.perf_counter()
+                AtlasIndex(dtype=dtype).load_npz(path)
+                npz = time.perf_counter() - t0
+            index.match_batch(queries, qkin, **p)  # Warm BLAS
+            times = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                index.match_batch(queries, qkin, **p)
+                times.append(time.perf_counter() - t0)
+            plate = float(np.median(times))
+
+            # Parity against the SQL transcription on a subset index (row-by-row is slow)
+            sub = AtlasIndex(dtype=dtype)
+            sub.sync(_AtlasSupabase(rows[:args.parity_refs]))
+            got = sub.match_batch(queries, qkin, **p)
+            same = sum([m["id"] for m in g] == _match_embryos_v2_reference(vecs, kins, ids, q, k, p)
+                       for g, q, k in zip(got, queries, qkin))
+            print(f"{n:>6} {np.dtype(dtype).name:<8} {index.snapshot()['matrix_mb']:>9.1f} {load:>7.2f} "
+                  f"{npz:>6.3f} {plate * 1e3:>8.2f} {plate * 1e3 / args.embryos:>10.3f} "
+                  f"{same:>6}/{len(queries):<6} {2 * args.embryos * args.rt:>11.2f}")
+
+
+# ─── embedding-storage: zero-padded vector(768) vs native halfvec(384) ───
+
+def _pgvector_bytes(dim: int, half: bool) -> int:
+    """On-disk size of one pgvector value: 8-byte header + 4 (vector) or 2 (halfvec) bytes per dim."""
+    return 8 + dim * (2 if half else 4)
+
+
+def bench_embedding_storage(args):
+    rng = np.random.default_rng(0)
+    p = pipeline._KNN_PARAMS
+    results = _bench_results(1)
+    layouts = (("padded", "vector(768)", 768, False), ("native", "halfvec(384)", 384, True))
+    print(f"{'layout':<7} {'column':<13} {'bytes/row':>9} {'JSON bytes':>10}")
+    for storage, column, dim, half in layouts:
+        pipeline.EMBEDDING_STORAGE = storage
+        record = pipeline._score_record(dict(results[0]))
+        payload = record[pipeline._embedding_layout()[1]]
+        print(f"{storage:<7} {column:<13} {_pgvector_bytes(dim, half):>9} {len(payload):>10}")
+    pipeline.EMBEDDING_STORAGE = "native"
+
+    print(f"\nKNN on the in-memory index, {args.embryos} queries per plate; parity = identical "
+          f"top-10 ids vs padded float32")
+    print(f"{'refs':>6} {'layout':<7} {'plate ms':>8} {'top-10 parity':>13}")
+    for n in args.refs:
+        rows, centers = _atlas_rows(n, rng)
+        native_rows = []
+        for r in rows:
+            vec = np.array(json.loads(r["embedding"])[:384], dtype=np.float16)  # halfvec round trip
+            native_rows.append({**r, "embedding_vits14": json.dumps(vec.astype(np.float32).tolist())})
+        queries = [centers[i % len(centers)] + 0.9 * rng.standard_normal(384) for i in range(args.embryos)]
+        qkin = [tuple(rng.random(3).round(4).tolist()) for _ in queries]
+        indexes = {
+            "padded": (AtlasIndex(), [np.concatenate([q, np.zeros(384)]) for q in queries], rows),
+            "native": (AtlasIndex(dim=384, column="embedding_vits14"), queries, native_rows),
+        }
+        expected = None
+        for name, (index, q, index_rows) in indexes.items():
+            index.sync(_AtlasSupabase(index_rows))
+            index.match_batch(q, qkin, **p)  # Warm BLAS
+            times = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                got = index.match_batch(q, qkin, **p)
+                times.append(time.perf_counter() - t0)
+            ids = [[m["id"] for m in g] for g in got]
+            expected = expected or ids
+            same = sum(a == b for a, b in zip(ids, expected))
+            print(f"{n:>6} {name:<7} {np.median(times) * 1e3:>8.2f} {same:>6}/{len(q):<6}")
+
+
+# ─── projection: reduced-dimension shortlist vs full-dimension KNN ───
+
+def _lowrank_atlas_index(n: int, rng, rank: int = 96, dim: int = 384):
+    """DINOv2-like ViT-S refs: class clusters in a rank-`rank` subspace with a decaying
+    spectrum plus a small isotropic residual, as AtlasIndex rows; 10% without kinetics."""
+    classes = ["BE", "BN", "BX", "BL", "BI", "Mo", "Dg"]
+    basis = np.linalg.qr(rng.standard_normal((dim, rank)))[0].T
+    scales = (1.0 / np.sqrt(np.arange(1, rank + 1))).astype(np.float32)
+    centers = rng.standard_normal((len(classes), rank)) * scales
+    latent = centers[np.arange(n) % len(classes)] + 0.8 * rng.standard_normal((n, rank)) * scales
+    vecs = (latent @ basis + 0.02 * rng.standard_normal((n, dim))).astype(np.float32)
+    index = AtlasIndex(dim=dim, column="embedding_vits14", model="dinov2_vits14")
+    index._upsert([
+        (f"{i:08d}-ref", classes[i % len(classes)], vecs[i] / np.linalg.norm(vecs[i]),
+         rng.random(3).round(4).tolist() if rng.random() > 0.1 else [np.nan] * 3)
+        for i in range(n)])
+    return index
+
+
+def bench_projection(args):
+    import fit_projection
+
+    rng = np.random.default_rng(0)
+    for n in args.refs:
+        index = _lowrank_atlas_index(n, rng)
+        unit = index._emb[:index.n]
+        for method in args.methods:
+            for dim in args.dim:
+                t0 = time.perf_counter()
+                projection = fit_projection.fit(unit, dim, method, "dinov2_vits14")
+                fit_s = time.perf_counter() - t0
+                rows = fit_projection.recall_report(index, projection, args.queries, args.factors,
+                                                    args.embryos, args.repeat)
+                print(f"\n{method} {dim}-d, fit {fit_s:.2f}s, {json.dumps(projection.stats)}")
+                fit_projection.print_report(rows, index.n, min(args.queries, index.n // 5), args.embryos)
+    print(f"\nembedding_reduced halfvec({pipeline.REDUCED_EMBEDDING_DIM}) = "
+          f"{_pgvector_bytes(pipeline.REDUCED_EMBEDDING_DIM, True)} B/row vs "
+          f"{_pgvector_bytes(384, True)} B for halfvec(384)")
+
+
+# ─── uploads: Storage upload wall time vs the slowest single file ───
+
+class _JitteryBucket:
+    """Storage bucket with log-normal upload latency and occasional transient errors."""
+
+    def __init__(self, median: float, sigma: float, error_rate: float, seed: int = 0):
+        self.median, self.sigma, self.error_rate = median, sigma, error_rate
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self.durations: list[float] = []
+
+    def upload(self, path, data, options=None):
+        with self._lock:
+            latency = float(self.median * self._rng.lognormal(0.0, self.sigma))
+            fail = self._rng.random() < self.error_rate
+        time.sleep(latency)
+        with self._lock:
+            self.durations.append(latency)
+        if fail:
+            raise ConnectionError("simulated 503")
+
+
+def bench_uploads(args):
+    pipeline.STORAGE_RETRY_BASE_SECONDS = args.retry_base
+    print(f"upload latency median {args.latency}s (sigma {args.sigma}), "
+          f"{args.error_rate:.0%} transient errors, concurrency {args.concurrency}")
+    print(f"{'embryos':>7} {'mode':<12} {'wall s':>7} {'sum s':>7} {'slowest s':>9} {'wall/slowest':>12}")
+    for n in args.embryos:
+        paths = ["plate_frame.jpg"] + [f"embryo_{i}/{name}.jpg" for i in range(n)
+                                       for name in ("crop", "motion")]
+        data = b"\xff" * 30_000
+
+        def per_embryo(sb):
+            # Previous layout: one pool task per embryo uploads crop then motion
+            def _task(i):
+                pipeline._upload_to_storage(sb, f"embryo_{i}/crop.jpg", data)
+                pipeline._upload_to_storage(sb, f"embryo_{i}/motion.jpg", data)
+            with ThreadPoolExecutor(max_workers=pipeline.PIPELINE_UPLOAD_WORKERS) as pool:
+                futures = [pool.submit(pipeline._upload_to_storage, sb, paths[0], data)]
+                futures += [pool.submit(_task, i) for i in range(n)]
+                for f in futures:
+                    f.result()
+
+        def uploader(sb):
+            with pipeline._StorageUploader(sb, max_workers=args.concurrency) as up:
+                for path in paths:
+                    up.submit(path, data)
+                pipeline._raise_failed_uploads(up.wait())
+
+        modes = [("per-embryo", per_embryo), ("uploader", uploader)]
+        if args.serial:
+            modes.insert(0, ("serial", lambda sb: [pipeline._upload_to_storage(sb, p, data)
+                                                   for p in paths]))
+        for name, run in modes:
+            bucket = _JitteryBucket(args.latency, args.sigma, args.error_rate, seed=n)
+            sb = type("Supabase", (), {"storage": type("Storage", (), {
+                "from_": staticmethod(lambda _bucket: bucket)})()})()
+            t0 = time.perf_counter()
+            run(sb)
+            wall = time.perf_counter() - t0
+            slowest = max(bucket.durations)
+            print(f"{n:>7} {name:<12} {wall:>7.2f} {sum(bucket.durations):>7.2f} "
+                  f"{slowest:>9.2f} {wall / slowest:>12.2f}")
+
+
+# ─── progress: per-job progress_message writes, blocking vs coalesced ───
+
+def bench_progress(args):
+    print(f"db {args.db_latency}s/write, {args.frames} frames, "
+          f"{args.frame_ms} ms per frame of work, interval {args.interval_ms} ms")
+    print(f"{'mode':<22} {'wall s':>7} {'in-loop blocked s':>17} {'final flush s':>13} {'writes':>7}")
+    for name, per_frame in (("blocking, 8 stages", False), ("coalesced, 8 stages", False),
+                            ("coalesced, per-frame %", True)):
+        sb = _FakeSupabase(args.db_latency, 0.0)
+        reporter = None
+        if name.startswith("coalesced"):
+            reporter = pipeline._ProgressReporter(sb, "bench", min_interval=args.interval_ms / 1000)
+        blocked, flush, writes = 0.0, 0.0, 0
+        t0 = time.perf_counter()
+        for i in range(args.frames):
+            stage_boundary = i % max(1, args.frames // 8) == 0
+            if stage_boundary or per_frame:
+                message = f"Etapa {i}" if not per_frame else None
+                t = time.perf_counter()
+                if reporter is None:
+                    sb.table("embryo_analysis_queue").update(
+                        {"progress_message": message}).eq("id", "bench").execute()
+                    writes += 1
+                elif per_frame:
+                    reporter.update_fraction("Analisando cinética...", i, args.frames)
+                else:
+                    reporter.update(message)
+                blocked += time.perf_counter() - t
+            time.sleep(args.frame_ms / 1000)
+        if reporter is not None:
+            t = time.perf_counter()
+            reporter.close(None)
+            flush = time.perf_counter() - t
+            writes = reporter.writes
+        wall = time.perf_counter() - t0
+        print(f"{name:<22} {wall:>7.2f} {blocked:>17.4f} {flush:>13.3f} {writes:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("decode", help="Frame sampling: per-sample seek vs decode-once walk")
+    p.add_argument("--video", nargs="*", help="Real videos (default: synthesize 30/60 fps)")
+    p.add_argument("--seconds", type=int, default=15)
+    p.add_argument("--gop", type=int, default=250, help="Keyframe interval for synthetic videos")
+    p.add_argument("--codec", default="libx264", help="libx264 or libx265")
+    p.add_argument("--repeat", type=int, default=1)
+    p.set_defaults(func=bench_decode)
+
+    p = sub.add_parser("accumulator", help="Streaming kinetics accumulator: time, memory, parity")
+    p.add_argument("--embryos", type=int, nargs="*", default=[5, 20, 50])
+    p.add_argument("--height", type=int, default=720)
+    p.add_argument("--frames", type=int, default=40)
+    p.add_argument("--modes", nargs="*", default=list(ACCUMULATOR_MODES),
+                   choices=list(ACCUMULATOR_MODES), help="First mode is the parity reference")
+    p.add_argument("--baseline", help="Directory with an older app.py; becomes the parity reference")
+    p.add_argument("--kinetics-only", action="store_true",
+                   help="Exclude best-crop resizing from the per-frame timings")
+    p.add_argument("--check", action="store_true",
+                   help="Exit 1 if any run differs from the reference by more than its tolerance")
+    p.add_argument("--tolerance", type=float, default=1e-5,
+                   help="Exact modes: max numeric |diff|; scores, categories and motion maps must match")
+    p.add_argument("--bg-tolerance", type=float, default=0.03,
+                   help="roi+sparse-bg: max relative diff of float metrics (the sparse grid's bg_std "
+                        "error bound, as in `background`); integer scores may differ by one")
+    p.set_defaults(func=bench_accumulator)
+
+    p = sub.add_parser("background", help="Sparse background noise grid vs full-pixel estimate")
+    p.add_argument("--video", nargs="*", help="Plate videos (default: synthetic plates)")
+    p.add_argument("--budgets", type=int, nargs="*", default=[16384, 65536])
+    p.add_argument("--frames", type=int, default=40)
+    p.add_argument("--tolerance", type=float, default=0.03, help="Max relative bg_std error")
+    p.add_argument("--timeline-tolerance", type=float, default=0.05,
+                   help="Max absolute error of any background diff timeline entry (gray levels)")
+    p.set_defaults(func=bench_background)
+
+    p = sub.add_parser("embed", help="DINOv2 ONNX: per-crop vs batched inference")
+    p.add_argument("--model", default=pipeline.ONNX_MODEL_PATH)
+    p.add_argument("--crops", type=int, nargs="*", default=[1, 8, 32])
+    p.add_argument("--batch-sizes", type=int, nargs="*", default=[1, 8, 16, 32])
+    p.add_argument("--baseline", help="Directory with an older app.py; becomes the parity reference")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_embed)
+
+    p = sub.add_parser("models", help="DINOv2 variants vs fp32: cosine, KNN top-1 agreement, latency")
+    p.add_argument("--variants", nargs="+", required=True,
+                   help="Model files; the first one (fp32) is the reference")
+    p.add_argument("--crops-dir", help="Stored embryo crops (default: synthetic)")
+    p.add_argument("--crops", type=int, default=64, help="Synthetic crop count without --crops-dir")
+    p.add_argument("--atlas", help="embryo_references export (JSON/JSONL: id, classification, embedding)")
+    p.add_argument("--latency-samples", type=int, default=16)
+    p.add_argument("--check", action="store_true", help="Exit 1 if a variant misses the thresholds")
+    p.add_argument("--min-cosine", type=float, default=0.98)
+    p.add_argument("--min-agreement", type=float, default=0.95,
+                   help="Min top-1 neighbour class agreement with fp32")
+    p.set_defaults(func=bench_models)
+
+    p = sub.add_parser("gemini", help="Gemini classification: serial vs rate-limited pool vs batched")
+    p.add_argument("--embryos", type=int, default=30)
+    p.add_argument("--rpm", type=int, default=60, help="Simulated per-key quota")
+    p.add_argument("--server-rpm", type=int,
+                   help="Quota actually enforced (default --rpm); lower it to exercise 429 retry hints")
+    p.add_argument("--latency", type=float, default=4.0, help="Seconds per generate_content")
+    p.add_argument("--deadline", type=float, default=250.0, help="Job deadline for the Gemini stage")
+    p.add_argument("--batch-sizes", type=int, nargs="*", default=[4, 8], help="K for batched mode")
+    p.add_argument("--drop-rate", type=float, default=0.0,
+                   help="Fraction of batch entries the fake model omits (fallback path)")
+    p.set_defaults(func=bench_gemini)
+
+    p = sub.add_parser("gemini-http", help="Gemini client overhead per call (no model time)")
+    p.add_argument("--calls", type=int, default=200)
+    p.add_argument("--in-flight", type=int, default=32, help="Concurrent calls for the burst test")
+    p.add_argument("--server-latency", type=float, default=0.5)
+    p.set_defaults(func=bench_gemini_http)
+
+    p = sub.add_parser("coldstart", help="Fresh-process startup, warm-up and first-request latency")
+    p.add_argument("--model", default=pipeline.ONNX_MODEL_PATH)
+    p.add_argument("--ort-model", help="Pre-optimized ORT-format artifact (convert_dino_to_onnx.py)")
+    p.add_argument("--baseline", help="Directory with an older app.py (lazy load in first request)")
+    p.add_argument("--crops", type=int, default=8, help="Embryo crops in the first request")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_coldstart)
+
+    p = sub.add_parser("stages", help="End-to-end /analyze wall clock and stage overlap")
+    p.add_argument("--video", help="Plate video (default: synthetic 30 fps)")
+    p.add_argument("--seconds", type=int, default=15)
+    p.add_argument("--height", type=int, default=720)
+    p.add_argument("--embryos", type=int, nargs="*", default=[5, 20])
+    p.add_argument("--baseline", help="Directory with an older app.py to compare against")
+    p.add_argument("--download-latency", type=float, default=1.0)
+    p.add_argument("--upload-latency", type=float, default=0.15)
+    p.add_argument("--db-latency", type=float, default=0.05)
+    p.add_argument("--gemini-latency", type=float, default=2.0)
+    p.add_argument("--budget", type=float,
+                   help="REQUEST_TIMEOUT_SECONDS for the run (exercises the deadline planner)")
+    p.add_argument("--defer", action="store_true",
+                   help="Deferred classification: /analyze stops before Gemini (see /classify)")
+    p.set_defaults(func=bench_stages)
+
+    p = sub.add_parser("claim", help="queue_id mode: job claim + context → video download start")
+    p.add_argument("--rt", type=float, default=0.04, help="Seconds per Supabase round trip")
+    p.add_argument("--rpc-extra", type=float, default=0.005, help="Extra server time of the claim RPC")
+    p.add_argument("--expected-count", type=int, default=0, help="0 exercises the embrioes count")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--baseline", help="Directory with an older app.py to compare against")
+    p.set_defaults(func=bench_claim)
+
+    p = sub.add_parser("save", help="Score persistence: sequential writes vs one RPC")
+    p.add_argument("--embryos", type=int, nargs="*", default=[5, 30])
+    p.add_argument("--rt", type=float, default=0.04)
+    p.set_defaults(func=bench_save)
+
+    p = sub.add_parser("knn", help="KNN round trips per plate: per-embryo RPCs vs match_embryos_batch")
+    p.add_argument("--embryos", type=int, nargs="+", default=[10, 30])
+    p.add_argument("--rt", type=float, default=0.04, help="Seconds per Supabase round trip")
+    p.add_argument("--search", type=float, default=0.005, help="Server seconds per KNN query")
+    p.add_argument("--baseline", help="Older checkout's cloud-run/embryoscore-pipeline directory")
+    p.set_defaults(func=bench_knn)
+
+    p = sub.add_parser("embedding-storage", help="Zero-padded vector(768) vs native halfvec(384): bytes, KNN")
+    p.add_argument("--refs", type=int, nargs="+", default=[1000, 10000])
+    p.add_argument("--embryos", type=int, default=30, help="Queries per plate")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_embedding_storage)
+
+    p = sub.add_parser("projection", help="Reduced-dimension shortlist vs full KNN: recall@10, class, latency")
+    p.add_argument("--refs", type=int, nargs="+", default=[5000, 10000, 50000])
+    p.add_argument("--dim", type=int, nargs="+", default=[128])
+    p.add_argument("--methods", nargs="+", choices=("pca", "random"), default=["pca", "random"])
+    p.add_argument("--factors", type=int, nargs="+", default=[1, 2, 4, 8])
+    p.add_argument("--queries", type=int, default=200, help="Held-out refs scored against both searches")
+    p.add_argument("--embryos", type=int, default=30, help="Queries per timed plate")
+    p.add_argument("--repeat", type=int, default=10)
+    p.set_defaults(func=bench_projection)
+
+    p = sub.add_parser("atlas", help="KNN: in-memory atlas index (one matmul per plate) vs per-embryo RPC")
+    p.add_argument("--refs", type=int, nargs="+", default=[1000, 10000, 50000])
+    p.add_argument("--embryos", type=int, default=30, help="Queries per plate")
+    p.add_argument("--parity-refs", type=int, default=1000, help="Atlas size for the SQL parity check")
+    p.add_argument("--rt", type=float, default=0.04, help="Seconds per Supabase round trip (RPC path)")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_atlas)
+
+    p = sub.add_parser("config-cache", help="Config/secrets lookups per job: uncached vs TTL cache")
+    p.add_argument("--jobs", type=int, default=200)
+    p.add_argument("--interval", type=float, default=0.02, help="Seconds between jobs")
+    p.add_argument("--rt", type=float, default=0.04)
+    p.add_argument("--ttl", type=float, default=1.0)
+    p.set_defaults(func=bench_config_cache)
+
+    p = sub.add_parser("progress", help="progress_message writes: blocking vs coalesced reporter")
+    p.add_argument("--frames", type=int, default=300)
+    p.add_argument("--frame-ms", type=float, default=10.0, help="Simulated work per frame")
+    p.add_argument("--db-latency", type=float, default=0.08)
+    p.add_argument("--interval-ms", type=int, default=pipeline.PROGRESS_MIN_INTERVAL_MS)
+    p.set_defaults(func=bench_progress)
+
+    p = sub.add_parser("uploads", help="Storage uploads: per-embryo serial pairs vs shared uploader")
+    p.add_argument("--embryos", type=int, nargs="*", default=[5, 20])
+    p.add_argument("--latency", type=float, default=0.15, help="Median seconds per upload")
+    p.add_argument("--sigma", type=float, default=0.5, help="Log-normal spread of upload latency")
+    p.add_argument("--error-rate", type=float, default=0.02)
+    p.add_argument("--retry-base", type=float, default=pipeline.STORAGE_RETRY_BASE_SECONDS)
+    p.add_argument("--concurrency", type=int, default=pipeline.STORAGE_UPLOAD_CONCURRENCY)
+    p.add_argument("--serial", action="store_true", help="Also time one-after-another uploads")
+    p.set_defaults(func=bench_uploads)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,46 @@
 """
-Convert DINOv2-ViT-S/14 to ONNX format.
+Build the DINOv2-ViT-S/14 model artifacts for the pipeline.
 
 Run this LOCALLY where PyTorch is installed (not in Cloud Run):
-    pip install torch torchvision onnx onnxscript
-    python convert_dino_to_onnx.py
+    pip install torch torchvision onnx onnxscript onnxruntime==1.17.0
+    python convert_dino_to_onnx.py                         # fp32 .onnx + .ort
+    python convert_dino_to_onnx.py --skip-export --variants int8-dynamic
+    python convert_dino_to_onnx.py --skip-export --variants int8-static \\
+        --calib-dir crops/                                 # stored crop.jpg files
 
-Output: dinov2_vits14.onnx (~85MB) — include in Docker build.
+Variants (app.py picks one at startup with DINO_MODEL_VARIANT):
+    fp32          dinov2_vits14.onnx (~85MB) + dinov2_vits14.ort
+    int8-dynamic  dinov2_vits14.int8-dynamic.{onnx,ort} — INT8 weights, activations
+                  quantized per batch at run time; no calibration data needed
+    int8-static   dinov2_vits14.int8-static.{onnx,ort} — INT8 weights + activations
+                  (QDQ, per-channel), ranges calibrated on real embryo crops
+
+The .ort files are the graph pre-optimized offline in ORT format; app.py loads
+them in preference to the .onnx. Build them with the onnxruntime version pinned
+in requirements.txt (ORT-format files must not be newer than the runtime that
+loads them). Copy only the variant you deploy next to app.py — every model file
+in this directory ends up in the image.
+
+Before switching a deployment to an INT8 variant, compare it against fp32:
+    python benchmark.py models --variants dinov2_vits14.onnx dinov2_vits14.int8-*.onnx \\
+        --crops-dir crops/ --atlas embryo_references.json
 """
 
-import torch
+import argparse
+import glob
+import os
+
+ONNX_PATH = "dinov2_vits14.onnx"
+VARIANTS = ("fp32", "int8-dynamic", "int8-static")
+
+
+def variant_stem(variant: str) -> str:
+    return "dinov2_vits14" if variant == "fp32" else f"dinov2_vits14.{variant}"
+
+
+def export_onnx(onnx_path: str = ONNX_PATH):
+    import torch
 
-def main():
     print("Loading DINOv2-ViT-S/14...")
     model = torch.hub.load('facebookresearch/dinov2', 'dinov2_vits14')
     model.eval()
@@ -19,7 +49,7 @@ def main():
 
     print("Exporting to ONNX (legacy exporter)...")
     torch.onnx.export(
-        model, dummy, "dinov2_vits14.onnx",
+        model, dummy, onnx_path,
         input_names=["image"],
         output_names=["embedding"],
         dynamic_axes={"image": {0: "batch"}, "embedding": {0: "batch"}},
@@ -27,8 +57,130 @@ def main():
         dynamo=False,  # Force legacy exporter (compatible with DINOv2)
     )
 
-    print("Done! Output: dinov2_vits14.onnx")
-    print("Copy this file to cloud-run/embryoscore-pipeline/ before deploying.")
+
+def optimize_to_ort(onnx_path: str, ort_path: str):
+    """Save the ORT-optimized graph in ORT format.
+
+    EXTENDED (not ALL): layout transforms applied by ALL are specific to the
+    build machine's CPU; the container applies those itself at load time.
+    """
+    import onnxruntime as ort
+
+    print(f"Optimizing {onnx_path} -> {ort_path} (onnxruntime {ort.__version__})...")
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    so.optimized_model_filepath = ort_path
+    so.add_session_config_entry("session.save_model_format", "ORT")
+    ort.InferenceSession(onnx_path, sess_options=so, providers=["CPUExecutionProvider"])
+
+
+def _pre_process(onnx_path: str) -> str:
+    """Shape inference + fusions the quantizer expects; returns a temp model path."""
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    out = onnx_path.replace(".onnx", ".preproc.onnx")
+    quant_pre_process(onnx_path, out, skip_symbolic_shape=False)
+    return out
+
+
+def quantize_dynamic_int8(onnx_path: str, out_path: str):
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    print(f"Dynamic INT8 quantization -> {out_path}...")
+    pre = _pre_process(onnx_path)
+    try:
+        quantize_dynamic(pre, out_path, weight_type=QuantType.QInt8, per_channel=True,
+                         op_types_to_quantize=["MatMul", "Gemm"])
+    finally:
+        os.remove(pre)
+
+
+class _CropCalibrationReader:
+    """Feeds stored embryo crops, preprocessed exactly as in app.py, in batches of 1."""
+
+    def __init__(self, paths: list[str], input_name: str = "image"):
+        import cv2
+        from app import _preprocess_for_dino
+
+        self.input_name = input_name
+        self._items = []
+        for path in paths:
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is not None:
+                self._items.append(_preprocess_for_dino([img]))
+        if not self._items:
+            raise SystemExit("No readable calibration crops")
+        self._iter = iter(self._items)
+
+    def get_next(self):
+        batch = next(self._iter, None)
+        return None if batch is None else {self.input_name: batch}
+
+    def rewind(self):
+        self._iter = iter(self._items)
+
+
+def quantize_static_int8(onnx_path: str, out_path: str, calib_dir: str, calib_count: int):
+    from onnxruntime.quantization import (
+        CalibrationMethod, QuantFormat, QuantType, quantize_static)
+
+    paths = sorted(
+        p for ext in ("jpg", "jpeg", "png")
+        for p in glob.glob(os.path.join(calib_dir, "**", f"*.{ext}"), recursive=True))
+    if not paths:
+        raise SystemExit(f"No calibration crops found under {calib_dir}")
+    paths = paths[:calib_count]
+    print(f"Static INT8 quantization -> {out_path} ({len(paths)} calibration crops)...")
+    reader = _CropCalibrationReader(paths)
+    pre = _pre_process(onnx_path)
+    try:
+        quantize_static(
+            pre, out_path, reader,
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+            op_types_to_quantize=["MatMul", "Gemm", "Conv"],
+            calibrate_method=CalibrationMethod.Percentile,
+            extra_options={"CalibPercentile": 99.99},
+        )
+    finally:
+        os.remove(pre)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--variants", nargs="*", default=["fp32"], choices=VARIANTS)
+    parser.add_argument("--skip-export", action="store_true",
+                        help="Reuse an existing dinov2_vits14.onnx (no PyTorch needed)")
+    parser.add_argument("--no-ort", action="store_true", help="Don't write the .ort artifacts")
+    parser.add_argument("--calib-dir", help="Stored embryo crops (crop.jpg) for int8-static")
+    parser.add_argument("--calib-count", type=int, default=300)
+    args = parser.parse_args()
+
+    if "int8-static" in args.variants and not args.calib_dir:
+        parser.error("int8-static needs --calib-dir")
+    if not args.skip_export:
+        export_onnx()
+
+    outputs = []
+    for variant in args.variants:
+        onnx_path = f"{variant_stem(variant)}.onnx"
+        if variant == "int8-dynamic":
+            quantize_dynamic_int8(ONNX_PATH, onnx_path)
+        elif variant == "int8-static":
+            quantize_static_int8(ONNX_PATH, onnx_path, args.calib_dir, args.calib_count)
+        outputs.append(onnx_path)
+        if not args.no_ort:
+            ort_path = f"{variant_stem(variant)}.ort"
+            optimize_to_ort(onnx_path, ort_path)
+            outputs.append(ort_path)
+
+    for path in outputs:
+        print(f"  {path}: {os.path.getsize(path) / 1e6:.1f} MB")
+    print("Done! Copy the deployed variant to cloud-run/embryoscore-pipeline/ and set "
+          "DINO_MODEL_VARIANT accordingly.")
 
 if __name__ == "__main__":
     main()
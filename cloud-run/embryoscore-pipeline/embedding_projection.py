@@ -0,0 +1,48 @@
+"""
+Reduced-dimension projection of atlas embeddings (fit_projection.py artifact).
+
+EmbeddingProjection maps one model's unit embeddings to short vectors whose
+L2 distances approximate the cosine distances of the originals. AtlasIndex
+and match_embryos_reduced use them only to shortlist candidates, which are
+then re-ranked at full dimension. Numpy only, so fit_projection.py and the
+tests can use it without the rest of the pipeline.
+"""
+
+import json
+
+import numpy as np
+
+
+class EmbeddingProjection:
+    """Linear map from one model's unit embeddings to a short vector.
+
+    reduced = (unit(x) - mean) @ components.T. Distances between reduced
+    vectors approximate distances between the unit vectors, so shortlisting by
+    reduced L2 distance approximates shortlisting by cosine. The version names
+    the artifact and tags the embedding_reduced values written with it.
+    """
+
+    def __init__(self, version: str, model: str, method: str, mean: np.ndarray,
+                 components: np.ndarray, stats: dict | None = None):
+        self.version = version
+        self.model = model
+        self.method = method
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.dim, self.source_dim = self.components.shape
+        self.stats = stats or {}
+
+    @classmethod
+    def load(cls, path: str) -> "EmbeddingProjection":
+        with np.load(path) as data:
+            return cls(str(data["version"]), str(data["model"]), str(data["method"]),
+                       data["mean"], data["components"], json.loads(str(data["stats"])))
+
+    def save(self, path: str):
+        np.savez(path, version=np.array(self.version), model=np.array(self.model),
+                 method=np.array(self.method), mean=self.mean, components=self.components,
+                 stats=np.array(json.dumps(self.stats)))
+
+    def project(self, unit: np.ndarray) -> np.ndarray:
+        """(n, source_dim) unit vectors → (n, dim) float32."""
+        return (np.asarray(unit, dtype=np.float32) - self.mean) @ self.components.T
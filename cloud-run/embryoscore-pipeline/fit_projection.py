@@ -0,0 +1,250 @@
+"""
+Fit the reduced-dimension embedding projection used for the atlas KNN shortlist.
+
+Run LOCALLY (not in Cloud Run), from this directory, with requirements.txt
+installed and SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY set (or an export):
+
+    python fit_projection.py                                 # PCA to 128-d of the dinov2_vits14 refs
+    python fit_projection.py --method random                 # Gaussian random projection instead
+    python fit_projection.py --atlas embryo_references.json  # JSON / JSONL export instead of the DB
+    python fit_projection.py --check --min-recall 0.95       # exit 1 below the recall gate
+    python fit_projection.py --write                         # register it + write embedding_reduced
+
+The projection is fit on the L2-normalized embeddings and saved as
+projections/<model>.<method><dim>.<hash>.npz (the version is a hash of the
+transform, so a refit of the same atlas gives the same file) next to a
+.report.json. The report compares KNN with the projection against the
+full-dimension search on held-out atlas rows, for several shortlist sizes
+(visual_top_n * factor):
+
+    recall@10   share of the full search's neighbor ids found
+    top-1 cls   same class for the first neighbor
+    vote cls    same KNN-voted classification (what embryo_scores stores)
+    plate ms    one match_batch over a plate of queries, in-process
+
+--write (needs 20261017000100_embedding_projection.sql and --dim 128) adds the
+embedding_projections row and writes every reference's embedding_reduced.
+Then deploy with the artifact in the image and
+EMBEDDING_PROJECTION_PATH=projections/<version>.npz
+PROJECTION_CANDIDATE_FACTOR=<factor from the report>. The in-process index
+only shortlists from PROJECTION_MIN_REFS refs on (default 10000): smaller
+atlases keep the exact full-dimension search, which is as fast there.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import app as pipeline
+from atlas_index import AtlasIndex
+from embedding_projection import EmbeddingProjection
+
+MODEL_DIMS = {"dinov2_vits14": 384, "dinov2_vitb14": 768}
+WRITE_PAGE_SIZE = 500
+
+
+# ─── Atlas ───────────────────────────────────────────────
+
+def load_atlas(model: str, path: str | None = None) -> "AtlasIndex":
+    """Full-dimension AtlasIndex of one model's refs, from the DB or an export."""
+    index = AtlasIndex(dim=MODEL_DIMS[model], column=pipeline._EMBEDDING_COLUMNS[model],
+                                 model=model)
+    if path is None:
+        url = os.environ.get("SUPABASE_URL", "")
+        key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
+        if not url or not key:
+            raise SystemExit("Set SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY, or pass --atlas")
+        index.sync(pipeline._get_supabase(url, key))
+        if not index.ready:
+            raise SystemExit("Atlas load failed (see the log above)")
+        return index
+
+    with open(path) as f:
+        text = f.read().strip()
+    rows = json.loads(text) if text.startswith("[") else [json.loads(l) for l in text.splitlines() if l]
+    rows = [_with_model_column(r) for r in rows]
+    index._upsert([index._parse(r) for r in rows if r.get("embedding_model") == model])
+    return index
+
+
+def _with_model_column(row: dict) -> dict:
+    """Exports predating the model columns only hold the legacy 768-d embedding:
+    route it like trg_route_legacy_embedding (zero tail = padded ViT-S/14)."""
+    if row.get("embedding_model") or not row.get("embedding"):
+        return row
+    vec = row["embedding"]
+    vec = json.loads(vec) if isinstance(vec, str) else vec
+    if not any(vec[384:]):
+        return {**row, "embedding_model": "dinov2_vits14", "embedding_vits14": vec[:384]}
+    return {**row, "embedding_model": "dinov2_vitb14", "embedding_vitb14": vec}
+
+
+def _parsed_rows(index, rows) -> list:
+    """AtlasIndex._parse tuples for the given row positions (valid embeddings only)."""
+    return [(index._ids[i], index._cls[i], index._emb[i].astype(np.float32),
+             index._kin[i].tolist()) for i in rows if index._valid[i]]
+
+
+# ─── Fit ─────────────────────────────────────────────────
+
+def fit(unit: np.ndarray, dim: int, method: str, model: str, seed: int = 0) -> EmbeddingProjection:
+    """PCA (top principal axes) or orthonormalized Gaussian projection of unit vectors."""
+    unit = unit.astype(np.float64)
+    mean = unit.mean(axis=0)
+    stats = {"refs": len(unit), "fitted_at": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+    if method == "pca":
+        _, s, vt = np.linalg.svd(unit - mean, full_matrices=False)
+        components = vt[:dim]
+        var = s ** 2
+        stats["explained_variance"] = round(float(var[:dim].sum() / var.sum()), 4)
+    else:
+        rng = np.random.default_rng(seed)
+        q, _ = np.linalg.qr(rng.standard_normal((unit.shape[1], dim)))
+        components = q.T
+        stats["seed"] = seed
+    mean, components = mean.astype(np.float32), components.astype(np.float32)
+    digest = hashlib.sha256(mean.tobytes() + components.tobytes()).hexdigest()[:8]
+    return EmbeddingProjection(f"{model}.{method}{dim}.{digest}", model, method, mean, components, stats)
+
+
+# ─── Report ──────────────────────────────────────────────
+
+def _median_ms(call, repeat: int) -> float:
+    call()  # Warm BLAS
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times)) * 1e3
+
+
+def recall_report(index, projection, queries: int = 200, factors=(1, 2, 4, 8),
+                  plate: int = 30, repeat: int = 10, seed: int = 0) -> list:
+    """One row per shortlist factor (plus the full search): agreement with the
+    full-dimension KNN for held-out atlas rows, and plate latency.
+
+    The held-out rows are removed from both indexes, so a query never finds itself.
+    """
+    p = pipeline._KNN_PARAMS
+    valid = np.flatnonzero(index._valid[:index.n])
+    held = np.random.default_rng(seed).permutation(valid)[:min(queries, len(valid) // 5)]
+    rest = np.setdiff1d(np.arange(index.n), held)
+    q_emb = index._emb[held].astype(np.float32)
+    q_kin = [tuple(None if np.isnan(v) else float(v) for v in index._kin[i]) for i in held]
+
+    full = AtlasIndex(dim=index.dim, column=index.column, model=index.model)
+    reduced = AtlasIndex(dim=index.dim, column=index.column, model=index.model, projection=projection)
+    for sub in (full, reduced):
+        sub._upsert(_parsed_rows(index, rest))
+
+    def votes(matches):
+        return [pipeline._knn_vote(m, full.n).get("combined_classification") for m in matches]
+
+    expected = full.match_batch(q_emb, q_kin, **p)
+    expected_votes = votes(expected)
+    plate_emb, plate_kin = q_emb[:plate], q_kin[:plate]
+    rows = [{"search": "full", "factor": None, "shortlist": full.n, "recall_at_10": 1.0,
+             "top1_class": 1.0, "vote_class": 1.0,
+             "plate_ms": round(_median_ms(lambda: full.match_batch(plate_emb, plate_kin, **p), repeat), 2)}]
+    for factor in factors:
+        got = reduced.match_batch(q_emb, q_kin, candidate_factor=factor, **p)
+        recall = [len({m["id"] for m in g} & {m["id"] for m in e}) / len(e)
+                  for g, e in zip(got, expected) if e]
+        top1 = [(g[0]["classification"] if g else None) == (e[0]["classification"] if e else None)
+                for g, e in zip(got, expected)]
+        vote = [a == b for a, b in zip(votes(got), expected_votes)]
+        ms = _median_ms(lambda: reduced.match_batch(plate_emb, plate_kin, candidate_factor=factor, **p), repeat)
+        rows.append({"search": f"{projection.method}{projection.dim}", "factor": factor,
+                     "shortlist": min(p["visual_top_n"] * factor, reduced.n),
+                     "recall_at_10": round(float(np.mean(recall)) if recall else 1.0, 4),
+                     "top1_class": round(float(np.mean(top1)), 4),
+                     "vote_class": round(float(np.mean(vote)), 4),
+                     "plate_ms": round(ms, 2)})
+    return rows
+
+
+def print_report(rows: list, refs: int, queries: int, plate: int):
+    print(f"{refs} refs, {queries} held-out queries, plate of {plate}")
+    print(f"{'search':<10} {'factor':>6} {'shortlist':>9} {'recall@10':>9} {'top-1 cls':>9} "
+          f"{'vote cls':>8} {'plate ms':>8}")
+    for r in rows:
+        print(f"{r['search']:<10} {r['factor'] or '-':>6} {r['shortlist']:>9} {r['recall_at_10']:>9.1%} "
+              f"{r['top1_class']:>9.1%} {r['vote_class']:>8.1%} {r['plate_ms']:>8.2f}")
+
+
+# ─── Write ───────────────────────────────────────────────
+
+def write(sb, projection, index, report: list):
+    """Register the version, then every reference's embedding_reduced in pages."""
+    if projection.dim != pipeline.REDUCED_EMBEDDING_DIM:
+        raise SystemExit(f"embedding_reduced holds {pipeline.REDUCED_EMBEDDING_DIM}-d vectors, "
+                         f"this projection is {projection.dim}-d")
+    sb.table('embedding_projections').upsert({
+        "version": projection.version,
+        "model": projection.model,
+        "method": projection.method,
+        "source_dim": projection.source_dim,
+        "dim": projection.dim,
+        "refs": projection.stats["refs"],
+        "report": {"stats": projection.stats, "rows": report},
+    }).execute()
+    rows = np.flatnonzero(index._valid[:index.n])
+    reduced = projection.project(index._emb[rows])
+    written = 0
+    for start in range(0, len(rows), WRITE_PAGE_SIZE):
+        page = [{"id": index._ids[i], "embedding_reduced": json.dumps(np.round(r, 6).tolist())}
+                for i, r in zip(rows[start:start + WRITE_PAGE_SIZE], reduced[start:start + WRITE_PAGE_SIZE])]
+        written += sb.rpc('set_reference_projection', {
+            "p_version": projection.version, "p_rows": page}).execute().data or 0
+    print(f"{written} embryo_references rows now carry {projection.version}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", choices=sorted(MODEL_DIMS), default=pipeline.EMBEDDING_MODEL)
+    parser.add_argument("--method", choices=("pca", "random"), default="pca")
+    parser.add_argument("--dim", type=int, default=pipeline.REDUCED_EMBEDDING_DIM)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--atlas", help="embryo_references export (JSON array or JSONL) instead of the DB")
+    parser.add_argument("--out", default="projections", help="Artifact directory")
+    parser.add_argument("--queries", type=int, default=200, help="Held-out atlas rows for the report")
+    parser.add_argument("--factors", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--plate", type=int, default=30, help="Queries per timed match_batch")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--check", action="store_true", help="Exit 1 if no factor reaches --min-recall")
+    parser.add_argument("--min-recall", type=float, default=0.95)
+    parser.add_argument("--write", action="store_true", help="Register the version and write embedding_reduced")
+    args = parser.parse_args()
+
+    index = load_atlas(args.model, args.atlas)
+    valid = np.flatnonzero(index._valid[:index.n])
+    if len(valid) <= args.dim:
+        raise SystemExit(f"{len(valid)} {args.model} refs: too few to fit {args.dim} dims")
+    projection = fit(index._emb[valid].astype(np.float32), args.dim, args.method, args.model, args.seed)
+    report = recall_report(index, projection, args.queries, args.factors, args.plate, args.repeat, args.seed)
+
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"{projection.version}.npz")
+    projection.save(path)
+    with open(os.path.join(args.out, f"{projection.version}.report.json"), "w") as f:
+        json.dump({"version": projection.version, "stats": projection.stats, "rows": report}, f, indent=2)
+    print(f"{path}: {projection.source_dim} → {projection.dim} dims, {json.dumps(projection.stats)}")
+    print_report(report, index.n, min(args.queries, len(valid) // 5), args.plate)
+
+    if args.check and max(r["recall_at_10"] for r in report[1:]) < args.min_recall:
+        print(f"No shortlist factor reaches --min-recall {args.min_recall}")
+        sys.exit(1)
+    if args.write:
+        write(pipeline._get_supabase(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_ROLE_KEY"]),
+              projection, index, report)
+
+
+if __name__ == "__main__":
+    main()
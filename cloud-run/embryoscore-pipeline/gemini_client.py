@@ -0,0 +1,121 @@
+"""
+Shared Gemini REST client (generateContent) for classification and OCR.
+
+One httpx.AsyncClient (HTTP/2, keep-alive pool) runs on a private event-loop
+thread, so connections and TLS sessions are reused by every call in the
+process and many requests can be in flight at once. Worker threads call
+generate_content() (blocks only the caller); async endpoints await
+agenerate_content(). Images go out as the JPEG bytes the pipeline already
+encoded (inline_data) — no decode / re-encode.
+"""
+
+import asyncio
+import base64
+import threading
+
+import httpx
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+
+
+class GeminiHTTPError(Exception):
+    """Non-2xx generateContent response. `code` and `response` feed the retry policy."""
+
+    def __init__(self, response: httpx.Response):
+        self.response = response
+        self.code = response.status_code
+        super().__init__(f"Gemini API error ({response.status_code}): {response.text[:500]}")
+
+
+def text_part(text: str) -> dict:
+    return {"text": text}
+
+
+def jpeg_part(data: bytes, mime_type: str = "image/jpeg") -> dict:
+    return {"inline_data": {"mime_type": mime_type, "data": base64.b64encode(data).decode("ascii")}}
+
+
+def response_text(data: dict) -> str:
+    """Concatenated text of the first candidate (what the SDK's response.text returns)."""
+    candidate = (data.get("candidates") or [{}])[0]
+    text = "".join(p.get("text", "") for p in (candidate.get("content") or {}).get("parts") or [])
+    if not text:
+        reason = candidate.get("finishReason") or (data.get("promptFeedback") or {}).get("blockReason")
+        raise ValueError(f"Gemini empty response (finishReason: {reason or 'UNKNOWN'})")
+    return text
+
+
+def total_tokens(data: dict) -> int | None:
+    return (data.get("usageMetadata") or {}).get("totalTokenCount")
+
+
+class GeminiClient:
+    def __init__(self, base_url: str = GEMINI_API_BASE, max_connections: int = 16,
+                 http2: bool = True, verify=True):
+        self.base_url = base_url.rstrip("/")
+        self._limits = httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_connections,
+                                    keepalive_expiry=120)
+        self._http2 = http2
+        self._verify = verify
+        self._client: httpx.AsyncClient | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="gemini-http", daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    async def _generate(self, model_name: str, api_key: str, parts: list[dict],
+                        generation_config: dict | None, system_instruction: str | None,
+                        timeout: float) -> dict:
+        if self._client is None:  # Created on the client loop, which owns it from then on
+            self._client = httpx.AsyncClient(http2=self._http2, limits=self._limits,
+                                             verify=self._verify, timeout=timeout)
+        payload = {"contents": [{"role": "user", "parts": parts}]}
+        if generation_config:
+            payload["generation_config"] = generation_config
+        if system_instruction:
+            payload["system_instruction"] = {"parts": [{"text": system_instruction}]}
+        response = await self._client.post(
+            f"{self.base_url}/models/{model_name}:generateContent",
+            json=payload,
+            headers={"x-goog-api-key": api_key},  # Header, not ?key=, so it never lands in URL logs
+            timeout=timeout,
+        )
+        if response.status_code != 200:
+            raise GeminiHTTPError(response)
+        return response.json()
+
+    def _submit(self, *args):
+        return asyncio.run_coroutine_threadsafe(self._generate(*args), self._ensure_loop())
+
+    def generate_content(self, model_name: str, api_key: str, parts: list[dict],
+                         generation_config: dict | None = None,
+                         system_instruction: str | None = None,
+                         timeout: float = 30) -> dict:
+        """Blocking call for worker threads. Returns the REST response JSON."""
+        return self._submit(model_name, api_key, parts, generation_config,
+                            system_instruction, timeout).result()
+
+    async def agenerate_content(self, model_name: str, api_key: str, parts: list[dict],
+                                generation_config: dict | None = None,
+                                system_instruction: str | None = None,
+                                timeout: float = 30) -> dict:
+        """Awaitable from any event loop (e.g. a FastAPI handler)."""
+        return await asyncio.wrap_future(self._submit(
+            model_name, api_key, parts, generation_config, system_instruction, timeout))
+
+    def close(self):
+        with self._lock:
+            loop, client = self._loop, self._client
+            self._loop = self._client = None
+        if loop is None:
+            return
+        if client is not None:
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
@@ -0,0 +1,206 @@
+"""
+Gemini quota handling and result cache shared by every job of the process.
+
+GeminiRateLimiter keeps one API key under its RPM/TPM quota across all
+threads (token buckets, 429 pauses); is_rate_limit_error/retry_delay read
+the server's 429s. GeminiResultCache remembers successful assessments by
+content hash (in-process LRU + optional Supabase table). app.py owns the
+per-key limiter registry, the retry policy and the env configuration.
+"""
+
+import collections
+import hashlib
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# ─── Rate limiting ─────────────────────────────────────
+
+class TokenBucket:
+    """Continuously refilled bucket: `per_minute` units/min, bursts up to 10 s worth."""
+
+    def __init__(self, per_minute: float):
+        self.rate = max(per_minute, 1) / 60.0
+        self.capacity = max(1.0, per_minute / 6.0)
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        # May go negative (token reconciliation) — later callers wait it out
+        self.level -= min(amount, self.capacity)
+
+
+class GeminiRateLimiter:
+    """Process-wide RPM + TPM limiter for one API key, shared by every job and thread.
+
+    acquire() blocks until both buckets admit the call. Token use is estimated
+    up front and settled against usage_metadata afterwards. A 429 pauses every
+    caller of the key for the server's retry delay (pause()).
+    """
+
+    def __init__(self, rpm: int, tpm: int, call_seconds: float = 6.0, max_concurrency: int = 8):
+        self.rpm, self.tpm = rpm, tpm
+        self.call_seconds, self.max_concurrency = call_seconds, max_concurrency
+        self._cond = threading.Condition()
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._paused_until = 0.0
+
+    def acquire(self, est_tokens: int, deadline: float | None = None) -> bool:
+        """Block until admitted. False if admission would land after `deadline` (time.time())."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = max(self._paused_until - now,
+                           self._requests.wait_time(1, now),
+                           self._tokens.wait_time(est_tokens, now))
+                if wait <= 0:
+                    self._requests.take(1)
+                    self._tokens.take(est_tokens)
+                    return True
+                if deadline is not None and time.time() + wait > deadline:
+                    return False
+                self._cond.wait(wait)
+
+    def settle(self, est_tokens: int, actual_tokens: int | None):
+        if actual_tokens is None:
+            return
+        with self._cond:
+            self._tokens.level -= actual_tokens - est_tokens
+            self._cond.notify_all()
+
+    def pause(self, seconds: float):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def concurrency(self) -> int:
+        """Workers needed to use the RPM quota at call_seconds per call (Little's law),
+        capped at max_concurrency."""
+        needed = -(-self.rpm * self.call_seconds // 60)  # ceil
+        return int(max(1, min(self.max_concurrency, needed)))
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    return (type(e).__name__ in ("ResourceExhausted", "TooManyRequests")
+            or getattr(e, "code", None) == 429
+            or "429" in str(e)[:200])
+
+
+def retry_delay(e: Exception) -> float | None:
+    """Server retry hint from a 429: Retry-After header or google.rpc.RetryInfo delay."""
+    response = getattr(e, "response", None)
+    retry_after = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    text = str(e)
+    for pattern in (r'retry_delay\s*\{\s*seconds:\s*(\d+)',   # RetryInfo (gRPC repr)
+                    r'"retryDelay":\s*"([\d.]+)s"',              # RetryInfo (REST JSON)
+                    r'retry in ([\d.]+)\s*s'):                   # "Please retry in 37.2s."
+        match = re.search(pattern, text, re.IGNORECASE)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class GeminiDeadlineExceeded(Exception):
+    """Rate-limit wait for a Gemini call would run past the job deadline."""
+
+
+# ─── Result cache ──────────────────────────────────────
+
+class GeminiResultCache:
+    """Content-addressed cache of successful Gemini assessments.
+
+    Key = sha256(crop JPEG, motion JPEG, resolved prompt, model_name), so a
+    reprocessed job with byte-identical crops and the same prompt/model costs
+    no Gemini call. Answers from a batched call are keyed by what the batch
+    asked about that embryo (_batch_cache_prompt), never by the single-call
+    prompt. Tier 1 is a bounded in-process LRU; tier 2 (optional) is `table`
+    (app.py GEMINI_CACHE_TABLE), shared across instances. Tier-2 errors are
+    logged and treated as misses — the cache never fails a job.
+    """
+
+    def __init__(self, max_entries: int = 1024, table: str = "gemini_result_cache"):
+        self.max_entries = max_entries
+        self.table = table
+        self._lru: collections.OrderedDict[str, dict] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "table_hits": 0, "misses": 0, "stores": 0, "table_errors": 0}
+
+    @staticmethod
+    def key(crop_jpg: bytes, motion_jpg: bytes, prompt: str, model_name: str) -> str:
+        h = hashlib.sha256()
+        for part in (crop_jpg or b"", motion_jpg or b"", prompt.encode("utf-8"), model_name.encode("utf-8")):
+            h.update(hashlib.sha256(part).digest())  # Hash of hashes: no ambiguity at part boundaries
+        return h.hexdigest()
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _remember(self, key: str, result: dict):
+        with self._lock:
+            self._lru[key] = result
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def get(self, keys: list[str], sb=None) -> dict | None:
+        """First cached result among `keys` (in order); one table round trip at most."""
+        with self._lock:
+            for key in keys:
+                result = self._lru.get(key)
+                if result is not None:
+                    self._lru.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return dict(result)
+        if sb is not None and self.table:
+            try:
+                rows = sb.table(self.table).select('cache_key, result').in_('cache_key', keys).execute()
+                found = {row["cache_key"]: row["result"] for row in rows.data or []}
+                key = next((k for k in keys if k in found), None)
+                if key is not None:
+                    self._remember(key, found[key])
+                    self._count("table_hits")
+                    return dict(found[key])
+            except Exception as e:
+                self._count("table_errors")
+                logger.warning(f"Gemini cache read failed ({self.table}): {e}")
+        self._count("misses")
+        return None
+
+    def put(self, key: str, result: dict, model_name: str, sb=None):
+        if result.get("classification") in (None, "Pending", "Error", "Unknown"):
+            return  # Only cache real assessments
+        self._remember(key, dict(result))
+        self._count("stores")
+        if sb is not None and self.table:
+            try:
+                sb.table(self.table).upsert({
+                    'cache_key': key,
+                    'model_name': model_name,
+                    'result': result,
+                }).execute()
+            except Exception as e:
+                self._count("table_errors")
+                logger.warning(f"Gemini cache write failed ({self.table}): {e}")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, entries=len(self._lru))
@@ -0,0 +1,181 @@
+"""
+Pipeline tests: run from cloud-run/embryoscore-pipeline with
+
+    python -m pytest tests
+
+Supabase is replaced by FakeSupabase, an in-memory stand-in for the few
+supabase-py query-builder calls the pipeline makes (no network, no project).
+"""
+
+import os
+import re
+import sys
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from atlas_index import parse_timestamp  # noqa: E402
+
+
+class FakeError(Exception):
+    """PostgREST error as supabase-py raises it (message + code)."""
+
+    def __init__(self, message: str, code: str | None = None):
+        super().__init__(message)
+        self.code = code
+
+
+# updated_at.gt."<ts>",and(updated_at.eq."<ts>",id.gt.<id>) — AtlasIndex's keyset filter
+_KEYSET = re.compile(r'updated_at\.gt\."([^"]+)",and\(updated_at\.eq\."([^"]+)",id\.gt\.(.+)\)$')
+
+
+class FakeQuery:
+    """One table query: filters, order and limit applied to the table's rows on execute()."""
+
+    def __init__(self, db, table: str):
+        self.db, self.table = db, table
+        self.filters, self.order_by, self.n = [], [], None
+        self.columns, self.head, self.count = "*", False, None
+        self.op, self.payload = "select", None
+
+    def select(self, columns="*", count=None, head=False):
+        self.columns, self.count, self.head = columns, count, head
+        return self
+
+    def insert(self, rows):
+        self.op, self.payload = "insert", rows
+        return self
+
+    def update(self, values):
+        self.op, self.payload = "update", values
+        return self
+
+    def upsert(self, rows, on_conflict=None):
+        self.op, self.payload = "upsert", (rows, on_conflict)
+        return self
+
+    def _where(self, fn):
+        self.filters.append(fn)
+        return self
+
+    def eq(self, column, value):
+        return self._where(lambda r: r.get(column) == value)
+
+    def gt(self, column, value):
+        return self._where(lambda r: _cmp(r.get(column), value, column) > 0)
+
+    def gte(self, column, value):
+        return self._where(lambda r: _cmp(r.get(column), value, column) >= 0)
+
+    def lt(self, column, value):
+        return self._where(lambda r: _cmp(r.get(column), value, column) < 0)
+
+    def in_(self, column, values):
+        return self._where(lambda r: r.get(column) in values)
+
+    def or_(self, expr):
+        m = _KEYSET.match(expr)
+        assert m, f"unsupported or_ filter: {expr}"
+        ts, ref_id = parse_timestamp(m.group(1)), m.group(3)
+        return self._where(lambda r: (parse_timestamp(r["updated_at"]), r["id"]) > (ts, ref_id))
+
+    def order(self, column, desc=False):
+        self.order_by.append(column)
+        return self
+
+    def limit(self, n):
+        self.n = n
+        return self
+
+    def execute(self):
+        self.db.calls.append((self.table, self.op))
+        if self.table in self.db.errors:
+            raise self.db.errors[self.table]
+        rows = self.db.tables.setdefault(self.table, [])
+        if self.op == "insert":
+            payload = self.payload if isinstance(self.payload, list) else [self.payload]
+            self.db.check_columns(self.table, payload)
+            now = datetime.now(timezone.utc).isoformat()  # created_at DEFAULT now()
+            rows.extend({"created_at": now, **r} for r in payload)
+            return SimpleNamespace(data=payload)
+        if self.op == "upsert":
+            payload, key = self.payload
+            payload = payload if isinstance(payload, list) else [payload]
+            key = key or self.db.primary_keys.get(self.table, "id")
+            self.db.check_columns(self.table, payload)
+            for new in payload:
+                old = next((r for r in rows if r.get(key) == new.get(key)), None)
+                if old is None:
+                    rows.append(dict(new))
+                else:
+                    old.update(new)
+            return SimpleNamespace(data=payload)
+        matched = [r for r in rows if all(f(r) for f in self.filters)]
+        if self.op == "update":
+            self.db.check_columns(self.table, [self.payload])
+            for r in matched:
+                r.update(self.payload)
+            return SimpleNamespace(data=matched)
+        self.db.check_columns(self.table, [dict.fromkeys(
+            c.strip() for c in self.columns.split(",") if c.strip() != "*")])
+        for column in reversed(self.order_by):
+            matched.sort(key=lambda r: _sort_key(r.get(column), column))
+        if self.n is not None:
+            matched = matched[:self.n]
+        return SimpleNamespace(data=[] if self.head else [dict(r) for r in matched],
+                               count=len(matched) if self.count else None)
+
+
+def _sort_key(value, column):
+    if not (column.endswith("_at") and isinstance(value, str)):
+        return value
+    ts = parse_timestamp(value)
+    # timestamptz: a value without offset is read in the session time zone (UTC)
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+
+def _cmp(a, b, column):
+    a, b = _sort_key(a, column), _sort_key(b, column)
+    return (a > b) - (a < b)
+
+
+class FakeSupabase:
+    """Tables as lists of dicts; `columns` restricts a table's schema (unknown
+    columns raise like PostgREST), `primary_keys` names upsert conflict targets
+    other than id, `rpcs` maps RPC names to callables, missing RPCs raise PGRST202."""
+
+    def __init__(self, url: str = "http://fake", tables=None, columns=None, rpcs=None,
+                 primary_keys=None):
+        self.supabase_url = url
+        self.tables = tables or {}
+        self.columns = columns or {}
+        self.primary_keys = primary_keys or {}
+        self.rpcs = rpcs or {}
+        self.errors = {}
+        self.calls = []
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def check_columns(self, table, rows):
+        allowed = self.columns.get(table)
+        if allowed is None:
+            return
+        for row in rows:
+            for column in row:
+                if column not in allowed:
+                    raise FakeError(f"Could not find the '{column}' column of '{table}' in the schema cache",
+                                    "PGRST204")
+
+    def rpc(self, name, params):
+        db = self
+
+        class _Call:
+            def execute(self):
+                db.calls.append(("rpc", name))
+                if name not in db.rpcs:
+                    raise FakeError(f"Could not find the function public.{name} in the schema cache",
+                                    "PGRST202")
+                return SimpleNamespace(data=db.rpcs[name](params))
+        return _Call()
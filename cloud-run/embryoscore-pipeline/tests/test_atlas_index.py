@@ -0,0 +1,119 @@
+import json
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from atlas_index import AtlasIndex, parse_timestamp
+from conftest import FakeSupabase
+
+
+def _ref(i: int, vec, updated_at: str, classification: str = "BE", model: str = "dinov2_vits14") -> dict:
+    return {
+        "id": f"{i:08d}-ref",
+        "classification": classification,
+        "embedding_vits14": json.dumps([round(float(v), 6) for v in vec]),
+        "embedding_model": model,
+        "kinetic_intensity": 0.5, "kinetic_harmony": 0.5, "kinetic_stability": 0.5,
+        "updated_at": updated_at,
+    }
+
+
+def _atlas(n: int = 30, dim: int = 16, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    vecs = rng.standard_normal((n, dim)).astype(np.float32)
+    rows = [_ref(i, v, "2026-10-16T12:00:00.12345+00:00") for i, v in enumerate(vecs)]
+    return FakeSupabase(tables={"embryo_references": rows}), vecs
+
+
+def _index(dim: int = 16, **kwargs) -> AtlasIndex:
+    return AtlasIndex(dim=dim, column="embedding_vits14", model="dinov2_vits14", page_size=7, **kwargs)
+
+
+@pytest.mark.parametrize("value, expected", [
+    # Postgres trims trailing zeros: 5-digit fraction (fromisoformat rejects it before 3.11)
+    ("2026-10-16T12:00:00.12345+00:00", datetime(2026, 10, 16, 12, 0, 0, 123450, timezone.utc)),
+    ("2026-10-16T12:00:00.1+00:00", datetime(2026, 10, 16, 12, 0, 0, 100000, timezone.utc)),
+    ("2026-10-16T12:00:00.123456Z", datetime(2026, 10, 16, 12, 0, 0, 123456, timezone.utc)),
+    ("2026-10-16T12:00:00+00:00", datetime(2026, 10, 16, 12, 0, 0, 0, timezone.utc)),
+    ("2026-10-16T12:00:00.1234567+00:00", datetime(2026, 10, 16, 12, 0, 0, 123456, timezone.utc)),
+])
+def test_parse_timestamp(value, expected):
+    assert parse_timestamp(value) == expected
+
+
+def test_full_load_pages_and_answers():
+    sb, vecs = _atlas()
+    index = _index()
+    index.sync(sb)
+    assert index.ready and index.n == len(vecs) and index.sync_errors == 0
+    assert index.watermark == (parse_timestamp("2026-10-16T12:00:00.12345+00:00"), "00000029-ref")
+
+    neighbors = index.match_batch(vecs[:3], [(0.5, 0.5, 0.5)] * 3, min_similarity=-1.0)
+    for i, found in enumerate(neighbors):
+        assert found[0]["id"] == f"{i:08d}-ref"
+        assert found[0]["visual_similarity"] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_incremental_sync_reads_only_changes():
+    sb, vecs = _atlas()
+    index = _index(sync_overlap=0)
+    index.sync(sb)
+    rows = sb.tables["embryo_references"]
+    # Moved ref + new ref, committed later with trimmed fractions
+    rows[0].update(_ref(0, -vecs[0], "2026-10-16T12:05:00.5+00:00", classification="Dg"))
+    rows.append(_ref(99, vecs[5], "2026-10-16T12:05:00.98765+00:00", classification="Mo"))
+    sb.calls.clear()
+    index.sync(sb)
+
+    assert index.sync_errors == 0 and index.loads == 1 and index.n == len(vecs) + 1
+    assert index.watermark == (parse_timestamp("2026-10-16T12:05:00.98765+00:00"), "00000099-ref")
+    found = index.match_batch([-vecs[0]], [(None, None, None)], min_similarity=-1.0)[0]
+    assert (found[0]["id"], found[0]["classification"]) == ("00000000-ref", "Dg")
+    found = index.match_batch([vecs[5]], [(None, None, None)], min_similarity=-1.0)[0]
+    assert {n["id"] for n in found[:2]} == {"00000005-ref", "00000099-ref"}
+
+
+def test_deletes_trigger_full_reload():
+    sb, vecs = _atlas()
+    index = _index()
+    index.sync(sb)
+    del sb.tables["embryo_references"][3]
+    index.sync(sb)
+    assert index.loads == 2 and index.n == len(vecs) - 1
+    assert all(n["id"] != "00000003-ref"
+               for n in index.match_batch([vecs[3]], [(None,) * 3], min_similarity=-1.0)[0])
+
+
+def test_sync_error_keeps_serving():
+    sb, vecs = _atlas()
+    index = _index()
+    index.sync(sb)
+    sb.errors["embryo_references"] = RuntimeError("connection reset")
+    index.sync(sb)
+    assert index.sync_errors == 1 and index.ready and index.n == len(vecs)
+
+
+def test_only_this_model_and_project():
+    sb, vecs = _atlas()
+    sb.tables["embryo_references"].append(
+        _ref(50, vecs[0], "2026-10-16T12:00:00+00:00", model="dinov2_vitb14"))
+    index = _index()
+    index.sync(sb)
+    assert index.n == len(vecs)
+    assert not index.ready_for(FakeSupabase(url="http://other-project"))
+
+
+def test_snapshot_round_trip(tmp_path):
+    sb, vecs = _atlas()
+    index = _index()
+    index.sync(sb)
+    path = str(tmp_path / "atlas.npz")
+    index.save_npz(path)
+
+    restored = _index()
+    assert restored.load_npz(path, scope=sb.supabase_url)
+    assert restored.n == index.n and restored.watermark == index.watermark
+    assert not _index().load_npz(path, scope="http://other-project")
+    query = [(None,) * 3]
+    assert restored.match_batch([vecs[7]], query) == index.match_batch([vecs[7]], query)
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+import app
+from conftest import FakeSupabase
+
+
+def _job(queue_id: str, status: str | None, minutes_ago: float) -> dict:
+    completed = datetime.utcnow() - timedelta(minutes=minutes_ago)
+    return {"id": queue_id, "classification_status": status,
+            "completed_at": completed.isoformat() + "+00:00"}
+
+
+def test_sweep_picks_only_stale_pending_jobs(monkeypatch):
+    sb = FakeSupabase(tables={"embryo_analysis_queue": [
+        _job("fresh", "pending", 1),            # Its own /classify call may still come
+        _job("lost", "pending", 30),
+        _job("stuck", "processing", 60),        # Instance died mid-classification
+        _job("done", "done", 30),
+        _job("ancient", "pending", 60 * 24 * 30),
+    ]})
+    monkeypatch.setattr(app, "_get_supabase", lambda url, key: sb)
+    classified = []
+    monkeypatch.setattr(app, "classify", lambda req: classified.append(req.queue_id) or {"queue_id": req.queue_id})
+
+    results = app._redrive_classifications("http://fake", "key")
+
+    assert classified == ["stuck", "lost"]  # Oldest first
+    assert [r["queue_id"] for r in results] == classified
+
+
+def test_sweep_continues_past_a_failing_job(monkeypatch):
+    sb = FakeSupabase(tables={"embryo_analysis_queue": [
+        _job("a", "pending", 40), _job("b", "pending", 20)]})
+    monkeypatch.setattr(app, "_get_supabase", lambda url, key: sb)
+
+    def classify(req):
+        if req.queue_id == "a":
+            raise app.HTTPException(500, "Gemini API key not configured")
+        return {"queue_id": req.queue_id, "classified": 1}
+    monkeypatch.setattr(app, "classify", classify)
+
+    results = app._redrive_classifications("http://fake", "key")
+
+    assert results == [{"queue_id": "a", "error": "Gemini API key not configured"},
+                       {"queue_id": "b", "classified": 1}]
+
+
+def test_opportunistic_sweep_is_rate_limited(monkeypatch):
+    started = []
+    monkeypatch.setattr(app, "_redrive_last", float("-inf"))
+    monkeypatch.setattr(app.threading, "Thread", lambda target, **kw: type(
+        "T", (), {"start": lambda self: started.append(target)})())
+
+    app._maybe_redrive_classifications("http://fake", "key")
+    app._maybe_redrive_classifications("http://fake", "key")
+
+    assert len(started) == 1
@@ -0,0 +1,53 @@
+import numpy as np
+
+from atlas_index import AtlasIndex
+from embedding_projection import EmbeddingProjection
+
+
+def _index(vecs: np.ndarray, projection=None, **kwargs) -> AtlasIndex:
+    index = AtlasIndex(dim=vecs.shape[1], projection=projection, **kwargs)
+    index._upsert([(f"{i:08d}-ref", "BE", v / np.linalg.norm(v), [np.nan] * 3)
+                   for i, v in enumerate(vecs)])
+    return index
+
+
+def _ids(index: AtlasIndex, queries: np.ndarray, **kwargs) -> list:
+    found = index.match_batch(queries, [(None,) * 3] * len(queries), min_similarity=-1.0, **kwargs)
+    return [[n["id"] for n in neighbors] for neighbors in found]
+
+
+def test_save_load_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    projection = EmbeddingProjection("dinov2_vits14.pca8.abcd1234", "dinov2_vits14", "pca",
+                                     rng.standard_normal(32), rng.standard_normal((8, 32)), {"refs": 10})
+    path = str(tmp_path / "projection.npz")
+    projection.save(path)
+
+    loaded = EmbeddingProjection.load(path)
+    assert (loaded.version, loaded.model, loaded.method, loaded.stats) == (
+        projection.version, projection.model, projection.method, projection.stats)
+    assert (loaded.dim, loaded.source_dim) == (8, 32)
+    x = rng.standard_normal((3, 32))
+    np.testing.assert_array_equal(loaded.project(x), projection.project(x))
+
+
+def test_exact_search_below_min_refs():
+    rng = np.random.default_rng(1)
+    vecs = rng.standard_normal((200, 32)).astype(np.float32)
+    # Useless projection (everything maps to 0): a shortlist on it is arbitrary
+    blind = EmbeddingProjection("blind", "m", "random", np.zeros(32), np.zeros((4, 32)))
+    queries = vecs[:5]
+
+    exact = _ids(_index(vecs), queries, visual_top_n=10, match_count=10)
+    assert _ids(_index(vecs, blind, projection_min_refs=201), queries,
+                visual_top_n=10, match_count=10, candidate_factor=2) == exact
+    assert _ids(_index(vecs, blind, projection_min_refs=200), queries,
+                visual_top_n=10, match_count=10, candidate_factor=2) != exact
+
+
+def test_shortlist_matches_exact_search_with_a_full_rank_projection():
+    rng = np.random.default_rng(2)
+    vecs = rng.standard_normal((300, 16)).astype(np.float32)
+    identity = EmbeddingProjection("identity", "m", "pca", np.zeros(16), np.eye(16))
+    queries = vecs[:5]
+    assert _ids(_index(vecs, identity), queries, candidate_factor=2) == _ids(_index(vecs), queries)
@@ -0,0 +1,90 @@
+import json
+import re
+import time
+
+import pytest
+
+import app
+from conftest import FakeSupabase
+
+
+class FakeGemini:
+    """generate_content that answers every embryo (batched requests get a JSON array)."""
+
+    def __init__(self):
+        self.calls = []
+
+    def generate_content(self, model_name, api_key, parts, generation_config=None,
+                         system_instruction=None, timeout=30):
+        texts = [p["text"] for p in parts if "text" in p]
+        labels = sorted({int(m) for t in texts for m in re.findall(r"EMBRIAO (\d+) — IMAGEM 1", t)})
+        self.calls.append(labels)
+        answer = {"classification": "BN", "reasoning": "ok", "confidence": "high"}
+        text = json.dumps([dict(answer, embryo_index=i) for i in labels] if labels else answer)
+        return {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    server = FakeGemini()
+    monkeypatch.setattr(app, "gemini_http", server)
+    monkeypatch.setattr(app, "_gemini_cache", app.GeminiResultCache(table="gemini_result_cache"))
+    monkeypatch.setattr(app, "_gemini_limiters", {})
+    return server
+
+
+def _results(n: int) -> list[dict]:
+    return [{"index": i, "_crop_jpg": b"crop%d" % i, "_motion_jpg": b"motion%d" % i,
+             "activity_score": 40 + i, "kinetic_profile": {"core_activity": i}, "nsd": 1.0, "anr": 2.0}
+            for i in range(n)]
+
+
+def _classify(results, sb=None):
+    req = app.AnalyzeRequest(gemini_api_key="key", model_name="gemini-test")
+    return app._classify_embryo_results(results, req, time.time() + 60, sb)
+
+
+def _single_key(result: dict) -> str:
+    prompt = app._render_gemini_prompt(app.DEFAULT_GEMINI_PROMPT, result["activity_score"],
+                                       result["kinetic_profile"], result["nsd"], result["anr"])
+    return app._gemini_cache.key(result["_crop_jpg"], result["_motion_jpg"], prompt, "gemini-test")
+
+
+def test_batch_answers_are_not_stored_under_the_single_prompt_key(gemini):
+    results = _results(3)
+    single_keys = [_single_key(r) for r in results]
+    _classify(results)
+
+    assert gemini.calls == [[0, 1, 2]]
+    assert all(app._gemini_cache.get([key]) is None for key in single_keys)
+    assert app._gemini_cache.snapshot()["stores"] == 3
+
+
+def test_batch_answers_are_reused_for_the_same_batch_prompt(gemini, monkeypatch):
+    _classify(_results(3))
+    assert [a["classification"] for a in _classify(_results(3))] == ["BN"] * 3
+    assert gemini.calls == [[0, 1, 2]]
+
+    monkeypatch.setattr(app, "GEMINI_BATCH_HEADER", app.GEMINI_BATCH_HEADER + "Nova regra.\n")
+    _classify(_results(3))
+    assert gemini.calls == [[0, 1, 2], [0, 1, 2]]
+
+
+def test_single_answers_keep_the_single_prompt_key(gemini):
+    result = _results(1)[0]
+    key = _single_key(result)
+    _classify([result])
+
+    assert gemini.calls == [[]]
+    assert app._gemini_cache.get([key])["classification"] == "BN"
+
+
+def test_table_tier_is_shared_across_instances(gemini, monkeypatch):
+    sb = FakeSupabase(tables={"gemini_result_cache": []}, primary_keys={"gemini_result_cache": "cache_key"})
+    _classify(_results(2), sb)
+    assert len(sb.tables["gemini_result_cache"]) == 2
+
+    monkeypatch.setattr(app, "_gemini_cache", app.GeminiResultCache(table="gemini_result_cache"))
+    _classify(_results(2), sb)
+    assert gemini.calls == [[0, 1]]
+    assert app._gemini_cache.snapshot()["table_hits"] == 2
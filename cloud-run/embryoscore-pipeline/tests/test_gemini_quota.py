@@ -0,0 +1,45 @@
+import time
+
+import pytest
+
+from gemini_quota import GeminiRateLimiter, is_rate_limit_error, retry_delay
+
+
+class ResourceExhausted(Exception):
+    pass
+
+
+@pytest.mark.parametrize("rpm, call_seconds, expected", [
+    (60, 6.0, 6),     # Little's law: 1 call/s x 6 s
+    (600, 6.0, 8),    # Capped at max_concurrency
+    (10, 0.5, 1),
+])
+def test_concurrency(rpm, call_seconds, expected):
+    assert GeminiRateLimiter(rpm, 10 ** 6, call_seconds, max_concurrency=8).concurrency() == expected
+
+
+def test_acquire_gives_up_when_the_wait_passes_the_deadline():
+    limiter = GeminiRateLimiter(rpm=6, tpm=10 ** 6)  # Burst of 1, then one call per 10 s
+    assert limiter.acquire(100, deadline=time.time() + 1)
+    assert not limiter.acquire(100, deadline=time.time() + 1)
+
+
+def test_pause_holds_every_caller():
+    limiter = GeminiRateLimiter(rpm=6000, tpm=10 ** 9)
+    limiter.pause(30)
+    assert not limiter.acquire(1, deadline=time.time() + 5)
+
+
+@pytest.mark.parametrize("error, delay", [
+    (ResourceExhausted("429 Quota exceeded. Please retry in 37.2s."), 37.2),
+    (Exception('429 {"error": {"details": [{"retryDelay": "12s"}]}}'), 12.0),
+    (Exception("429 retry_delay { seconds: 8 }"), 8.0),
+    (ResourceExhausted("429 Quota exceeded"), None),
+])
+def test_retry_delay(error, delay):
+    assert is_rate_limit_error(error)
+    assert retry_delay(error) == delay
+
+
+def test_other_errors_are_not_rate_limits():
+    assert not is_rate_limit_error(ValueError("Gemini empty response (finishReason: SAFETY)"))
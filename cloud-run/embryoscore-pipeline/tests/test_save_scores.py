@@ -0,0 +1,210 @@
+import json
+
+import numpy as np
+import pytest
+
+import app
+from atlas_index import AtlasIndex
+from conftest import FakeError, FakeSupabase
+
+# embryo_scores before 20261016000700_native_embeddings.sql
+_LEGACY_SCORE_COLUMNS = {
+    "id", "embriao_id", "media_id", "is_current", "created_at", "biologist_classification",
+    "classification", "confidence", "embryo_score", "transfer_recommendation", "gemini_classification",
+    "gemini_reasoning", "stage_code", "quality_grade", "visual_features", "ai_confidence", "reasoning",
+    "classification_status", "crop_image_path", "motion_map_path", "kinetic_intensity",
+    "kinetic_harmony", "kinetic_stability", "kinetic_bg_noise", "kinetic_inputs", "embedding",
+}
+_LEGACY_REFERENCE_COLUMNS = {
+    "id", "embriao_id", "classification", "embedding", "kinetic_intensity", "kinetic_harmony",
+    "kinetic_stability", "kinetic_bg_noise", "best_frame_path", "motion_map_path", "species",
+    "source", "lab_id",
+}
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(app, "_save_rpc_available", True)
+    monkeypatch.setattr(app, "_native_embeddings_available", None)
+    monkeypatch.setattr(app, "EMBEDDING_STORAGE", "native")
+    # As built at import, before any probe: native column
+    monkeypatch.setattr(app, "_embedding_projection", None)
+    monkeypatch.setattr(app, "_atlas_index", AtlasIndex(dim=384, column="embedding_vits14",
+                                                        model="dinov2_vits14"))
+
+
+def _results(n: int, classification: str = "BN") -> list[dict]:
+    rng = np.random.default_rng(n)
+    return [{
+        "index": i, "crop_image_path": f"analysis/q1/embryo_{i}/crop.jpg",
+        "motion_map_path": f"analysis/q1/embryo_{i}/motion.jpg",
+        "nsd": 0.1, "anr": 0.2, "bg_std": 1.0, "activity_score": 40,
+        "kinetic_profile": {"activity_symmetry": 0.5},
+        "embedding": rng.standard_normal(384).astype(np.float32).tolist(),
+        "gemini_analysis": {"classification": classification, "quality_grade": 1, "confidence": "high"},
+    } for i in range(n)]
+
+
+def _db(n: int, columns=None, rpcs=None) -> FakeSupabase:
+    return FakeSupabase(tables={
+        "embrioes": [{"id": f"e{i}", "queue_id": "q1", "identificacao": i,
+                      "classificacao": "BE" if i == 0 else None} for i in range(n)],
+        "embryo_analysis_queue": [{"id": "q1", "status": "processing"}],
+        "embryo_scores": [{"id": "old", "embriao_id": "e1", "is_current": True,
+                           "created_at": "2026-10-01T00:00:00+00:00"}],
+        "embryo_references": [],
+    }, columns=columns, rpcs=rpcs, primary_keys={"embryo_references": "embriao_id"})
+
+
+def _save(sb, results) -> bool:
+    req = app.AnalyzeRequest(job_id="q1", media_id="m1")
+    return app._save_scores_to_db(sb, req, results, [{"x_percent": 50}], "analysis/q1", knn=False)
+
+
+# ─── save_embryo_analysis_results (one RPC per job) ───
+
+def test_rpc_saves_everything_in_one_call():
+    saved = []
+
+    def rpc(params):
+        saved.append(params)
+        return {"saved": len(params["p_result"]["scores"]), "atlas": 1, "classification_pending": False}
+
+    sb = _db(3, rpcs={"save_embryo_analysis_results": rpc})
+    assert _save(sb, _results(3)) is False
+    assert [c for c in sb.calls if c[1] != "select"] == [("rpc", "save_embryo_analysis_results")]
+    (params,) = saved
+    assert params["p_queue_id"] == "q1"
+    assert params["p_result"]["media_id"] == "m1"
+    assert [s["index"] for s in params["p_result"]["scores"]] == [0, 1, 2]
+
+
+def test_rpc_reports_pending_classification():
+    sb = _db(2, rpcs={"save_embryo_analysis_results": lambda p: {"saved": 2, "classification_pending": True}})
+    assert _save(sb, _results(2, classification="Pending")) is True
+
+
+def test_missing_rpc_falls_back_to_sequential_writes_once():
+    sb = _db(3)
+    assert _save(sb, _results(3)) is False
+    assert app._save_rpc_available is False
+
+    scores = sb.tables["embryo_scores"]
+    current = [s for s in scores if s["is_current"]]
+    assert [s["embriao_id"] for s in current] == ["e0", "e1", "e2"]
+    assert {s["media_id"] for s in current} == {"m1"}
+    assert next(s for s in scores if s["id"] == "old")["is_current"] is False
+    assert current[0]["biologist_classification"] == "BE"
+    assert [r["embriao_id"] for r in sb.tables["embryo_references"]] == ["e0"]
+    assert sb.tables["embryo_analysis_queue"][0]["status"] == "completed"
+    assert sb.tables["embryo_analysis_queue"][0]["classification_status"] == "done"
+
+    sb.calls.clear()
+    _save(sb, _results(3))
+    assert ("rpc", "save_embryo_analysis_results") not in sb.calls
+
+
+def test_sequential_writes_the_rpc_payload():
+    saved = []
+    rpc_db = _db(3, rpcs={"save_embryo_analysis_results": lambda p: saved.append(p) or {"saved": 3}})
+    _save(rpc_db, _results(3))
+    app._save_rpc_available = False
+    sequential_db = _db(3)
+    _save(sequential_db, _results(3))
+
+    written = [s for s in sequential_db.tables["embryo_scores"] if s["is_current"]]
+    for record, row in zip(saved[0]["p_result"]["scores"], written):
+        assert {k: v for k, v in record.items() if k != "index"} == {
+            k: v for k, v in row.items()
+            if k not in ("embriao_id", "media_id", "is_current", "created_at", "biologist_classification")}
+
+
+def test_other_rpc_errors_are_raised():
+    def rpc(params):
+        raise FakeError("deadlock detected", "40P01")
+
+    sb = _db(1, rpcs={"save_embryo_analysis_results": rpc})
+    with pytest.raises(FakeError):
+        _save(sb, _results(1))
+    assert app._save_rpc_available is True
+
+
+# ─── Native embedding columns vs the legacy padded layout ───
+
+def test_native_columns_present():
+    saved = []
+    sb = _db(2, rpcs={"save_embryo_analysis_results": lambda p: saved.append(p) or {"saved": 2}})
+    _save(sb, _results(2))
+
+    assert app._native_embeddings_available is True
+    record = saved[0]["p_result"]["scores"][0]
+    assert record["embedding_model"] == "dinov2_vits14"
+    assert len(json.loads(record["embedding_vits14"])) == 384 and "embedding" not in record
+
+
+def test_probe_falls_back_to_padded_before_the_rpc():
+    # The RPC ignores unknown keys: without the probe the embeddings would be dropped
+    saved = []
+    sb = _db(2, columns={"embryo_scores": _LEGACY_SCORE_COLUMNS},
+             rpcs={"save_embryo_analysis_results": lambda p: saved.append(p) or {"saved": 2}})
+    _save(sb, _results(2))
+
+    assert app._native_embeddings_available is False
+    assert app._embedding_layout() == (None, "embedding", 768)
+    record = saved[0]["p_result"]["scores"][0]
+    assert "embedding_model" not in record and "embedding_vits14" not in record
+    vec = json.loads(record["embedding"])
+    assert len(vec) == 768 and not any(vec[384:])
+
+
+def test_probe_error_is_retried_on_the_next_save():
+    sb = _db(1, rpcs={"save_embryo_analysis_results": lambda p: {"saved": 1}})
+    sb.errors["embryo_scores"] = FakeError("connection reset")
+    app._check_native_embeddings(sb)
+    assert app._native_embeddings_available is None
+
+    del sb.errors["embryo_scores"]
+    app._check_native_embeddings(sb)
+    assert app._native_embeddings_available is True
+
+
+def test_sequential_insert_retries_in_the_padded_layout():
+    # Probe passed (e.g. columns dropped since), then the insert hits PGRST204
+    app._native_embeddings_available = True
+    app._save_rpc_available = False
+    sb = _db(2, columns={"embryo_scores": _LEGACY_SCORE_COLUMNS,
+                         "embryo_references": _LEGACY_REFERENCE_COLUMNS})
+    _save(sb, _results(2))
+
+    assert app._native_embeddings_available is False
+    current = [s for s in sb.tables["embryo_scores"] if s["is_current"]]
+    assert len(current) == 2
+    assert all(len(json.loads(s["embedding"])) == 768 for s in current)
+    (ref,) = sb.tables["embryo_references"]
+    assert ref["embriao_id"] == "e0" and len(json.loads(ref["embedding"])) == 768
+
+
+def test_atlas_index_follows_the_padded_fallback():
+    rng = np.random.default_rng(7)
+    vecs = rng.standard_normal((6, 384)).astype(np.float32)
+    sb = _db(2, columns={"embryo_scores": _LEGACY_SCORE_COLUMNS,
+                         "embryo_references": _LEGACY_REFERENCE_COLUMNS | {"updated_at"}},
+             rpcs={"save_embryo_analysis_results": lambda p: {"saved": 2}})
+    sb.tables["embryo_references"] = [{
+        "id": f"r{i}", "embriao_id": f"x{i}", "classification": "BN" if i else "BE",
+        "embedding": json.dumps(v.tolist() + [0.0] * 384),
+        "kinetic_intensity": 0.1, "kinetic_harmony": 0.5, "kinetic_stability": 0.9,
+        "updated_at": "2026-10-16T12:00:00+00:00",
+    } for i, v in enumerate(vecs)]
+    _save(sb, _results(2))
+
+    index = app._atlas_index
+    assert (index.column, index.dim, index.model) == ("embedding", 768, None)
+    assert not index.ready and index.n == 0  # Native rows dropped; a full load is due
+    index.sync(sb)
+    assert index.sync_errors == 0 and index.n == 6
+
+    sb.calls.clear()
+    (knn,) = app._knn_lookup_batch(sb, [(vecs[0].tolist() + [0.0] * 384, 0.1, 0.5, 0.9)])
+    assert knn["knn_real_bovine_count"] == 6 and knn["knn_neighbor_ids"][0] == "r0"
+    assert not any(c[0] == "rpc" for c in sb.calls)  # Answered by the local index
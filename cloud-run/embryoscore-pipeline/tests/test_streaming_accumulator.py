@@ -0,0 +1,140 @@
+import cv2
+import numpy as np
+import pytest
+
+import app
+
+W, H, GAP = 320, 240, 3
+
+# Mid-plate, touching the left edge (clipped ROI window), small, overlapping
+_BBOXES = [
+    {"x_percent": 50, "y_percent": 50, "width_percent": 20, "height_percent": 25},
+    {"x_percent": 4, "y_percent": 30, "width_percent": 12, "height_percent": 12},
+    {"x_percent": 80, "y_percent": 80, "width_percent": 6, "height_percent": 8},
+    {"x_percent": 58, "y_percent": 58, "width_percent": 15, "height_percent": 15},
+]
+
+
+def _frames(n: int, seed: int = 0, w: int = W, h: int = H) -> list[np.ndarray]:
+    """Random uint8 frames whose noise amplitude ramps up left to right."""
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0.1, 1.0, w)[None, :, None]
+    return [(rng.integers(0, 256, (h, w, 3)) * ramp).astype(np.uint8) for _ in range(n)]
+
+
+def _circle(cx: int, cy: int, radius: int) -> np.ndarray:
+    mask = np.zeros((H, W), dtype=np.uint8)
+    cv2.circle(mask, (cx, cy), radius, 255, -1)
+    return mask > 0
+
+
+def _reference(frames, bboxes):
+    """Full-frame float64 statistics, as the pre-streaming pipeline computed them."""
+    gray = np.stack([cv2.cvtColor(f, cv2.COLOR_BGR2GRAY) for f in frames]).astype(np.float64)
+    diffs = np.abs(gray[GAP:] - gray[:-GAP])
+
+    bg = np.ones((H, W), dtype=bool)
+    embryos = []
+    for b in bboxes:
+        cx, cy = int(b["x_percent"] / 100 * W), int(b["y_percent"] / 100 * H)
+        radius = max(int(b["width_percent"] / 100 * W), int(b["height_percent"] / 100 * H)) // 2
+        bg &= ~_circle(cx, cy, int(radius * 1.3))
+        full, core = _circle(cx, cy, radius), _circle(cx, cy, max(1, radius // 2))
+        embryos.append((full, core & full, full & ~core))
+
+    return {
+        "bg_index": np.flatnonzero(bg),
+        "bg_sum": gray[:, bg].sum(axis=0), "bg_sumsq": (gray[:, bg] ** 2).sum(axis=0),
+        "bg_std": float(np.mean(np.std(gray[:, bg], axis=0, ddof=1))),
+        "bg_timeline": diffs[:, bg].mean(axis=1),
+        "px_index": np.concatenate([np.flatnonzero(full) for full, _, _ in embryos]),
+        "px_sum": np.concatenate([gray[:, full].sum(axis=0) for full, _, _ in embryos]),
+        "px_sumsq": np.concatenate([(gray[:, full] ** 2).sum(axis=0) for full, _, _ in embryos]),
+        "embryos": [{
+            "mean_std": np.mean(np.std(gray[:, full], axis=0)),
+            "core_std": np.mean(np.std(gray[:, core], axis=0)),
+            "peri_std": np.mean(np.std(gray[:, peri], axis=0)),
+            "mean_intensity": np.mean(gray[:, full]),
+            "emb_timeline": diffs[:, full].mean(axis=1),
+        } for full, core, peri in embryos],
+        "heat": diffs.sum(axis=0),
+    }
+
+
+def _accumulate(frames, bboxes, bg_budget: int = 0, **kwargs) -> app._StreamingAccumulator:
+    h, w = frames[0].shape[:2]
+    acc = app._StreamingAccumulator(bboxes, w, h, 8.0, GAP, bg_budget=bg_budget, **kwargs)
+    for frame in frames:
+        acc.process_frame(frame)
+    return acc
+
+
+@pytest.mark.parametrize("roi", [True, False])
+@pytest.mark.parametrize("max_frames", [app.MAX_SAMPLED_FRAMES, 1000])  # uint16/uint32 and uint32/uint64 sums
+def test_integer_sums_are_exact(roi, max_frames):
+    frames = _frames(40)
+    ref = _reference(frames, _BBOXES)
+    acc = _accumulate(frames, _BBOXES, roi=roi, max_frames=max_frames)
+
+    np.testing.assert_array_equal(acc.bg_index, ref["bg_index"])  # Dense: every background pixel
+    np.testing.assert_array_equal(acc.bg_sum, ref["bg_sum"])
+    np.testing.assert_array_equal(acc.bg_sumsq, ref["bg_sumsq"])
+    np.testing.assert_array_equal(acc.px_index, ref["px_index"])
+    np.testing.assert_array_equal(acc.px_sum, ref["px_sum"])
+    np.testing.assert_array_equal(acc.px_sumsq, ref["px_sumsq"])
+    np.testing.assert_array_equal(acc.cumulative_heat, ref["heat"])
+
+
+@pytest.mark.parametrize("roi", [True, False])
+def test_derived_profile_matches_float64_reference(roi):
+    frames = _frames(40, seed=1)
+    ref = _reference(frames, _BBOXES)
+    acc = _accumulate(frames, _BBOXES, roi=roi)
+    results, bg_std = acc.finalize()
+
+    assert bg_std == pytest.approx(ref["bg_std"], rel=1e-12)
+    np.testing.assert_allclose(acc.bg_timeline, ref["bg_timeline"], rtol=1e-6)
+    for acc_emb, ref_emb, result in zip(acc.embryo_accs, ref["embryos"], results):
+        for key in ("mean_std", "core_std", "peri_std", "mean_intensity"):
+            assert acc_emb[key] == pytest.approx(ref_emb[key], rel=1e-12), key
+        np.testing.assert_allclose(acc_emb["emb_timeline"], ref_emb["emb_timeline"], rtol=1e-6)
+
+        compensated = max(0.0, ref_emb["mean_std"] - ref["bg_std"])
+        assert result["nsd"] == pytest.approx(compensated / max(ref_emb["mean_intensity"], 1.0), abs=1e-6)
+        assert result["anr"] == pytest.approx(compensated / max(ref["bg_std"], 0.5), abs=1e-3)
+
+
+def test_roi_windows_match_full_frame():
+    frames = _frames(30, seed=2)
+    roi_results, roi_bg = _accumulate(frames, _BBOXES, roi=True).finalize()
+    full_results, full_bg = _accumulate(frames, _BBOXES, roi=False).finalize()
+
+    assert roi_bg == full_bg
+    for a, b in zip(roi_results, full_results):
+        assert (a["activity_score"], a["nsd"], a["anr"]) == (b["activity_score"], b["nsd"], b["anr"])
+        assert a["kinetic_profile"] == b["kinetic_profile"]
+        np.testing.assert_array_equal(a["heat_colored"], b["heat_colored"])
+
+
+# ─── Sparse background grid (BG_SAMPLE_BUDGET) vs every background pixel ───
+
+_FEW = [
+    {"x_percent": 30, "y_percent": 40, "width_percent": 10, "height_percent": 13},
+    {"x_percent": 70, "y_percent": 60, "width_percent": 10, "height_percent": 13},
+]
+# 8 x 7 plate: embryo circles cover most of the frame
+_MANY = [{"x_percent": 7 + x * 12.5, "y_percent": 8 + y * 14, "width_percent": 8, "height_percent": 10}
+         for x in range(8) for y in range(7)]
+
+
+@pytest.mark.parametrize("bboxes", [_FEW, _MANY], ids=["few", "many"])
+def test_sparse_background_stays_within_tolerance(bboxes):
+    frames = _frames(10, seed=3, w=640, h=480)
+    dense = _accumulate(frames, bboxes)
+    sparse = _accumulate(frames, bboxes, bg_budget=app.BG_SAMPLE_BUDGET)
+    _, dense_std = dense.finalize()
+    _, sparse_std = sparse.finalize()
+
+    assert sparse.bg_pixel_count <= app.BG_SAMPLE_BUDGET < dense.bg_pixel_count
+    assert sparse_std == pytest.approx(dense_std, rel=0.03)
+    np.testing.assert_allclose(sparse.bg_timeline, dense.bg_timeline, rtol=0.03)
@@ -11,6 +11,7 @@ Stateless. Sem credenciais Supabase — recebe signed URLs.
 """
 
 import base64
+import collections
 import io
 import os
 import subprocess
@@ -51,6 +52,12 @@ except ImportError:
 
 app = Flask(__name__)
 
+# Ruído de fundo: máximo de pixels de fundo amostrados por frame (0 = todos, como
+# antes da amostragem). A grade esparsa mantém bg_std e a timeline de fundo a até
+# 3% dos valores densos.
+BG_SAMPLE_BUDGET = int(os.environ.get("BG_SAMPLE_BUDGET", "65536"))
+BG_PATCH_SIZE = 8
+
 
 @app.route("/extract-frame", methods=["POST"])
 def extract_frame():
@@ -767,6 +774,8 @@ def analyze_activity():
 
     Extrai frames do vídeo, calcula perfil cinético completo por embrião,
     gera frames limpos (para Gemini morfologia) + compostos com overlay (para Storage debug).
+    Processa um frame por vez (_ActivityAccumulator): o pico de memória não
+    cresce com a duração do vídeo (benchmark.py activity).
     """
     import traceback as _tb
 
@@ -778,6 +787,7 @@ def analyze_activity():
     output_size = data.get("output_size", 400)
     overlay_opacity = data.get("overlay_opacity", 0.4)
     skip_composites = data.get("skip_composites", False)
+    bg_sample_budget = data.get("bg_sample_budget", BG_SAMPLE_BUDGET)
 
     if not video_url:
         return jsonify({"error": "video_url é obrigatório"}), 400
@@ -818,54 +828,36 @@ def analyze_activity():
             cap.release()
             return jsonify({"error": "Vídeo muito curto para análise"}), 422
 
-        gray_frames = []
-        color_frames = []
+        # ═══════════════════════════════════════════════
+        # Streaming: um frame por vez, memória independente da duração
+        # ═══════════════════════════════════════════════
+        # Wide diffs (~1s gap) por janela deslizante; guarda só os recortes
+        # dos key frames (e os diffs dos seus overlays), nunca a sequência
+        gap = max(1, int(fps))
+        acc = _ActivityAccumulator(
+            bboxes, vid_w, vid_h, gap,
+            key_positions=_key_positions(len(sampled_indices), num_key_frames),
+            keep_diffs=not skip_composites,
+            bg_budget=bg_sample_budget,
+            max_frames=len(sampled_indices),
+        )
         for idx in sampled_indices:
             cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
             ret, frame = cap.read()
             if not ret:
                 break
-            color_frames.append(frame)
-            gray_frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+            acc.process_frame(frame)
 
-        cap.release()
-
-        if len(gray_frames) < 2:
+        if acc.frame_count < 2:
+            cap.release()
             return jsonify({"error": "Poucos frames extraídos"}), 422
 
-        # ═══════════════════════════════════════════════
-        # Wide diffs (~1s gap) — compartilhados entre embriões
-        # ═══════════════════════════════════════════════
-        gap = max(1, int(fps))
-        wide_diffs = []
-        for i in range(gap, len(gray_frames)):
-            wide_diffs.append(cv2.absdiff(gray_frames[i - gap], gray_frames[i]))
-
-        # ═══════════════════════════════════════════════
-        # Compensação de ruído de câmera (fundo = tudo fora dos embriões)
-        # ═══════════════════════════════════════════════
-        all_embryo_mask = np.zeros((vid_h, vid_w), dtype=np.uint8)
-        for bbox in bboxes:
-            bcx = int(bbox.get("x_percent", 50) / 100 * vid_w)
-            bcy = int(bbox.get("y_percent", 50) / 100 * vid_h)
-            bbw = int(bbox.get("width_percent", 10) / 100 * vid_w)
-            bbh = int(bbox.get("height_percent", 10) / 100 * vid_h)
-            br = max(bbw, bbh) // 2
-            cv2.circle(all_embryo_mask, (bcx, bcy), int(br * 1.3), 255, -1)
-
-        bg_indices = all_embryo_mask == 0
-
-        if int(np.sum(bg_indices)) > 100:
-            bg_pixels = [g[bg_indices].astype(np.float32) for g in gray_frames]
-            bg_stack = np.stack(bg_pixels, axis=0)
-            bg_std = float(np.mean(np.std(bg_stack, axis=0)))
-            bg_timeline = [
-                float(np.mean(wd[bg_indices].astype(np.float32)))
-                for wd in wide_diffs
-            ]
-        else:
-            bg_std = 0.0
-            bg_timeline = [0.0] * len(wide_diffs)
+        # Leitura parou antes do previsto: key frames equidistantes no total real
+        if acc.frame_count < len(sampled_indices):
+            acc.recapture_keys(
+                cap, sampled_indices, _key_positions(acc.frame_count, num_key_frames)
+            )
+        cap.release()
 
         # ═══════════════════════════════════════════════
         # Para cada embrião (bbox)
@@ -873,104 +865,25 @@ def analyze_activity():
         embryo_results = []
         activity_scores = []
 
-        for bbox_idx, bbox in enumerate(bboxes):
-            x_pct = bbox.get("x_percent", 50)
-            y_pct = bbox.get("y_percent", 50)
-            w_pct = bbox.get("width_percent", 10)
-            h_pct = bbox.get("height_percent", 10)
-
-            cx = int(x_pct / 100 * vid_w)
-            cy = int(y_pct / 100 * vid_h)
-            bw = int(w_pct / 100 * vid_w)
-            bh = int(h_pct / 100 * vid_h)
-            radius = max(bw, bh) // 2
-
-            # Máscara circular para a região do embrião
-            mask = np.zeros((vid_h, vid_w), dtype=np.uint8)
-            cv2.circle(mask, (cx, cy), radius, 255, -1)
-            mask_indices = mask > 0
-
-            # ── Activity Score (compensado por ruído de câmera) ──
-            pixel_values = [g[mask_indices].astype(np.float32) for g in gray_frames]
-            if len(pixel_values) >= 2:
-                pixel_stack = np.stack(pixel_values, axis=0)
-                pixel_std = np.std(pixel_stack, axis=0)
-                mean_std = float(np.mean(pixel_std))
-                compensated_std = max(0.0, mean_std - bg_std)
-                activity_score = int(min(100, max(0, compensated_std * 100 / 15)))
-            else:
-                activity_score = 0
-
+        for emb in acc.finalize():
+            activity_score = emb["activity_score"]
             activity_scores.append(activity_score)
-
-            # ── Perfil Cinético (compensado, sem pulsação/expansão) ──
-            kinetic_profile = _compute_kinetic_profile(
-                gray_frames, mask, mask_indices, cx, cy, radius, fps,
-                wide_diffs, bg_std, bg_timeline
-            )
+            kinetic_profile = emb["kinetic_profile"]
             kinetic_quality = _compute_kinetic_quality(activity_score, kinetic_profile)
 
-            # ── Key frames equidistantes ──
-            total_sampled = len(color_frames)
-            if num_key_frames == 1:
-                key_indices = [total_sampled // 2]
-            elif total_sampled <= num_key_frames:
-                key_indices = list(range(total_sampled))
-            else:
-                key_indices = [
-                    int(i * (total_sampled - 1) / (num_key_frames - 1))
-                    for i in range(num_key_frames)
-                ]
-
-            # ── Região de crop com padding 20% ──
-            padding_ratio = 0.20
-            size = max(bw, bh)
-            padded = int(size * (1 + padding_ratio * 2))
-            half = padded // 2
-
-            crop_left = max(0, cx - half)
-            crop_top = max(0, cy - half)
-            crop_right = min(vid_w, cx + half)
-            crop_bottom = min(vid_h, cy + half)
-
-            # ── Pre-compute diff max para normalização do overlay ──
-            global_diff_max = 1.0
-            for wd in wide_diffs:
-                rv = wd[crop_top:crop_bottom, crop_left:crop_right]
-                rm = float(rv.max())
-                if rm > global_diff_max:
-                    global_diff_max = rm
-
             # ── Gerar clean_frames (Gemini) + composite_frames (Storage) ──
             clean_frames_b64 = []
             composite_frames_b64 = []
+            global_diff_max = emb["diff_max"]
 
-            for ki, frame_idx in enumerate(key_indices):
-                raw_crop = color_frames[frame_idx][crop_top:crop_bottom, crop_left:crop_right]
-
+            for raw_crop, diff_region in zip(emb["key_crops"], emb["key_diffs"]):
                 # Clean frame (sem overlay — para Gemini avaliar morfologia)
-                if raw_crop.shape[0] > 0 and raw_crop.shape[1] > 0:
-                    clean_resized = cv2.resize(
-                        raw_crop, (output_size, output_size),
-                        interpolation=cv2.INTER_LANCZOS4
-                    )
-                else:
-                    clean_resized = np.zeros((output_size, output_size, 3), dtype=np.uint8)
-                _, clean_buf = cv2.imencode(
-                    ".jpg", clean_resized, [cv2.IMWRITE_JPEG_QUALITY, 85]
-                )
-                clean_frames_b64.append(
-                    base64.b64encode(clean_buf.tobytes()).decode("ascii")
-                )
+                clean_frames_b64.append(_encode_crop_b64(raw_crop, output_size))
 
                 # Composite frames + heatmap (skipped when skip_composites=True)
                 if not skip_composites:
                     composite_crop = raw_crop.copy()
-                    if ki > 0 and len(wide_diffs) > 0:
-                        wide_idx = min(max(0, frame_idx - gap), len(wide_diffs) - 1)
-                        diff_region = wide_diffs[wide_idx][
-                            crop_top:crop_bottom, crop_left:crop_right
-                        ]
+                    if diff_region is not None:
                         diff_norm = np.clip(
                             diff_region.astype(np.float32) / global_diff_max * 255,
                             0, 255,
@@ -986,52 +899,20 @@ def analyze_activity():
                             composite_crop.astype(np.float32) * (1 - diff_alpha_3ch)
                             + diff_colored.astype(np.float32) * diff_alpha_3ch
                         ).astype(np.uint8)
-
-                    if composite_crop.shape[0] > 0 and composite_crop.shape[1] > 0:
-                        comp_resized = cv2.resize(
-                            composite_crop, (output_size, output_size),
-                            interpolation=cv2.INTER_LANCZOS4,
-                        )
-                    else:
-                        comp_resized = np.zeros(
-                            (output_size, output_size, 3), dtype=np.uint8
-                        )
-                    _, comp_buf = cv2.imencode(
-                        ".jpg", comp_resized, [cv2.IMWRITE_JPEG_QUALITY, 85]
-                    )
-                    composite_frames_b64.append(
-                        base64.b64encode(comp_buf.tobytes()).decode("ascii")
-                    )
+                    composite_frames_b64.append(_encode_crop_b64(composite_crop, output_size))
 
             heatmap_b64 = ""
             if not skip_composites:
-                cumulative_heat = np.zeros((vid_h, vid_w), dtype=np.float64)
-                for wd in wide_diffs:
-                    cumulative_heat += wd.astype(np.float64)
-
-                heat_crop = cumulative_heat[crop_top:crop_bottom, crop_left:crop_right]
+                heat_crop = emb["heat_crop"]
                 if heat_crop.max() > 0:
                     heat_norm = (heat_crop / heat_crop.max() * 255).astype(np.uint8)
                 else:
                     heat_norm = np.zeros_like(heat_crop, dtype=np.uint8)
-
                 heat_colored = cv2.applyColorMap(heat_norm, cv2.COLORMAP_JET)
-                if heat_colored.shape[0] > 0 and heat_colored.shape[1] > 0:
-                    heat_resized = cv2.resize(
-                        heat_colored, (output_size, output_size),
-                        interpolation=cv2.INTER_LANCZOS4,
-                    )
-                else:
-                    heat_resized = np.zeros(
-                        (output_size, output_size, 3), dtype=np.uint8
-                    )
-                _, heat_buf = cv2.imencode(
-                    ".jpg", heat_resized, [cv2.IMWRITE_JPEG_QUALITY, 85]
-                )
-                heatmap_b64 = base64.b64encode(heat_buf.tobytes()).decode("ascii")
+                heatmap_b64 = _encode_crop_b64(heat_colored, output_size)
 
             embryo_results.append({
-                "index": bbox_idx,
+                "index": emb["index"],
                 "activity_score": activity_score,
                 "kinetic_profile": kinetic_profile,
                 "kinetic_quality_score": kinetic_quality,
@@ -1043,7 +924,7 @@ def analyze_activity():
         return jsonify({
             "activity_scores": activity_scores,
             "embryos": embryo_results,
-            "frames_sampled": len(gray_frames),
+            "frames_sampled": acc.frame_count,
         })
 
     except Exception as e:
@@ -1062,123 +943,400 @@ def health():
 # ─── Kinetic Profile Helpers ──────────────────────────────
 
 
-def _compute_kinetic_profile(gray_frames, full_mask, mask_indices,
-                             cx, cy, radius, fps, wide_diffs,
-                             bg_std, bg_timeline):
+def _background_sample_index(all_mask, budget=BG_SAMPLE_BUDGET, patch=BG_PATCH_SIZE):
     """
-    Compute kinetic profile from frame sequence, compensated for camera noise.
-
-    bg_std: background pixel std (camera noise floor)
-    bg_timeline: per-frame background diff means (camera movement per frame)
+    Índices planos dos pixels de fundo (all_mask == 0) usados no ruído de câmera.
 
-    Returns dict with regional activity, temporal pattern, symmetry,
-    and focal activity — all mathematically computed and compensated.
+    budget <= 0, ou fundo menor que o budget: todos os pixels de fundo (exato).
+    Caso contrário: grade estratificada com um patch patch×patch centrado em
+    cada célula, mantendo só os pixels de fundo — no máximo ~budget pixels
+    espalhados pela placa (mesma lógica do embryoscore-pipeline).
     """
-    vid_h, vid_w = gray_frames[0].shape
+    h, w = all_mask.shape[:2]
+    flat_mask = all_mask.reshape(-1)
+    bg_total = int(np.count_nonzero(flat_mask == 0))
+    if budget <= 0 or bg_total <= budget:
+        return np.flatnonzero(flat_mask == 0)
+
+    bg_fraction = bg_total / float(h * w)
+    n_patches = max(1, int(budget / (patch * patch * bg_fraction)))
+    grid_y = max(1, min(h // patch, round((n_patches * h / w) ** 0.5)))
+    grid_x = max(1, min(w // patch, -(-n_patches // grid_y)))
+
+    tops = ((np.arange(grid_y) + 0.5) * h / grid_y - patch / 2).astype(np.int64).clip(0, h - patch)
+    lefts = ((np.arange(grid_x) + 0.5) * w / grid_x - patch / 2).astype(np.int64).clip(0, w - patch)
+    offs = np.arange(patch)
+    rows = (tops[:, None] + offs[None, :]).reshape(-1)
+    cols = (lefts[:, None] + offs[None, :]).reshape(-1)
+    flat = np.unique((rows[:, None] * w + cols[None, :]).reshape(-1))
+    flat = flat[flat_mask[flat] == 0]
+    if flat.size > budget:
+        flat = flat[np.linspace(0, flat.size - 1, budget).astype(np.int64)]
+    return flat
+
+
+def _key_positions(total_sampled, num_key_frames):
+    """Posições (na sequência amostrada) dos key frames equidistantes."""
+    if num_key_frames == 1:
+        return [total_sampled // 2]
+    if total_sampled <= num_key_frames:
+        return list(range(total_sampled))
+    return [
+        int(i * (total_sampled - 1) / (num_key_frames - 1))
+        for i in range(num_key_frames)
+    ]
 
-    # ── 1. Regional: core (inner 50%) vs periphery (outer ring), compensado ──
-    inner_mask = np.zeros((vid_h, vid_w), dtype=np.uint8)
-    cv2.circle(inner_mask, (cx, cy), max(1, radius // 2), 255, -1)
-    inner_idx = inner_mask > 0
 
-    outer_mask = full_mask.copy()
-    outer_mask[inner_idx] = 0
-    outer_idx = outer_mask > 0
+def _accumulator_dtypes(max_frames):
+    """Menores dtypes exatos (soma, soma dos quadrados) para max_frames amostras uint8."""
+    sum_dtype = np.uint16 if max_frames * 255 <= np.iinfo(np.uint16).max else np.uint32
+    sumsq_dtype = np.uint32 if max_frames * 255 * 255 <= np.iinfo(np.uint32).max else np.uint64
+    return sum_dtype, sumsq_dtype
 
-    core_activity = 0
-    periphery_activity = 0
 
-    if np.sum(inner_idx) > 0 and len(gray_frames) >= 2:
-        core_stack = np.stack(
-            [g[inner_idx].astype(np.float32) for g in gray_frames]
-        )
-        core_raw = float(np.mean(np.std(core_stack, axis=0)))
-        core_compensated = max(0.0, core_raw - bg_std)
-        core_activity = int(min(100, max(0, core_compensated * 100 / 15)))
+def _variance_from_sums(n, sums, sumsqs):
+    """Variância populacional exata por pixel a partir das somas inteiras."""
+    s = sums.astype(np.int64)
+    return (sumsqs.astype(np.int64) * n - s * s) / float(n * n)
 
-    if np.sum(outer_idx) > 0 and len(gray_frames) >= 2:
-        periph_stack = np.stack(
-            [g[outer_idx].astype(np.float32) for g in gray_frames]
+
+def _encode_crop_b64(img, output_size):
+    """Redimensiona para output_size² (preto se vazio) → JPEG q85 base64."""
+    if img.shape[0] > 0 and img.shape[1] > 0:
+        resized = cv2.resize(
+            img, (output_size, output_size), interpolation=cv2.INTER_LANCZOS4
         )
-        periph_raw = float(np.mean(np.std(periph_stack, axis=0)))
-        periph_compensated = max(0.0, periph_raw - bg_std)
-        periphery_activity = int(min(100, max(0, periph_compensated * 100 / 15)))
-
-    if core_activity > periphery_activity * 1.5 and core_activity > 5:
-        peak_zone = "core"
-    elif periphery_activity > core_activity * 1.5 and periphery_activity > 5:
-        peak_zone = "periphery"
     else:
-        peak_zone = "uniform"
+        resized = np.zeros((output_size, output_size, 3), dtype=np.uint8)
+    _, buf = cv2.imencode(".jpg", resized, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    return base64.b64encode(buf.tobytes()).decode("ascii")
 
-    # ── 2. Activity timeline (compensado por movimento de câmera) ──
-    raw_timeline = []
-    for j, wd in enumerate(wide_diffs):
-        embryo_diff = float(np.mean(wd[mask_indices].astype(np.float32)))
-        bg_diff = bg_timeline[j] if j < len(bg_timeline) else 0.0
-        raw_timeline.append(max(0.0, embryo_diff - bg_diff))
 
-    timeline_norm = [
-        int(min(100, max(0, v * 100 / 15))) for v in raw_timeline
-    ]
-    temporal_variability = (
-        round(float(np.std(raw_timeline)), 2) if len(raw_timeline) > 1 else 0.0
-    )
+class _ActivityAccumulator:
+    """
+    Perfil cinético do /analyze-activity processando um frame por vez
+    (mesma lógica do _StreamingAccumulator do embryoscore-pipeline).
+
+    A memória não cresce com a duração do vídeo:
+      - janela deslizante com os últimos gap+1 frames cinza para os wide diffs;
+      - somas inteiras exatas (Σx, Σx²) por pixel de embrião e de fundo, com
+        todos os embriões lidos em um único take() por frame; a variância
+        (populacional, como np.std) sai uma vez em finalize();
+      - heatmap acumulado em inteiros;
+      - só os recortes dos key frames e, com keep_diffs, o recorte do diff
+        que o overlay de cada um usa.
+    Cada embrião trabalha na sua janela (crop com padding ∪ círculo), com
+    máscaras locais; os quadrantes de simetria saem da mesma janela.
+    """
 
-    # ── 3. Temporal pattern (sem pulsação — vídeo de 10s é curto demais) ──
-    temporal_pattern = "stable"
-
-    if len(raw_timeline) >= 3:
-        x = np.arange(len(raw_timeline), dtype=np.float64)
-        slope = float(np.polyfit(x, raw_timeline, 1)[0])
-        mean_tl = float(np.mean(raw_timeline))
-        rel_slope = slope / max(mean_tl, 0.01)
-
-        if rel_slope > 0.08:
-            temporal_pattern = "increasing"
-        elif rel_slope < -0.08:
-            temporal_pattern = "decreasing"
-        elif temporal_variability > 2.0:
-            temporal_pattern = "irregular"
-
-    # ── 4. Symmetry (quadrant analysis of cumulative activity) ──
-    cumulative = np.zeros((vid_h, vid_w), dtype=np.float64)
-    for wd in wide_diffs:
-        cumulative += wd.astype(np.float64)
-
-    quads = []
-    for y_sl, x_sl in [
-        (slice(0, cy), slice(0, cx)),
-        (slice(0, cy), slice(cx, vid_w)),
-        (slice(cy, vid_h), slice(0, cx)),
-        (slice(cy, vid_h), slice(cx, vid_w)),
-    ]:
-        q_mask = np.zeros((vid_h, vid_w), dtype=np.uint8)
-        q_mask[y_sl, x_sl] = full_mask[y_sl, x_sl]
-        quads.append(float(np.sum(cumulative[q_mask > 0])))
-
-    total_q = sum(quads)
-    activity_symmetry = 1.0
-    focal_activity_detected = False
-
-    if total_q > 0:
-        mean_q = float(np.mean(quads))
-        std_q = float(np.std(quads))
-        activity_symmetry = round(
-            max(0.0, min(1.0, 1.0 - std_q / max(mean_q, 0.01))), 2
+    def __init__(self, bboxes, vid_w, vid_h, gap, key_positions, keep_diffs=True,
+                 bg_budget=BG_SAMPLE_BUDGET, max_frames=120):
+        self.vid_w = vid_w
+        self.vid_h = vid_h
+        self.gap = gap
+        self.keep_diffs = keep_diffs
+        self.frame_count = 0
+        self.diff_count = 0
+        self.max_frames = max_frames
+        self.sum_dtype, self.sumsq_dtype = _accumulator_dtypes(max_frames)
+        self._set_keys(key_positions)
+
+        self.gray_window = collections.deque(maxlen=gap + 1)
+        self.cumulative_heat = np.zeros((vid_h, vid_w), dtype=self.sum_dtype)
+
+        # Fundo = tudo fora dos embriões (raio × 1.3), grade esparsa
+        all_mask = np.zeros((vid_h, vid_w), dtype=np.uint8)
+        for bbox in bboxes:
+            bcx = int(bbox.get("x_percent", 50) / 100 * vid_w)
+            bcy = int(bbox.get("y_percent", 50) / 100 * vid_h)
+            bbw = int(bbox.get("width_percent", 10) / 100 * vid_w)
+            bbh = int(bbox.get("height_percent", 10) / 100 * vid_h)
+            br = max(bbw, bbh) // 2
+            cv2.circle(all_mask, (bcx, bcy), int(br * 1.3), 255, -1)
+        self.bg_index = _background_sample_index(all_mask, bg_budget)
+        self.bg_pixel_count = int(self.bg_index.size)
+        del all_mask
+        self.bg_n = 0
+        self.bg_sum = np.zeros(self.bg_pixel_count, dtype=self.sum_dtype)
+        self.bg_sumsq = np.zeros(self.bg_pixel_count, dtype=self.sumsq_dtype)
+        self.bg_timeline = []
+
+        self.embryos = []
+        px_parts, core_parts = [], []
+        for bbox in bboxes:
+            cx = int(bbox.get("x_percent", 50) / 100 * vid_w)
+            cy = int(bbox.get("y_percent", 50) / 100 * vid_h)
+            bw = int(bbox.get("width_percent", 10) / 100 * vid_w)
+            bh = int(bbox.get("height_percent", 10) / 100 * vid_h)
+            radius = max(bw, bh) // 2
+
+            # Região de crop com padding 20%
+            half = int(max(bw, bh) * 1.4) // 2
+            crop = (slice(max(0, cy - half), min(vid_h, cy + half)),
+                    slice(max(0, cx - half), min(vid_w, cx + half)))
+
+            # Janela de análise: crop ∪ círculo
+            win_top = max(0, min(crop[0].start, cy - radius))
+            win_left = max(0, min(crop[1].start, cx - radius))
+            win_bottom = min(vid_h, max(crop[0].stop, cy + radius + 1))
+            win_right = min(vid_w, max(crop[1].stop, cx + radius + 1))
+            win_h = max(0, win_bottom - win_top)
+            win_w = max(0, win_right - win_left)
+            lcx, lcy = cx - win_left, cy - win_top
+
+            mask = np.zeros((win_h, win_w), dtype=np.uint8)
+            cv2.circle(mask, (lcx, lcy), radius, 255, -1)
+            mask_indices = mask > 0
+            inner_mask = np.zeros((win_h, win_w), dtype=np.uint8)
+            cv2.circle(inner_mask, (lcx, lcy), max(1, radius // 2), 255, -1)
+            inner_idx = inner_mask > 0
+            outer_idx = mask_indices & ~inner_idx
+
+            # Índices planos (row-major, mesma ordem de g[mask]) + flag de núcleo
+            ys, xs = np.nonzero(mask_indices)
+            px_parts.append((ys + win_top) * vid_w + (xs + win_left))
+            core_parts.append(inner_idx[ys, xs])
+
+            self.embryos.append({
+                "crop": crop,
+                "win": (slice(win_top, win_bottom), slice(win_left, win_right)),
+                "lcx": lcx, "lcy": lcy,
+                "mask_indices": mask_indices,
+                "inner_count": int(np.sum(inner_idx)),
+                "outer_count": int(np.sum(outer_idx)),
+                "timeline": [],
+                "diff_max": 1.0,
+                "key_crops": {}, "key_diffs": {},
+            })
+
+        n_emb = len(self.embryos)
+        counts = np.array([len(p) for p in px_parts], dtype=np.int64)
+        self.px_index = np.concatenate(px_parts) if px_parts else np.zeros(0, dtype=np.intp)
+        self.px_core = np.concatenate(core_parts) if core_parts else np.zeros(0, dtype=bool)
+        self.px_label = np.repeat(np.arange(n_emb), counts)
+        self.px_n = 0
+        self.px_sum = np.zeros(self.px_index.size, dtype=self.sum_dtype)
+        self.px_sumsq = np.zeros(self.px_index.size, dtype=self.sumsq_dtype)
+
+    def _set_keys(self, key_positions):
+        self.key_positions = list(key_positions)
+        self.key_set = set(self.key_positions)
+        # Overlay do key frame ki > 0: wide diff de índice p - gap (como antes)
+        self.diff_set = {max(0, p - self.gap) for p in self.key_positions[1:]}
+
+    def process_frame(self, color_frame):
+        """Chamado uma vez por frame amostrado, em ordem."""
+        if self.frame_count >= self.max_frames:
+            raise ValueError(f"Mais de max_frames={self.max_frames} frames")
+        gray = cv2.cvtColor(color_frame, cv2.COLOR_BGR2GRAY)
+        self.gray_window.append(gray)
+
+        if len(self.gray_window) == self.gap + 1:
+            # wide_diffs[frame_count - gap]
+            diff = cv2.absdiff(self.gray_window[0], self.gray_window[-1])
+            self.cumulative_heat += diff
+            if self.bg_pixel_count > 100:
+                self.bg_timeline.append(
+                    float(np.mean(diff.reshape(-1).take(self.bg_index).astype(np.float32)))
+                )
+            if self.px_index.size > 0:
+                emb_diffs = self._segment_means(diff.reshape(-1).take(self.px_index))
+                for emb, emb_diff in zip(self.embryos, emb_diffs.tolist()):
+                    emb["timeline"].append(emb_diff)
+            if self.keep_diffs:
+                self._keep_diff(self.diff_count, diff)
+            self.diff_count += 1
+
+        if self.bg_pixel_count > 100:
+            pixels = gray.reshape(-1).take(self.bg_index)
+            self.bg_n += 1
+            self.bg_sum += pixels
+            self.bg_sumsq += np.multiply(pixels, pixels, dtype=np.uint16)
+
+        if self.px_index.size > 0:
+            pixels = gray.reshape(-1).take(self.px_index)
+            self.px_n += 1
+            self.px_sum += pixels
+            self.px_sumsq += np.multiply(pixels, pixels, dtype=np.uint16)
+
+        if self.frame_count in self.key_set:
+            self._keep_frame(self.frame_count, color_frame)
+        self.frame_count += 1
+
+    def _keep_diff(self, diff_idx, diff):
+        for emb in self.embryos:
+            region = diff[emb["crop"]]
+            if region.size > 0:
+                emb["diff_max"] = max(emb["diff_max"], float(region.max()))
+            if diff_idx in self.diff_set:
+                emb["key_diffs"][diff_idx] = region.copy()
+
+    def _keep_frame(self, position, color_frame):
+        for emb in self.embryos:
+            emb["key_crops"][position] = color_frame[emb["crop"]].copy()
+
+    def recapture_keys(self, cap, sampled_indices, key_positions):
+        """
+        Releitura (seek) dos key frames quando o vídeo entregou menos frames
+        que o previsto: as posições equidistantes mudam com o total real.
+        """
+        def _read(position):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, sampled_indices[position])
+            ret, frame = cap.read()
+            if not ret:
+                raise ValueError(f"Frame {sampled_indices[position]} não pôde ser relido")
+            return frame
+
+        self._set_keys(key_positions)
+        for emb in self.embryos:
+            emb["key_crops"], emb["key_diffs"] = {}, {}
+        for position in self.key_positions:
+            self._keep_frame(position, _read(position))
+        if self.keep_diffs and self.diff_count > 0:
+            for diff_idx in {min(d, self.diff_count - 1) for d in self.diff_set}:
+                diff = cv2.absdiff(
+                    cv2.cvtColor(_read(diff_idx), cv2.COLOR_BGR2GRAY),
+                    cv2.cvtColor(_read(diff_idx + self.gap), cv2.COLOR_BGR2GRAY),
+                )
+                for emb in self.embryos:
+                    emb["key_diffs"][diff_idx] = diff[emb["crop"]].copy()
+
+    def _segment_means(self, values, select=None):
+        """Média por embrião de um array por pixel (opcionalmente num subconjunto)."""
+        labels = self.px_label
+        if select is not None:
+            labels, values = labels[select], values[select]
+        n_emb = len(self.embryos)
+        sums = np.bincount(labels, weights=values, minlength=n_emb)
+        return sums / np.maximum(np.bincount(labels, minlength=n_emb), 1)
+
+    def finalize(self):
+        """
+        Gera, por embrião: activity_score, kinetic_profile, recortes dos key
+        frames (key_crops), diffs dos overlays (key_diffs, None sem overlay),
+        diff_max do crop e heat_crop (heatmap acumulado no crop).
+        """
+        # Ruído de câmera (fundo)
+        bg_std = 0.0
+        if self.bg_n > 1:
+            bg_std = float(np.mean(np.sqrt(
+                _variance_from_sums(self.bg_n, self.bg_sum, self.bg_sumsq)
+            )))
+        self.bg_sum = self.bg_sumsq = None
+
+        n_emb = len(self.embryos)
+        mean_std = core_std = peri_std = np.zeros(n_emb)
+        if self.px_n >= 2:
+            pixel_std = np.sqrt(_variance_from_sums(self.px_n, self.px_sum, self.px_sumsq))
+            mean_std = self._segment_means(pixel_std)
+            core_std = self._segment_means(pixel_std, self.px_core)
+            peri_std = self._segment_means(pixel_std, ~self.px_core)
+            del pixel_std
+        self.px_sum = self.px_sumsq = None
+
+        for i, emb in enumerate(self.embryos):
+            yield self._finalize_embryo(
+                i, emb, bg_std, float(mean_std[i]), float(core_std[i]), float(peri_std[i])
+            )
+            self.embryos[i] = None  # Libera recortes e máscaras
+
+    def _finalize_embryo(self, idx, emb, bg_std, mean_std, core_std, peri_std):
+        def _score(std):
+            return int(min(100, max(0, max(0.0, std - bg_std) * 100 / 15)))
+
+        # ── Activity Score (compensado por ruído de câmera) ──
+        has_stats = self.px_n >= 2
+        activity_score = _score(mean_std) if has_stats else 0
+
+        # ── 1. Regional: core (inner 50%) vs periphery (outer ring), compensado ──
+        core_activity = _score(core_std) if has_stats and emb["inner_count"] > 0 else 0
+        periphery_activity = _score(peri_std) if has_stats and emb["outer_count"] > 0 else 0
+
+        if core_activity > periphery_activity * 1.5 and core_activity > 5:
+            peak_zone = "core"
+        elif periphery_activity > core_activity * 1.5 and periphery_activity > 5:
+            peak_zone = "periphery"
+        else:
+            peak_zone = "uniform"
+
+        # ── 2. Activity timeline (compensado por movimento de câmera) ──
+        raw_timeline = []
+        for j, embryo_diff in enumerate(emb["timeline"]):
+            bg_diff = self.bg_timeline[j] if j < len(self.bg_timeline) else 0.0
+            raw_timeline.append(max(0.0, embryo_diff - bg_diff))
+
+        timeline_norm = [
+            int(min(100, max(0, v * 100 / 15))) for v in raw_timeline
+        ]
+        temporal_variability = (
+            round(float(np.std(raw_timeline)), 2) if len(raw_timeline) > 1 else 0.0
         )
-        focal_activity_detected = max(quads) / total_q > 0.50
-
-    return {
-        "core_activity": core_activity,
-        "periphery_activity": periphery_activity,
-        "peak_zone": peak_zone,
-        "temporal_pattern": temporal_pattern,
-        "activity_timeline": timeline_norm,
-        "temporal_variability": temporal_variability,
-        "activity_symmetry": activity_symmetry,
-        "focal_activity_detected": focal_activity_detected,
-    }
+
+        # ── 3. Temporal pattern (sem pulsação — vídeo de 10s é curto demais) ──
+        temporal_pattern = "stable"
+        if len(raw_timeline) >= 3:
+            x = np.arange(len(raw_timeline), dtype=np.float64)
+            slope = float(np.polyfit(x, raw_timeline, 1)[0])
+            mean_tl = float(np.mean(raw_timeline))
+            rel_slope = slope / max(mean_tl, 0.01)
+
+            if rel_slope > 0.08:
+                temporal_pattern = "increasing"
+            elif rel_slope < -0.08:
+                temporal_pattern = "decreasing"
+            elif temporal_variability > 2.0:
+                temporal_pattern = "irregular"
+
+        # ── 4. Symmetry (quadrantes do heatmap acumulado, na janela) ──
+        lcx, lcy = emb["lcx"], emb["lcy"]
+        mask_indices = emb["mask_indices"]
+        heat_win = self.cumulative_heat[emb["win"]]
+        quads = []
+        for y_sl, x_sl in [
+            (slice(0, lcy), slice(0, lcx)),
+            (slice(0, lcy), slice(lcx, None)),
+            (slice(lcy, None), slice(0, lcx)),
+            (slice(lcy, None), slice(lcx, None)),
+        ]:
+            quads.append(float(np.sum(heat_win[y_sl, x_sl][mask_indices[y_sl, x_sl]])))
+
+        total_q = sum(quads)
+        activity_symmetry = 1.0
+        focal_activity_detected = False
+
+        if total_q > 0:
+            mean_q = float(np.mean(quads))
+            std_q = float(np.std(quads))
+            activity_symmetry = round(
+                max(0.0, min(1.0, 1.0 - std_q / max(mean_q, 0.01))), 2
+            )
+            focal_activity_detected = max(quads) / total_q > 0.50
+
+        # Overlay só a partir do 2º key frame, e só se houve algum wide diff
+        key_diffs = [
+            emb["key_diffs"].get(min(max(0, p - self.gap), self.diff_count - 1))
+            if ki > 0 and self.diff_count > 0 else None
+            for ki, p in enumerate(self.key_positions)
+        ]
+
+        return {
+            "index": idx,
+            "activity_score": activity_score,
+            "kinetic_profile": {
+                "core_activity": core_activity,
+                "periphery_activity": periphery_activity,
+                "peak_zone": peak_zone,
+                "temporal_pattern": temporal_pattern,
+                "activity_timeline": timeline_norm,
+                "temporal_variability": temporal_variability,
+                "activity_symmetry": activity_symmetry,
+                "focal_activity_detected": focal_activity_detected,
+            },
+            "key_crops": [emb["key_crops"][p] for p in self.key_positions],
+            "key_diffs": key_diffs,
+            "diff_max": emb["diff_max"],
+            "heat_crop": self.cumulative_heat[emb["crop"]],
+        }
 
 
 def _compute_kinetic_quality(activity_score, profile):
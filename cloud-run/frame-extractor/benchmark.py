@@ -0,0 +1,218 @@
+"""
+Frame Extractor — local benchmarks.
+
+Run LOCALLY (not in Cloud Run), from this directory, with requirements.txt
+installed. Test videos are synthesized with OpenCV's VideoWriter (mp4v):
+
+    python benchmark.py activity                         # 480p / 720p / 1080p, 10 s at 30 fps
+    python benchmark.py activity --heights 1080 --seconds 30 --embryos 12
+    python benchmark.py activity --baseline /path/to/older/checkout/cloud-run/frame-extractor --check
+
+Each run of /analyze-activity happens in a fresh process (Flask test client,
+video download served from the local file) so peak RSS is per request.
+Each subcommand prints a plain-text table; numbers go in the PR/commit body.
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+
+
+# ─── Helpers ─────────────────────────────────────────────
+
+def _plate_bboxes(n, width, height, diameter_ratio=0.06):
+    """n embryos on a regular grid, as percentage bboxes (detector output format)."""
+    cols = max(1, math.ceil(math.sqrt(n * width / height)))
+    rows = max(1, math.ceil(n / cols))
+    d_px = diameter_ratio * width
+    bboxes = []
+    for i in range(n):
+        r, c = divmod(i, cols)
+        bboxes.append({
+            "x_percent": (c + 0.5) / cols * 100,
+            "y_percent": (r + 0.5) / rows * 100,
+            "width_percent": d_px / width * 100,
+            "height_percent": d_px / height * 100,
+        })
+    return bboxes
+
+
+def _make_video(path, width, height, fps, seconds, bboxes, seed=0):
+    """Vignetted plate with dark embryos, sensor noise and flicker on half of them."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    r2 = ((xx - width / 2) ** 2 + (yy - height / 2) ** 2) / ((width / 2) ** 2 + (height / 2) ** 2)
+    base = (215 - 60 * r2).astype(np.uint8)
+    del yy, xx, r2
+    for b in bboxes:
+        cx, cy = int(b["x_percent"] / 100 * width), int(b["y_percent"] / 100 * height)
+        r = int(b["width_percent"] / 100 * width) // 2
+        cv2.circle(base, (cx, cy), r, 90, -1)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    if not writer.isOpened():
+        raise SystemExit("OpenCV VideoWriter could not open an mp4v stream")
+    for _ in range(int(fps * seconds)):
+        noise = rng.normal(0, 2.0, size=(height, width)).astype(np.int16)
+        frame = np.clip(base.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        for b in bboxes[::2]:
+            cx, cy = int(b["x_percent"] / 100 * width), int(b["y_percent"] / 100 * height)
+            r = int(b["width_percent"] / 100 * width) // 4
+            cv2.circle(frame, (cx + int(rng.integers(-3, 4)), cy), r, int(rng.integers(60, 120)), -1)
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    writer.release()
+    return path
+
+
+# ─── activity: /analyze-activity peak RSS and output parity ───
+
+_ACTIVITY_CHILD = r"""
+import hashlib, importlib.util, json, os, resource, sys, time
+directory, video, payload = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+sys.path.insert(0, directory)
+os.chdir(directory)
+spec = importlib.util.spec_from_file_location("app", os.path.join(directory, "app.py"))
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+class _LocalVideo:
+    def raise_for_status(self):
+        pass
+    def iter_content(self, chunk_size):
+        with open(video, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+app.http_requests.get = lambda *a, **k: _LocalVideo()
+client = app.app.test_client()
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+t0 = time.perf_counter()
+resp = client.post("/analyze-activity", json=payload)
+elapsed = time.perf_counter() - t0
+body = resp.get_json()
+if resp.status_code != 200:
+    raise SystemExit(f"HTTP {resp.status_code}: {body}")
+digest = lambda items: [hashlib.sha1(s.encode()).hexdigest()[:12] for s in items]
+print(json.dumps({
+    "seconds": elapsed,
+    "rss_before_kb": rss_before,
+    "rss_peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "frames_sampled": body["frames_sampled"],
+    "activity_scores": body["activity_scores"],
+    "embryos": [{
+        "kinetic_profile": e["kinetic_profile"],
+        "kinetic_quality_score": e["kinetic_quality_score"],
+        "clean_frames": digest(e["clean_frames"]),
+        "composite_frames": digest(e["composite_frames"]),
+        "cumulative_heatmap": digest([e["cumulative_heatmap"]]),
+    } for e in body["embryos"]],
+}))
+"""
+
+
+def _run_activity(directory, video, payload):
+    out = subprocess.run(
+        [sys.executable, "-c", _ACTIVITY_CHILD, directory, video, json.dumps(payload)],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def _activity_diff(a, b):
+    """(max numeric |diff|, images that differ) between two /analyze-activity results."""
+    worst, images = 0.0, 0
+    if a["frames_sampled"] != b["frames_sampled"]:
+        return float("inf"), 0
+    for sa, sb in zip(a["activity_scores"], b["activity_scores"]):
+        worst = max(worst, abs(sa - sb))
+    for ea, eb in zip(a["embryos"], b["embryos"]):
+        ka, kb = ea["kinetic_profile"], eb["kinetic_profile"]
+        for key in ("core_activity", "periphery_activity", "temporal_variability",
+                    "activity_symmetry"):
+            worst = max(worst, abs(float(ka[key]) - float(kb[key])))
+        for va, vb in zip(ka["activity_timeline"], kb["activity_timeline"]):
+            worst = max(worst, abs(va - vb))
+        for key in ("peak_zone", "temporal_pattern", "focal_activity_detected"):
+            if ka[key] != kb[key]:
+                worst = float("inf")
+        worst = max(worst, abs(ea["kinetic_quality_score"] - eb["kinetic_quality_score"]))
+        for key in ("clean_frames", "composite_frames", "cumulative_heatmap"):
+            images += sum(x != y for x, y in zip(ea[key], eb[key]))
+            images += abs(len(ea[key]) - len(eb[key]))
+    return worst, images
+
+
+def bench_activity(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    variants = []
+    if args.baseline:
+        variants.append(("baseline", os.path.abspath(args.baseline)))
+    variants.append(("streaming", here))
+    payload = {"video_url": "local", "fps": args.fps, "num_key_frames": args.key_frames,
+               "skip_composites": args.skip_composites}
+
+    tmpdir = tempfile.mkdtemp(prefix="fe-bench-")
+    print(f"{'res':>10} {'frames':>7} {'variant':>10} {'seconds':>8} {'base MB':>8} "
+          f"{'peak MB':>8} {'req MB':>7} {'max |diff|':>10} {'img diff':>8}")
+    worst = 0.0
+    try:
+        for height in args.heights:
+            width = int(round(height * 16 / 9)) // 2 * 2
+            bboxes = _plate_bboxes(args.embryos, width, height)
+            video = _make_video(os.path.join(tmpdir, f"plate_{height}p.mp4"),
+                                width, height, args.video_fps, args.seconds, bboxes)
+            reference = None
+            for name, directory in variants:
+                result = _run_activity(directory, video, dict(payload, bboxes=bboxes))
+                if reference is None:
+                    reference = result
+                diff, images = _activity_diff(reference, result)
+                worst = max(worst, diff)
+                base_mb = result["rss_before_kb"] / 1024
+                peak_mb = result["rss_peak_kb"] / 1024
+                print(f"{f'{width}x{height}':>10} {result['frames_sampled']:>7} {name:>10} "
+                      f"{result['seconds']:>8.2f} {base_mb:>8.0f} {peak_mb:>8.0f} "
+                      f"{peak_mb - base_mb:>7.0f} {diff:>10.4g} {images:>8}")
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    if args.check:
+        if worst > args.tolerance:
+            print(f"Parity check FAILED: max |diff| {worst:.4g} > {args.tolerance:g}")
+            sys.exit(1)
+        print(f"Parity check passed: max |diff| {worst:.4g} <= {args.tolerance:g}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("activity", help="/analyze-activity: peak RSS per resolution, parity")
+    p.add_argument("--heights", type=int, nargs="+", default=[480, 720, 1080])
+    p.add_argument("--seconds", type=float, default=10)
+    p.add_argument("--video-fps", type=int, default=30)
+    p.add_argument("--fps", type=int, default=8, help="Sampling fps sent to the endpoint")
+    p.add_argument("--embryos", type=int, default=6)
+    p.add_argument("--key-frames", type=int, default=10)
+    p.add_argument("--skip-composites", action="store_true")
+    p.add_argument("--baseline", help="frame-extractor directory of an older checkout")
+    p.add_argument("--check", action="store_true", help="Exit 1 if parity exceeds --tolerance")
+    p.add_argument("--tolerance", type=float, default=1.0,
+                   help="Integer scores may move by one on float rounding")
+    p.set_defaults(func=bench_activity)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
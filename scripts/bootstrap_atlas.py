@@ -6,6 +6,7 @@ Executar UMA VEZ antes do primeiro uso do sistema.
 Requer:
   - DINOv2 Cloud Run deployado e rodando
   - Supabase com migration v2 aplicada (embryo_references + pgvector)
+    e 20261016000700_native_embeddings.sql (coluna embedding_vitb14)
   - Datasets baixados localmente:
       ./datasets/kromp/   (Kromp et al. 2023 — 2.344 blastocistos humanos)
       ./datasets/rocha/   (Rocha et al. 2017 — 482 blastocistos bovinos)
@@ -215,7 +216,8 @@ def process_kromp_dataset(base_dir: str):
         return {
             "lab_id": LAB_ID,
             "classification": entry["classification"],
-            "embedding": result["embedding"],
+            "embedding_model": "dinov2_vitb14",
+            "embedding_vitb14": result["embedding"],
             "species": "human",
             "source": "dataset_kromp",
         }
@@ -337,7 +339,8 @@ def process_rocha_dataset(base_dir: str):
         return {
             "lab_id": LAB_ID,
             "classification": entry["classification"],
-            "embedding": result["embedding"],
+            "embedding_model": "dinov2_vitb14",
+            "embedding_vitb14": result["embedding"],
             "species": "bovine_rocha",
             "source": "dataset_rocha",
         }
@@ -109,8 +109,8 @@ def fetch_atlas_data() -> tuple[np.ndarray, np.ndarray]:
     while True:
         url = (
             f"{SUPABASE_URL}/rest/v1/embryo_references"
-            f"?select=embedding,classification"
-            f"&embedding=not.is.null"
+            f"?select=embedding_vitb14,classification"
+            f"&embedding_model=eq.dinov2_vitb14"
             f"&order=id"
             f"&offset={offset}&limit={page_size}"
         )
@@ -123,7 +123,7 @@ def fetch_atlas_data() -> tuple[np.ndarray, np.ndarray]:
 
         for row in data:
             cls = row.get("classification")
-            emb = row.get("embedding")
+            emb = row.get("embedding_vitb14")
             if cls not in CLASS_TO_IDX or not emb:
                 continue
             # Supabase may return embedding as JSON string or list
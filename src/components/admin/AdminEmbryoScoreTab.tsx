@@ -12,7 +12,7 @@
 import { useState, useEffect } from 'react';
 import { useQuery, useMutation, useQueryClient } from '@tanstack/react-query';
 import { supabase } from '@/lib/supabase';
-import { triggerAnalysis } from '@/hooks/useAnalyzeEmbryo';
+import { invalidatePipelineCaches, triggerAnalysis } from '@/hooks/useAnalyzeEmbryo';
 import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
 import { Label } from '@/components/ui/label';
@@ -202,6 +202,7 @@ export default function AdminEmbryoScoreTab() {
     },
     onSuccess: () => {
       queryClient.invalidateQueries({ queryKey: ['embryo-score-secret'] });
+      invalidatePipelineCaches('secrets');
       setApiKeySaved(true);
       setTimeout(() => setApiKeySaved(false), 3000);
     },
@@ -240,6 +241,7 @@ export default function AdminEmbryoScoreTab() {
     },
     onSuccess: () => {
       queryClient.invalidateQueries({ queryKey: ['embryo-score-configs'] });
+      invalidatePipelineCaches('config');
       setNotes('');
     },
   });
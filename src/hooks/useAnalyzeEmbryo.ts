@@ -4,12 +4,56 @@
  * Replaces all `supabase.functions.invoke('embryo-analyze')` calls.
  * Uses fetchWithRetry (same pattern as OCR) to handle cold-start 503s.
  * If Cloud Run fails after retries, marks the queue job as 'failed' in DB.
+ * When /analyze leaves classification pending (deferred mode or out of time),
+ * chains POST /classify on VITE_CLASSIFY_URL (defaults to the pipeline URL).
  */
 
 import { PIPELINE_URL, fetchWithRetry } from '@/lib/cloudRunOcr';
 import { supabase } from '@/lib/supabase';
 
 const API_KEY = import.meta.env.VITE_PIPELINE_API_KEY || '';
+const CLASSIFY_URL = import.meta.env.VITE_CLASSIFY_URL || PIPELINE_URL;
+
+/**
+ * Trigger the deferred Gemini + KNN stage for a job. Fire-and-forget: the job
+ * is already 'completed' and /classify is idempotent (it claims the pending
+ * embryos), so a lost call is picked up by the pipeline's re-drive sweep
+ * (CLASSIFY_REDRIVE_* in cloud-run/embryoscore-pipeline/app.py).
+ */
+export function triggerClassification(queueId: string): void {
+  fetchWithRetry(
+    `${CLASSIFY_URL}/classify`,
+    {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        ...(API_KEY ? { 'X-Api-Key': API_KEY } : {}),
+      },
+      body: JSON.stringify({ queue_id: queueId }),
+    },
+    3,
+  ).catch((err: unknown) => {
+    console.warn(`[classify] ${queueId}:`, err);
+  });
+}
+
+/**
+ * Ask the pipeline to drop its cached embryo_score_config / secrets after an
+ * admin edit. Fire-and-forget: it reaches one instance; the others pick the
+ * change up within their cache TTL anyway.
+ */
+export function invalidatePipelineCaches(cache?: 'config' | 'secrets'): void {
+  fetch(`${PIPELINE_URL}/cache/invalidate`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      ...(API_KEY ? { 'X-Api-Key': API_KEY } : {}),
+    },
+    body: JSON.stringify({ cache: cache ?? null }),
+  }).catch((err: unknown) => {
+    console.warn('[pipeline] cache invalidation failed:', err);
+  });
+}
 
 /**
  * Trigger analysis for a queue job. NOT fire-and-forget:
@@ -53,6 +97,11 @@ export async function triggerAnalysis(
       return { success: false, error: errorMsg };
     }
 
+    const result = await resp.json().catch(() => null);
+    if (result?.classification_pending) {
+      triggerClassification(queueId);
+    }
+
     return { success: true };
   } catch (err) {
     const errorMsg = err instanceof Error ? err.message : String(err);
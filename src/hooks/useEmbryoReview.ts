@@ -103,11 +103,11 @@ export function useSubmitClassification() {
       // 2. Fetch score data for atlas insertion
       const { data: score } = await supabase
         .from('embryo_scores')
-        .select('embedding, kinetic_intensity, kinetic_harmony, kinetic_stability, kinetic_bg_noise, crop_image_path, motion_map_path, composite_path, knn_classification, knn_confidence')
+        .select('embedding, embedding_model, embedding_vits14, embedding_vitb14, kinetic_intensity, kinetic_harmony, kinetic_stability, kinetic_bg_noise, crop_image_path, motion_map_path, composite_path, knn_classification, knn_confidence')
         .eq('id', scoreId)
         .single();
 
-      if (!score?.embedding) return;
+      if (!score?.embedding && !score?.embedding_vits14 && !score?.embedding_vitb14) return;
 
       // 3. Fetch lote_fiv_id for the reference
       const { data: queue } = await supabase
@@ -141,6 +141,9 @@ export function useSubmitClassification() {
           embriao_id: embriaoId,
           classification,
           embedding: score.embedding,
+          embedding_model: score.embedding_model,
+          embedding_vits14: score.embedding_vits14,
+          embedding_vitb14: score.embedding_vitb14,
           kinetic_intensity: score.kinetic_intensity,
           kinetic_harmony: score.kinetic_harmony,
           kinetic_stability: score.kinetic_stability,
@@ -595,6 +595,9 @@ export interface EmbryoScore {
   knn_neighbor_ids?: string[] | null;
   knn_real_bovine_count?: number | null;
   embedding?: number[] | null;
+  embedding_model?: string | null;
+  embedding_vits14?: number[] | null;
+  embedding_vitb14?: number[] | null;
   kinetic_intensity?: number | null;
   kinetic_harmony?: number | null;
   kinetic_symmetry?: number | null;
@@ -692,7 +695,10 @@ export interface EmbryoReference {
   embriao_id?: string | null;
   classification: ClassificacaoEmbriao;
   stage_iets?: number | null;
-  embedding?: number[];
+  embedding?: number[] | null;
+  embedding_model?: string | null;
+  embedding_vits14?: number[] | null;
+  embedding_vitb14?: number[] | null;
   kinetic_intensity?: number | null;
   kinetic_harmony?: number | null;
   kinetic_symmetry?: number | null;
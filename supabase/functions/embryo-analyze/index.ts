@@ -151,11 +151,28 @@ Deno.serve(async (req: Request) => {
       const result = await pipelineResp.json().catch(() => ({}));
       console.log(`Pipeline completed for ${queue_id}: ${result.embryos?.length ?? 0} embryos`);
 
+      // Scores saved with pending classification: chain /classify in the background
+      // (the pipeline's re-drive sweep picks the job up if this call is lost)
+      if (result.classification_pending) {
+        const CLASSIFY_URL = Deno.env.get('EMBRYOSCORE_CLASSIFY_URL') || PIPELINE_URL;
+        const apiKey = Deno.env.get('EMBRYOSCORE_PIPELINE_API_KEY');
+        const classify = fetch(`${CLASSIFY_URL}/classify`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json', ...(apiKey ? { 'X-Api-Key': apiKey } : {}) },
+          body: JSON.stringify({ queue_id }),
+        }).then((r) => {
+          if (!r.ok) console.warn(`Classify ${queue_id}: HTTP ${r.status}`);
+        }).catch((err) => console.warn(`Classify ${queue_id} failed:`, err));
+        // deno-lint-ignore no-explicit-any
+        (globalThis as any).EdgeRuntime?.waitUntil?.(classify);
+      }
+
       return jsonResponse({
         success: true,
         message: 'Analysis completed',
         queue_id,
         embryo_count: result.embryos?.length ?? 0,
+        classification_pending: Boolean(result.classification_pending),
       });
 
     } catch (fetchErr: unknown) {
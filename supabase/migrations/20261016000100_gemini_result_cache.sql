@@ -0,0 +1,23 @@
+-- Persistent tier of the Cloud Run Gemini result cache (GEMINI_CACHE_TABLE)
+-- Key: sha256 of crop JPEG + motion JPEG + resolved prompt + model_name
+-- (answers from a batched call: the batch prompt and response schema instead).
+-- Reprocessing an identical video (failed job, stale-claim reclaim) reads the
+-- classification back instead of calling Gemini again.
+-- Written/read only by the pipeline with the service role key.
+-- Idempotent: safe to re-run
+
+CREATE TABLE IF NOT EXISTS gemini_result_cache (
+  cache_key TEXT PRIMARY KEY,
+  model_name TEXT NOT NULL,
+  result JSONB NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS gemini_result_cache_created_idx
+  ON gemini_result_cache (created_at);
+
+-- No policies: only the service role (which bypasses RLS) can touch it
+ALTER TABLE gemini_result_cache ENABLE ROW LEVEL SECURITY;
+
+COMMENT ON TABLE gemini_result_cache IS
+'Cache de classificações Gemini do pipeline (chave = hash das imagens + prompt + modelo). Pode ser truncada a qualquer momento.';
@@ -0,0 +1,22 @@
+-- Deferred classification (Cloud Run CLASSIFY_MODE=deferred and deadline-deferred embryos)
+-- /analyze saves scores with classification_status = 'pending' plus the Gemini prompt
+-- inputs; POST /classify completes them from the stored crop + heatmap.
+
+ALTER TABLE embryo_scores
+ADD COLUMN IF NOT EXISTS classification_status TEXT DEFAULT 'done',
+ADD COLUMN IF NOT EXISTS kinetic_inputs JSONB DEFAULT NULL;
+
+ALTER TABLE embryo_analysis_queue
+ADD COLUMN IF NOT EXISTS classification_status TEXT DEFAULT NULL,
+ADD COLUMN IF NOT EXISTS classification_started_at TIMESTAMPTZ DEFAULT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_embryo_scores_classification_pending
+  ON embryo_scores (embriao_id)
+  WHERE classification_status = 'pending' AND is_current;
+
+COMMENT ON COLUMN embryo_scores.classification_status IS
+'done = Gemini já avaliou (ou falhou definitivamente); pending = aguardando /classify.';
+COMMENT ON COLUMN embryo_scores.kinetic_inputs IS
+'Entradas do prompt Gemini (activity_score, nsd, anr, kinetic_profile) para a classificação adiada.';
+COMMENT ON COLUMN embryo_analysis_queue.classification_status IS
+'NULL/done = nada pendente; pending = há embriões aguardando /classify; processing = /classify em andamento.';
@@ -0,0 +1,118 @@
+-- Single-round-trip job claim for Cloud Run /analyze (queue_id mode)
+-- claim_embryo_analysis_job: atomically claims the queue row (pending, stale
+-- processing or failed) and returns everything the pipeline needs before the
+-- video download: job fields, media path, active config, Gemini key and the
+-- expected embryo count. Replaces up to 8 sequential PostgREST calls.
+-- embryo_analysis_media_path: read-only media path lookup, so the pipeline can
+-- create the signed video URL while the claim runs.
+-- Called only by the pipeline with the service role key.
+-- Idempotent: safe to re-run
+
+CREATE OR REPLACE FUNCTION public.claim_embryo_analysis_job(
+  p_queue_id UUID,
+  p_stale_after_seconds INT DEFAULT 300
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  q embryo_analysis_queue%ROWTYPE;
+  v_outcome TEXT;
+  v_progress TEXT;
+  v_media_path TEXT;
+  v_config JSONB;
+  v_gemini_key TEXT;
+  v_expected INT;
+BEGIN
+  -- Row lock: concurrent claims of the same job serialize here
+  SELECT * INTO q FROM embryo_analysis_queue WHERE id = p_queue_id FOR UPDATE;
+  IF NOT FOUND THEN
+    RETURN jsonb_build_object('outcome', 'not_found');
+  END IF;
+
+  IF q.status = 'pending' THEN
+    v_outcome := 'claimed';
+    v_progress := 'Iniciando análise...';
+  ELSIF q.status = 'completed' THEN
+    RETURN jsonb_build_object('outcome', 'completed', 'status', q.status);
+  ELSIF q.status = 'processing' THEN
+    IF q.started_at IS NOT NULL
+       AND q.started_at > now() - make_interval(secs => p_stale_after_seconds) THEN
+      RETURN jsonb_build_object('outcome', 'busy', 'status', q.status);
+    END IF;
+    v_outcome := 'reclaimed_stale';
+    v_progress := 'Reprocessando (timeout anterior)...';
+  ELSIF q.status = 'failed' THEN
+    v_outcome := 'reclaimed_failed';
+    v_progress := 'Reprocessando...';
+  ELSE
+    RETURN jsonb_build_object('outcome', 'invalid_state', 'status', q.status);
+  END IF;
+
+  UPDATE embryo_analysis_queue
+  SET status = 'processing',
+      started_at = now(),
+      error_message = NULL,
+      progress_message = v_progress
+  WHERE id = p_queue_id;
+
+  SELECT m.arquivo_path INTO v_media_path
+  FROM acasalamento_embrioes_media m WHERE m.id = q.media_id;
+
+  SELECT jsonb_build_object('calibration_prompt', c.calibration_prompt, 'model_name', c.model_name)
+  INTO v_config
+  FROM embryo_score_config c
+  WHERE c.active
+  ORDER BY c.created_at DESC
+  LIMIT 1;
+
+  SELECT s.key_value INTO v_gemini_key
+  FROM embryo_score_secrets s
+  WHERE s.key_name = 'GEMINI_API_KEY'
+  LIMIT 1;
+
+  v_expected := COALESCE(q.expected_count, 0);
+  IF v_expected = 0 THEN
+    SELECT count(*) INTO v_expected FROM embrioes e WHERE e.queue_id = p_queue_id;
+  END IF;
+
+  RETURN jsonb_build_object(
+    'outcome', v_outcome,
+    'job', jsonb_build_object(
+      'media_id', q.media_id,
+      'lote_fiv_acasalamento_id', q.lote_fiv_acasalamento_id,
+      'expected_count', q.expected_count,
+      'manual_bboxes', q.manual_bboxes,
+      'embryo_offset', q.embryo_offset
+    ),
+    'media_path', v_media_path,
+    'config', COALESCE(v_config, '{}'::jsonb),
+    'gemini_api_key', v_gemini_key,
+    'expected_count', v_expected
+  );
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.embryo_analysis_media_path(p_queue_id UUID)
+RETURNS TEXT
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT m.arquivo_path
+  FROM embryo_analysis_queue q
+  JOIN acasalamento_embrioes_media m ON m.id = q.media_id
+  WHERE q.id = p_queue_id;
+$$;
+
+-- Returns the Gemini key: never callable from the browser roles
+REVOKE ALL ON FUNCTION public.claim_embryo_analysis_job(UUID, INT) FROM PUBLIC, anon, authenticated;
+REVOKE ALL ON FUNCTION public.embryo_analysis_media_path(UUID) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.claim_embryo_analysis_job(UUID, INT) TO service_role;
+GRANT EXECUTE ON FUNCTION public.embryo_analysis_media_path(UUID) TO service_role;
+
+COMMENT ON FUNCTION public.claim_embryo_analysis_job(UUID, INT) IS
+'Reivindica o job (pending, processing expirado ou failed) e devolve job, caminho do vídeo, config ativa, chave Gemini e contagem esperada em uma chamada. Uso exclusivo do pipeline (service role).';
@@ -0,0 +1,32 @@
+-- Change watermark for the pipeline's in-memory atlas index
+-- The Cloud Run pipeline mirrors embryo_references in memory and answers KNN
+-- queries locally. It syncs incrementally by (updated_at, id): every insert and
+-- update stamps updated_at, and the index below serves the keyset scan.
+-- Existing rows get the migration time, so the first sync after this migration
+-- re-reads the whole atlas once. Deletes are detected by the pipeline through
+-- the row count (they trigger a full reload).
+-- Idempotent: safe to re-run
+
+ALTER TABLE embryo_references
+  ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION trg_embryo_references_updated_at_fn()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  NEW.updated_at := now();
+  RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_embryo_references_updated_at ON embryo_references;
+CREATE TRIGGER trg_embryo_references_updated_at
+BEFORE UPDATE ON embryo_references
+FOR EACH ROW EXECUTE FUNCTION trg_embryo_references_updated_at_fn();
+
+CREATE INDEX IF NOT EXISTS idx_embryo_refs_updated_at
+  ON embryo_references(updated_at, id);
+
+COMMENT ON COLUMN embryo_references.updated_at IS
+'Última inserção/alteração da referência (marca d''água da sincronização do índice KNN em memória do pipeline).';
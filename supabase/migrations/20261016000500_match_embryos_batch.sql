@@ -0,0 +1,65 @@
+-- Batched KNN for the Cloud Run pipeline
+-- match_embryos_batch runs match_embryos_v2 for every query of a job and
+-- returns the neighbors per query together with the embryo_references count,
+-- so a plate's KNN is one round trip instead of a count + one RPC per embryo.
+-- Payload: query_embeddings = pgvector texts ("[0.1,...]", 768-d),
+--          query_kinetics = [[intensity, harmony, stability] | null, ...] in the same order.
+-- Returns: { total_refs, neighbors: [[{ id, classification, visual_similarity,
+--            kinetic_similarity, composite_score }, ...], ...] }
+-- Requires match_embryos_v2 (saved_migrations/20260218_knn_v2_match_embryos.sql).
+-- Service role only.
+-- Idempotent: safe to re-run
+
+CREATE OR REPLACE FUNCTION public.match_embryos_batch(
+  query_embeddings TEXT[],
+  query_kinetics JSONB DEFAULT NULL,
+  match_count INT DEFAULT 10,
+  visual_top_n INT DEFAULT 30,
+  alpha FLOAT DEFAULT 0.7,
+  beta FLOAT DEFAULT 0.3,
+  filter_lab_id UUID DEFAULT NULL,
+  min_similarity FLOAT DEFAULT 0.50
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_total BIGINT;
+  v_neighbors JSONB;
+BEGIN
+  SELECT count(*) INTO v_total FROM embryo_references;
+
+  SELECT COALESCE(jsonb_agg(COALESCE(m.neighbors, '[]'::jsonb) ORDER BY q.ord), '[]'::jsonb)
+  INTO v_neighbors
+  FROM unnest(query_embeddings) WITH ORDINALITY AS q(embedding, ord)
+  LEFT JOIN LATERAL (
+    SELECT jsonb_agg(jsonb_build_object(
+             'id', v.id,
+             'classification', v.classification,
+             'visual_similarity', v.visual_similarity,
+             'kinetic_similarity', v.kinetic_similarity,
+             'composite_score', v.composite_score
+           ) ORDER BY v.composite_score DESC) AS neighbors
+    FROM match_embryos_v2(
+      q.embedding::vector(768),
+      (query_kinetics -> (q.ord::INT - 1) ->> 0)::REAL,
+      (query_kinetics -> (q.ord::INT - 1) ->> 1)::REAL,
+      (query_kinetics -> (q.ord::INT - 1) ->> 2)::REAL,
+      match_count, visual_top_n, alpha, beta, filter_lab_id, min_similarity
+    ) v
+  ) m ON true;
+
+  RETURN jsonb_build_object('total_refs', v_total, 'neighbors', v_neighbors);
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT)
+  FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT)
+  TO service_role;
+
+COMMENT ON FUNCTION public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT) IS
+'KNN (match_embryos_v2) de todos os embriões de um job em uma chamada, com a contagem do atlas. Uso exclusivo do pipeline (service role).';
@@ -0,0 +1,151 @@
+-- Transactional score persistence for Cloud Run /analyze
+-- save_embryo_analysis_results takes the whole job result as one JSON payload
+-- and, in a single transaction: records the plate frame + detected bboxes,
+-- maps result indices to the job's embrioes (ORDER BY identificacao), copies an
+-- existing biologist classification, retires the current scores, inserts the
+-- new ones, upserts the embryo_references atlas and completes the job.
+-- An instance dying mid-save leaves the previous state intact.
+-- Payload: { plate_frame_path, detected_bboxes, media_id,
+--            scores: [{ index, <embryo_scores columns>... }] }
+-- Score keys that are not embryo_scores columns are ignored, so the pipeline
+-- can send columns from migrations that are not applied yet.
+-- Requires 20261016000200_deferred_classification.sql. Service role only.
+-- Idempotent: safe to re-run
+
+CREATE OR REPLACE FUNCTION public.save_embryo_analysis_results(
+  p_queue_id UUID,
+  p_result JSONB
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_scores JSONB;
+  v_cols TEXT;
+  v_saved INT := 0;
+  v_skipped JSONB;
+  v_atlas INT := 0;
+  v_atlas_error TEXT;
+  v_pending BOOLEAN;
+BEGIN
+  -- Row lock: a reclaim of the same job waits for this save to finish
+  PERFORM 1 FROM embryo_analysis_queue WHERE id = p_queue_id FOR UPDATE;
+  IF NOT FOUND THEN
+    RAISE EXCEPTION 'Job not found: %', p_queue_id;
+  END IF;
+
+  UPDATE embryo_analysis_queue
+  SET plate_frame_path = p_result->>'plate_frame_path',
+      detected_bboxes = p_result->'detected_bboxes'
+  WHERE id = p_queue_id;
+
+  IF jsonb_array_length(COALESCE(p_result->'scores', '[]'::jsonb)) = 0 THEN
+    UPDATE embryo_analysis_queue
+    SET status = 'completed', completed_at = now(), error_log = 'No embryos detected'
+    WHERE id = p_queue_id;
+    RETURN jsonb_build_object('saved', 0, 'skipped', '[]'::jsonb, 'atlas', 0,
+                              'classification_pending', false);
+  END IF;
+
+  -- Attach embriao_id (+ biologist classification) by detection index
+  WITH embryos AS (
+    SELECT e.id, e.classificacao,
+           (row_number() OVER (ORDER BY e.identificacao) - 1)::INT AS idx
+    FROM embrioes e
+    WHERE e.queue_id = p_queue_id
+  )
+  SELECT
+    COALESCE(jsonb_agg(
+      s.rec - 'index'
+        || jsonb_build_object('embriao_id', em.id, 'media_id', p_result->>'media_id',
+                              'is_current', true)
+        || CASE WHEN em.classificacao IN ('BE', 'BN', 'BX', 'BL', 'BI', 'Mo', 'Dg')
+                THEN jsonb_build_object('biologist_classification', em.classificacao)
+                ELSE '{}'::jsonb END
+    ) FILTER (WHERE em.id IS NOT NULL), '[]'::jsonb),
+    COALESCE(jsonb_agg((s.rec->>'index')::INT) FILTER (WHERE em.id IS NULL), '[]'::jsonb)
+  INTO v_scores, v_skipped
+  FROM jsonb_array_elements(p_result->'scores') AS s(rec)
+  LEFT JOIN embryos em ON em.idx = (s.rec->>'index')::INT;
+
+  IF jsonb_array_length(v_scores) > 0 THEN
+    -- Retire the current scores; the insert below is in the same transaction
+    UPDATE embryo_scores
+    SET is_current = false
+    WHERE is_current
+      AND embriao_id IN (SELECT (r->>'embriao_id')::UUID FROM jsonb_array_elements(v_scores) r);
+
+    -- Insert only the columns present in the payload (the rest keep their defaults)
+    SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum)
+    INTO v_cols
+    FROM pg_attribute a
+    WHERE a.attrelid = 'public.embryo_scores'::regclass
+      AND a.attnum > 0 AND NOT a.attisdropped
+      AND EXISTS (SELECT 1 FROM jsonb_array_elements(v_scores) r WHERE r ? a.attname);
+
+    EXECUTE format(
+      'INSERT INTO embryo_scores (%s) SELECT %s FROM jsonb_populate_recordset(NULL::embryo_scores, $1)',
+      v_cols, v_cols)
+    USING v_scores;
+    GET DIAGNOSTICS v_saved = ROW_COUNT;
+
+    -- Atlas: biologist-classified embryos with an embedding. Best effort, as
+    -- before: a failure here must not lose the scores.
+    BEGIN
+      INSERT INTO embryo_references (
+        embriao_id, classification, embedding,
+        kinetic_intensity, kinetic_harmony, kinetic_stability, kinetic_bg_noise,
+        best_frame_path, motion_map_path, species, source, lab_id
+      )
+      SELECT (r->>'embriao_id')::UUID, r->>'biologist_classification', (r->>'embedding')::vector,
+             (r->>'kinetic_intensity')::REAL, (r->>'kinetic_harmony')::REAL,
+             (r->>'kinetic_stability')::REAL, (r->>'kinetic_bg_noise')::REAL,
+             r->>'crop_image_path', r->>'motion_map_path',
+             'bovine_real', 'lab', '00000000-0000-0000-0000-000000000001'::UUID
+      FROM jsonb_array_elements(v_scores) r
+      WHERE r ? 'biologist_classification' AND r->>'embedding' IS NOT NULL
+      ON CONFLICT (embriao_id) DO UPDATE SET
+        classification = EXCLUDED.classification,
+        embedding = EXCLUDED.embedding,
+        kinetic_intensity = EXCLUDED.kinetic_intensity,
+        kinetic_harmony = EXCLUDED.kinetic_harmony,
+        kinetic_stability = EXCLUDED.kinetic_stability,
+        kinetic_bg_noise = EXCLUDED.kinetic_bg_noise,
+        best_frame_path = EXCLUDED.best_frame_path,
+        motion_map_path = EXCLUDED.motion_map_path,
+        species = EXCLUDED.species,
+        source = EXCLUDED.source,
+        lab_id = EXCLUDED.lab_id;
+      GET DIAGNOSTICS v_atlas = ROW_COUNT;
+    EXCEPTION WHEN OTHERS THEN
+      v_atlas_error := SQLERRM;
+    END;
+  END IF;
+
+  v_pending := EXISTS (
+    SELECT 1 FROM jsonb_array_elements(v_scores) r
+    WHERE r->>'classification_status' = 'pending');
+
+  UPDATE embryo_analysis_queue
+  SET status = 'completed',
+      completed_at = now(),
+      classification_status = CASE WHEN v_pending THEN 'pending' ELSE 'done' END
+  WHERE id = p_queue_id;
+
+  RETURN jsonb_build_object(
+    'saved', v_saved,
+    'skipped', v_skipped,
+    'atlas', v_atlas,
+    'atlas_error', v_atlas_error,
+    'classification_pending', v_pending
+  );
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.save_embryo_analysis_results(UUID, JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.save_embryo_analysis_results(UUID, JSONB) TO service_role;
+
+COMMENT ON FUNCTION public.save_embryo_analysis_results(UUID, JSONB) IS
+'Grava scores, atualiza o atlas e conclui o job em uma única transação (payload JSON do pipeline). Uso exclusivo do pipeline (service role).';
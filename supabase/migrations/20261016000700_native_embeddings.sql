@@ -0,0 +1,414 @@
+-- Native-dimension, model-tagged embeddings
+-- Until now every embedding went into vector(768): the pipeline's 384-d
+-- DINOv2 ViT-S/14 vectors were zero-padded to 768 and shared one HNSW index
+-- with the 768-d ViT-B/14 vectors of the DINOv2 service / bootstrap script,
+-- which are not comparable with them.
+-- 1. embryo_scores + embryo_references get embedding_model plus one column per
+--    model at its native dimension: halfvec when pgvector >= 0.7 provides it
+--    (half the bytes), else vector.
+-- 2. A trigger routes writes that still use the legacy embedding column
+--    (frontend, bootstrap script, older pipeline revisions): zero-padded
+--    vectors go to embedding_vits14, real 768-d ones to embedding_vitb14.
+--    The same routing backfills the existing rows.
+-- 3. One HNSW index per model column.
+-- 4. match_embryos_v3 searches only the query model's column (same scoring as
+--    match_embryos_v2, which keeps serving the legacy column);
+--    match_embryos_batch gains query_model and routes to it.
+-- 5. save_embryo_analysis_results copies the model columns into the atlas.
+-- The legacy embedding columns are kept (nullable) until every reader moved.
+-- Requires 20261016000400_embryo_references_updated_at.sql,
+-- 20261016000500_match_embryos_batch.sql and
+-- 20261016000600_save_embryo_analysis_results.sql: sections 4 and 5 replace
+-- their functions, so this file must be applied after them.
+-- Idempotent: safe to re-run
+
+-- ── 1. Columns ──
+DO $$
+DECLARE
+  v_type TEXT := CASE WHEN to_regtype('halfvec') IS NOT NULL THEN 'halfvec' ELSE 'vector' END;
+  v_table TEXT;
+BEGIN
+  FOREACH v_table IN ARRAY ARRAY['embryo_scores', 'embryo_references'] LOOP
+    EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS embedding_model TEXT', v_table);
+    EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS embedding_vits14 %s(384)', v_table, v_type);
+    EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS embedding_vitb14 %s(768)', v_table, v_type);
+  END LOOP;
+END $$;
+
+ALTER TABLE embryo_references ALTER COLUMN embedding DROP NOT NULL;
+
+-- ── 2. Legacy writes → model columns ──
+CREATE OR REPLACE FUNCTION trg_route_legacy_embedding_fn()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_values REAL[];
+BEGIN
+  IF NEW.embedding IS NULL OR NEW.embedding_vits14 IS NOT NULL OR NEW.embedding_vitb14 IS NOT NULL THEN
+    RETURN NEW;
+  END IF;
+  IF TG_OP = 'UPDATE' AND NEW.embedding IS NOT DISTINCT FROM OLD.embedding
+     AND NEW.embedding_model IS NOT NULL THEN
+    RETURN NEW;  -- Model columns cleared on purpose
+  END IF;
+  v_values := NEW.embedding::REAL[];
+  IF NOT EXISTS (SELECT 1 FROM unnest(v_values[385:768]) x WHERE x <> 0) THEN
+    NEW.embedding_vits14 := v_values[1:384];  -- Zero-padded ViT-S/14 (assignment cast)
+    NEW.embedding_model := 'dinov2_vits14';
+  ELSE
+    NEW.embedding_vitb14 := v_values;
+    NEW.embedding_model := 'dinov2_vitb14';
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_route_legacy_embedding ON embryo_scores;
+CREATE TRIGGER trg_route_legacy_embedding
+BEFORE INSERT OR UPDATE OF embedding ON embryo_scores
+FOR EACH ROW EXECUTE FUNCTION trg_route_legacy_embedding_fn();
+
+DROP TRIGGER IF EXISTS trg_route_legacy_embedding ON embryo_references;
+CREATE TRIGGER trg_route_legacy_embedding
+BEFORE INSERT OR UPDATE OF embedding ON embryo_references
+FOR EACH ROW EXECUTE FUNCTION trg_route_legacy_embedding_fn();
+
+-- Backfill through the trigger (embryo_references rows also get a new
+-- updated_at, so the pipeline's atlas index re-reads them)
+UPDATE embryo_references SET embedding = embedding
+WHERE embedding IS NOT NULL AND embedding_vits14 IS NULL AND embedding_vitb14 IS NULL;
+UPDATE embryo_scores SET embedding = embedding
+WHERE embedding IS NOT NULL AND embedding_vits14 IS NULL AND embedding_vitb14 IS NULL;
+
+-- ── 3. Per-model HNSW indexes ──
+DO $$
+DECLARE
+  v_ops TEXT := CASE WHEN to_regtype('halfvec') IS NOT NULL THEN 'halfvec_cosine_ops' ELSE 'vector_cosine_ops' END;
+BEGIN
+  EXECUTE format('CREATE INDEX IF NOT EXISTS embryo_refs_vits14_idx ON embryo_references '
+                 'USING hnsw (embedding_vits14 %s) WITH (m = 16, ef_construction = 64)', v_ops);
+  EXECUTE format('CREATE INDEX IF NOT EXISTS embryo_refs_vitb14_idx ON embryo_references '
+                 'USING hnsw (embedding_vitb14 %s) WITH (m = 16, ef_construction = 64)', v_ops);
+END $$;
+
+CREATE INDEX IF NOT EXISTS idx_embryo_refs_embedding_model ON embryo_references(embedding_model);
+
+-- ── 4. KNN routed by model ──
+CREATE OR REPLACE FUNCTION public.match_embryos_v3(
+  query_model TEXT,
+  query_embedding TEXT,
+  query_kinetic_intensity REAL DEFAULT NULL,
+  query_kinetic_harmony REAL DEFAULT NULL,
+  query_kinetic_stability REAL DEFAULT NULL,
+  match_count INT DEFAULT 10,
+  visual_top_n INT DEFAULT 30,
+  alpha FLOAT DEFAULT 0.7,
+  beta FLOAT DEFAULT 0.3,
+  filter_lab_id UUID DEFAULT NULL,
+  min_similarity FLOAT DEFAULT 0.50
+)
+RETURNS TABLE (
+  id UUID, classification TEXT,
+  visual_similarity REAL, kinetic_similarity REAL, composite_score REAL,
+  species TEXT,
+  kinetic_intensity REAL, kinetic_harmony REAL, kinetic_stability REAL,
+  pregnancy_result BOOLEAN,
+  best_frame_path TEXT, motion_map_path TEXT
+)
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+  v_column TEXT := CASE query_model
+    WHEN 'dinov2_vits14' THEN 'embedding_vits14'
+    WHEN 'dinov2_vitb14' THEN 'embedding_vitb14'
+  END;
+  v_type TEXT;
+BEGIN
+  IF v_column IS NULL THEN
+    RAISE EXCEPTION 'Unknown embedding model: %', query_model;
+  END IF;
+  -- halfvec(384) / vector(384)...: the query is cast to the column's type so the HNSW index applies
+  SELECT format_type(a.atttypid, a.atttypmod) INTO v_type
+  FROM pg_attribute a
+  WHERE a.attrelid = 'public.embryo_references'::regclass AND a.attname = v_column;
+
+  -- Same visual search + kinetic re-ranking as match_embryos_v2
+  RETURN QUERY EXECUTE format($q$
+    WITH visual_neighbors AS (
+      SELECT er.id, er.classification,
+        (1 - (er.%1$I <=> $1::%2$s))::REAL AS vis_sim,
+        er.species, er.kinetic_intensity, er.kinetic_harmony, er.kinetic_stability,
+        er.pregnancy_result, er.best_frame_path, er.motion_map_path
+      FROM embryo_references er
+      WHERE ($9::UUID IS NULL OR er.lab_id = $9)
+        AND (1 - (er.%1$I <=> $1::%2$s)) > $10
+      ORDER BY er.%1$I <=> $1::%2$s ASC
+      LIMIT $6
+    ),
+    scored AS (
+      SELECT vn.*,
+        CASE WHEN $2 IS NULL OR vn.kinetic_intensity IS NULL
+          THEN 0.0
+          ELSE (1.0 - (
+            ABS(COALESCE(vn.kinetic_intensity,0) - COALESCE($2,0)) +
+            ABS(COALESCE(vn.kinetic_harmony,0) - COALESCE($3,0)) +
+            ABS(COALESCE(vn.kinetic_stability,0) - COALESCE($4,0))
+          ) / 3.0)
+        END::REAL AS kin_sim
+      FROM visual_neighbors vn
+    )
+    SELECT s.id, s.classification,
+      s.vis_sim, s.kin_sim,
+      ($7 * s.vis_sim + $8 * CASE WHEN $2 IS NULL OR s.kinetic_intensity IS NULL
+                                  THEN s.vis_sim ELSE s.kin_sim END)::REAL AS comp_score,
+      s.species, s.kinetic_intensity, s.kinetic_harmony, s.kinetic_stability,
+      s.pregnancy_result, s.best_frame_path, s.motion_map_path
+    FROM scored s
+    ORDER BY comp_score DESC
+    LIMIT $5
+  $q$, v_column, v_type)
+  USING query_embedding, query_kinetic_intensity, query_kinetic_harmony, query_kinetic_stability,
+        match_count, visual_top_n, alpha, beta, filter_lab_id, min_similarity;
+END;
+$$;
+
+-- New signature (query_model): the 8-argument version is replaced
+DROP FUNCTION IF EXISTS public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT);
+
+CREATE OR REPLACE FUNCTION public.match_embryos_batch(
+  query_embeddings TEXT[],
+  query_kinetics JSONB DEFAULT NULL,
+  match_count INT DEFAULT 10,
+  visual_top_n INT DEFAULT 30,
+  alpha FLOAT DEFAULT 0.7,
+  beta FLOAT DEFAULT 0.3,
+  filter_lab_id UUID DEFAULT NULL,
+  min_similarity FLOAT DEFAULT 0.50,
+  query_model TEXT DEFAULT NULL
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_total BIGINT;
+  v_neighbors JSONB;
+BEGIN
+  -- Only references of the query model are comparable (NULL = legacy 768-d column)
+  SELECT count(*) INTO v_total FROM embryo_references er
+  WHERE query_model IS NULL OR er.embedding_model = query_model;
+
+  IF query_model IS NULL THEN
+    SELECT COALESCE(jsonb_agg(COALESCE(m.neighbors, '[]'::jsonb) ORDER BY q.ord), '[]'::jsonb)
+    INTO v_neighbors
+    FROM unnest(query_embeddings) WITH ORDINALITY AS q(embedding, ord)
+    LEFT JOIN LATERAL (
+      SELECT jsonb_agg(jsonb_build_object(
+               'id', v.id,
+               'classification', v.classification,
+               'visual_similarity', v.visual_similarity,
+               'kinetic_similarity', v.kinetic_similarity,
+               'composite_score', v.composite_score
+             ) ORDER BY v.composite_score DESC) AS neighbors
+      FROM match_embryos_v2(
+        q.embedding::vector(768),
+        (query_kinetics -> (q.ord::INT - 1) ->> 0)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 1)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 2)::REAL,
+        match_count, visual_top_n, alpha, beta, filter_lab_id, min_similarity
+      ) v
+    ) m ON true;
+  ELSE
+    SELECT COALESCE(jsonb_agg(COALESCE(m.neighbors, '[]'::jsonb) ORDER BY q.ord), '[]'::jsonb)
+    INTO v_neighbors
+    FROM unnest(query_embeddings) WITH ORDINALITY AS q(embedding, ord)
+    LEFT JOIN LATERAL (
+      SELECT jsonb_agg(jsonb_build_object(
+               'id', v.id,
+               'classification', v.classification,
+               'visual_similarity', v.visual_similarity,
+               'kinetic_similarity', v.kinetic_similarity,
+               'composite_score', v.composite_score
+             ) ORDER BY v.composite_score DESC) AS neighbors
+      FROM match_embryos_v3(
+        query_model, q.embedding,
+        (query_kinetics -> (q.ord::INT - 1) ->> 0)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 1)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 2)::REAL,
+        match_count, visual_top_n, alpha, beta, filter_lab_id, min_similarity
+      ) v
+    ) m ON true;
+  END IF;
+
+  RETURN jsonb_build_object('total_refs', v_total, 'neighbors', v_neighbors);
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT, TEXT)
+  FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT, TEXT)
+  TO service_role;
+
+-- ── 5. Atlas upsert with the model columns ──
+CREATE OR REPLACE FUNCTION public.save_embryo_analysis_results(
+  p_queue_id UUID,
+  p_result JSONB
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_scores JSONB;
+  v_cols TEXT;
+  v_saved INT := 0;
+  v_skipped JSONB;
+  v_atlas INT := 0;
+  v_atlas_error TEXT;
+  v_pending BOOLEAN;
+BEGIN
+  -- Row lock: a reclaim of the same job waits for this save to finish
+  PERFORM 1 FROM embryo_analysis_queue WHERE id = p_queue_id FOR UPDATE;
+  IF NOT FOUND THEN
+    RAISE EXCEPTION 'Job not found: %', p_queue_id;
+  END IF;
+
+  UPDATE embryo_analysis_queue
+  SET plate_frame_path = p_result->>'plate_frame_path',
+      detected_bboxes = p_result->'detected_bboxes'
+  WHERE id = p_queue_id;
+
+  IF jsonb_array_length(COALESCE(p_result->'scores', '[]'::jsonb)) = 0 THEN
+    UPDATE embryo_analysis_queue
+    SET status = 'completed', completed_at = now(), error_log = 'No embryos detected'
+    WHERE id = p_queue_id;
+    RETURN jsonb_build_object('saved', 0, 'skipped', '[]'::jsonb, 'atlas', 0,
+                              'classification_pending', false);
+  END IF;
+
+  -- Attach embriao_id (+ biologist classification) by detection index
+  WITH embryos AS (
+    SELECT e.id, e.classificacao,
+           (row_number() OVER (ORDER BY e.identificacao) - 1)::INT AS idx
+    FROM embrioes e
+    WHERE e.queue_id = p_queue_id
+  )
+  SELECT
+    COALESCE(jsonb_agg(
+      s.rec - 'index'
+        || jsonb_build_object('embriao_id', em.id, 'media_id', p_result->>'media_id',
+                              'is_current', true)
+        || CASE WHEN em.classificacao IN ('BE', 'BN', 'BX', 'BL', 'BI', 'Mo', 'Dg')
+                THEN jsonb_build_object('biologist_classification', em.classificacao)
+                ELSE '{}'::jsonb END
+    ) FILTER (WHERE em.id IS NOT NULL), '[]'::jsonb),
+    COALESCE(jsonb_agg((s.rec->>'index')::INT) FILTER (WHERE em.id IS NULL), '[]'::jsonb)
+  INTO v_scores, v_skipped
+  FROM jsonb_array_elements(p_result->'scores') AS s(rec)
+  LEFT JOIN embryos em ON em.idx = (s.rec->>'index')::INT;
+
+  IF jsonb_array_length(v_scores) > 0 THEN
+    -- Retire the current scores; the insert below is in the same transaction
+    UPDATE embryo_scores
+    SET is_current = false
+    WHERE is_current
+      AND embriao_id IN (SELECT (r->>'embriao_id')::UUID FROM jsonb_array_elements(v_scores) r);
+
+    -- Insert only the columns present in the payload (the rest keep their defaults)
+    SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum)
+    INTO v_cols
+    FROM pg_attribute a
+    WHERE a.attrelid = 'public.embryo_scores'::regclass
+      AND a.attnum > 0 AND NOT a.attisdropped
+      AND EXISTS (SELECT 1 FROM jsonb_array_elements(v_scores) r WHERE r ? a.attname);
+
+    EXECUTE format(
+      'INSERT INTO embryo_scores (%s) SELECT %s FROM jsonb_populate_recordset(NULL::embryo_scores, $1)',
+      v_cols, v_cols)
+    USING v_scores;
+    GET DIAGNOSTICS v_saved = ROW_COUNT;
+
+    -- Atlas: biologist-classified embryos with an embedding. Best effort, as
+    -- before: a failure here must not lose the scores. jsonb_populate_recordset
+    -- casts each embedding to its column's type (vector / halfvec).
+    BEGIN
+      INSERT INTO embryo_references (
+        embriao_id, classification, embedding, embedding_model, embedding_vits14, embedding_vitb14,
+        kinetic_intensity, kinetic_harmony, kinetic_stability, kinetic_bg_noise,
+        best_frame_path, motion_map_path, species, source, lab_id
+      )
+      SELECT p.embriao_id, p.classification, p.embedding, p.embedding_model,
+             p.embedding_vits14, p.embedding_vitb14,
+             p.kinetic_intensity, p.kinetic_harmony, p.kinetic_stability, p.kinetic_bg_noise,
+             p.best_frame_path, p.motion_map_path, 'bovine_real', 'lab',
+             '00000000-0000-0000-0000-000000000001'::UUID
+      FROM jsonb_populate_recordset(NULL::embryo_references, (
+        SELECT COALESCE(jsonb_agg(jsonb_build_object(
+                 'embriao_id', r->'embriao_id',
+                 'classification', r->'biologist_classification',
+                 'embedding', r->'embedding',
+                 'embedding_model', r->'embedding_model',
+                 'embedding_vits14', r->'embedding_vits14',
+                 'embedding_vitb14', r->'embedding_vitb14',
+                 'kinetic_intensity', r->'kinetic_intensity',
+                 'kinetic_harmony', r->'kinetic_harmony',
+                 'kinetic_stability', r->'kinetic_stability',
+                 'kinetic_bg_noise', r->'kinetic_bg_noise',
+                 'best_frame_path', r->'crop_image_path',
+                 'motion_map_path', r->'motion_map_path')), '[]'::jsonb)
+        FROM jsonb_array_elements(v_scores) r
+        WHERE r ? 'biologist_classification'
+          AND COALESCE(r->>'embedding', r->>'embedding_vits14', r->>'embedding_vitb14') IS NOT NULL
+      )) p
+      ON CONFLICT (embriao_id) DO UPDATE SET
+        classification = EXCLUDED.classification,
+        embedding = EXCLUDED.embedding,
+        embedding_model = EXCLUDED.embedding_model,
+        embedding_vits14 = EXCLUDED.embedding_vits14,
+        embedding_vitb14 = EXCLUDED.embedding_vitb14,
+        kinetic_intensity = EXCLUDED.kinetic_intensity,
+        kinetic_harmony = EXCLUDED.kinetic_harmony,
+        kinetic_stability = EXCLUDED.kinetic_stability,
+        kinetic_bg_noise = EXCLUDED.kinetic_bg_noise,
+        best_frame_path = EXCLUDED.best_frame_path,
+        motion_map_path = EXCLUDED.motion_map_path,
+        species = EXCLUDED.species,
+        source = EXCLUDED.source,
+        lab_id = EXCLUDED.lab_id;
+      GET DIAGNOSTICS v_atlas = ROW_COUNT;
+    EXCEPTION WHEN OTHERS THEN
+      v_atlas_error := SQLERRM;
+    END;
+  END IF;
+
+  v_pending := EXISTS (
+    SELECT 1 FROM jsonb_array_elements(v_scores) r
+    WHERE r->>'classification_status' = 'pending');
+
+  UPDATE embryo_analysis_queue
+  SET status = 'completed',
+      completed_at = now(),
+      classification_status = CASE WHEN v_pending THEN 'pending' ELSE 'done' END
+  WHERE id = p_queue_id;
+
+  RETURN jsonb_build_object(
+    'saved', v_saved,
+    'skipped', v_skipped,
+    'atlas', v_atlas,
+    'atlas_error', v_atlas_error,
+    'classification_pending', v_pending
+  );
+END;
+$$;
+
+COMMENT ON COLUMN embryo_references.embedding_model IS
+'Modelo que gerou o embedding (dinov2_vits14 = pipeline, dinov2_vitb14 = serviço DINOv2); só embeddings do mesmo modelo são comparados.';
+COMMENT ON FUNCTION public.match_embryos_v3(TEXT, TEXT, REAL, REAL, REAL, INT, INT, FLOAT, FLOAT, UUID, FLOAT) IS
+'KNN visual + cinético (mesma pontuação do match_embryos_v2) na coluna de embedding do modelo informado.';
+COMMENT ON FUNCTION public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT, TEXT) IS
+'KNN (match_embryos_v2, ou match_embryos_v3 quando query_model é informado) de todos os embriões de um job em uma chamada, com a contagem do atlas. Uso exclusivo do pipeline (service role).';
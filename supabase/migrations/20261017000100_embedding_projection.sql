@@ -0,0 +1,325 @@
+-- Reduced-dimension embeddings for a faster atlas KNN shortlist
+-- fit_projection.py (cloud-run/embryoscore-pipeline) fits a PCA or random
+-- projection of one model's embeddings down to 128 dims, saves it as a
+-- versioned .npz artifact and writes the reduced vectors here.
+-- 1. embedding_projections: one row per artifact version, with its recall report.
+-- 2. embryo_scores + embryo_references get embedding_projection (the version)
+--    and embedding_reduced (halfvec(128) when pgvector >= 0.7, else vector),
+--    with an L2 HNSW index on the atlas column.
+-- 3. A trigger copies the pipeline's reduced vector from the current score
+--    into the atlas whenever an atlas row's embedding is written.
+-- 4. set_reference_projection: bulk write of reduced vectors (the fit tool).
+-- 5. match_embryos_reduced shortlists candidate_count refs on embedding_reduced,
+--    adds the refs not (yet) reduced with that version, and scores them
+--    exactly as match_embryos_v3; match_embryos_batch gains the projection
+--    arguments and routes to it.
+-- A reduced vector is only compared with vectors of the same projection version.
+-- Requires 20261016000700_native_embeddings.sql.
+-- Idempotent: safe to re-run
+
+-- ── 1. Artifact registry ──
+CREATE TABLE IF NOT EXISTS embedding_projections (
+  version TEXT PRIMARY KEY,
+  model TEXT NOT NULL,
+  method TEXT NOT NULL,
+  source_dim INT NOT NULL,
+  dim INT NOT NULL,
+  refs INT NOT NULL,
+  report JSONB,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- No policies: only the service role (which bypasses RLS) can touch it
+ALTER TABLE embedding_projections ENABLE ROW LEVEL SECURITY;
+
+-- ── 2. Columns + index ──
+DO $$
+DECLARE
+  v_half BOOLEAN := to_regtype('halfvec') IS NOT NULL;
+  v_table TEXT;
+BEGIN
+  FOREACH v_table IN ARRAY ARRAY['embryo_scores', 'embryo_references'] LOOP
+    EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS embedding_projection TEXT', v_table);
+    EXECUTE format('ALTER TABLE %I ADD COLUMN IF NOT EXISTS embedding_reduced %s(128)',
+                   v_table, CASE WHEN v_half THEN 'halfvec' ELSE 'vector' END);
+  END LOOP;
+  EXECUTE format('CREATE INDEX IF NOT EXISTS embryo_refs_reduced_idx ON embryo_references '
+                 'USING hnsw (embedding_reduced %s) WITH (m = 16, ef_construction = 64)',
+                 CASE WHEN v_half THEN 'halfvec_l2_ops' ELSE 'vector_l2_ops' END);
+END $$;
+
+CREATE INDEX IF NOT EXISTS idx_embryo_refs_embedding_projection
+  ON embryo_references(embedding_model, embedding_projection);
+
+-- ── 3. Atlas rows inherit the score's reduced vector ──
+-- Runs after trg_route_legacy_embedding (triggers fire in name order), so
+-- legacy writes already carry embedding_model here.
+CREATE OR REPLACE FUNCTION trg_route_reduced_embedding_fn()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF TG_OP = 'INSERT' AND NEW.embedding_reduced IS NOT NULL THEN
+    RETURN NEW;  -- Written explicitly
+  END IF;
+  -- The embedding changed: the old reduced vector no longer describes it. The
+  -- current score of the same embryo and model holds the pipeline's one (if any).
+  SELECT s.embedding_projection, s.embedding_reduced
+  INTO NEW.embedding_projection, NEW.embedding_reduced
+  FROM embryo_scores s
+  WHERE s.embriao_id = NEW.embriao_id
+    AND s.is_current
+    AND s.embedding_model IS NOT DISTINCT FROM NEW.embedding_model
+    AND s.embedding_reduced IS NOT NULL
+  ORDER BY s.created_at DESC
+  LIMIT 1;
+  RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_route_reduced_embedding ON embryo_references;
+CREATE TRIGGER trg_route_reduced_embedding
+BEFORE INSERT OR UPDATE OF embedding, embedding_vits14, embedding_vitb14 ON embryo_references
+FOR EACH ROW EXECUTE FUNCTION trg_route_reduced_embedding_fn();
+
+-- ── 4. Bulk write from fit_projection.py ──
+CREATE OR REPLACE FUNCTION public.set_reference_projection(
+  p_version TEXT,
+  p_rows JSONB  -- [{"id": ..., "embedding_reduced": "[...]"}]
+)
+RETURNS INT
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_updated INT;
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM embedding_projections WHERE version = p_version) THEN
+    RAISE EXCEPTION 'Unknown projection: %', p_version;
+  END IF;
+  -- jsonb_populate_recordset casts each vector to the column's type (vector / halfvec)
+  UPDATE embryo_references er
+  SET embedding_projection = p_version,
+      embedding_reduced = r.embedding_reduced
+  FROM jsonb_populate_recordset(NULL::embryo_references, p_rows) r
+  WHERE er.id = r.id;
+  GET DIAGNOSTICS v_updated = ROW_COUNT;
+  RETURN v_updated;
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.set_reference_projection(TEXT, JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.set_reference_projection(TEXT, JSONB) TO service_role;
+
+-- ── 5. KNN: reduced shortlist, full-dimension scoring ──
+CREATE OR REPLACE FUNCTION public.match_embryos_reduced(
+  query_model TEXT,
+  query_embedding TEXT,
+  query_projection TEXT,
+  query_reduced TEXT,
+  query_kinetic_intensity REAL DEFAULT NULL,
+  query_kinetic_harmony REAL DEFAULT NULL,
+  query_kinetic_stability REAL DEFAULT NULL,
+  match_count INT DEFAULT 10,
+  visual_top_n INT DEFAULT 30,
+  alpha FLOAT DEFAULT 0.7,
+  beta FLOAT DEFAULT 0.3,
+  filter_lab_id UUID DEFAULT NULL,
+  min_similarity FLOAT DEFAULT 0.50,
+  candidate_count INT DEFAULT 120
+)
+RETURNS TABLE (
+  id UUID, classification TEXT,
+  visual_similarity REAL, kinetic_similarity REAL, composite_score REAL,
+  species TEXT,
+  kinetic_intensity REAL, kinetic_harmony REAL, kinetic_stability REAL,
+  pregnancy_result BOOLEAN,
+  best_frame_path TEXT, motion_map_path TEXT
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_column TEXT := CASE query_model
+    WHEN 'dinov2_vits14' THEN 'embedding_vits14'
+    WHEN 'dinov2_vitb14' THEN 'embedding_vitb14'
+  END;
+  v_type TEXT;
+  v_reduced_type TEXT;
+BEGIN
+  IF v_column IS NULL THEN
+    RAISE EXCEPTION 'Unknown embedding model: %', query_model;
+  END IF;
+  SELECT format_type(a.atttypid, a.atttypmod) INTO v_type
+  FROM pg_attribute a
+  WHERE a.attrelid = 'public.embryo_references'::regclass AND a.attname = v_column;
+  SELECT format_type(a.atttypid, a.atttypmod) INTO v_reduced_type
+  FROM pg_attribute a
+  WHERE a.attrelid = 'public.embryo_references'::regclass AND a.attname = 'embedding_reduced';
+  -- An HNSW scan returns at most ef_search rows (default 40)
+  PERFORM set_config('hnsw.ef_search', greatest(candidate_count, 40)::TEXT, true);
+
+  RETURN QUERY EXECUTE format($q$
+    WITH candidates AS (
+      (SELECT er.id
+       FROM embryo_references er
+       WHERE er.embedding_projection = $11
+         AND ($9::UUID IS NULL OR er.lab_id = $9)
+       ORDER BY er.embedding_reduced <-> $12::%3$s
+       LIMIT $13)
+      UNION
+      -- Not reduced with this version yet (e.g. bootstrap rows): exact
+      SELECT er.id
+      FROM embryo_references er
+      WHERE er.embedding_model = $14
+        AND er.embedding_projection IS DISTINCT FROM $11
+        AND ($9::UUID IS NULL OR er.lab_id = $9)
+    ),
+    visual_neighbors AS (
+      SELECT er.id, er.classification,
+        (1 - (er.%1$I <=> $1::%2$s))::REAL AS vis_sim,
+        er.species, er.kinetic_intensity, er.kinetic_harmony, er.kinetic_stability,
+        er.pregnancy_result, er.best_frame_path, er.motion_map_path
+      FROM embryo_references er
+      JOIN candidates c ON c.id = er.id
+      WHERE (1 - (er.%1$I <=> $1::%2$s)) > $10
+      ORDER BY er.%1$I <=> $1::%2$s ASC
+      LIMIT $6
+    ),
+    scored AS (
+      SELECT vn.*,
+        CASE WHEN $2 IS NULL OR vn.kinetic_intensity IS NULL
+          THEN 0.0
+          ELSE (1.0 - (
+            ABS(COALESCE(vn.kinetic_intensity,0) - COALESCE($2,0)) +
+            ABS(COALESCE(vn.kinetic_harmony,0) - COALESCE($3,0)) +
+            ABS(COALESCE(vn.kinetic_stability,0) - COALESCE($4,0))
+          ) / 3.0)
+        END::REAL AS kin_sim
+      FROM visual_neighbors vn
+    )
+    SELECT s.id, s.classification,
+      s.vis_sim, s.kin_sim,
+      ($7 * s.vis_sim + $8 * CASE WHEN $2 IS NULL OR s.kinetic_intensity IS NULL
+                                  THEN s.vis_sim ELSE s.kin_sim END)::REAL AS comp_score,
+      s.species, s.kinetic_intensity, s.kinetic_harmony, s.kinetic_stability,
+      s.pregnancy_result, s.best_frame_path, s.motion_map_path
+    FROM scored s
+    ORDER BY comp_score DESC
+    LIMIT $5
+  $q$, v_column, v_type, v_reduced_type)
+  USING query_embedding, query_kinetic_intensity, query_kinetic_harmony, query_kinetic_stability,
+        match_count, visual_top_n, alpha, beta, filter_lab_id, min_similarity,
+        query_projection, query_reduced, candidate_count, query_model;
+END;
+$$;
+
+-- New signature (projection arguments): the 9-argument version is replaced
+DROP FUNCTION IF EXISTS public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT, TEXT);
+
+CREATE OR REPLACE FUNCTION public.match_embryos_batch(
+  query_embeddings TEXT[],
+  query_kinetics JSONB DEFAULT NULL,
+  match_count INT DEFAULT 10,
+  visual_top_n INT DEFAULT 30,
+  alpha FLOAT DEFAULT 0.7,
+  beta FLOAT DEFAULT 0.3,
+  filter_lab_id UUID DEFAULT NULL,
+  min_similarity FLOAT DEFAULT 0.50,
+  query_model TEXT DEFAULT NULL,
+  query_projection TEXT DEFAULT NULL,
+  query_reduced TEXT[] DEFAULT NULL,
+  candidate_count INT DEFAULT 120
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  v_total BIGINT;
+  v_neighbors JSONB;
+BEGIN
+  -- Only references of the query model are comparable (NULL = legacy 768-d column)
+  SELECT count(*) INTO v_total FROM embryo_references er
+  WHERE query_model IS NULL OR er.embedding_model = query_model;
+
+  IF query_model IS NULL THEN
+    SELECT COALESCE(jsonb_agg(COALESCE(m.neighbors, '[]'::jsonb) ORDER BY q.ord), '[]'::jsonb)
+    INTO v_neighbors
+    FROM unnest(query_embeddings) WITH ORDINALITY AS q(embedding, ord)
+    LEFT JOIN LATERAL (
+      SELECT jsonb_agg(jsonb_build_object(
+               'id', v.id,
+               'classification', v.classification,
+               'visual_similarity', v.visual_similarity,
+               'kinetic_similarity', v.kinetic_similarity,
+               'composite_score', v.composite_score
+             ) ORDER BY v.composite_score DESC) AS neighbors
+      FROM match_embryos_v2(
+        q.embedding::vector(768),
+        (query_kinetics -> (q.ord::INT - 1) ->> 0)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 1)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 2)::REAL,
+        match_count, visual_top_n, alpha, beta, filter_lab_id, min_similarity
+      ) v
+    ) m ON true;
+  ELSIF query_projection IS NULL THEN
+    SELECT COALESCE(jsonb_agg(COALESCE(m.neighbors, '[]'::jsonb) ORDER BY q.ord), '[]'::jsonb)
+    INTO v_neighbors
+    FROM unnest(query_embeddings) WITH ORDINALITY AS q(embedding, ord)
+    LEFT JOIN LATERAL (
+      SELECT jsonb_agg(jsonb_build_object(
+               'id', v.id,
+               'classification', v.classification,
+               'visual_similarity', v.visual_similarity,
+               'kinetic_similarity', v.kinetic_similarity,
+               'composite_score', v.composite_score
+             ) ORDER BY v.composite_score DESC) AS neighbors
+      FROM match_embryos_v3(
+        query_model, q.embedding,
+        (query_kinetics -> (q.ord::INT - 1) ->> 0)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 1)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 2)::REAL,
+        match_count, visual_top_n, alpha, beta, filter_lab_id, min_similarity
+      ) v
+    ) m ON true;
+  ELSE
+    SELECT COALESCE(jsonb_agg(COALESCE(m.neighbors, '[]'::jsonb) ORDER BY q.ord), '[]'::jsonb)
+    INTO v_neighbors
+    FROM unnest(query_embeddings, query_reduced) WITH ORDINALITY AS q(embedding, reduced, ord)
+    LEFT JOIN LATERAL (
+      SELECT jsonb_agg(jsonb_build_object(
+               'id', v.id,
+               'classification', v.classification,
+               'visual_similarity', v.visual_similarity,
+               'kinetic_similarity', v.kinetic_similarity,
+               'composite_score', v.composite_score
+             ) ORDER BY v.composite_score DESC) AS neighbors
+      FROM match_embryos_reduced(
+        query_model, q.embedding, query_projection, q.reduced,
+        (query_kinetics -> (q.ord::INT - 1) ->> 0)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 1)::REAL,
+        (query_kinetics -> (q.ord::INT - 1) ->> 2)::REAL,
+        match_count, visual_top_n, alpha, beta, filter_lab_id, min_similarity, candidate_count
+      ) v
+    ) m ON true;
+  END IF;
+
+  RETURN jsonb_build_object('total_refs', v_total, 'neighbors', v_neighbors);
+END;
+$$;
+
+REVOKE ALL ON FUNCTION public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT, TEXT, TEXT, TEXT[], INT)
+  FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT, TEXT, TEXT, TEXT[], INT)
+  TO service_role;
+
+COMMENT ON TABLE embedding_projections IS
+'Projeções de embedding (PCA / aleatória) geradas pelo fit_projection.py, com o relatório de recall contra a busca em dimensão completa.';
+COMMENT ON COLUMN embryo_references.embedding_reduced IS
+'Embedding projetado para 128 dimensões (versão em embedding_projection); usado só para a pré-seleção de candidatos do KNN.';
+COMMENT ON FUNCTION public.match_embryos_reduced(TEXT, TEXT, TEXT, TEXT, REAL, REAL, REAL, INT, INT, FLOAT, FLOAT, UUID, FLOAT, INT) IS
+'KNN com pré-seleção no embedding reduzido e pontuação idêntica ao match_embryos_v3 na dimensão completa.';
+COMMENT ON FUNCTION public.match_embryos_batch(TEXT[], JSONB, INT, INT, FLOAT, FLOAT, UUID, FLOAT, TEXT, TEXT, TEXT[], INT) IS
+'KNN (match_embryos_v2, v3 ou reduced, conforme query_model / query_projection) de todos os embriões de um job em uma chamada, com a contagem do atlas. Uso exclusivo do pipeline (service role).';